@@ -20,6 +20,18 @@ import traceback
 import signal
 import time
 
+try:
+    from hashlib import md5
+except ImportError:     # Python < 2.5
+    from md5 import new as md5
+try:
+    # Reads into preallocated buffers (Python >= 2.7)
+    import io
+    memoryview
+    HAVE_READINTO = True
+except (ImportError, NameError):
+    HAVE_READINTO = False
+
 if os.name == "posix":  # Linux
     os_linux = True
     import fcntl
@@ -39,6 +51,58 @@ exiting = False
 virt = None
 
 
+def write_all(desc, data):
+    """
+    Write all data to descriptor (os.write() can write only a part).
+
+    :return: Number of written bytes.
+    """
+    written = 0
+    while written < len(data):
+        written += os.write(desc, data[written:])
+    return written
+
+
+class Reader:
+
+    """
+    Reads from descriptors into one preallocated buffer, falls back to
+    os.read() and string concatenation on old Pythons.
+    """
+
+    def __init__(self, count, blocklen):
+        """
+        :param count: Maximal number of descriptors read at once.
+        :param blocklen: Maximal length of one read.
+        """
+        self.blocklen = blocklen
+        self.files = {}
+        if HAVE_READINTO:
+            self.buf = bytearray(count * blocklen)
+            self.view = memoryview(self.buf)
+
+    def read(self, descs):
+        """
+        Read up to blocklen bytes from every descriptor.
+
+        :return: Read data (memoryview of the buffer or string), valid until
+                 the next read.
+        """
+        if not HAVE_READINTO:
+            data = ""
+            for desc in descs:
+                data += os.read(desc, self.blocklen)
+            return data
+        pos = 0
+        for desc in descs:
+            fileobj = self.files.get(desc)
+            if fileobj is None:
+                fileobj = io.FileIO(desc, "r", closefd=False)
+                self.files[desc] = fileobj
+            pos += fileobj.readinto(self.view[pos:pos + self.blocklen]) or 0
+        return self.view[:pos]
+
+
 class VirtioGuest:
 
     """
@@ -358,19 +422,17 @@ class VirtioGuestPosix(VirtioGuest):
             self.method = method
 
             self.cachesize = cachesize
+            self.reader = Reader(len(self.in_files), cachesize)
 
         def _none_mode(self):
             """
             Read and write to device in blocking mode
             """
-            data = ""
             while not self.exit_thread.isSet():
-                data = ""
-                for desc in self.in_files:
-                    data += os.read(desc, self.cachesize)
-                if data != "":
+                data = self.reader.read(self.in_files)
+                if len(data):
                     for desc in self.out_files:
-                        os.write(desc, data)
+                        write_all(desc, data)
 
         def _poll_mode(self):
             """
@@ -387,19 +449,17 @@ class VirtioGuestPosix(VirtioGuest):
                 po.register(fd, select.POLLOUT)
 
             while not self.exit_thread.isSet():
-                data = ""
                 t_out = self.out_files
 
                 readyf = pi.poll(1.0)
-                for i in readyf:
-                    data += os.read(i[0], self.cachesize)
+                data = self.reader.read([i[0] for i in readyf])
 
-                if data != "":
+                if len(data):
                     while ((len(t_out) != len(readyf)) and not
                            self.exit_thread.isSet()):
                         readyf = po.poll(1.0)
                     for desc in t_out:
-                        os.write(desc, data)
+                        write_all(desc, data)
 
         def _select_mode(self):
             """
@@ -407,17 +467,14 @@ class VirtioGuestPosix(VirtioGuest):
             """
             while not self.exit_thread.isSet():
                 ret = select.select(self.in_files, [], [], 1.0)
-                data = ""
-                if ret[0] != []:
-                    for desc in ret[0]:
-                        data += os.read(desc, self.cachesize)
-                if data != "":
+                data = self.reader.read(ret[0])
+                if len(data):
                     ret = select.select([], self.out_files, [], 1.0)
                     while ((len(self.out_files) != len(ret[1])) and not
                            self.exit_thread.isSet()):
                         ret = select.select([], self.out_files, [], 1.0)
                     for desc in ret[1]:
-                        os.write(desc, data)
+                        write_all(desc, data)
 
         def _reconnect_none_mode(self):
             """
@@ -880,27 +937,29 @@ class VirtioGuestPosix(VirtioGuest):
         """
         in_f = self._open([port])
 
-        data = ""
         writes = 0
+        checksum = md5()
 
         if not is_static:
-            while len(data) < length:
-                data += "%c" % random.randrange(255)
+            data = os.urandom(length)
             try:
                 writes = os.write(in_f[0], data)
+                checksum.update(data[:writes])
             except Exception, inst:
                 print inst
         else:
-            while len(data) < 4096:
-                data += "%c" % random.randrange(255)
+            data = os.urandom(4096)
         if mode:
             while (writes < length):
                 try:
-                    writes += os.write(in_f[0], data)
+                    written = os.write(in_f[0], data)
+                    checksum.update(data[:written])
+                    writes += written
                 except Exception, inst:
                     print inst
         if writes >= length:
-            print "PASS: Send data length %d" % writes
+            print ("PASS: Send data length %d, md5 %s" %
+                   (writes, checksum.hexdigest()))
         else:
             print ("FAIL: Partial send: desired %d, transferred %d" %
                    (length, writes))
@@ -915,22 +974,29 @@ class VirtioGuestPosix(VirtioGuest):
         """
         in_f = self._open([port])
 
-        recvs = ""
+        reader = Reader(1, bfr)
+        checksum = md5()
+        recvs = 0
         try:
-            recvs = os.read(in_f[0], bfr)
+            data = reader.read(in_f)
+            checksum.update(data)
+            recvs = len(data)
         except Exception, inst:
             print inst
         if mode:
-            while (len(recvs) < length):
+            while (recvs < length):
                 try:
-                    recvs += os.read(in_f[0], bfr)
+                    data = reader.read(in_f)
+                    checksum.update(data)
+                    recvs += len(data)
                 except Exception, inst:
                     print inst
-        if len(recvs) >= length:
-            print "PASS: Recv data length %d" % len(recvs)
+        if recvs >= length:
+            print ("PASS: Recv data length %d, md5 %s" %
+                   (recvs, checksum.hexdigest()))
         else:
             print ("FAIL: Partial recv: desired %d, transferred %d" %
-                   (length, len(recvs)))
+                   (length, recvs))
 
     def clean_port(self, port, bfr=1024):
         in_f = self._open([port])
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+"""
+Benchmark of aexpect servers: a server process per session versus the
+shared server (aexpect.SharedServer).
+
+Starts a number of aexpect.Expect sessions running cat, measures the
+startup time, a send/expect round trip in every session, the memory and
+the wakeups (context switches) of the server processes while the sessions
+are idle, and the time to close them.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import time
+import optparse
+
+import common
+from virttest import aexpect
+
+
+def proc_status(pid):
+    """
+    Return the dict of /proc/<pid>/status.
+    """
+    status = {}
+    for line in open("/proc/%d/status" % pid):
+        key, value = line.split(":", 1)
+        status[key] = value.split()
+    return status
+
+
+def parent_pid(pid):
+    return int(proc_status(pid)["PPid"][0])
+
+
+def server_stats(pids):
+    """
+    Return (RSS in kB, context switches, CPU ticks) of processes.
+    """
+    rss = switches = ticks = 0
+    for pid in pids:
+        status = proc_status(pid)
+        rss += int(status["VmRSS"][0])
+        switches += (int(status["voluntary_ctxt_switches"][0]) +
+                     int(status["nonvoluntary_ctxt_switches"][0]))
+        stat = open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()
+        ticks += int(stat[11]) + int(stat[12])
+    return rss, switches, ticks
+
+
+def run(shared, count, idle):
+    aexpect.SHARED_SERVER = shared
+    start = time.time()
+    sessions = [aexpect.Expect("cat") for _ in range(count)]
+    startup = time.time() - start
+
+    start = time.time()
+    for i, session in enumerate(sessions):
+        session.sendline("ping %d" % i)
+        session.read_until_last_line_matches([r"^ping %d$" % i], timeout=10)
+    roundtrip = (time.time() - start) / count
+
+    servers = set(parent_pid(session.get_pid()) for session in sessions)
+    rss, switches, ticks = server_stats(servers)
+    time.sleep(idle)
+    _, switches_idle, ticks_idle = server_stats(servers)
+    wakeups = (switches_idle - switches) / float(idle)
+    cpu = (ticks_idle - ticks) / float(os.sysconf("SC_CLK_TCK")) / idle
+
+    start = time.time()
+    for session in sessions:
+        session.close()
+    close = time.time() - start
+
+    print ("%-8s %5d %9.3f %9.2f %7d %9.1f %9.1f %8.2f %8.3f" %
+           (shared and "shared" or "separate", len(servers), startup,
+            roundtrip * 1000, rss / 1024, wakeups, cpu * 100, close,
+            startup / count * 1000))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--sessions", type="int", default=200,
+                      help="Number of sessions [default: %default]")
+    parser.add_option("-i", "--idle", type="float", default=5,
+                      help="Seconds of idle sessions [default: %default]")
+    parser.add_option("--skip-separate", action="store_true", default=False,
+                      help="Don't run a server process per session")
+    options, args = parser.parse_args()
+
+    print ("%-8s %5s %9s %9s %7s %9s %9s %8s %8s" %
+           ("servers", "procs", "start[s]", "rtt[ms]", "RSS[MB]",
+            "wakeup/s", "idle CPU%", "close[s]", "ms/start"))
+    if not options.skip_separate:
+        run(False, options.sessions, options.idle)
+    run(True, options.sessions, options.idle)
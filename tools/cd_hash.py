@@ -2,6 +2,9 @@
 """
 Program that calculates several hashes for a given CD image.
 
+Hashes are looked up in (and recorded to) the hash index shared with
+virt-test, option --verify-all checks all hashes recorded in the index.
+
 :copyright: Red Hat 2008-2009
 """
 
@@ -12,16 +15,34 @@ import logging
 
 import common
 from autotest.client.shared import logging_manager
-from autotest.client import utils
 from virttest import utils_misc
+from virttest import hash_index
 
 
 if __name__ == "__main__":
     parser = optparse.OptionParser("usage: %prog [options] [filenames]")
+    parser.add_option("--verify-all", action="store_true", default=False,
+                      help="Compute again all hashes recorded in the hash "
+                           "index and drop entries of changed files")
+    parser.add_option("--index", default=None,
+                      help="Path of hash index [default: %s in data dir]" %
+                           hash_index.INDEX_BASENAME)
     options, args = parser.parse_args()
 
     logging_manager.configure_logging(utils_misc.VirtLoggingConfig())
 
+    index = hash_index.HashIndex(options.index)
+
+    if options.verify_all:
+        verified, mismatched, stale = index.verify_all()
+        logging.info("Hash index %s: %d verified, %d mismatched, %d stale",
+                     index.path, len(verified), len(mismatched), len(stale))
+        for path in mismatched:
+            logging.error("Mismatched: %s", path)
+        for path in stale:
+            logging.info("Stale (removed or changed): %s", path)
+        sys.exit(bool(mismatched))
+
     if args:
         filenames = args
     else:
@@ -42,12 +63,10 @@ if __name__ == "__main__":
             continue
 
         logging.info("Hash values for file %s", os.path.basename(filename))
-        logging.info("md5    (1m): %s", utils.hash_file(filename, 1024 * 1024,
-                                                        method="md5"))
-        logging.info("sha1   (1m): %s", utils.hash_file(filename, 1024 * 1024,
-                                                        method="sha1"))
-        logging.info(
-            "md5  (full): %s", utils.hash_file(filename, method="md5"))
-        logging.info("sha1 (full): %s", utils.hash_file(filename,
-                                                        method="sha1"))
+        logging.info("md5    (1m): %s", index.get_hash(filename, "md5",
+                                                       1024 * 1024))
+        logging.info("sha1   (1m): %s", index.get_hash(filename, "sha1",
+                                                       1024 * 1024))
+        logging.info("md5  (full): %s", index.get_hash(filename, "md5"))
+        logging.info("sha1 (full): %s", index.get_hash(filename, "sha1"))
         logging.info("")
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+"""
+Benchmark of serial console checks for kernel crashes.
+
+Writes a synthetic console log of the given size in steps and after each
+step checks it for kernel crashes and illegal instructions the way
+BaseVM.verify_alive() does:
+
+full         Whole log is read and matched against the crash and illegal
+             instruction regular expressions (the former implementation).
+incremental  Only the bytes written since the previous check are fed to
+             the stream matchers of console_scanner.ConsoleScanner.
+
+With --crash a kernel oops split between the last two steps is appended,
+both implementations have to find it.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import re
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import common
+from virttest import console_scanner
+from virttest import virt_vm
+
+
+FULL_PANIC_RE = (r"BUG:.*---\[ end trace .* \]---|"
+                 r"----------\[ cut here.* BUG .*\[ end trace .* \]---|"
+                 r"general protection fault:.* RSP.*>")
+FULL_ILLEGAL_RE = r".*trap invalid opcode.*\n"
+
+MESSAGES = ["usb 1-1: new high-speed USB device number %d using ehci-pci",
+            "EXT4-fs (vda%d): re-mounted. Opts: (null)",
+            "systemd[1]: Started Session %d of user root.",
+            "e1000: eth0 NIC Link is Up %d Mbps Full Duplex, Flow Control: "
+            "None",
+            "audit: type=1305 audit(%d.123:4): audit_pid=0 old=560 res=1"]
+
+OOPS = """BUG: unable to handle kernel NULL pointer dereference at 0000000000000008
+IP: [<ffffffff8107a9c4>] kthread_data+0x14/0x40
+Oops: 0000 [#1] SMP
+Call Trace:
+ [<ffffffff81075c51>] wq_worker_sleeping+0x11/0x90
+ [<ffffffff815d46dd>] __schedule+0x5bd/0x790
+---[ end trace 4f6b2a1c2b1e8e21 ]---
+"""
+
+
+def console_text(size, rand, start):
+    """
+    Return about size bytes of kernel log like lines.
+    """
+    lines = []
+    length = 0
+    stamp = start
+    while length < size:
+        stamp += rand.random()
+        line = "[%12.6f] %s\r\n" % (stamp, rand.choice(MESSAGES) %
+                                    rand.randint(0, 1000))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines), stamp
+
+
+def full_check(path):
+    data = open(path).read()
+    crash = re.search(FULL_PANIC_RE, data, re.DOTALL | re.MULTILINE | re.I)
+    illegal = re.findall(FULL_ILLEGAL_RE, data, re.MULTILINE)
+    return crash is not None, len(illegal)
+
+
+def incremental_check(scanner):
+    scanner.update()
+    return (bool(scanner.matchers["kernel_crash"].matches),
+            len(scanner.matchers["illegal_instruction"].matches))
+
+
+def run_benchmark(options):
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "serial.log")
+    rand = random.Random(options.seed)
+    scanner = console_scanner.ConsoleScanner(path)
+    scanner.add_matcher("kernel_crash", console_scanner.StreamMatcher(
+        virt_vm.KERNEL_CRASH_PATTERNS, re.DOTALL | re.MULTILINE | re.I))
+    scanner.add_matcher("illegal_instruction", console_scanner.StreamMatcher(
+        virt_vm.ILLEGAL_INSTRUCTION_PATTERNS, re.MULTILINE))
+    step = options.size * 1024 * 1024 / options.checks
+    total = {"full": 0.0, "incremental": 0.0}
+    stamp = 0.0
+    try:
+        log = open(path, "w")
+        for check in xrange(options.checks):
+            text, stamp = console_text(step, rand, stamp)
+            if options.crash and check == options.checks - 2:
+                text += OOPS[:len(OOPS) / 2]
+            elif options.crash and check == options.checks - 1:
+                text = OOPS[len(OOPS) / 2:] + text
+            log.write(text)
+            log.flush()
+            results = []
+            for name in ("full", "incremental"):
+                if name == "full" and options.skip_full:
+                    continue
+                start = time.time()
+                if name == "full":
+                    results.append(full_check(path))
+                else:
+                    results.append(incremental_check(scanner))
+                elapsed = time.time() - start
+                total[name] += elapsed
+                print ("check %3d  log %7.1f MB  %-11s %8.3f s  crash: %s" %
+                       (check + 1, os.path.getsize(path) / 1048576.0, name,
+                        elapsed, results[-1][0]))
+            if len(set(results)) > 1:
+                raise Exception("Results differ: %s" % results)
+        log.close()
+    finally:
+        shutil.rmtree(workdir)
+    print ("total: full %.3f s, incremental %.3f s" %
+           (total["full"], total["incremental"]))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--size", type="int", default=256,
+                      help="Final size of the log in MB [default: %default]")
+    parser.add_option("-n", "--checks", type="int", default=8,
+                      help="Number of checks while the log grows "
+                           "[default: %default]")
+    parser.add_option("--crash", action="store_true", default=False,
+                      help="Append a kernel oops to the log")
+    parser.add_option("--skip-full", action="store_true", default=False,
+                      help="Measure the incremental checks only")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed of the generated log [default: %default]")
+    options, args = parser.parse_args()
+
+    run_benchmark(options)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""
+Benchmark of IOzone results analysis.
+
+Generates N synthetic IOzone outputs (iozone -a like, all file sizes from
+64 KB to 512 MB against record sizes from 4 KB to 16 MB) and measures:
+
+per-file  Analysis of each file (overall, per record size and per file size
+          averages), as IOzoneAnalyzer.analyze() does it.
+pooled    Averages of all the files together.
+compare   Comparison of every run with the first one.
+
+The pure python implementation is compared with the numpy one, numpy has
+to be installed for the second.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import common
+from virttest import postprocess_iozone
+
+
+FILE_SIZES = [2 ** i for i in xrange(6, 20)]
+RECORD_SIZES = [2 ** i for i in xrange(2, 15)]
+
+
+def write_outputs(workdir, files, seed):
+    rand = random.Random(seed)
+    paths = []
+    for i in xrange(files):
+        lines = ["\tIozone: Performance Test of File I/O",
+                 "\tRun began: Mon Jan  6 12:00:00 2014",
+                 "",
+                 "              KB  reclen   write rewrite    read    reread"]
+        for file_size in FILE_SIZES:
+            for record_size in RECORD_SIZES:
+                if record_size > file_size:
+                    continue
+                values = [file_size, record_size]
+                values += [rand.randint(100000, 4000000) for _ in xrange(13)]
+                lines.append(" ".join("%8d" % value for value in values))
+        lines += ["", "iozone test complete.", ""]
+        paths.append(os.path.join(workdir, "iozone-%d.txt" % i))
+        open(paths[-1], "w").write("\n".join(lines))
+    return paths
+
+
+def analyze(paths, output_dir):
+    analyzer = postprocess_iozone.IOzoneAnalyzer([], output_dir)
+    numpy = postprocess_iozone.numpy
+    per_file = []
+    pooled = []
+    start = time.time()
+    for path in paths:
+        fileobj = open(path)
+        if numpy is not None:
+            aggregator = postprocess_iozone.IOzoneAggregator()
+            aggregator.add(postprocess_iozone.parse_results(fileobj))
+            per_file.append([aggregator.process_results(label)
+                             for label in (None, 'record_size',
+                                           'file_size')])
+        else:
+            results = analyzer.parse_file(fileobj)
+            pooled += results
+            per_file.append([analyzer.process_results(results, label)
+                             for label in (None, 'record_size',
+                                           'file_size')])
+        fileobj.close()
+    per_file_time = time.time() - start
+
+    start = time.time()
+    if numpy is not None:
+        aggregator = postprocess_iozone.aggregate_files(paths)
+        [aggregator.process_results(label)
+         for label in (None, 'record_size', 'file_size')]
+    else:
+        # Parsing is not measured here, pooled results are kept from above
+        [analyzer.process_results(pooled, label)
+         for label in (None, 'record_size', 'file_size')]
+    pooled_time = time.time() - start
+
+    start = time.time()
+    for results in per_file[1:]:
+        for i in (1, 2):
+            postprocess_iozone.compare_matrices(per_file[0][i], results[i])
+    compare_time = time.time() - start
+    return per_file_time, pooled_time, compare_time
+
+
+def run_benchmark(options):
+    workdir = tempfile.mkdtemp()
+    numpy = postprocess_iozone.numpy
+    try:
+        paths = write_outputs(workdir, options.files, options.seed)
+        implementations = [("python", None)]
+        if numpy is not None:
+            implementations.append(("numpy", numpy))
+        for name, module in implementations:
+            postprocess_iozone.numpy = module
+            times = analyze(paths, os.path.join(workdir, "results"))
+            print ("%-6s %4d files: per-file %7.3f s   pooled %7.3f s   "
+                   "compare %7.3f s" % ((name, options.files) + times))
+    finally:
+        postprocess_iozone.numpy = numpy
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--files", type="int", default=300,
+                      help="Number of IOzone outputs [default: %default]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed of the generated results [default: %default]")
+    options, args = parser.parse_args()
+
+    run_benchmark(options)
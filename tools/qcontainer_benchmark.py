@@ -0,0 +1,128 @@
+#!/usr/bin/python
+"""
+Benchmark of DevContainer with big device trees.
+
+Builds containers with N scsi disks (-drive + scsi-hd device each) spread
+over virtio-scsi HBAs, the way multi_disk and scsi stress tests do, and
+measures insertion, cmdline rendering (first and after a change of one
+disk), lookups and removal of all disks.
+
+By default DevContainer is created from qemu-1.5.0 outputs stored in
+virttest/unittest_data, so qemu doesn't have to be installed. Use --qemu
+to query a real qemu binary instead.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import time
+import optparse
+
+import common
+from virttest.qemu_devices import qbuses, qcontainer, qdevices
+
+
+UNITTEST_DATA_DIR = os.path.join(os.path.dirname(common.__file__), "..",
+                                 "virttest", "unittest_data")
+# Targets of one virtio-scsi bus
+SCSI_TARGETS = 256
+
+
+def fake_system_output(cmd, *args, **kwargs):
+    """
+    Replacement of utils.system_output returning recorded qemu outputs.
+    """
+    for option, name in (("-help", "help"), ("-device", "devices_help"),
+                         ("-M", "machine_help"), ("-monitor", "hmp_help"),
+                         ("-qmp", "qmp_help")):
+        if option in cmd:
+            path = os.path.join(UNITTEST_DATA_DIR, "qemu-1.5.0__%s" % name)
+            return open(path).read()
+    return ""
+
+
+def create_container(qemu_binary):
+    if qemu_binary:
+        return qcontainer.DevContainer(qemu_binary, "vm1")
+    system_output = qcontainer.utils.system_output
+    qcontainer.utils.system_output = fake_system_output
+    try:
+        return qcontainer.DevContainer("/usr/bin/qemu-kvm", "vm1")
+    finally:
+        qcontainer.utils.system_output = system_output
+
+
+def disk_devices(name):
+    drive = qdevices.QDrive(name)
+    drive.set_param("file", "/tmp/%s.qcow2" % name)
+    device = qdevices.QDevice("scsi-hd", {"id": name,
+                                          "drive": "drive_%s" % name},
+                              aobject=name,
+                              parent_bus=({"busid": "drive_%s" % name},
+                                          {"type": "SCSI"}))
+    return [drive, device]
+
+
+def measure(func):
+    start = time.time()
+    ret = func()
+    return time.time() - start, ret
+
+
+def run_benchmark(qemu_binary, disks):
+    qdev = create_container(qemu_binary)
+    pci_bus = qbuses.QPCIBus("pci.0", "PCI", "pci.0")
+    qdev.insert(qdevices.QStringDevice("machine", child_bus=pci_bus))
+    for i in xrange((disks + SCSI_TARGETS - 1) / SCSI_TARGETS):
+        bus = qbuses.QSCSIBus("scsi_hba%d.0" % i, "SCSI",
+                              [SCSI_TARGETS, 16384])
+        qdev.insert(qdevices.QDevice("virtio-scsi-pci",
+                                     {"id": "scsi_hba%d" % i},
+                                     child_bus=bus,
+                                     parent_bus={"aobject": "pci.0"}))
+    names = ["image%d" % i for i in xrange(disks)]
+
+    def insert():
+        for name in names:
+            qdev.insert(disk_devices(name))
+
+    def lookup():
+        for name in names:
+            qdev.get_by_qid(name)
+            qdev[name]
+            qdev.get_by_properties({"aobject": name})
+        qdev.get_by_params({"driver": "scsi-hd"})
+
+    def remove():
+        # Device and drive are children of each other, remove them one by one
+        for name in names:
+            qdev.remove(qdev[name], False)
+            qdev.remove(qdev["drive_%s" % name], False)
+
+    def recmdline():
+        qdev[names[0]].set_param("serial", "changed")
+        qdev.cmdline()
+
+    insert_time, _ = measure(insert)
+    cmdline_time, _ = measure(qdev.cmdline)
+    recmdline_time, _ = measure(recmdline)
+    lookup_time, _ = measure(lookup)
+    remove_time, _ = measure(remove)
+    print ("%5d disks (%5d devices): insert %7.3f s   cmdline %6.3f s   "
+           "changed cmdline %6.3f s   %d lookups %6.3f s   remove %7.3f s" %
+           (disks, disks * 2, insert_time, cmdline_time, recmdline_time,
+            disks * 3 + 1, lookup_time, remove_time))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--disks", default="125,250,500",
+                      help="Comma separated numbers of disks (2 devices per "
+                           "disk) [default: %default]")
+    parser.add_option("--qemu", default=None,
+                      help="Query this qemu binary instead of using "
+                           "recorded outputs")
+    options, args = parser.parse_args()
+
+    for disks in options.disks.split(","):
+        run_benchmark(options.qemu, int(disks))
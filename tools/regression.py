@@ -10,12 +10,23 @@ import os
 import sys
 import re
 import commands
-import warnings
 import ConfigParser
-import MySQLdb
+
+import common
+from virttest import perf_store
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DEFAULT_STORE = os.path.join(common.virt_test_dir, "logs",
+                             "perf_results.sqlite")
 
 
 def exec_sql(cmd, conf="../../global_config.ini"):
+    import MySQLdb
     config = ConfigParser.ConfigParser()
     config.read(conf)
     user = config.get("AUTOTEST_WEB", "user")
@@ -43,24 +54,79 @@ def exec_sql(cmd, conf="../../global_config.ini"):
     return lines
 
 
-def get_test_keyval(jobid, keyname, default=''):
+def get_test_keyvals(jobid):
+    """
+    Get all test attributes of a job with one query.
+
+    :return: Dict {attribute: value}.
+    """
     idx = exec_sql("select job_idx from tko_jobs where afe_job_id=%s"
                    % jobid)[-1]
     test_idx = exec_sql('select test_idx from tko_tests where job_idx=%s'
                         % idx)[3]
-    try:
-        return exec_sql('select value from tko_test_attributes'
-                        ' where test_idx=%s and attribute="%s"'
-                        % (test_idx, keyname))[-1]
-    except:
-        return default
+    keyvals = {}
+    for line in exec_sql('select attribute,value from tko_test_attributes'
+                         ' where test_idx=%s' % test_idx):
+        key = line.split(" ", 1)
+        keyvals[key[0]] = key[1:] and key[1] or ''
+    return keyvals
+
+
+def get_test_keyval(jobid, keyname, default=''):
+    return get_test_keyvals(jobid).get(keyname, default)
+
+
+def _format_sd(value):
+    if value == 0:
+        return "0.0"
+    return "%f" % value
+
+
+def _format_rate(value):
+    """ Format num2 / num1 * 100 """
+    if value is None:
+        return "0.0"
+    if value > 100:
+        return "%.2f%%" % value
+    return "%.4f%%" % value
+
+
+def _format_augment_rate(value):
+    """ Format (num2 - num1) / num1 * 100 """
+    if value is None:
+        return "+0.0"
+    if value > 100:
+        return "%+.2f%%" % value
+    return "%+.4f%%" % value
+
+
+def _format_significance(avg1, avg2, pvalues):
+    """ Format 1 - p with '-' when the average decreased """
+    with numpy.errstate(invalid='ignore'):
+        flags = numpy.where(avg1 > avg2, "-", "+").ravel().tolist()
+    values = ["%s%f" % (flag, 1 - p)
+              for flag, p in zip(flags, pvalues.ravel().tolist())]
+    return numpy.array(values, dtype=object).reshape(avg1.shape)
+
+
+def _percent(values, bases):
+    """ values / bases * 100 of lists of rows, None where the base is 0 """
+    return [[value / base * 100 if base != 0 else None
+             for value, base in zip(row, base_row)]
+            for row, base_row in zip(values, bases)]
 
 
 class Sample(object):
 
-    """ Collect test results in same environment to a sample """
+    """
+    Collect test results in same environment to a sample.
+
+    Results of all repetitions are kept in a perf_store.SampleTable, the
+    statistics of all cells are computed with numpy at once. Without numpy,
+    a perf_store.ListTable is used and the t-tests are skipped.
+    """
 
-    def __init__(self, sample_type, arg):
+    def __init__(self, sample_type, arg, test=None, store=None):
         def generate_raw_table(test_dict):
             ret_dict = []
             tmp = []
@@ -89,6 +155,14 @@ class Sample(object):
             ret_dict.append('|'.join(sample_type + tmp))
             return ret_dict
 
+        if numpy is None:
+            table_class = perf_store.ListTable
+        else:
+            table_class = perf_store.SampleTable
+        self.kvmver = self.hostkernel = self.guestkernel = ""
+        self.len = self.testdata = ""
+        self.categories = ""
+        machine_info = None
         if sample_type == 'filepath':
             files = arg.split()
             self.files_dict = []
@@ -135,13 +209,17 @@ class Sample(object):
             nicnum = len(re.findall("\d+:\d+\.0 Ethernet", lspci))
             disknum = re.findall("sd\w+\S", partitions)
             fdiskinfo = re.findall("Disk\s+(/dev/sd.*\s+GiB),", fdisk)
-        elif sample_type == 'database':
+            machine_info = (cpunum, cpumodel, corenum, threadnum, socketnum,
+                            numanodenum, memnum, nicnum, fdiskinfo, disknum)
+            self.table = table_class.from_lines(self.files_dict)
+        elif sample_type in ('database', 'db'):
             jobid = arg
-            self.kvmver = get_test_keyval(jobid, "kvm-userspace-ver")
-            self.hostkernel = get_test_keyval(jobid, "kvm_version")
-            self.guestkernel = get_test_keyval(jobid, "guest-kernel-ver")
-            self.len = get_test_keyval(jobid, "session-length")
-            self.categories = get_test_keyval(jobid, "category")
+            keyvals = get_test_keyvals(jobid)
+            self.kvmver = keyvals.get("kvm-userspace-ver", "")
+            self.hostkernel = keyvals.get("kvm_version", "")
+            self.guestkernel = keyvals.get("guest-kernel-ver", "")
+            self.len = keyvals.get("session-length", "")
+            self.categories = keyvals.get("category", "")
 
             idx = exec_sql("select job_idx from tko_jobs where afe_job_id=%s"
                            % jobid)[-1]
@@ -162,6 +240,16 @@ class Sample(object):
 
             job_dict.append(generate_raw_table(test_dict))
             self.files_dict = job_dict
+            self.table = table_class.from_lines(self.files_dict)
+        elif sample_type == 'store':
+            attributes = store.get_attributes(test, arg)
+            self.kvmver = attributes.get("kvm-userspace-ver", "")
+            self.hostkernel = attributes.get("kvm_version", "")
+            self.guestkernel = attributes.get("guest-kernel-ver", "")
+            self.len = attributes.get("session-length", "")
+            self.testdata = attributes.get("test-date", "")
+            self.table = table_class.from_store(store, test, arg)
+            self.files_dict = self.table.raw_lines()
 
         self.version = " userspace: %s\n host kernel: %s\n guest kernel: %s" % (
             self.kvmver, self.hostkernel, self.guestkernel)
@@ -170,14 +258,18 @@ class Sample(object):
             print "`nrepeat' should be larger than 1!"
             sys.exit(1)
 
-        self.desc = """<hr>Machine Info:
+        if machine_info:
+            self.desc = """<hr>Machine Info:
 o CPUs(%s * %s), Cores(%s), Threads(%s), Sockets(%s),
 o NumaNodes(%s), Memory(%.1fG), NICs(%s)
 o Disks(%s | %s)
 
 Please check sysinfo directory in autotest result to get more details.
 (eg: http://autotest-server.com/results/5057-autotest/host1/sysinfo/)
-<hr>""" % (cpunum, cpumodel, corenum, threadnum, socketnum, numanodenum, memnum, nicnum, fdiskinfo, disknum)
+<hr>""" % machine_info
+        else:
+            self.desc = "<hr>Machine Info: not available<hr>"
+        self.avg = None
 
         self.desc += """ - Every Avg line represents the average value based on *%d* repetitions of the same test,
    and the following SD line represents the Standard Deviation between the *%d* repetitions.
@@ -189,156 +281,86 @@ Please check sysinfo directory in autotest result to get more details.
 """ % (nrepeat, nrepeat)
 
     def getAvg(self, avg_update=None):
-        return self._process_files(self.files_dict, self._get_list_avg,
-                                   avg_update=avg_update)
-
-    def getAvgPercent(self, avgs_dict):
-        return self._process_files(avgs_dict, self._get_augment_rate)
+        self.avg = self.table.mean(avg_update)
+        return self.table.format(self.avg)
 
     def getSD(self):
-        return self._process_files(self.files_dict, self._get_list_sd)
-
-    def getSDRate(self, sds_dict):
-        return self._process_files(sds_dict, self._get_rate)
-
-    def getTtestPvalue(self, fs_dict1, fs_dict2, paired=None, ratio=None):
+        self.sd = self.table.sd()
+        return self.table.format(self.sd, _format_sd)
+
+    def getSDRate(self):
+        """ SD as percentage of the average """
+        if numpy is None:
+            return self.table.format(_percent(self.sd, self.avg),
+                                     _format_rate)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rate = (self.sd / self.avg * 100).astype(object)
+        rate[self.avg == 0] = None
+        return self.table.format(rate, _format_rate)
+
+    def _common_shape(self, other):
+        rows = min(self.avg.shape[0], other.avg.shape[0])
+        cols = min(self.avg.shape[1], other.avg.shape[1])
+        return rows, cols
+
+    def getAvgPercent(self, other):
+        """ Difference of averages of other sample in percent """
+        if numpy is None:
+            diff = [[avg2 - avg1 for avg1, avg2 in zip(row1, row2)]
+                    for row1, row2 in zip(self.avg, other.avg)]
+            return self.table.format(_percent(diff, self.avg),
+                                     _format_augment_rate)
+        rows, cols = self._common_shape(other)
+        avg1 = self.avg[:rows, :cols]
+        avg2 = other.avg[:rows, :cols]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rate = ((avg2 - avg1) / avg1 * 100).astype(object)
+        rate[avg1 == 0] = None
+        return self.table.format(rate, _format_augment_rate)
+
+    def getTtestPvalue(self, other):
         """
-        scipy lib is used to compute p-value of Ttest
-        scipy: http://www.scipy.org/
+        Significance of the differences of all cells of two samples
+        (unpaired t-test over the repetitions).
         t-test: http://en.wikipedia.org/wiki/Student's_t-test
+
+        :return: Lines of significances or None without numpy.
         """
-        try:
-            from scipy import stats
-            import numpy as np
-        except ImportError:
-            print "No python scipy/numpy library installed!"
+        if numpy is None:
+            print "No python numpy library installed!"
             return None
-
-        ret = []
-        s1 = self._process_files(fs_dict1, self._get_list_self, merge=False)
-        s2 = self._process_files(fs_dict2, self._get_list_self, merge=False)
-        # s*[line][col] contians items (line*col) of all sample files
-
-        for line in range(len(s1)):
-            tmp = []
-            if type(s1[line]) != list:
-                tmp = s1[line]
-            else:
-                if len(s1[line][0]) < 2:
-                    continue
-                for col in range(len(s1[line])):
-                    avg1 = self._get_list_avg(s1[line][col])
-                    avg2 = self._get_list_avg(s2[line][col])
-                    sample1 = np.array(s1[line][col])
-                    sample2 = np.array(s2[line][col])
-                    warnings.simplefilter("ignore", RuntimeWarning)
-                    if (paired):
-                        if (ratio):
-                            (_, p) = stats.ttest_rel(np.log(sample1), np.log(sample2))
-                        else:
-                            (_, p) = stats.ttest_rel(sample1, sample2)
-                    else:
-                        (_, p) = stats.ttest_ind(sample1, sample2)
-                    flag = "+"
-                    if float(avg1) > float(avg2):
-                        flag = "-"
-                    tmp.append(flag + "%f" % (1 - p))
-                tmp = "|".join(tmp)
-            ret.append(tmp)
-        return ret
-
-    def _get_rate(self, data):
-        """ num2 / num1 * 100 """
-        result = "0.0"
-        if len(data) == 2 and float(data[0]) != 0:
-            result = float(data[1]) / float(data[0]) * 100
-            if result > 100:
-                result = "%.2f%%" % result
-            else:
-                result = "%.4f%%" % result
-        return result
-
-    def _get_augment_rate(self, data):
-        """ (num2 - num1) / num1 * 100 """
-        result = "+0.0"
-        if len(data) == 2 and float(data[0]) != 0:
-            result = (float(data[1]) - float(data[0])) / float(data[0]) * 100
-            if result > 100:
-                result = "%+.2f%%" % result
-            else:
-                result = "%+.4f%%" % result
-        return result
-
-    def _get_list_sd(self, data):
+        rows, cols = self._common_shape(other)
+        values1 = self.table.values[:, :rows, :cols]
+        values2 = other.table.values[:, :rows, :cols]
+        _, pvalues = perf_store.ttest_ind(values1, values2)
+        return self.table.format(_format_significance(
+            values1.mean(axis=0), values2.mean(axis=0), pvalues), str)
+
+    def getCategoryPvalues(self, other):
         """
-        sumX = x1 + x2 + ... + xn
-        avgX = sumX / n
-        sumSquareX = x1^2 + ... + xn^2
-        SD = sqrt([sumSquareX - (n * (avgX ^ 2))] / (n - 1))
+        Significance of the differences of averages of each category
+        (paired t-test of logarithms of the averages of the category rows).
+
+        :return: List with one list per category, containing the line of
+                 significances or nothing when the category has less than
+                 two rows.
         """
-        o_sum = sqsum = 0.0
-        n = len(data)
-        for i in data:
-            o_sum += float(i)
-            sqsum += float(i) ** 2
-        avg = o_sum / n
-        if avg == 0 or n == 1 or sqsum - (n * avg ** 2) <= 0:
-            return "0.0"
-        return "%f" % (((sqsum - (n * avg ** 2)) / (n - 1)) ** 0.5)
-
-    def _get_list_avg(self, data):
-        """ Compute the average of list entries """
-        o_sum = 0.0
-        for i in data:
-            o_sum += float(i)
-        return "%f" % (o_sum / len(data))
-
-    def _get_list_self(self, data):
-        """ Use this to convert sample dicts """
-        return data
-
-    def _process_lines(self, files_dict, row, func, avg_update, merge):
-        """ Use unified function to process same lines of different samples """
-        lines = []
         ret = []
-
-        for i in range(len(files_dict)):
-            lines.append(files_dict[i][row].split("|"))
-
-        for col in range(len(lines[0])):
-            data_list = []
-            for i in range(len(lines)):
-                tmp = lines[i][col].strip()
-                if is_int(tmp):
-                    data_list.append(int(tmp))
-                else:
-                    data_list.append(float(tmp))
-            ret.append(func(data_list))
-
-        if avg_update:
-            for i in avg_update.split('|'):
-                l = i.split(',')
-                ret[int(l[0])] = "%f" % (float(ret[int(l[1])]) /
-                                         float(ret[int(l[2])]))
-        if merge:
-            return "|".join(ret)
+        for rows in self.table.numeric_groups():
+            if len(rows) < 2 or numpy is None:
+                ret.append([])
+                continue
+            cols = self.table.widths[rows[0]]
+            avg1 = self.avg[rows, :cols]
+            avg2 = other.avg[rows, :cols]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                _, pvalues = perf_store.ttest_rel(numpy.log(avg1),
+                                                  numpy.log(avg2))
+            line = _format_significance(avg1.mean(axis=0), avg2.mean(axis=0),
+                                        pvalues)
+            ret.append(["|".join(line)])
         return ret
 
-    def _process_files(self, files_dict, func, avg_update=None, merge=True):
-        """
-        Process dicts of sample files with assigned function,
-        func has one list augment.
-        """
-        ret_lines = []
-        for i in range(len(files_dict[0])):
-            if re.findall("[a-zA-Z]", files_dict[0][i]):
-                ret_lines.append(files_dict[0][i].strip())
-            else:
-                line = self._process_lines(files_dict, i, func, avg_update,
-                                           merge)
-                ret_lines.append(line)
-        return ret_lines
-
 
 def display(lists, rates, allpvalues, f, ignore_col, o_sum="Augment Rate",
             prefix0=None, prefix1=None, prefix2=None, prefix3=None):
@@ -437,7 +459,7 @@ def display(lists, rates, allpvalues, f, ignore_col, o_sum="Augment Rate",
     tee("</TBODY></TABLE>", f)
 
 
-def analyze(test, sample_type, arg1, arg2, configfile):
+def analyze(test, sample_type, arg1, arg2, configfile, store_path=None):
     """ Compute averages/p-vales of two samples, print results nicely """
     config = ConfigParser.ConfigParser()
     config.read(configfile)
@@ -455,40 +477,25 @@ def analyze(test, sample_type, arg1, arg2, configfile):
         arg1 = get_list(arg1)
         arg2 = get_list(arg2)
 
+    store = None
+    if sample_type == 'store':
+        store = perf_store.ResultStore(store_path or DEFAULT_STORE)
+
     commands.getoutput("rm -f %s.*html" % test)
-    s1 = Sample(sample_type, arg1)
+    s1 = Sample(sample_type, arg1, test, store)
     avg1 = s1.getAvg(avg_update=avg_update)
     sd1 = s1.getSD()
 
-    s2 = Sample(sample_type, arg2)
+    s2 = Sample(sample_type, arg2, test, store)
     avg2 = s2.getAvg(avg_update=avg_update)
     sd2 = s2.getSD()
 
-    sd1 = s1.getSDRate([avg1, sd1])
-    sd2 = s1.getSDRate([avg2, sd2])
-    avgs_rate = s1.getAvgPercent([avg1, avg2])
-
-    navg1 = []
-    navg2 = []
-    allpvalues = []
-    tmp1 = []
-    tmp2 = []
-    for i in range(len(avg1)):
-        if not re.findall("[a-zA-Z]", avg1[i]):
-            tmp1.append([avg1[i]])
-            tmp2.append([avg2[i]])
-        elif 'Category' in avg1[i] and i != 0:
-            navg1.append(tmp1)
-            navg2.append(tmp2)
-            tmp1 = []
-            tmp2 = []
-    navg1.append(tmp1)
-    navg2.append(tmp2)
-
-    for i in range(len(navg1)):
-        allpvalues.append(s1.getTtestPvalue(navg1[i], navg2[i], True, True))
-
-    pvalues = s1.getTtestPvalue(s1.files_dict, s2.files_dict, False)
+    sd1 = s1.getSDRate()
+    sd2 = s2.getSDRate()
+    avgs_rate = s1.getAvgPercent(s2)
+
+    allpvalues = s1.getCategoryPvalues(s2)
+    pvalues = s1.getTtestPvalue(s2)
     rlist = [avgs_rate]
     if pvalues:
         # p-value list isn't null
@@ -545,9 +552,14 @@ def tee(content, filepath):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
+    if len(sys.argv) not in (5, 6):
         this = os.path.basename(sys.argv[0])
         print 'Usage: %s <testname> filepath <dir1> <dir2>' % this
         print '    or %s <testname> db <jobid1> <jobid2>' % this
+        print ('    or %s <testname> store <sample1> <sample2> '
+               '[<results store>]' % this)
+        print
+        print 'Results store defaults to %s' % DEFAULT_STORE
         sys.exit(1)
-    analyze(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], 'perf.conf')
+    analyze(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], 'perf.conf',
+            *sys.argv[5:])
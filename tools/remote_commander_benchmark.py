@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""
+Loopback benchmark of remote_commander transport.
+
+Starts remote_runner.py as local subprocess connected by pipes and measures
+latency of small commands and throughput of big results for every
+combination of encoding (raw, base64) and framing (legacy, binary).
+Option --bandwidth simulates slower link to guest. Serial commands are
+compared with the same commands run in parallel by the runner worker pool.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+virt_test_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+commander_dir = os.path.join(virt_test_dir, "virttest", "remote_commander")
+sys.path.insert(0, commander_dir)
+
+import messenger
+import remote_master
+
+
+BENCH_FUNCS = '''
+def bench_echo(data):
+    return data
+
+
+def bench_random(size):
+    return os.urandom(size)
+
+
+def bench_text(size):
+    line = "%08d some compressible output of guest command\\n"
+    return "".join([line % i for i in xrange(size / len(line % 0))])
+'''
+
+ENCODINGS = {"raw": ("agent", messenger.StdIOWrapperIn,
+                     messenger.StdIOWrapperOut),
+             "base64": ("agent_base64", messenger.StdIOWrapperInBase64,
+                        messenger.StdIOWrapperOutBase64)}
+
+
+def link_wrapper(in_cls, bandwidth):
+    """
+    Create input wrapper which counts read bytes and optionally simulates
+    link with limited bandwidth (guest network, serial line).
+
+    :param bandwidth: Bandwidth of link in bytes per second or None.
+    """
+    class LinkWrapperIn(in_cls):
+
+        wire_bytes = 0
+
+        def read(self, max_len, timeout=None):
+            data = in_cls.read(self, max_len, timeout)
+            if data:
+                LinkWrapperIn.wire_bytes += len(data)
+                if bandwidth:
+                    time.sleep(len(data) / float(bandwidth))
+            return data
+
+    return LinkWrapperIn
+
+
+def start_commander(encoding, framing, bandwidth=None):
+    """
+    Start local runner and connect commander master to it.
+
+    :return: (process, CommanderMaster, input wrapper class)
+    """
+    agent, in_cls, out_cls = ENCODINGS[encoding]
+    in_cls = link_wrapper(in_cls, bandwidth)
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(commander_dir, "remote_runner.py"),
+                             agent],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Commander closes its fds, keep file objects of process untouched.
+    master = remote_master.CommanderMaster(in_cls(os.dup(proc.stdout.fileno())),
+                                           out_cls(os.dup(proc.stdin.fileno())),
+                                           False, framing)
+    master.manage.add_function(BENCH_FUNCS)
+    return proc, master, in_cls
+
+
+def measure(func, repeat, link):
+    """
+    :return: (average time of call, average bytes read by master per call)
+    """
+    link.wire_bytes = 0
+    start = time.time()
+    for _ in xrange(repeat):
+        func()
+    return ((time.time() - start) / repeat,
+            link.wire_bytes / float(repeat))
+
+
+def run_benchmark(encoding, framing, size, repeat, calls, bandwidth=None):
+    proc, master, link = start_commander(encoding, framing, bandwidth)
+    try:
+        latency, _ = measure(lambda: master.manage.bench_echo("x"), calls,
+                             link)
+        rnd, rnd_wire = measure(lambda: master.manage.bench_random(size),
+                                repeat, link)
+        txt, txt_wire = measure(lambda: master.manage.bench_text(size),
+                                repeat, link)
+        serial, _ = measure(lambda: [master.os.path.exists(commander_dir)
+                                     for _ in xrange(calls)], 1, link)
+        pool, _ = measure(lambda: master.pool_map("os.path.exists",
+                                                  [commander_dir] * calls),
+                          1, link)
+    finally:
+        master.close()
+        proc.wait()
+    mb = size / 1024.0 / 1024.0
+    print ("%-7s %-7s call %7.3f ms   random %8.2f MB/s (wire %5.2fx)   "
+           "text %8.2f MB/s (wire %5.2fx)   %d cmds serial %6.3f s "
+           "pool %6.3f s" %
+           (encoding, framing, latency * 1000, mb / rnd, rnd_wire / size,
+            mb / txt, txt_wire / size, calls, serial, pool))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--size", type="int", default=16,
+                      help="Size of big result in MB [default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="Transfers of big result [default: %default]")
+    parser.add_option("-c", "--calls", type="int", default=200,
+                      help="Number of small calls [default: %default]")
+    parser.add_option("-b", "--bandwidth", type="float", default=None,
+                      help="Simulate link with bandwidth in MB/s")
+    options, args = parser.parse_args()
+
+    for encoding in sorted(ENCODINGS):
+        for framing in messenger.FRAMINGS:
+            bandwidth = None
+            if options.bandwidth:
+                bandwidth = options.bandwidth * 1024 * 1024
+            run_benchmark(encoding, framing, options.size * 1024 * 1024,
+                          options.repeat, options.calls, bandwidth)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""
+Loopback run of the transfer benchmark suite (virttest.utils_transfer).
+
+A temporary host directory stands in for the guest, transfers go over
+a socket pair to a local process (loopback) and to a local rss_server.py
+(rss). Prints the throughput statistics of every transport, direction and
+size as a results table.
+
+:copyright: Red Hat 2014
+"""
+
+import shutil
+import logging
+import optparse
+import tempfile
+
+import common
+from virttest import utils_transfer
+
+
+def run_benchmark(options):
+    workdir = tempfile.mkdtemp()
+    endpoint = utils_transfer.LocalEndpoint(workdir)
+    transports = utils_transfer.loopback_transports(
+        endpoint, options.transports.split(","), options.timeout)
+    sizes = [int(float(size) * utils_transfer.MEGABYTE)
+             for size in options.sizes.split(",")]
+    benchmark = utils_transfer.TransferBenchmark(endpoint, transports, sizes,
+                                                 options.repeats, workdir)
+    try:
+        benchmark.run()
+    finally:
+        benchmark.close()
+        shutil.rmtree(workdir)
+    for line in benchmark.table():
+        print line
+    failures = benchmark.failures()
+    if failures:
+        raise Exception("Checksum mismatch: %s" %
+                        ", ".join(str(result) for result in failures))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--sizes", default="1,16,64",
+                      help="Comma separated sizes of the transfers in MB "
+                           "[default: %default]")
+    parser.add_option("-r", "--repeats", type="int", default=5,
+                      help="Transfers of every size, transport and direction "
+                           "[default: %default]")
+    parser.add_option("-t", "--transports", default="loopback,rss",
+                      help="Comma separated transports (loopback, rss) "
+                           "[default: %default]")
+    parser.add_option("--timeout", type="int", default=600,
+                      help="Timeout of one transfer [default: %default]")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="Log every transfer")
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    run_benchmark(options)
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""
+Benchmark of the virtio-serial data paths over local Unix sockets.
+
+Host and guest sides of a port are replaced by socket pairs, so only the
+Python overhead of the data paths is measured:
+
+stream       qemu_virtio_port.ThStreamSend -> ThStreamLoopback ->
+             ThStreamRecv, md5 sums of the sent and received data are
+             compared.
+check        qemu_virtio_port.ThSendCheck -> ThRecvCheck (byte by byte
+             check against a FIFO) for the time the stream path took.
+guest        ThStreamSend -> Switch (loopback thread of
+             virtio_console_guest.py) -> ThStreamRecv, with reads into
+             a preallocated buffer and with os.read() (old Pythons).
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import imp
+import time
+import socket
+import optparse
+import threading
+from collections import deque
+
+import common
+from virttest import qemu_virtio_port
+
+
+GUEST_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "shared", "scripts",
+    "virtio_console_guest.py")
+
+
+class Port(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
+def socketpair():
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+def report(name, size, elapsed, checked):
+    print ("%-14s %8.1f MB  %7.3f s  %8.1f MB/s  %s" %
+           (name, size / 1048576.0, elapsed, size / 1048576.0 / elapsed,
+            checked))
+
+
+def run_stream(size, blocklen):
+    exit_event = threading.Event()
+    send_a, send_b = socketpair()
+    recv_a, recv_b = socketpair()
+    sender = qemu_virtio_port.ThStreamSend(send_a, exit_event, size,
+                                           blocklen)
+    loopback = qemu_virtio_port.ThStreamLoopback(send_b, [recv_a],
+                                                 exit_event, blocklen)
+    receiver = qemu_virtio_port.ThStreamRecv(recv_b, exit_event, size,
+                                             blocklen)
+    start = time.time()
+    for thread in (receiver, loopback, sender):
+        thread.start()
+    sender.join()
+    receiver.join()
+    elapsed = time.time() - start
+    exit_event.set()
+    loopback.join()
+    for sock in (send_a, send_b, recv_a, recv_b):
+        sock.close()
+    report("stream", receiver.idx, elapsed,
+           receiver.md5.hexdigest() == sender.md5.hexdigest() and
+           "md5 OK" or "md5 MISMATCH")
+    return elapsed
+
+
+def run_check(duration, blocklen):
+    exit_event = threading.Event()
+    send_a, send_b = socketpair()
+    queue = deque()
+    # The sender doesn't accept longer blocks
+    blocklen = min(blocklen, 102400)
+    sender = qemu_virtio_port.ThSendCheck(Port(send_a), exit_event, [queue],
+                                          blocklen)
+    receiver = qemu_virtio_port.ThRecvCheck(Port(send_b), queue, exit_event,
+                                            blocklen)
+    start = time.time()
+    receiver.start()
+    sender.start()
+    time.sleep(duration)
+    exit_event.set()
+    sender.join()
+    receiver.join()
+    elapsed = time.time() - start
+    send_a.close()
+    send_b.close()
+    report("check", receiver.idx, elapsed,
+           receiver.ret_code == 0 and "data OK" or "data MISMATCH")
+
+
+def run_guest(size, blocklen, readinto):
+    guest = imp.load_source("virtio_console_guest", GUEST_SCRIPT)
+    guest.HAVE_READINTO = guest.HAVE_READINTO and readinto
+    exit_event = threading.Event()
+    send_a, send_b = socketpair()
+    recv_a, recv_b = socketpair()
+    switch = guest.VirtioGuestPosix.Switch(
+        [[send_b.fileno()], ["in"]], [[recv_a.fileno()], ["out"]],
+        threading.Event(), blocklen, guest.VirtioGuest.LOOP_NONE)
+    switch.daemon = True
+    sender = qemu_virtio_port.ThStreamSend(send_a, exit_event, size,
+                                           blocklen)
+    receiver = qemu_virtio_port.ThStreamRecv(recv_b, exit_event, size,
+                                             blocklen)
+    start = time.time()
+    for thread in (receiver, switch, sender):
+        thread.start()
+    sender.join()
+    receiver.join()
+    elapsed = time.time() - start
+    switch.exit_thread.set()
+    send_a.close()
+    switch.join()
+    for sock in (send_b, recv_a, recv_b):
+        sock.close()
+    report(readinto and "guest" or "guest os.read", receiver.idx, elapsed,
+           receiver.md5.hexdigest() == sender.md5.hexdigest() and
+           "md5 OK" or "md5 MISMATCH")
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--size", type="int", default=256,
+                      help="Size of the transferred data in MB "
+                           "[default: %default]")
+    parser.add_option("-b", "--blocklen", type="int",
+                      default=qemu_virtio_port.STREAM_BLOCKLEN,
+                      help="Block length [default: %default]")
+    parser.add_option("--skip-check", action="store_true", default=False,
+                      help="Don't run the check threads")
+    parser.add_option("--skip-guest", action="store_true", default=False,
+                      help="Don't run the guest loopback")
+    options, args = parser.parse_args()
+
+    size = options.size * 1048576
+    elapsed = run_stream(size, options.blocklen)
+    if not options.skip_check:
+        run_check(elapsed, options.blocklen)
+    if not options.skip_guest:
+        run_guest(size, options.blocklen, True)
+        run_guest(size, options.blocklen, False)
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Benchmark of parallel VM creation locking.
+
+Starts N fake qemu processes at once, the same way VM.create() does: ports
+are allocated, host resources are set up and the process is started, then
+the monitor socket is waited for. The fake qemu listens on its ports and
+opens its monitor after a startup delay. Two schemes are compared:
+
+global  The whole creation runs under one lock (ports probed by
+        utils_misc.find_free_ports).
+lease   Only host resource setup runs under the lock, ports are leased by
+        port_allocator and qemu start-up runs in parallel.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import fcntl
+import optparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import common
+from virttest import utils_misc
+from virttest import port_allocator
+
+
+FAKE_QEMU = '''
+import sys, time, socket
+listening = []
+for port in sys.argv[3:]:
+    s = socket.socket()
+    s.bind(("localhost", int(port)))
+    s.listen(1)
+    listening.append(s)
+time.sleep(float(sys.argv[2]))
+monitor = socket.socket(socket.AF_UNIX)
+monitor.bind(sys.argv[1])
+monitor.listen(1)
+monitor.accept()
+'''
+
+
+def wait_for_monitor(path, timeout):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        s = socket.socket(socket.AF_UNIX)
+        try:
+            s.connect(path)
+            return s
+        except socket.error:
+            s.close()
+            time.sleep(0.02)
+    raise RuntimeError("Monitor %s not created" % path)
+
+
+def create_vm(scheme, index, workdir, options, results):
+    """
+    Create one fake VM and put (start, end, ok) to results queue.
+    """
+    start = time.time()
+    lock_path = os.path.join(workdir, "create.lock")
+    monitor_path = os.path.join(workdir, "monitor-%d" % index)
+    allocator = port_allocator.PortAllocator(os.path.join(workdir,
+                                                          "leases.json"))
+    lockfile = open(lock_path, "w+")
+    fcntl.lockf(lockfile, fcntl.LOCK_EX)
+    try:
+        if scheme == "global":
+            ports = utils_misc.find_free_ports(options.base_port,
+                                               options.base_port + 1000,
+                                               options.ports)
+        else:
+            ports = allocator.allocate(options.base_port,
+                                       options.base_port + 1000,
+                                       options.ports, index)
+        # Host setup (TAP devices, ...)
+        time.sleep(options.setup)
+        if scheme == "lease":
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+        process = subprocess.Popen([sys.executable, "-c", FAKE_QEMU,
+                                    monitor_path, str(options.startup)] +
+                                   [str(port) for port in ports],
+                                   stderr=subprocess.PIPE)
+        try:
+            monitor = wait_for_monitor(monitor_path, options.startup + 30)
+        except RuntimeError:
+            monitor = None
+    finally:
+        fcntl.lockf(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+    end = time.time()
+    if monitor is not None:
+        monitor.close()
+    process.wait()
+    ok = monitor is not None and process.returncode == 0
+    results.put((start, end, ok))
+    allocator.release(owner=index)
+
+
+def run_benchmark(scheme, options):
+    workdir = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=create_vm,
+                                       args=(scheme, i, workdir, options,
+                                             results))
+               for i in xrange(options.vms)]
+    start = time.time()
+    try:
+        for worker in workers:
+            worker.start()
+        times = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        shutil.rmtree(workdir)
+    total = time.time() - start
+    failed = len([ok for _, _, ok in times if not ok])
+    average = sum(end - begin for begin, end, _ in times) / len(times)
+    print ("%-6s %3d VMs: all created in %6.2f s, average create %6.2f s, "
+           "%d failed" % (scheme, options.vms, total, average, failed))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--vms", type="int", default=16,
+                      help="Number of VMs created at once [default: %default]")
+    parser.add_option("-p", "--ports", type="int", default=3,
+                      help="Ports allocated per VM [default: %default]")
+    parser.add_option("--base-port", type="int", default=15000,
+                      help="First port to allocate [default: %default]")
+    parser.add_option("--setup", type="float", default=0.05,
+                      help="Host setup time under lock in seconds "
+                           "[default: %default]")
+    parser.add_option("--startup", type="float", default=1.0,
+                      help="Time until fake qemu creates monitor in seconds "
+                           "[default: %default]")
+    options, args = parser.parse_args()
+
+    for scheme in ("global", "lease"):
+        run_benchmark(scheme, options)
@@ -6,17 +6,43 @@ A class and functions used for running and controlling child processes.
 """
 
 import os
+import re
 import sys
 import pty
+import gzip
+import json
+import time
+import array
+import errno
+import signal
+import socket
 import select
 import termios
 import fcntl
 import tempfile
 import logging
 import shutil
+import resource
+import threading
+import Queue
 
 BASE_DIR = os.path.join('/tmp', 'aexpect')
 
+# Size of reads of the output file
+OUTPUT_CHUNK_SIZE = 1 << 16
+
+# Run the children of all clients by a single shared server (see
+# SharedServer) instead of a server process per child
+SHARED_SERVER = os.environ.get("AEXPECT_SHARED_SERVER") == "yes"
+SHARED_SERVER_SOCKET = os.path.join(BASE_DIR, "shared-server.sock")
+# Seconds the shared server keeps running without any child
+SHARED_SERVER_IDLE_TIMEOUT = 60
+# Descriptors the shared server keeps per session (pty, lock, output file,
+# input and control pipes) besides the reader pipes, and descriptors kept
+# free for accepting clients, logging, status files...
+SHARED_SESSION_FDS = 5
+SHARED_SERVER_RESERVED_FDS = 16
+
 
 def clean_tmp_files():
     """
@@ -98,8 +124,829 @@ def _get_reader_filename(base_dir, a_id, reader):
     return os.path.join(base_dir, a_id, "outpipe-%s" % reader)
 
 
+class OutputStore(object):
+
+    """
+    Reader of the output of a server, which may be split into segments.
+
+    The output is addressed by offsets counted from the start of the process.
+    Lines are indexed incrementally and counted from the first line of the
+    output retained when the store was first indexed.
+    The server writes to the output file; when the output limit is set (see
+    Spawn.set_output_limit()), the full output file is renamed to
+    <output>.<start>-<end> (optionally gzipped to <output>.<start>-<end>.gz)
+    and the oldest segments are removed.  Output of the removed segments is
+    not available anymore, reads start at the first retained offset.
+    """
+
+    def __init__(self, filename, chunk_size=OUTPUT_CHUNK_SIZE):
+        """
+        :param filename: Path of the output file written by the server.
+        :param chunk_size: Size of reads of the output.
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.segment_re = re.compile(r"^%s\.(\d+)-(\d+)(\.gz)?$" %
+                                     re.escape(os.path.basename(filename)))
+        # Offsets of the starts of lines, the first line starts at 0
+        self.line_offsets = array.array("L", [0])
+        self.indexed = 0
+
+    def segments(self):
+        """
+        Return the sorted list of (start, end, path) of the rotated segments.
+        """
+        dirname = os.path.dirname(self.filename)
+        segments = {}
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        for name in names:
+            match = self.segment_re.match(name)
+            if match is None:
+                continue
+            start = int(match.group(1))
+            # An uncompressed segment is preferred to the one being gzipped
+            if start not in segments or not match.group(3):
+                segments[start] = (start, int(match.group(2)),
+                                   os.path.join(dirname, name))
+        return [segments[start] for start in sorted(segments)]
+
+    def _active_start(self, segments):
+        if segments:
+            return segments[-1][1]
+        return 0
+
+    def start(self):
+        """
+        Return the first offset of the retained output.
+        """
+        segments = self.segments()
+        if segments:
+            return segments[0][0]
+        return 0
+
+    def size(self):
+        """
+        Return the total size of the output written so far.
+        """
+        while True:
+            segments = self.segments()
+            start = self._active_start(segments)
+            try:
+                size = os.path.getsize(self.filename)
+            except OSError:
+                size = 0
+            if self._active_start(self.segments()) == start:
+                return start + size
+
+    def _open(self, offset):
+        """
+        Open the segment holding offset.
+
+        :return: Tuple (start, fileobj) of the segment, or None when the
+                 offset is beyond the end of the output.
+        """
+        while True:
+            segments = self.segments()
+            active_start = self._active_start(segments)
+            if offset >= active_start:
+                try:
+                    fileobj = open(self.filename, "rb")
+                except IOError:
+                    fileobj = None
+                # The output file may have been rotated before it was open
+                if self._active_start(self.segments()) != active_start:
+                    if fileobj is not None:
+                        fileobj.close()
+                    continue
+                if fileobj is None:
+                    return None
+                return active_start, fileobj
+            for start, end, path in segments:
+                if end > offset:
+                    try:
+                        if path.endswith(".gz"):
+                            return start, gzip.open(path, "rb")
+                        return start, open(path, "rb")
+                    except IOError:
+                        # Removed or compressed in the meantime
+                        break
+
+    def iter_chunks(self, offset=0, size=None):
+        """
+        Iterate over chunks of the output.
+
+        :param offset: Offset of the first byte; negative offsets count from
+                       the current end of the output.
+        :param size: Maximal number of bytes, None for all of them.
+        """
+        if offset < 0:
+            offset = max(self.size() + offset, 0)
+        offset = max(offset, self.start())
+        end = None
+        if size is not None:
+            end = offset + size
+        while end is None or offset < end:
+            segment = self._open(offset)
+            if segment is None:
+                return
+            start, fileobj = segment
+            # Skip the output of segments removed in the meantime
+            offset = max(offset, start)
+            progress = False
+            try:
+                fileobj.seek(offset - start)
+                while end is None or offset < end:
+                    length = self.chunk_size
+                    if end is not None:
+                        length = min(length, end - offset)
+                    data = fileobj.read(length)
+                    if not data:
+                        break
+                    offset += len(data)
+                    progress = True
+                    yield data
+            finally:
+                fileobj.close()
+            if not progress:
+                return
+
+    def read(self, offset=0, size=None):
+        """
+        Return the output from offset.
+
+        :param offset: Offset of the first byte; negative offsets count from
+                       the current end of the output.
+        :param size: Maximal number of bytes, None for all of them.
+        """
+        return "".join(self.iter_chunks(offset, size))
+
+    def update_index(self):
+        """
+        Add the lines written since the last update to the line index.
+        """
+        start = self.start()
+        if self.indexed < start:
+            # Segments were removed before they were indexed, lines are
+            # counted from the first retained one
+            if self.indexed == 0:
+                self.line_offsets = array.array("L", [start])
+            else:
+                self.line_offsets.append(start)
+            self.indexed = start
+        offsets = self.line_offsets
+        for data in self.iter_chunks(self.indexed):
+            pos = data.find("\n")
+            while pos != -1:
+                offsets.append(self.indexed + pos + 1)
+                pos = data.find("\n", pos + 1)
+            self.indexed += len(data)
+
+    def line_count(self):
+        """
+        Return the number of lines (including an unterminated last line).
+        """
+        self.update_index()
+        count = len(self.line_offsets) - 1
+        if self.indexed > self.line_offsets[-1]:
+            count += 1
+        return count
+
+    def line_offset(self, line):
+        """
+        Return the offset of the start of a line.
+
+        :param line: Index of the line; negative indexes count from the end.
+        """
+        count = self.line_count()
+        if line < 0:
+            line = max(count + line, 0)
+        if line >= len(self.line_offsets):
+            return self.indexed
+        return self.line_offsets[line]
+
+    def read_lines(self, first=0, last=None):
+        """
+        Return the text of lines first to last (excluding last).
+
+        :param first: Index of the first line; negative indexes count from
+                      the end.
+        :param last: Index of the line after the last one, None for all
+                     lines to the end of the output.
+        """
+        start = self.line_offset(first)
+        if last is None:
+            return self.read(start)
+        end = self.line_offset(last)
+        # Lines of segments removed after they were indexed are skipped
+        start = max(start, self.start())
+        return self.read(start, max(end - start, 0))
+
+    def remove(self):
+        """
+        Remove the output file and all segments.
+        """
+        for path in [self.filename] + [seg[2] for seg in self.segments()]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.line_offsets = array.array("L", [0])
+        self.indexed = 0
+
+
+def _exec_command(a_id, command, env=None):
+    """
+    Run command in bash, replacing the (forked child of the) server.
+
+    :param a_id: ID of the server.
+    :param command: Command to run.
+    :param env: Environment of the command, None to keep the current one.
+    """
+    if len(command) > 255:
+        new_stack = None
+        if len(command) > 2000000:
+            # Stack size would probably not suffice (and no open files)
+            # (1 + len(command) * 4 / 8290304) * 8196
+            # 2MB => 8196kb, 4MB => 16392, ...
+            new_stack = (1 + len(command) / 2072576) * 8196
+            command = "ulimit -s %s\nulimit -n 819200\n%s" % (new_stack,
+                                                              command)
+        tmp_dir = os.path.join(BASE_DIR, a_id)
+        tmp_file = tempfile.mktemp(suffix='.sh',
+                                   prefix='aexpect-', dir=tmp_dir)
+        fd_cmd = open(tmp_file, "w")
+        fd_cmd.write(command)
+        fd_cmd.close()
+        args = ["/bin/bash", "-c", "source %s" % tmp_file]
+    else:
+        args = ["/bin/bash", "-c", command]
+    if env is None:
+        os.execv("/bin/bash", args)
+    else:
+        os.execve("/bin/bash", args, env)
+
+
+def _handle_ctrl(data, shell_fd, echo):
+    """
+    Carry out a control command sent by a client (see Spawn.send_ctrl()).
+
+    :return: Tuple (segment_size, segments, compress) of an output_limit
+             command, None for the other commands.
+    """
+    if data == "raw":
+        _makeraw(shell_fd)
+    elif data == "standard":
+        _makestandard(shell_fd, echo)
+    elif data.startswith("output_limit "):
+        return tuple(int(_) for _ in data.split()[1:])
+    return None
+
+
+def _rotate_output(output_file, filename, start, segments, compress):
+    """
+    Rename the output file to a segment and open a new output file.
+
+    :param output_file: Open output file.
+    :param filename: Path of the output file.
+    :param start: Offset of the start of the output file.
+    :param segments: Number of rotated segments to keep.
+    :param compress: Whether to gzip the rotated segment.
+    :return: Tuple (output_file, start) of the new output file.
+    """
+    end = start + output_file.tell()
+    output_file.close()
+    segment = "%s.%d-%d" % (filename, start, end)
+    os.rename(filename, segment)
+    output_file = open(filename, "w")
+    # Gzipping would stall the server, the rotation thread finishes it
+    _run_in_background(_finish_rotation, filename, segment, segments,
+                       compress)
+    return output_file, end
+
+
+def _finish_rotation(filename, segment, segments, compress):
+    """
+    Gzip the rotated segment and remove the oldest segments.
+    """
+    if compress:
+        # Readers prefer the uncompressed segment until it's removed
+        tmp = open(segment, "rb")
+        gzipped = gzip.open(segment + ".gz.tmp", "wb", 1)
+        shutil.copyfileobj(tmp, gzipped, OUTPUT_CHUNK_SIZE)
+        gzipped.close()
+        tmp.close()
+        os.rename(segment + ".gz.tmp", segment + ".gz")
+        os.unlink(segment)
+    old = OutputStore(filename).segments()
+    for _, _, path in old[:max(len(old) - segments, 0)]:
+        os.unlink(path)
+
+
+# Jobs of the rotation thread of a server, run in order
+_background_jobs = Queue.Queue()
+_background_thread = None
+
+
+def _background_worker():
+    while True:
+        func, args = _background_jobs.get()
+        try:
+            func(*args)
+        except Exception:
+            # The output may have been removed by the client meanwhile
+            logging.exception("Background job %s%s failed", func.__name__,
+                              args)
+        _background_jobs.task_done()
+
+
+def _run_in_background(func, *args):
+    """
+    Queue func(*args) to the rotation thread of the server.
+    """
+    global _background_thread
+    if _background_thread is None:
+        _background_thread = threading.Thread(target=_background_worker,
+                                              name="aexpect-rotation")
+        _background_thread.daemon = True
+        _background_thread.start()
+    _background_jobs.put((func, args))
+
+
+def _wait_background_jobs():
+    """
+    Wait until the jobs queued by _run_in_background() are done.
+    """
+    if _background_thread is not None:
+        _background_jobs.join()
+
+
 # The following is the server part of the module.
 
+
+class _SharedSession(object):
+
+    """
+    A child process run by the shared server.
+
+    The session talks to its client using the same files and pipes as
+    the standalone server.
+    """
+
+    def __init__(self, poller, a_id, echo, readers, command, cwd, env,
+                 nofile_limits):
+        """
+        Fork the child process and create the files and pipes.
+
+        :param poller: select.epoll object of the shared server.
+        :param a_id: ID of the session.
+        :param echo: Whether the terminal echo is initially enabled.
+        :param readers: List of names of reader pipes.
+        :param command: Command to run.
+        :param cwd: Working directory of the command.
+        :param env: Environment of the command.
+        :param nofile_limits: RLIMIT_NOFILE limits of the child.
+        """
+        self.poller = poller
+        self.a_id = a_id
+        self.echo = echo
+        (self.shell_pid_filename,
+         self.status_filename,
+         self.output_filename,
+         self.inpipe_filename,
+         self.ctrlpipe_filename,
+         self.lock_server_running_filename,
+         self.lock_client_starting_filename,
+         _) = _get_filenames(BASE_DIR, a_id)
+        env["TERM"] = "dumb"
+        command += " && echo %s > /dev/null" % a_id
+        self.lock_server_running = None
+        self.output_file = None
+        self.inpipe_fd = None
+        self.ctrlpipe_fd = None
+        self.reader_fds = []
+
+        (self.shell_pid, self.shell_fd) = pty.fork()
+        if self.shell_pid == 0:
+            try:
+                # Don't pass descriptors of the other sessions to the child
+                for fd in [int(_) for _ in os.listdir("/proc/self/fd")]:
+                    if fd > 2:
+                        try:
+                            os.close(fd)
+                        except OSError:
+                            pass
+                resource.setrlimit(resource.RLIMIT_NOFILE, nofile_limits)
+                os.chdir(cwd)
+                _exec_command(a_id, command, env)
+            finally:
+                os._exit(1)
+
+        try:
+            self.lock_server_running = _lock(
+                self.lock_server_running_filename)
+            _makestandard(self.shell_fd, echo)
+            self.output_file = open(self.output_filename, "w")
+            self.output_start = 0
+            self.output_limit = (0, 0, 0)
+            self.rotated = False
+            self.status_written = False
+            os.mkfifo(self.inpipe_filename)
+            self.inpipe_fd = os.open(self.inpipe_filename, os.O_RDWR)
+            os.mkfifo(self.ctrlpipe_filename)
+            self.ctrlpipe_fd = os.open(self.ctrlpipe_filename, os.O_RDWR)
+            for reader in readers:
+                filename = _get_reader_filename(BASE_DIR, a_id, reader)
+                os.mkfifo(filename)
+                self.reader_fds.append(os.open(filename,
+                                               os.O_RDWR | os.O_NONBLOCK))
+            fileobj = open(self.shell_pid_filename, "w")
+            fileobj.write(str(self.shell_pid))
+            fileobj.close()
+
+            self.buffers = ["" for _ in readers]
+            self.input = ""
+            self.status = None
+            flags = fcntl.fcntl(self.shell_fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.shell_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.shell_open = True
+            self.poller.register(self.shell_fd, select.EPOLLIN)
+            self.poller.register(self.inpipe_fd, select.EPOLLIN)
+            self.poller.register(self.ctrlpipe_fd, select.EPOLLIN)
+        except Exception:
+            self._abort()
+            raise
+
+    def _abort(self):
+        """
+        Kill the child and close the descriptors of a session which failed
+        to start.
+        """
+        try:
+            os.kill(self.shell_pid, signal.SIGKILL)
+            os.waitpid(self.shell_pid, 0)
+        except OSError:
+            pass
+        # Closed descriptors are removed from the poller
+        for fd in [self.shell_fd, self.inpipe_fd,
+                   self.ctrlpipe_fd] + self.reader_fds:
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        if self.output_file is not None:
+            self.output_file.close()
+        if self.lock_server_running is not None:
+            _unlock(self.lock_server_running)
+
+    def fds(self):
+        """
+        Return the descriptors watched by the shared server.
+        """
+        fds = [self.inpipe_fd, self.ctrlpipe_fd] + self.reader_fds
+        if self.shell_open:
+            fds.append(self.shell_fd)
+        return fds
+
+    def handle(self, fd, events):
+        """
+        Handle events of one of the descriptors of the session.
+        """
+        if fd == self.shell_fd:
+            if events & select.EPOLLOUT:
+                self._write_input()
+            if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                self._read_output()
+        elif fd == self.inpipe_fd:
+            self.input += os.read(self.inpipe_fd, 1024)
+            self._write_input()
+        elif fd == self.ctrlpipe_fd:
+            cmd_len = int(os.read(self.ctrlpipe_fd, 10))
+            output_limit = _handle_ctrl(os.read(self.ctrlpipe_fd, cmd_len),
+                                        self.shell_fd, self.echo)
+            if output_limit is not None:
+                self.output_limit = output_limit
+        else:
+            i = self.reader_fds.index(fd)
+            try:
+                bytes_written = os.write(fd, self.buffers[i])
+            except OSError:
+                bytes_written = 0
+            self.buffers[i] = self.buffers[i][bytes_written:]
+            if not self.buffers[i]:
+                self.poller.unregister(fd)
+
+    def _read_output(self):
+        try:
+            data = os.read(self.shell_fd, 16384)
+        except OSError, details:
+            if details.errno == errno.EAGAIN:
+                return False
+            data = ""
+        if not data:
+            # The terminal was closed, wait for the exit of the child
+            self.poller.unregister(self.shell_fd)
+            self.shell_open = False
+            return False
+        # Remove carriage returns from the data -- they often cause
+        # trouble and are normally not needed
+        data = data.replace("\r", "")
+        self.output_file.write(data)
+        self.output_file.flush()
+        segment_size, segments, compress = self.output_limit
+        if segment_size and self.output_file.tell() >= segment_size:
+            self.output_file, self.output_start = _rotate_output(
+                self.output_file, self.output_filename, self.output_start,
+                segments, compress)
+            self.rotated = True
+        for i, fd in enumerate(self.reader_fds):
+            if not self.buffers[i]:
+                self.poller.register(fd, select.EPOLLOUT)
+            self.buffers[i] += data
+        return True
+
+    def _write_input(self):
+        if not self.shell_open:
+            self.input = ""
+            return
+        try:
+            bytes_written = os.write(self.shell_fd, self.input)
+        except OSError, details:
+            if details.errno != errno.EAGAIN:
+                self.input = ""
+            bytes_written = 0
+        self.input = self.input[bytes_written:]
+        events = select.EPOLLIN
+        if self.input:
+            events |= select.EPOLLOUT
+        self.poller.modify(self.shell_fd, events)
+
+    def exited(self, status):
+        """
+        Read the rest of the output of the exited child and write its status.
+
+        :param status: Exit status of the child.
+        """
+        while self.shell_open and self._read_output():
+            pass
+        if self.shell_open:
+            self.poller.unregister(self.shell_fd)
+            self.shell_open = False
+        self.status = status
+        if self.rotated:
+            # Report the exit once the rotated output is complete
+            _run_in_background(self._write_status)
+        else:
+            self._write_status()
+
+    def _write_status(self):
+        try:
+            fileobj = open(self.status_filename, "w")
+            fileobj.write(str(self.status))
+            fileobj.close()
+        finally:
+            self.status_written = True
+
+    def finish(self):
+        """
+        Close the session once its client finished initialization.
+
+        :return: True if the session was closed.
+        """
+        if (not self.status_written or
+                _locked(self.lock_client_starting_filename)):
+            return False
+        for i, fd in enumerate(self.reader_fds):
+            if self.buffers[i]:
+                self.poller.unregister(fd)
+            os.close(fd)
+        for fd in (self.inpipe_fd, self.ctrlpipe_fd):
+            self.poller.unregister(fd)
+            os.close(fd)
+        os.close(self.shell_fd)
+        self.output_file.close()
+        _unlock(self.lock_server_running)
+        return True
+
+
+class SharedServer(object):
+
+    """
+    A server running the child processes of many clients.
+
+    Clients connect to a Unix socket, send the parameters of the new
+    session as a line of JSON and wait for the "Server <id> ready" reply.
+    All children are served by a single epoll loop, which only wakes up when
+    there's something to do.  The server exits when it has been idle for
+    idle_timeout seconds.
+    """
+
+    def __init__(self, path=None, idle_timeout=None):
+        """
+        :param path: Path of the Unix socket.
+        :param idle_timeout: Seconds to run without any session.
+        """
+        self.path = path or SHARED_SERVER_SOCKET
+        if idle_timeout is None:
+            idle_timeout = SHARED_SERVER_IDLE_TIMEOUT
+        self.idle_timeout = idle_timeout
+        self.poller = select.epoll()
+        self.sessions = {}
+        self.fd_sessions = {}
+        self.pid_sessions = {}
+        self.finishing = []
+        self.log = logging.getLogger("aexpect.shared")
+        self.nofile_limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.max_fds = self.nofile_limits[0]
+
+    def _raise_fd_limit(self):
+        """
+        Raise the soft limit of open descriptors to the hard one, every
+        session needs several of them.
+        """
+        soft, hard = self.nofile_limits
+        if hard != resource.RLIM_INFINITY and soft < hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, resource.error), details:
+                self.log.warning("Failed to raise the limit of open files "
+                                 "to %s: %s", hard, details)
+        self.max_fds = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        self.log.info("Limit of open files: %s", self.max_fds)
+
+    def _check_fds(self, readers):
+        """
+        Refuse a new session when the server would run out of descriptors.
+
+        :param readers: List of names of reader pipes of the session.
+        """
+        needed = SHARED_SESSION_FDS + len(readers)
+        used = len(os.listdir("/proc/self/fd"))
+        if used + needed + SHARED_SERVER_RESERVED_FDS > self.max_fds:
+            raise OSError(errno.EMFILE, "Too many sessions, %d descriptors "
+                          "used, %d needed by the session, limit %d" %
+                          (used, needed, self.max_fds))
+
+    def _accept(self):
+        try:
+            conn = self.listener.accept()[0]
+        except socket.error:
+            return
+        a_id = None
+        try:
+            conn.settimeout(10)
+            params = json.loads(conn.makefile().readline())
+            a_id = str(params["a_id"])
+            readers = [str(_) for _ in params["readers"]]
+            self._check_fds(readers)
+            session = _SharedSession(self.poller, a_id, params["echo"],
+                                     readers, str(params["command"]),
+                                     str(params["cwd"]),
+                                     dict((str(key), str(value))
+                                          for key, value in
+                                          params["env"].items()),
+                                     self.nofile_limits)
+            self.sessions[a_id] = session
+            self.pid_sessions[session.shell_pid] = session
+            for fd in session.fds():
+                self.fd_sessions[fd] = session
+            self.log.info("Session %s started, pid %s: %s", a_id,
+                          session.shell_pid, params["command"])
+            conn.sendall("Server %s ready\n" % a_id)
+        except Exception, details:
+            self.log.error("Session %s failed to start: %s", a_id, details)
+            try:
+                conn.sendall("Server %s failed: %s\n" % (a_id, details))
+            except socket.error:
+                pass
+        conn.close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            session = self.pid_sessions.pop(pid, None)
+            if session is None:
+                continue
+            session.exited(os.WEXITSTATUS(status))
+            self.log.info("Session %s exited with status %s",
+                          session.a_id, session.status)
+            self.finishing.append(session)
+
+    def _finish(self):
+        for session in self.finishing[:]:
+            if session.finish():
+                self.finishing.remove(session)
+                for fd in session.fds() + [session.shell_fd]:
+                    self.fd_sessions.pop(fd, None)
+                del self.sessions[session.a_id]
+                self.log.info("Session %s closed", session.a_id)
+
+    def run(self):
+        """
+        Serve the clients until the server is idle.
+        """
+        lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another shared server is running
+            os.close(lock_fd)
+            return
+        self._raise_fd_limit()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        socket_ino = os.stat(self.path).st_ino
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        self.poller.register(self.listener.fileno(), select.EPOLLIN)
+        # Exits of children are reported through a pipe
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # Reads and writes of the sessions must not fail with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self.poller.register(wakeup_r, select.EPOLLIN)
+        self.log.info("Shared server listening on %s", self.path)
+
+        idle_since = time.time()
+        while True:
+            timeout = -1
+            if self.finishing:
+                timeout = 0.1
+            elif not self.sessions:
+                timeout = max(idle_since + self.idle_timeout - time.time(),
+                              0)
+            try:
+                events = self.poller.poll(timeout)
+            except IOError, details:
+                if details.errno != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == self.listener.fileno():
+                    self._accept()
+                elif fd == wakeup_r:
+                    try:
+                        os.read(wakeup_r, 1024)
+                    except OSError:
+                        pass
+                elif fd in self.fd_sessions:
+                    session = self.fd_sessions[fd]
+                    try:
+                        session.handle(fd, event)
+                    except Exception:
+                        self.log.exception("Session %s failed to handle "
+                                           "events %s of fd %s",
+                                           session.a_id, event, fd)
+            self._reap()
+            self._finish()
+            if self.sessions:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = time.time()
+            elif time.time() - idle_since >= self.idle_timeout:
+                break
+
+        # Connecting clients retry with a new server; the socket may have
+        # been removed by clean_tmp_files() and bound by another server
+        try:
+            if os.stat(self.path).st_ino == socket_ino:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self.listener.close()
+        _wait_background_jobs()
+        self.log.info("Shared server exiting")
+        fcntl.lockf(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--shared-server"]:
+    # Detach from the client which started the shared server
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    os.chdir("/")
+    logging.basicConfig(filename=os.path.join(BASE_DIR, "shared-server-log"),
+                        level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)-5.5s| %(message)s',
+                        datefmt='%m/%d %H:%M:%S')
+    SharedServer(sys.argv[2]).run()
+    sys.exit(0)
+
 if __name__ == "__main__":
     a_id = sys.stdin.readline().strip()
     echo = sys.stdin.readline().strip() == "True"
@@ -138,25 +985,7 @@ if __name__ == "__main__":
     (shell_pid, shell_fd) = pty.fork()
     if shell_pid == 0:
         # Child process: run the command in a subshell
-        if len(command) > 255:
-            new_stack = None
-            if len(command) > 2000000:
-                # Stack size would probably not suffice (and no open files)
-                # (1 + len(command) * 4 / 8290304) * 8196
-                # 2MB => 8196kb, 4MB => 16392, ...
-                new_stack = (1 + len(command) / 2072576) * 8196
-                command = "ulimit -s %s\nulimit -n 819200\n%s" % (new_stack,
-                                                                  command)
-            tmp_dir = os.path.join(BASE_DIR, a_id)
-            tmp_file = tempfile.mktemp(suffix='.sh',
-                                       prefix='aexpect-', dir=tmp_dir)
-            fd_cmd = open(tmp_file, "w")
-            fd_cmd.write(command)
-            fd_cmd.close()
-            os.execv("/bin/bash", ["/bin/bash", "-c", "source %s" % tmp_file])
-            os.remove(tmp_file)
-        else:
-            os.execv("/bin/bash", ["/bin/bash", "-c", command])
+        _exec_command(a_id, command)
     else:
         # Parent process
         server_log.info('Acquiring server lock on %s' % lock_server_running_filename)
@@ -167,6 +996,11 @@ if __name__ == "__main__":
 
         server_log.info('Opening output file %s' % output_filename)
         output_file = open(output_filename, "w")
+        # Output limit (see Spawn.set_output_limit()), no rotation by default
+        output_start = 0
+        segment_size = 0
+        segments = 0
+        compress = False
         server_log.info('Opening input pipe %s' % inpipe_filename)
         os.mkfifo(inpipe_filename)
         inpipe_fd = os.open(inpipe_filename, os.O_RDWR)
@@ -211,10 +1045,12 @@ if __name__ == "__main__":
             if ctrlpipe_fd in r:
                 cmd_len = int(os.read(ctrlpipe_fd, 10))
                 data = os.read(ctrlpipe_fd, cmd_len)
-                if data == "raw":
-                    _makeraw(shell_fd)
-                elif data == "standard":
-                    _makestandard(shell_fd, echo)
+                output_limit = _handle_ctrl(data, shell_fd, echo)
+                if output_limit is not None:
+                    segment_size, segments, compress = output_limit
+                    server_log.info('Output limit: %d segments of %d bytes, '
+                                    'compress %s' % (segments, segment_size,
+                                                     bool(compress)))
             # If there's data to read from the child process --
             if shell_fd in r:
                 try:
@@ -228,6 +1064,10 @@ if __name__ == "__main__":
                 data = data.replace("\r", "")
                 output_file.write(data)
                 output_file.flush()
+                if segment_size and output_file.tell() >= segment_size:
+                    output_file, output_start = _rotate_output(
+                        output_file, output_filename, output_start, segments,
+                        compress)
                 for i in range(len(readers)):
                     buffers[i] += data
             # If os.read() raised an exception or there was nothing to read --
@@ -241,6 +1081,8 @@ if __name__ == "__main__":
                 data = os.read(inpipe_fd, 1024)
                 os.write(shell_fd, data)
 
+        # Finish the rotations of the output before reporting the exit
+        _wait_background_jobs()
         server_log.info('Out of the main read loop. Writing status to %s' % status_filename)
         fileobj = open(status_filename, "w")
         fileobj.write(str(status))
@@ -273,6 +1115,18 @@ import logging
 import utils_misc
 
 
+class SharedServerError(Exception):
+
+    def __init__(self, a_id, reply):
+        Exception.__init__(self, a_id, reply)
+        self.a_id = a_id
+        self.reply = reply
+
+    def __str__(self):
+        return ("Shared server failed to start session %s (reply: %r)" %
+                (self.a_id, self.reply))
+
+
 class ExpectError(Exception):
 
     def __init__(self, patterns, output):
@@ -469,6 +1323,59 @@ def run_fg(command, output_func=None, output_prefix="", timeout=1.0):
     return (status, output)
 
 
+def _connect_shared_server(timeout=10):
+    """
+    Connect to the shared server, start it when it's not running.
+
+    :param timeout: Seconds to wait for the server.
+    :return: Connected socket.
+    """
+    end_time = time.time() + timeout
+    next_start = 0
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SHARED_SERVER_SOCKET)
+            return sock
+        except socket.error:
+            sock.close()
+            if time.time() > end_time:
+                raise
+        # The start fails while an idle server is exiting, so try again
+        if time.time() >= next_start:
+            subprocess.call([sys.executable, __file__, "--shared-server",
+                             SHARED_SERVER_SOCKET], close_fds=True)
+            next_start = time.time() + 1
+        time.sleep(0.01)
+
+
+def _start_shared_session(a_id, command, echo, readers):
+    """
+    Ask the shared server to run a command.
+
+    :param a_id: ID of the session.
+    :param command: Command to run.
+    :param echo: Whether the terminal echo is initially enabled.
+    :param readers: List of names of reader pipes.
+    """
+    request = json.dumps({"a_id": a_id, "echo": echo, "readers": readers,
+                          "command": command, "cwd": os.getcwd(),
+                          "env": dict(os.environ)})
+    for _ in range(10):
+        sock = _connect_shared_server()
+        try:
+            sock.sendall(request + "\n")
+            reply = sock.makefile().readline()
+        except socket.error:
+            reply = ""
+        sock.close()
+        if reply:
+            break
+        # The server exited before it accepted the connection
+    if reply.strip() != "Server %s ready" % a_id:
+        raise SharedServerError(a_id, reply.strip())
+
+
 class Spawn(object):
 
     """
@@ -478,6 +1385,8 @@ class Spawn(object):
     program that reads output from the child process and reports it to the
     client and to a text file) or attach to an already running server.
     When a server is started it runs the child process.
+    If SHARED_SERVER is set, the child process is run by the shared server
+    (see SharedServer) instead of a new server process.
     The server writes output from the child's STDOUT and STDERR to a text file.
     The text file can be accessed at any time using get_output().
     In addition, the server opens as many pipes as requested by the client and
@@ -535,6 +1444,7 @@ class Spawn(object):
          self.lock_client_starting_filename,
          self.server_log_filename) = _get_filenames(BASE_DIR,
                                                     self.a_id)
+        self.output_store = OutputStore(self.output_filename)
 
         self.command = command
 
@@ -560,23 +1470,32 @@ class Spawn(object):
         lock_client_starting = _lock(self.lock_client_starting_filename)
 
         # Start the server (which runs the command)
-        if command:
-            sub = subprocess.Popen("%s %s" % (sys.executable, __file__),
-                                   shell=True,
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-            # Send parameters to the server
-            sub.stdin.write("%s\n" % self.a_id)
-            sub.stdin.write("%s\n" % echo)
-            sub.stdin.write("%s\n" % ",".join(self.readers))
-            sub.stdin.write("%s\n" % command)
-            # Wait for the server to complete its initialization
-            while "Server %s ready" % self.a_id not in sub.stdout.readline():
-                pass
+        self.reader_fds = {}
+        try:
+            if command and SHARED_SERVER:
+                _start_shared_session(self.a_id, command, echo, self.readers)
+            elif command:
+                sub = subprocess.Popen("%s %s" % (sys.executable, __file__),
+                                       shell=True,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+                # Send parameters to the server
+                sub.stdin.write("%s\n" % self.a_id)
+                sub.stdin.write("%s\n" % echo)
+                sub.stdin.write("%s\n" % ",".join(self.readers))
+                sub.stdin.write("%s\n" % command)
+                # Wait for the server to complete its initialization
+                while ("Server %s ready" % self.a_id not in
+                       sub.stdout.readline()):
+                    pass
+        except Exception:
+            # Nothing runs, there's nothing to close() on deletion
+            self.auto_close = False
+            _unlock(lock_client_starting)
+            raise
 
         # Open the reading pipes
-        self.reader_fds = {}
         try:
             assert(_locked(self.lock_server_running_filename))
             for reader, filename in self.reader_filenames.items():
@@ -604,8 +1523,9 @@ class Spawn(object):
         return (None, self.a_id, self.auto_close, self.echo, self.linesep)
 
     def __del__(self):
+        # The attributes aren't set when __init__() failed early
         self._close_reader_fds()
-        if self.auto_close:
+        if getattr(self, "auto_close", False):
             self.close()
 
     def _add_reader(self, reader):
@@ -646,7 +1566,7 @@ class Spawn(object):
         """
         Close all reader file descriptors.
         """
-        for fd in self.reader_fds.values():
+        for fd in getattr(self, "reader_fds", {}).values():
             try:
                 os.close(fd)
             except OSError:
@@ -688,24 +1608,92 @@ class Spawn(object):
         except Exception:
             return None
 
-    def get_output(self):
+    def get_output(self, offset=0, size=None):
         """
         Return the STDOUT and STDERR output of the process so far.
+
+        Offsets are counted from the start of the process, output removed by
+        the output limit (see set_output_limit()) is skipped.
+
+        :param offset: Offset of the first byte; negative offsets count from
+                the end of the output.
+        :param size: Maximal number of bytes, None for the rest of the output.
         """
         try:
-            fileobj = open(self.output_filename, "r")
-            output = fileobj.read()
-            fileobj.close()
-            return output
+            return self.output_store.read(offset, size)
         except Exception:
             return ""
 
-    def get_stripped_output(self):
+    def get_output_size(self):
+        """
+        Return the number of bytes of output produced by the process so far.
+        """
+        return self.output_store.size()
+
+    def get_output_tail(self, size):
+        """
+        Return the last size bytes of the output of the process.
+
+        :param size: Number of bytes.
+        """
+        return self.get_output(-size)
+
+    def get_output_lines(self, first=0, last=None):
+        """
+        Return lines of the output of the process.
+
+        Lines are indexed incrementally, only the output produced since the
+        last call is scanned for line ends.
+
+        :param first: Index of the first line; negative indexes count from
+                the end of the output.
+        :param last: Index of the line after the last returned one, None for
+                all lines to the end of the output.
+        """
+        try:
+            return self.output_store.read_lines(first, last)
+        except Exception:
+            return ""
+
+    def get_output_line_count(self):
+        """
+        Return the number of lines of the output of the process so far.
+        """
+        return self.output_store.line_count()
+
+    def iter_output(self, offset=0, size=None):
+        """
+        Iterate over chunks of the output of the process.
+
+        :param offset: Offset of the first byte; negative offsets count from
+                the end of the output.
+        :param size: Maximal number of bytes, None for the rest of the output.
+        """
+        return self.output_store.iter_chunks(offset, size)
+
+    def get_stripped_output(self, offset=0, size=None):
         """
         Return the STDOUT and STDERR output without the console codes escape
         and sequences of the process so far.
+
+        :param offset: Offset of the first byte (see get_output()).
+        :param size: Maximal number of bytes, None for the rest of the output.
+        """
+        return utils_misc.strip_console_codes(self.get_output(offset, size))
+
+    def set_output_limit(self, segment_size, segments=1, compress=False):
+        """
+        Limit the disk space used by the output file of the process.
+
+        Whenever the output file reaches segment_size bytes, it is rotated
+        to a segment and only the last segments are kept.
+
+        :param segment_size: Size of a segment in bytes, 0 turns rotation off.
+        :param segments: Number of rotated segments to keep.
+        :param compress: Whether to gzip the rotated segments.
         """
-        return utils_misc.strip_console_codes(self.get_output())
+        self.send_ctrl("output_limit %d %d %d" % (segment_size, segments,
+                                                  bool(compress)))
 
     def is_alive(self):
         """
@@ -737,12 +1725,13 @@ class Spawn(object):
         # Wait for the server to exit
         _wait(self.lock_server_running_filename)
         # Call all cleanup routines
-        for hook in self.close_hooks:
+        for hook in getattr(self, "close_hooks", []):
             hook(self)
         # Close reader file descriptors
         self._close_reader_fds()
         self.reader_fds = {}
         # Remove all used files
+        self.output_store.remove()
         for filename in (_get_filenames(BASE_DIR, self.a_id)):
             try:
                 os.unlink(filename)
@@ -1027,7 +2016,7 @@ class Tail(Spawn):
         # Wait for the tail thread to exit
         # (it's done this way because self.tail_thread may become None at any
         # time)
-        t = self.tail_thread
+        t = getattr(self, "tail_thread", None)
         if t:
             t.join()
 
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import random
+import signal
+import resource
+import tempfile
+import unittest
+
+import common
+import aexpect
+
+
+def numbered_lines(first, last):
+    return "".join("line %d\n" % i for i in xrange(first, last))
+
+
+class OutputStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "output")
+        self.store = aexpect.OutputStore(self.filename, chunk_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, chunks, segment_size=0, segments=10, compress=False):
+        """
+        Write the chunks the way the server does.
+        """
+        output_file = open(self.filename, "w")
+        start = 0
+        for data in chunks:
+            output_file.write(data)
+            output_file.flush()
+            if segment_size and output_file.tell() >= segment_size:
+                output_file, start = aexpect._rotate_output(
+                    output_file, self.filename, start, segments, compress)
+        output_file.close()
+        aexpect._wait_background_jobs()
+
+    def test_single_file(self):
+        data = numbered_lines(0, 1000)
+        self.write([data])
+        self.assertEqual(self.store.size(), len(data))
+        self.assertEqual(self.store.read(), data)
+        self.assertEqual(self.store.read(100, 50), data[100:150])
+        self.assertEqual(self.store.read(-30), data[-30:])
+        self.assertEqual(self.store.read(len(data) + 10), "")
+        self.assertEqual(self.store.line_count(), 1000)
+        self.assertEqual(self.store.read_lines(10, 12), "line 10\nline 11\n")
+        self.assertEqual(self.store.read_lines(-1), "line 999\n")
+
+    def test_rotation(self):
+        chunks = [numbered_lines(i, i + 10) for i in xrange(0, 1000, 10)]
+        data = "".join(chunks)
+        for compress in (False, True):
+            self.store.remove()
+            self.write(chunks, segment_size=500, compress=compress)
+            segments = self.store.segments()
+            self.assertEqual(len(segments), 10)
+            self.assertEqual(segments[0][2].endswith(".gz"), compress)
+            self.assertEqual(self.store.start(), segments[0][0])
+            self.assertEqual(segments[-1][1] +
+                             os.path.getsize(self.filename), len(data))
+            available = data[self.store.start():]
+            self.assertEqual(self.store.size(), len(data))
+            self.assertEqual(self.store.read(), available)
+            # Reads across segment boundaries
+            offset = segments[3][1] - 7
+            self.assertEqual(self.store.read(offset, 500),
+                             data[offset:offset + 500])
+            self.assertEqual(self.store.read(-1500), data[-1500:])
+            self.assertEqual("".join(self.store.iter_chunks(offset)),
+                             data[offset:])
+            # Offsets of removed segments are skipped
+            self.assertEqual(self.store.read(0, 10), available[:10])
+            self.assertEqual(self.store.read_lines(-2), "line 998\nline 999\n")
+
+    def test_incremental_index(self):
+        output_file = open(self.filename, "w")
+        output_file.write("a\nb")
+        output_file.flush()
+        self.assertEqual(self.store.line_count(), 2)
+        self.assertEqual(self.store.read_lines(1), "b")
+        output_file.write("c\nd\n")
+        output_file.close()
+        self.assertEqual(self.store.line_count(), 3)
+        self.assertEqual(self.store.read_lines(1, 2), "bc\n")
+        self.assertEqual(self.store.read_lines(2, 10), "d\n")
+
+
+class SpawnOutputTest(unittest.TestCase):
+
+    def test_output_limit(self):
+        session = aexpect.Spawn("read x; seq 0 99999")
+        try:
+            session.set_output_limit(65536, segments=2, compress=True)
+            session.sendline()
+            self.assertEqual(session.get_status(), 0)
+            data = "".join("%d\n" % i for i in xrange(100000))
+            store = session.output_store
+            self.assertEqual(session.get_output_size(), len(data))
+            self.assertEqual(len(store.segments()), 2)
+            self.assertTrue(os.path.getsize(store.segments()[0][2]) < 65536)
+            self.assertEqual(session.get_output(), data[store.start():])
+            self.assertEqual(session.get_output_tail(6), "99999\n")
+            self.assertEqual(session.get_output_lines(-3, -1),
+                             "99997\n99998\n")
+            # Lines are counted from the first retained one
+            self.assertEqual(session.get_output_line_count(),
+                             session.get_output().count("\n"))
+            self.assertEqual(session.get_output_lines(0, 1),
+                             session.get_output().split("\n", 1)[0] + "\n")
+        finally:
+            session.close()
+        self.assertEqual(store.segments(), [])
+
+
+class SharedServerTest(SpawnOutputTest):
+
+    def setUp(self):
+        self.shared_server = aexpect.SHARED_SERVER
+        aexpect.SHARED_SERVER = True
+
+    def tearDown(self):
+        aexpect.SHARED_SERVER = self.shared_server
+
+    def test_sessions(self):
+        sessions = [aexpect.ShellSession("/bin/sh", prompt=r"^[\#\$] $")
+                    for _ in range(3)]
+        try:
+            for session in sessions:
+                session.read_up_to_prompt()
+            servers = set(open("/proc/%d/stat" % session.get_pid()).read()
+                          .split()[3] for session in sessions)
+            self.assertEqual(len(servers), 1)
+            for i, session in enumerate(sessions):
+                self.assertEqual(session.cmd_status_output("echo %d" % i),
+                                 (0, "%d\n" % i))
+            sessions[0].close()
+            self.assertFalse(sessions[0].is_alive())
+            self.assertTrue(sessions[1].is_alive())
+            # Sessions are accessible by their ids
+            session = aexpect.ShellSession(a_id=sessions[1].get_id(),
+                                           prompt=r"^[\#\$] $")
+            session.sendline()
+            session.read_up_to_prompt()
+            self.assertEqual(session.cmd_output("echo $TERM"), "dumb\n")
+        finally:
+            for session in sessions:
+                session.close()
+
+    def test_failed_start(self):
+        server_session = aexpect.Expect("cat")
+        try:
+            server = int(open("/proc/%d/stat" % server_session.get_pid())
+                         .read().split()[3])
+            fds = len(os.listdir("/proc/%d/fd" % server))
+            # The input pipe can't be created
+            a_id = "failed%d" % os.getpid()
+            os.makedirs(os.path.join(aexpect.BASE_DIR, a_id))
+            inpipe = aexpect._get_filenames(aexpect.BASE_DIR, a_id)[3]
+            open(inpipe, "w").close()
+            self.assertRaises(aexpect.SharedServerError, aexpect.Expect,
+                              "sleep 100", a_id)
+            shutil.rmtree(os.path.join(aexpect.BASE_DIR, a_id))
+            # The child was killed and the descriptors closed
+            self.assertTrue(len(os.listdir("/proc/%d/fd" % server)) <= fds)
+            for pid in os.listdir("/proc"):
+                try:
+                    cmdline = open("/proc/%s/cmdline" % pid).read()
+                except IOError:
+                    continue
+                self.assertFalse(a_id in cmdline, cmdline)
+        finally:
+            server_session.close()
+
+    def test_fd_limit(self):
+        # The server inherits the limit of the client; sessions which don't
+        # fit are refused before their setup
+        tmpdir = tempfile.mkdtemp()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            sessions = []
+            try:
+                # Don't reuse the ids of the sessions of the parent
+                random.seed()
+                resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+                aexpect.SHARED_SERVER_SOCKET = os.path.join(tmpdir, "sock")
+                try:
+                    for _ in xrange(20):
+                        sessions.append(aexpect.Expect("cat"))
+                except aexpect.SharedServerError, details:
+                    session = sessions[-1]
+                    session.sendline("alive")
+                    session.read_until_last_line_matches([r"^alive$"],
+                                                         timeout=10)
+                    if "Too many sessions" in str(details):
+                        status = 0
+            finally:
+                if sessions:
+                    server = int(open("/proc/%d/stat" % sessions[0].get_pid())
+                                 .read().split()[3])
+                for session in sessions:
+                    session.close()
+                if sessions:
+                    os.kill(server, signal.SIGTERM)
+                os._exit(status)
+        try:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_exit_status(self):
+        process = aexpect.run_bg("echo output; exit 3")
+        self.assertEqual(process.get_status(), 3)
+        self.assertEqual(process.get_output(), "output\n")
+        process.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,7 @@ if ARCH in ('ppc64', 'ppc64le'):
     SIOCGIFNETMASK = 0x891B
     SIOCSIFNETMASK = 0x891C
     SIOCGIFINDEX = 0x8933
+    SIOCGIFNAME = 0x8910
     SIOCBRADDIF = 0x89a2
     SIOCBRDELIF = 0x89a3
     SIOCBRADDBR = 0x89a0
@@ -33,8 +34,25 @@ if ARCH in ('ppc64', 'ppc64le'):
     NETLINK_ROUTE = 0
     NLM_F_REQUEST = 1
     NLM_F_ACK = 4
+    NLM_F_DUMP = 0x300
     RTM_DELLINK = 17
+    RTM_NEWROUTE = 24
+    RTM_GETROUTE = 26
+    RTM_NEWNEIGH = 28
+    RTM_DELNEIGH = 29
+    RTM_GETNEIGH = 30
     NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    RTMGRP_NEIGH = 0x4
+    # From linux/rtnetlink.h and linux/neighbour.h
+    RT_TABLE_MAIN = 254
+    RTA_DST = 1
+    RTA_OIF = 4
+    NDA_DST = 1
+    NDA_LLADDR = 2
+    NUD_INCOMPLETE = 0x01
+    NUD_FAILED = 0x20
+    NUD_NOARP = 0x40
     # From linux/socket.h
     AF_PACKET = 17
 else:
@@ -48,6 +66,7 @@ else:
     SIOCGIFNETMASK = 0x891B
     SIOCSIFNETMASK = 0x891C
     SIOCGIFINDEX = 0x8933
+    SIOCGIFNAME = 0x8910
     SIOCBRADDIF = 0x89a2
     SIOCBRDELIF = 0x89a3
     SIOCBRADDBR = 0x89a0
@@ -67,8 +86,25 @@ else:
     NETLINK_ROUTE = 0
     NLM_F_REQUEST = 1
     NLM_F_ACK = 4
+    NLM_F_DUMP = 0x300
     RTM_DELLINK = 17
+    RTM_NEWROUTE = 24
+    RTM_GETROUTE = 26
+    RTM_NEWNEIGH = 28
+    RTM_DELNEIGH = 29
+    RTM_GETNEIGH = 30
     NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    RTMGRP_NEIGH = 0x4
+    # From linux/rtnetlink.h and linux/neighbour.h
+    RT_TABLE_MAIN = 254
+    RTA_DST = 1
+    RTA_OIF = 4
+    NDA_DST = 1
+    NDA_LLADDR = 2
+    NUD_INCOMPLETE = 0x01
+    NUD_FAILED = 0x20
+    NUD_NOARP = 0x40
     # From linux/socket.h
     AF_PACKET = 17
 
@@ -1,12 +1,32 @@
 import urllib2
+import httplib
+import socket
 import logging
 import os
 import glob
+import time
+import zlib
+import bz2
+import hashlib
 from autotest.client import utils, test_config
 from autotest.client.shared import git, error
 import data_dir
+import hash_index
 import re
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Size of blocks read from the network during download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# How many times interrupted download is resumed before giving up
+DOWNLOAD_RETRIES = 5
+# Suffix of partially downloaded files
+PART_SUFFIX = ".part"
+
 
 def get_known_backends():
     """
@@ -228,6 +248,267 @@ def uncompress_asset(asset_info, force=False):
             utils.run(uncompress_cmd)
 
 
+def read_verified_sha1(path):
+    """
+    Get SHA1 of file recorded by write_verified_sha1().
+
+    :param path: Path to file.
+    :return: SHA1 or None if there is no record or the file was changed
+             since the record was written.
+    """
+    return hash_index.get_index().lookup(path, "sha1")
+
+
+def write_verified_sha1(path, sha1):
+    """
+    Record SHA1 of file to the hash index, so the next check of the file
+    doesn't need to read it again.
+
+    :param path: Path to file.
+    :param sha1: SHA1 of the file.
+    """
+    hash_index.get_index().record(path, sha1, "sha1")
+
+
+def get_file_sha1(path):
+    """
+    Get SHA1 of file, from the hash index if the file wasn't changed.
+
+    :param path: Path to file.
+    """
+    return hash_index.get_file_hash(path, "sha1")
+
+
+class StreamDecompressor(object):
+
+    """
+    Incremental decompressor of gzip, bzip2 and xz (if lzma module is
+    available) streams. Concatenated streams are supported.
+    """
+
+    formats = {"gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+               "bz2": bz2.BZ2Decompressor}
+    if lzma is not None:
+        formats["xz"] = lzma.LZMADecompressor
+
+    def __init__(self, fmt):
+        """
+        :param fmt: Format of compressed data, one of formats.
+        """
+        self._factory = self.formats[fmt]
+        self._obj = self._factory()
+
+    @classmethod
+    def for_file(cls, path):
+        """
+        :return: Decompressor for format of file by its extension or None.
+        """
+        fmt = path.rsplit(".", 1)[-1]
+        if fmt in cls.formats:
+            return cls(fmt)
+        return None
+
+    def decompress(self, data):
+        """
+        :param data: Next block of compressed data.
+        :return: Decompressed data.
+        """
+        out = []
+        while data:
+            try:
+                out.append(self._obj.decompress(data))
+            except EOFError:
+                # bzip2 stream is finished, data belongs to the next one.
+                self._obj = self._factory()
+                continue
+            data = self._obj.unused_data
+            if data:
+                self._obj = self._factory()
+        return "".join(out)
+
+
+class StreamDownload(object):
+
+    """
+    Download file by blocks which are hashed (SHA1) and optionally
+    decompressed on the fly. Interrupted download is resumed by HTTP range
+    request, also when it's started again later (partial data are kept in
+    destination.part).
+    """
+
+    def __init__(self, url, destination, destination_uncompressed=None,
+                 title=None, retries=DOWNLOAD_RETRIES,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        :param url: URL (or local path) of file.
+        :param destination: Where the file will be stored.
+        :param destination_uncompressed: If provided and format of file
+                is supported by StreamDecompressor, uncompressed data are
+                stored there during download.
+        :param title: Title of file for log messages.
+        :param retries: How many times download is resumed after failure.
+        :param chunk_size: Size of blocks read from network.
+        """
+        if "://" not in url:
+            url = "file://" + os.path.abspath(url)
+        self.url = url
+        self.destination = destination
+        self.destination_uncompressed = destination_uncompressed
+        self.title = title or os.path.basename(destination)
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.part = destination + PART_SUFFIX
+        self.sha1 = None
+        self.uncompressed = False
+        self._hasher = None
+        self._decompressor = None
+        self._out = None
+        self._offset = 0
+        self._size = None
+        self._last_log = 0
+
+    def _start(self):
+        """
+        Prepare hash (and decompressor) for data which are already
+        downloaded in part file.
+        """
+        self._hasher = hashlib.sha1()
+        self._offset = 0
+        if os.path.isfile(self.part):
+            part = open(self.part, "rb")
+            try:
+                while True:
+                    data = part.read(self.chunk_size)
+                    if not data:
+                        break
+                    self._hasher.update(data)
+                    self._offset += len(data)
+            finally:
+                part.close()
+        if self._offset:
+            logging.info("Resuming download of %s from %d bytes", self.title,
+                         self._offset)
+        self._close_out()
+        self._decompressor = None
+        # Decompressor state can't be restored for old partial data.
+        if self.destination_uncompressed is not None and not self._offset:
+            self._decompressor = StreamDecompressor.for_file(self.destination)
+            if self._decompressor is not None:
+                self._out = open(self.destination_uncompressed + PART_SUFFIX,
+                                 "wb")
+
+    def _close_out(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+    def _restart(self):
+        """
+        Server doesn't support ranges, download from the beginning.
+        """
+        logging.info("Server doesn't support resume of %s, downloading it "
+                     "from the beginning", self.title)
+        os.remove(self.part)
+        self._start()
+
+    def _log_progress(self):
+        if time.time() - self._last_log < 10:
+            return
+        self._last_log = time.time()
+        if self._size:
+            logging.info("Downloading %s: %d%% (%d/%d MB)", self.title,
+                         self._offset * 100 / self._size,
+                         self._offset >> 20, self._size >> 20)
+        else:
+            logging.info("Downloading %s: %d MB", self.title,
+                         self._offset >> 20)
+
+    def _fetch(self):
+        """
+        Download data from current offset to the end of file.
+        """
+        request = urllib2.Request(self.url)
+        if self._offset:
+            request.add_header("Range", "bytes=%d-" % self._offset)
+        response = urllib2.urlopen(request)
+        try:
+            if self._offset and response.getcode() != 206:
+                self._restart()
+            length = response.info().getheader("Content-Length")
+            if length is not None:
+                self._size = self._offset + int(length)
+            part = open(self.part, "ab")
+            try:
+                while True:
+                    data = response.read(self.chunk_size)
+                    if not data:
+                        break
+                    part.write(data)
+                    self._hasher.update(data)
+                    if self._decompressor is not None:
+                        self._out.write(self._decompressor.decompress(data))
+                    self._offset += len(data)
+                    self._log_progress()
+            finally:
+                part.close()
+        finally:
+            response.close()
+        if self._size is not None and self._offset < self._size:
+            raise IOError("Connection closed after %d of %d bytes" %
+                          (self._offset, self._size))
+
+    def run(self):
+        """
+        Download the file.
+
+        :return: SHA1 of downloaded file.
+        """
+        logging.info("Downloading %s from %s", self.title, self.url)
+        self._start()
+        attempt = 0
+        while True:
+            try:
+                self._fetch()
+                break
+            except (urllib2.URLError, httplib.HTTPException, socket.error,
+                    IOError), e:
+                if isinstance(e, urllib2.HTTPError) and e.code == 416:
+                    # Part file is complete or longer than the file.
+                    self._restart()
+                attempt += 1
+                if attempt > self.retries:
+                    self._close_out()
+                    raise
+                logging.warning("Download of %s interrupted at %d bytes "
+                                "(%s), resuming", self.title, self._offset, e)
+                time.sleep(min(2 ** attempt, 30))
+        os.rename(self.part, self.destination)
+        self.sha1 = self._hasher.hexdigest()
+        write_verified_sha1(self.destination, self.sha1)
+        if self._out is not None:
+            self._close_out()
+            os.rename(self.destination_uncompressed + PART_SUFFIX,
+                      self.destination_uncompressed)
+            self.uncompressed = True
+        logging.info("Downloaded %s (%d MB)", self.title, self._offset >> 20)
+        return self.sha1
+
+
+def _download_asset_file(asset_info):
+    """
+    Download asset file, decompress it on the fly when possible.
+
+    :return: StreamDownload object with sha1 and uncompressed attributes.
+    """
+    destination_uncompressed = None
+    if asset_info.get('uncompress_cmd') is None:
+        destination_uncompressed = asset_info.get('destination_uncompressed')
+    download = StreamDownload(asset_info['url'], asset_info['destination'],
+                              destination_uncompressed, asset_info['title'])
+    download.run()
+    return download
+
+
 def download_file(asset_info, interactive=False, force=False):
     """
     Verifies if file that can be find on url is on destination with right hash.
@@ -240,12 +521,12 @@ def download_file(asset_info, interactive=False, force=False):
     file_ok = False
     problems_ignored = False
     had_to_download = False
+    uncompressed = False
     sha1 = None
 
     url = asset_info['url']
     sha1_url = asset_info['sha1_url']
     destination = asset_info['destination']
-    title = asset_info['title']
 
     if sha1_url is not None:
         try:
@@ -270,9 +551,12 @@ def download_file(asset_info, interactive=False, force=False):
         else:
             answer = 'y'
         if answer == 'y':
-            utils.interactive_download(
-                url, destination, "Downloading %s" % title)
+            download = _download_asset_file(asset_info)
             had_to_download = True
+            uncompressed = download.uncompressed
+            if sha1 is not None and download.sha1 != sha1:
+                logging.error("Downloaded %s has wrong SHA1 sum: %s",
+                              destination, download.sha1)
         else:
             logging.warning("Missing file %s", destination)
     else:
@@ -283,7 +567,7 @@ def download_file(asset_info, interactive=False, force=False):
             answer = 'y'
 
         if answer == 'y':
-            actual_sha1 = utils.hash_file(destination, method='sha1')
+            actual_sha1 = get_file_sha1(destination)
             if actual_sha1 != sha1:
                 logging.info("Actual SHA1 sum: %s", actual_sha1)
                 if interactive:
@@ -295,9 +579,9 @@ def download_file(asset_info, interactive=False, force=False):
                 if answer == 'y':
                     logging.info("Updating image to the latest available...")
                     while not file_ok:
-                        utils.interactive_download(url, destination, title)
-                        sha1_post_download = utils.hash_file(destination,
-                                                             method='sha1')
+                        download = _download_asset_file(asset_info)
+                        sha1_post_download = download.sha1
+                        uncompressed = download.uncompressed
                         had_to_download = True
                         if sha1_post_download != sha1:
                             logging.error("Actual SHA1 sum: %s", actual_sha1)
@@ -329,7 +613,8 @@ def download_file(asset_info, interactive=False, force=False):
         if not problems_ignored:
             logging.info("%s present, with proper checksum", destination)
 
-    uncompress_asset(asset_info=asset_info, force=force or had_to_download)
+    if not uncompressed:  # Not done during download
+        uncompress_asset(asset_info=asset_info, force=force or had_to_download)
 
 
 def download_asset(asset, interactive=True, restore_image=False):
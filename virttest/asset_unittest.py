@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+import common
+import asset
+import hash_index
+import http_server
+
+
+class TruncatingRequestHandler(http_server.HTTPRequestHandler):
+
+    """
+    Sends only part of the file for the first request.
+    """
+
+    truncate = 0
+
+    def copyfile(self, source, outputfile):
+        if TruncatingRequestHandler.truncate:
+            outputfile.write(source.read(TruncatingRequestHandler.truncate))
+            TruncatingRequestHandler.truncate = 0
+            return
+        http_server.HTTPRequestHandler.copyfile(self, source, outputfile)
+
+    def log_message(self, fmt, *args):
+        self.server.requests.append(self.headers.get("Range"))
+
+
+class StreamDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        hash_index.INDEX_PATH = os.path.join(self.tmpdir, "hash_index.json")
+        self.srvdir = os.path.join(self.tmpdir, "srv")
+        os.mkdir(self.srvdir)
+        self.data = os.urandom(300000) + "x" * 300000
+        self.src = os.path.join(self.srvdir, "image.gz")
+        gz = gzip.open(self.src, "wb")
+        gz.write(self.data)
+        gz.close()
+        self.compressed = open(self.src, "rb").read()
+        self.sha1 = hashlib.sha1(self.compressed).hexdigest()
+        self.dst = os.path.join(self.tmpdir, "image.gz")
+        self.dst_uncompressed = os.path.join(self.tmpdir, "image")
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                TruncatingRequestHandler)
+        self.server.cwd = self.srvdir
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/image.gz" % self.server.server_port
+
+    def tearDown(self):
+        TruncatingRequestHandler.truncate = 0
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        hash_index.INDEX_PATH = None
+
+    def _download(self):
+        download = asset.StreamDownload(self.url, self.dst,
+                                        self.dst_uncompressed, retries=2,
+                                        chunk_size=65536)
+        self.assertEqual(download.run(), self.sha1)
+        self.assertEqual(open(self.dst, "rb").read(), self.compressed)
+        self.assertFalse(os.path.exists(self.dst + asset.PART_SUFFIX))
+        return download
+
+    def test_download_uncompress(self):
+        download = self._download()
+        self.assertTrue(download.uncompressed)
+        self.assertEqual(open(self.dst_uncompressed, "rb").read(), self.data)
+        self.assertEqual(asset.read_verified_sha1(self.dst), self.sha1)
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume_part_file(self):
+        part = open(self.dst + asset.PART_SUFFIX, "wb")
+        part.write(self.compressed[:100000])
+        part.close()
+        download = self._download()
+        self.assertFalse(download.uncompressed)
+        self.assertEqual(self.server.requests, ["bytes=100000-"])
+
+    def test_resume_interrupted(self):
+        TruncatingRequestHandler.truncate = 200000
+        download = self._download()
+        self.assertTrue(download.uncompressed)
+        self.assertEqual(open(self.dst_uncompressed, "rb").read(), self.data)
+        self.assertEqual(self.server.requests, [None, "bytes=200000-"])
+
+    def test_verified_sha1(self):
+        path = os.path.join(self.tmpdir, "file")
+        open(path, "w").write("data")
+        self.assertEqual(asset.read_verified_sha1(path), None)
+        sha1 = asset.get_file_sha1(path)
+        self.assertEqual(sha1, hashlib.sha1("data").hexdigest())
+        self.assertEqual(asset.read_verified_sha1(path), sha1)
+        open(path, "a").write("changed")
+        self.assertEqual(asset.read_verified_sha1(path), None)
+
+    def test_decompressor_concatenated(self):
+        parts = []
+        for data in ("first", "second"):
+            path = os.path.join(self.tmpdir, "part.gz")
+            gz = gzip.open(path, "wb")
+            gz.write(data)
+            gz.close()
+            parts.append(open(path, "rb").read())
+        stream = "".join(parts)
+        decompressor = asset.StreamDecompressor("gz")
+        out = "".join(decompressor.decompress(stream[i:i + 7])
+                      for i in range(0, len(stream), 7))
+        self.assertEqual(out, "firstsecond")
+
+
+if __name__ == '__main__':
+    unittest.main()
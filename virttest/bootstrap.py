@@ -3,6 +3,9 @@ import os
 import glob
 import shutil
 import sys
+import json
+import hashlib
+from multiprocessing.pool import ThreadPool
 from autotest.client.shared import logging_manager, error
 from autotest.client import utils
 import utils_misc
@@ -55,6 +58,9 @@ last_subtest = {'qemu': ['shutdown'],
 
 test_filter = ['__init__', 'cfg', 'dropin.py']
 
+# Number of threads scanning test provider directories
+SCAN_THREADS = 8
+
 
 def get_guest_os_info_list(test_name, guest_os):
     """
@@ -147,6 +153,171 @@ def verify_mandatory_programs(t_type, guest_os):
         raise ValueError('Missing (cmds/includes): %s' % " ".join(failures))
 
 
+class ConfigManifest(object):
+
+    """
+    Record of input files of a generated config file (size, mtime, SHA1 and
+    data derived from the file). Generation is skipped when neither the
+    inputs nor the output changed since the manifest was saved. Files with
+    new mtime but the same content (e.g. after git checkout) are considered
+    unchanged.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: Name of manifest, unique for every generated file.
+        """
+        self.path = os.path.join(data_dir.get_tmp_dir(),
+                                 "%s.manifest" % name)
+        self.files = {}
+        self.extra = None
+        self.output = None
+        self._current = {}
+        try:
+            manifest_file = open(self.path)
+            try:
+                data = json.load(manifest_file)
+            finally:
+                manifest_file.close()
+            self.files = data["files"]
+            self.extra = data["extra"]
+            self.output = data["output"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def _hash_file(path):
+        config_file = open(path, 'rb')
+        try:
+            return hashlib.sha1(config_file.read()).hexdigest()
+        finally:
+            config_file.close()
+
+    def _entry(self, path):
+        """
+        :return: Entry of file in its current state. Entry from manifest is
+                 reused when the file is unchanged.
+        """
+        if path in self._current:
+            return self._current[path]
+        st = os.stat(path)
+        old = self.files.get(path)
+        if (old is not None and old["size"] == st.st_size and
+                old["mtime"] == st.st_mtime):
+            entry = old
+        else:
+            sha1 = self._hash_file(path)
+            if old is not None and old["sha1"] == sha1:
+                entry = old
+                entry["mtime"] = st.st_mtime
+            else:
+                entry = {"sha1": sha1}
+            entry["size"] = st.st_size
+            entry["mtime"] = st.st_mtime
+        self._current[path] = entry
+        return entry
+
+    def _unchanged(self, path):
+        return self._entry(path) is self.files.get(path)
+
+    def is_current(self, inputs, extra, output):
+        """
+        :param inputs: List of input files.
+        :param extra: Other (JSON serializable) inputs of generation.
+        :param output: Path of generated file.
+        :return: True if output was generated from the same inputs.
+        """
+        if extra != self.extra or self.output is None:
+            return False
+        try:
+            st = os.stat(output)
+        except OSError:
+            return False
+        if [st.st_size, st.st_mtime] != self.output:
+            return False
+        if set(inputs) != set(self.files):
+            return False
+        for path in inputs:
+            if not self._unchanged(path):
+                logging.debug("%s changed, %s will be regenerated", path,
+                              output)
+                return False
+        return True
+
+    def get_data(self, path, name, func):
+        """
+        Get data derived from file, computed again only if the file changed.
+
+        :param path: Path of input file.
+        :param name: Name of data.
+        :param func: Function which computes data from path.
+        """
+        entry = self._entry(path)
+        if name not in entry:
+            entry[name] = func(path)
+        return entry[name]
+
+    def save(self, inputs, extra, output):
+        """
+        Save state of inputs and output after generation.
+        """
+        st = os.stat(output)
+        data = {"files": dict((path, self._entry(path)) for path in inputs),
+                "extra": extra,
+                "output": [st.st_size, st.st_mtime]}
+        tmp_path = "%s.%d" % (self.path, os.getpid())
+        manifest_file = open(tmp_path, 'w')
+        try:
+            json.dump(data, manifest_file)
+        finally:
+            manifest_file.close()
+        os.rename(tmp_path, self.path)
+        self.files = data["files"]
+        self.extra = extra
+        self.output = data["output"]
+
+
+def scan_subdirs(subdirs, globstr, filterlist):
+    """
+    Find files matching globstr in all subdirs (and their subdirectories)
+    in parallel threads.
+
+    :return: List of files.
+    """
+    if not subdirs:
+        return []
+    pool = ThreadPool(min(SCAN_THREADS, len(subdirs)))
+    try:
+        results = pool.map(lambda subdir: data_dir.SubdirGlobList(subdir,
+                                                                  globstr,
+                                                                  filterlist),
+                           subdirs)
+    finally:
+        pool.close()
+        pool.join()
+    file_list = []
+    for result in results:
+        file_list += result
+    return file_list
+
+
+def get_cfg_test_types(cfg_path):
+    """
+    :return: Values of all type parameters defined in config file.
+    """
+    types = []
+    cfg_file = open(cfg_path, 'r')
+    for line in cfg_file.readlines():
+        line = line.strip()
+        if line.startswith("type"):
+            cartesian_parser = cartesian_config.Parser()
+            cartesian_parser.parse_string(line)
+            td = cartesian_parser.get_dicts().next()
+            types += td['type'].split(" ")
+    cfg_file.close()
+    return types
+
+
 def write_subtests_files(config_file_list, output_file_object, test_type=None):
     """
     Writes a collection of individual subtests config file to one output file
@@ -249,15 +420,44 @@ def get_directory_structure(rootdir, guest_file):
         previous_indent = indent
 
 
-def create_guest_os_cfg(t_type):
+def create_guest_os_cfg(t_type, force=False):
+    """
+    Generate guest-os.cfg of backend from shared/cfg/guest-os tree.
+
+    :param t_type: Backend type, such as 'qemu'.
+    :param force: Generate file even if the tree wasn't changed.
+    :return: True if the file was generated.
+    """
     root_dir = data_dir.get_root_dir()
     guest_os_cfg_dir = os.path.join(root_dir, 'shared', 'cfg', 'guest-os')
     guest_os_cfg_path = data_dir.get_backend_cfg_path(t_type, 'guest-os.cfg')
+
+    inputs = []
+    dirs = []
+    for path, subdirs, files in os.walk(guest_os_cfg_dir):
+        dirs += [os.path.join(path, d) for d in subdirs]
+        inputs += [os.path.join(path, f) for f in files]
+    dirs.sort()
+    manifest = ConfigManifest("guest-os-%s" % t_type)
+    if not force and manifest.is_current(inputs, dirs, guest_os_cfg_path):
+        logging.debug("%s is up to date", guest_os_cfg_path)
+        return False
+
     guest_os_cfg_file = open(guest_os_cfg_path, 'w')
     get_directory_structure(guest_os_cfg_dir, guest_os_cfg_file)
+    guest_os_cfg_file.close()
+    manifest.save(inputs, dirs, guest_os_cfg_path)
+    return True
+
 
+def create_subtests_cfg(t_type, force=False):
+    """
+    Generate subtests.cfg of backend from configs of test providers.
 
-def create_subtests_cfg(t_type):
+    :param t_type: Backend type, such as 'qemu'.
+    :param force: Generate file even if no input was changed.
+    :return: True if the file was generated.
+    """
     root_dir = data_dir.get_root_dir()
 
     specific_test_list = []
@@ -269,13 +469,9 @@ def create_subtests_cfg(t_type):
     for specific_provider in provider_names_specific:
         provider_info_specific.append(asset.get_test_provider_info(specific_provider))
 
-    for subdir in specific_subdirs:
-        specific_test_list += data_dir.SubdirGlobList(subdir,
-                                                      '*.py',
-                                                      test_filter)
-        specific_file_list += data_dir.SubdirGlobList(subdir,
-                                                      '*.cfg',
-                                                      config_filter)
+    specific_test_list = scan_subdirs(specific_subdirs, '*.py', test_filter)
+    specific_file_list = scan_subdirs(specific_subdirs, '*.cfg',
+                                      config_filter)
 
     shared_test_list = []
     shared_file_list = []
@@ -287,13 +483,23 @@ def create_subtests_cfg(t_type):
         provider_info_shared.append(asset.get_test_provider_info(shared_provider))
 
     if not t_type == 'lvsb':
-        for subdir in shared_subdirs:
-            shared_test_list += data_dir.SubdirGlobList(subdir,
-                                                        '*.py',
-                                                        test_filter)
-            shared_file_list += data_dir.SubdirGlobList(subdir,
-                                                        '*.cfg',
-                                                        config_filter)
+        shared_test_list = scan_subdirs(shared_subdirs, '*.py', test_filter)
+        shared_file_list = scan_subdirs(shared_subdirs, '*.cfg',
+                                        config_filter)
+
+    subtests_cfg = os.path.join(root_dir, 'backends', t_type, 'cfg',
+                                'subtests.cfg')
+    dropin_dir = os.path.join(data_dir.get_root_dir(), "dropin")
+    inputs = (glob.glob(os.path.join(data_dir.get_test_providers_dir(),
+                                     '*.ini')) +
+              specific_test_list + specific_file_list +
+              shared_test_list + shared_file_list)
+    extra = {"dropin": sorted(os.listdir(dropin_dir)),
+             "tmp_dir": data_dir.get_tmp_dir()}
+    manifest = ConfigManifest("subtests-%s" % t_type)
+    if not force and manifest.is_current(inputs, extra, subtests_cfg):
+        logging.debug("%s is up to date", subtests_cfg)
+        return False
 
     all_specific_test_list = []
     for test in specific_test_list:
@@ -339,18 +545,10 @@ def create_subtests_cfg(t_type):
                 provider_name = p['name']
                 break
 
-        shared_file_obj = open(shared_file, 'r')
-        for line in shared_file_obj.readlines():
-            line = line.strip()
-            if line.startswith("type"):
-                cartesian_parser = cartesian_config.Parser()
-                cartesian_parser.parse_string(line)
-                td = cartesian_parser.get_dicts().next()
-                values = td['type'].split(" ")
-                for value in values:
-                    if t_type not in non_dropin_tests:
-                        non_dropin_tests.append("%s.%s" %
-                                                (provider_name, value))
+        values = manifest.get_data(shared_file, "types", get_cfg_test_types)
+        for value in values:
+            if t_type not in non_dropin_tests:
+                non_dropin_tests.append("%s.%s" % (provider_name, value))
 
         shared_file_name = os.path.basename(shared_file)
         shared_file_name = shared_file_name.split(".")[0]
@@ -374,18 +572,10 @@ def create_subtests_cfg(t_type):
                 provider_name = p['name']
                 break
 
-        shared_file_obj = open(shared_file, 'r')
-        for line in shared_file_obj.readlines():
-            line = line.strip()
-            if line.startswith("type"):
-                cartesian_parser = cartesian_config.Parser()
-                cartesian_parser.parse_string(line)
-                td = cartesian_parser.get_dicts().next()
-                values = td['type'].split(" ")
-                for value in values:
-                    if value not in non_dropin_tests:
-                        non_dropin_tests.append("%s.%s" %
-                                                (provider_name, value))
+        values = manifest.get_data(shared_file, "types", get_cfg_test_types)
+        for value in values:
+            if value not in non_dropin_tests:
+                non_dropin_tests.append("%s.%s" % (provider_name, value))
 
         shared_file_name = os.path.basename(shared_file)
         shared_file_name = shared_file_name.split(".")[0]
@@ -422,7 +612,7 @@ def create_subtests_cfg(t_type):
         dropin_file_list.append([provider, autogen_cfg_path])
 
     dropin_file_list_2 = []
-    dropin_tests = os.listdir(os.path.join(data_dir.get_root_dir(), "dropin"))
+    dropin_tests = extra["dropin"]
     dropin_cfg_path = os.path.join(tmp_dir, 'dropin.cfg')
     dropin_cfg_file = open(dropin_cfg_path, 'w')
     dropin_cfg_file.write("# Auto generated snippet for dropin tests\n")
@@ -439,8 +629,6 @@ def create_subtests_cfg(t_type):
     dropin_cfg_file.close()
     dropin_file_list_2.append(['io-github-autotest-qemu', dropin_cfg_path])
 
-    subtests_cfg = os.path.join(root_dir, 'backends', t_type, 'cfg',
-                                'subtests.cfg')
     subtests_file = open(subtests_cfg, 'w')
     subtests_file.write(
         "# Do not edit, auto generated file from subtests config\n")
@@ -454,6 +642,8 @@ def create_subtests_cfg(t_type):
     write_subtests_files(last_subtest_file, subtests_file)
 
     subtests_file.close()
+    manifest.save(inputs, extra, subtests_cfg)
+    return True
 
 
 def create_config_files(test_dir, shared_dir, interactive, step=None,
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import common
+from autotest.client.shared.test_utils import mock
+from virttest import bootstrap
+from virttest import data_dir
+from virttest import asset
+
+
+class ConfigManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root_dir = os.path.join(self.tmpdir, "root")
+        self.tmp_dir = os.path.join(self.tmpdir, "tmp")
+        self.providers_dir = os.path.join(self.root_dir, "test-providers.d")
+        os.makedirs(self.tmp_dir)
+        os.makedirs(os.path.join(self.root_dir, "backends", "qemu", "cfg"))
+        os.makedirs(os.path.join(self.root_dir, "dropin"))
+        os.makedirs(self.providers_dir)
+        self.write(os.path.join(self.root_dir, "dropin", "README"), "")
+        self.providers = {"qemu": self.make_provider("qemu_tests", "qemu"),
+                          "generic": self.make_provider("generic_tests",
+                                                        "generic")}
+        self.subtests_cfg = os.path.join(self.root_dir, "backends", "qemu",
+                                         "cfg", "subtests.cfg")
+        self.guest_os_cfg = os.path.join(self.root_dir, "backends", "qemu",
+                                         "cfg", "guest-os.cfg")
+        self.parsed = []
+
+        def get_cfg_test_types(cfg_path):
+            self.parsed.append(cfg_path)
+            return self.get_cfg_test_types(cfg_path)
+
+        def get_test_provider_info(name):
+            for provider in self.providers.values():
+                if provider["name"] == name:
+                    return provider
+            raise ValueError(name)
+
+        self.get_cfg_test_types = bootstrap.get_cfg_test_types
+        self.god = mock.mock_god()
+        self.god.stub_with(data_dir, "get_root_dir", lambda: self.root_dir)
+        self.god.stub_with(data_dir, "get_tmp_dir", lambda: self.tmp_dir)
+        self.god.stub_with(data_dir, "get_test_providers_dir",
+                           lambda: self.providers_dir)
+        self.god.stub_with(data_dir, "get_backend_cfg_path",
+                           lambda t_type, name: os.path.join(
+                               self.root_dir, "backends", t_type, "cfg",
+                               name))
+        self.god.stub_with(asset, "get_test_provider_subdirs",
+                           lambda backend: [os.path.join(
+                               self.providers[backend]["backends"][backend]
+                               ["path"], "tests")])
+        self.god.stub_with(asset, "get_test_provider_names",
+                           lambda backend: [self.providers[backend]["name"]])
+        self.god.stub_with(asset, "get_test_provider_info",
+                           get_test_provider_info)
+        self.god.stub_with(bootstrap, "config_filter", ["__init__"])
+        self.god.stub_with(bootstrap, "get_cfg_test_types",
+                           get_cfg_test_types)
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def write(path, content, mtime=None):
+        out_file = open(path, "w")
+        out_file.write(content)
+        out_file.close()
+        if mtime is None:
+            # Make the change visible on file systems with coarse mtime
+            mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+
+    def make_provider(self, name, backend):
+        path = os.path.join(self.root_dir, "providers", name, backend)
+        os.makedirs(os.path.join(path, "tests", "cfg"))
+        self.write(os.path.join(self.providers_dir, "%s.ini" % name), "")
+        self.add_test(os.path.join(path, "tests"), "%s_a" % name)
+        return {"name": name, "backends": {backend: {"path": path}}}
+
+    def add_test(self, tests_dir, test_type):
+        self.write(os.path.join(tests_dir, "%s.py" % test_type), "")
+        self.write(os.path.join(tests_dir, "cfg", "%s.cfg" % test_type),
+                   "- %s:\n    type = %s\n" % (test_type, test_type))
+
+    def provider_tests_dir(self, backend):
+        return os.path.join(self.providers[backend]["backends"][backend]
+                            ["path"], "tests")
+
+    def read_subtests_cfg(self):
+        return open(self.subtests_cfg).read()
+
+    def test_unchanged(self):
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        self.assertEqual(len(self.parsed), 2)
+        content = self.read_subtests_cfg()
+        self.assertTrue("qemu_tests.qemu_tests_a" in content)
+        self.assertTrue("generic_tests.generic_tests_a" in content)
+        self.parsed = []
+        self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(self.read_subtests_cfg(), content)
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu", force=True))
+
+    def test_changed_provider(self):
+        bootstrap.create_subtests_cfg("qemu")
+        self.parsed = []
+        cfg_path = os.path.join(self.provider_tests_dir("generic"), "cfg",
+                                "generic_tests_a.cfg")
+        self.write(cfg_path, "- generic_tests_a:\n    type = generic_tests_a"
+                   "\n    changed = yes\n")
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        # Types of the unchanged provider are taken from the manifest
+        self.assertEqual(self.parsed, [cfg_path])
+        self.assertTrue("changed = yes" in self.read_subtests_cfg())
+        self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+
+    def test_touched(self):
+        bootstrap.create_subtests_cfg("qemu")
+        self.parsed = []
+        cfg_path = os.path.join(self.provider_tests_dir("qemu"), "cfg",
+                                "qemu_tests_a.cfg")
+        content = open(cfg_path).read()
+        self.write(cfg_path, content)
+        self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+        self.assertEqual(self.parsed, [])
+        # The new mtime is recorded when the manifest is saved
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu", force=True))
+        manifest = bootstrap.ConfigManifest("subtests-qemu")
+        self.assertEqual(manifest.files[cfg_path]["mtime"],
+                         os.stat(cfg_path).st_mtime)
+
+    def test_added_file(self):
+        bootstrap.create_subtests_cfg("qemu")
+        self.add_test(self.provider_tests_dir("qemu"), "qemu_tests_b")
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        self.assertTrue("qemu_tests.qemu_tests_b" in self.read_subtests_cfg())
+        # A test without config file is a drop-in test
+        self.write(os.path.join(self.provider_tests_dir("generic"),
+                                "generic_c.py"), "")
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        self.assertTrue("type = generic_c" in self.read_subtests_cfg())
+        self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+
+    def test_removed_file(self):
+        self.add_test(self.provider_tests_dir("qemu"), "qemu_tests_b")
+        bootstrap.create_subtests_cfg("qemu")
+        self.assertTrue("qemu_tests.qemu_tests_b" in self.read_subtests_cfg())
+        tests_dir = self.provider_tests_dir("qemu")
+        os.unlink(os.path.join(tests_dir, "cfg", "qemu_tests_b.cfg"))
+        os.unlink(os.path.join(tests_dir, "qemu_tests_b.py"))
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        self.assertFalse("qemu_tests_b" in self.read_subtests_cfg())
+
+    def test_changed_output(self):
+        bootstrap.create_subtests_cfg("qemu")
+        self.write(self.subtests_cfg, "# edited\n")
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        os.unlink(self.subtests_cfg)
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+
+    def test_bad_manifest(self):
+        bootstrap.create_subtests_cfg("qemu")
+        manifest_path = bootstrap.ConfigManifest("subtests-qemu").path
+        self.assertTrue(os.path.isfile(manifest_path))
+        os.unlink(manifest_path)
+        self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+        for content in ("{\"files\": {", "[]", "{}", "null"):
+            self.write(manifest_path, content)
+            self.assertTrue(bootstrap.create_subtests_cfg("qemu"))
+            self.assertFalse(bootstrap.create_subtests_cfg("qemu"))
+
+    def test_guest_os(self):
+        guest_os_dir = os.path.join(self.root_dir, "shared", "cfg",
+                                    "guest-os")
+        os.makedirs(os.path.join(guest_os_dir, "Linux"))
+        self.write(os.path.join(guest_os_dir, "Linux.cfg"), "- Linux:\n")
+        self.write(os.path.join(guest_os_dir, "Linux", "Fedora.cfg"),
+                   "- Fedora:\n")
+        self.assertTrue(bootstrap.create_guest_os_cfg("qemu"))
+        self.assertFalse(bootstrap.create_guest_os_cfg("qemu"))
+        # An empty directory changes the variants of the file
+        os.makedirs(os.path.join(guest_os_dir, "Windows"))
+        self.assertTrue(bootstrap.create_guest_os_cfg("qemu"))
+        self.write(os.path.join(guest_os_dir, "Windows", "Win7.cfg"),
+                   "- Win7:\n")
+        self.assertTrue(bootstrap.create_guest_os_cfg("qemu"))
+        self.assertTrue("Win7" in open(self.guest_os_cfg).read())
+        os.unlink(os.path.join(guest_os_dir, "Windows", "Win7.cfg"))
+        self.assertTrue(bootstrap.create_guest_os_cfg("qemu"))
+        self.assertFalse("Win7" in open(self.guest_os_cfg).read())
+        self.assertFalse(bootstrap.create_guest_os_cfg("qemu"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Incremental scanning of console logs for known messages.
+
+Console logs (serial console of VMs) grow during the whole life of the guest
+and they are checked for kernel crashes and similar messages every time the
+VM is verified. Instead of reading and matching the whole log on each check,
+the scanner remembers the offset up to which the log was already processed
+and only feeds the new bytes to stream matchers.
+
+Every pattern of a matcher is paired with a literal trigger string, which
+has to be part of the matched text. New data are searched for triggers
+with plain string search and the (expensive) regular expressions run only
+from the start of the lines holding a trigger. The text from the first
+trigger which didn't match yet (the end of the message can still be on its
+way) and the last incomplete line are carried over to the next chunk, up to
+a window size.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import re
+
+
+# Maximal size of text carried over between chunks
+WINDOW = 1 << 20
+# Size of reads of the console log
+CHUNK_SIZE = 1 << 20
+
+
+class StreamMatcher(object):
+
+    """
+    Multi-pattern matcher of a stream of text fed in chunks.
+    """
+
+    def __init__(self, patterns, flags=0, window=WINDOW):
+        """
+        :param patterns: List of (trigger, regex) tuples; trigger is a string
+                         contained in every text matched by regex.
+        :param flags: Flags of the regular expressions (re.I makes triggers
+                      case insensitive too).
+        :param window: Maximal size of text carried over between chunks.
+        """
+        self.ignorecase = bool(flags & re.I)
+        self.triggers = [trigger for trigger, _ in patterns]
+        if self.ignorecase:
+            self.triggers = [trigger.lower() for trigger in self.triggers]
+        self.regex = re.compile("|".join("(?:%s)" % regex
+                                         for _, regex in patterns), flags)
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the carried over text and all matches.
+        """
+        self.carry = ""
+        self.matches = []
+
+    def _candidates(self, buf):
+        """
+        Return sorted offsets of starts of lines holding a trigger.
+        """
+        haystack = buf
+        if self.ignorecase:
+            haystack = buf.lower()
+        starts = set()
+        for trigger in self.triggers:
+            pos = haystack.find(trigger)
+            while pos != -1:
+                starts.add(buf.rfind("\n", 0, pos) + 1)
+                pos = haystack.find(trigger, pos + 1)
+        return sorted(starts)
+
+    def feed(self, data):
+        """
+        Match the next chunk of the stream.
+
+        :param data: New text of the stream.
+        :return: List of texts matched in this chunk, they are appended to
+                 self.matches too.
+        """
+        buf = self.carry + data
+        new_start = len(self.carry)
+        found = []
+        pending = None
+        end = 0
+        for start in self._candidates(buf):
+            if start < end:
+                continue
+            match = self.regex.search(buf, start)
+            if match is None:
+                # Nothing matches after this line (yet)
+                pending = start
+                break
+            end = max(match.end(), start + 1)
+            # Matches ending in the carried over text were already reported
+            if match.end() > new_start:
+                found.append(match.group(0))
+        carry_start = buf.rfind("\n") + 1
+        if pending is not None:
+            carry_start = min(carry_start, pending)
+        self.carry = buf[max(carry_start, len(buf) - self.window):]
+        self.matches.extend(found)
+        return found
+
+
+class ConsoleScanner(object):
+
+    """
+    Scanner of a growing console log file remembering the processed offset.
+    """
+
+    def __init__(self, filename, chunk_size=CHUNK_SIZE, store=None):
+        """
+        :param filename: Path of the console log.
+        :param chunk_size: Size of reads of the log.
+        :param store: aexpect.OutputStore of the log; it is used instead of
+                      reading the file, so rotated logs are read in full.
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.store = store
+        self.offset = 0
+        self.matchers = {}
+
+    def add_matcher(self, name, matcher):
+        """
+        Register a StreamMatcher fed with the console output.
+
+        :param name: Name of the matcher.
+        :param matcher: StreamMatcher instance.
+        """
+        self.matchers[name] = matcher
+
+    def reset(self):
+        """
+        Scan the log from its beginning on the next update.
+        """
+        self.offset = 0
+        for matcher in self.matchers.values():
+            matcher.reset()
+
+    def update(self):
+        """
+        Feed the output written since the last update to all matchers.
+
+        :return: Dict of matcher name: list of new matches.
+        """
+        found = dict((name, []) for name in self.matchers)
+        if self.store is not None:
+            if self.store.size() < self.offset:
+                self.reset()
+            # Output of removed segments of rotated logs is skipped
+            self.offset = max(self.offset, self.store.start())
+            for data in self.store.iter_chunks(self.offset):
+                self.offset += len(data)
+                for name, matcher in self.matchers.items():
+                    found[name] += matcher.feed(data)
+            return found
+        try:
+            fileobj = open(self.filename, "rb")
+        except IOError:
+            return found
+        try:
+            if os.fstat(fileobj.fileno()).st_size < self.offset:
+                # The log was truncated or replaced
+                self.reset()
+            fileobj.seek(self.offset)
+            while True:
+                data = fileobj.read(self.chunk_size)
+                if not data:
+                    break
+                self.offset += len(data)
+                for name, matcher in self.matchers.items():
+                    found[name] += matcher.feed(data)
+        finally:
+            fileobj.close()
+        return found
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+import os
+import re
+import random
+import shutil
+import tempfile
+import unittest
+
+import common
+import console_scanner
+
+
+PATTERNS = [("BUG:", r"BUG:.*?---\[ end trace .*? \]---"),
+            ("trap invalid opcode", r"^[^\n]*trap invalid opcode[^\n]*\n")]
+
+CRASH = """[   10.123456] BUG: unable to handle kernel NULL pointer dereference
+[   10.123457] IP: [<ffffffff8107a9c4>] do_something+0x14/0x40
+[   10.123458] Call Trace:
+[   10.123459]  [<ffffffff8107b000>] ? other+0x10/0x20
+[   10.123460] ---[ end trace 4f6b2a1c2b1e8e21 ]---
+"""
+
+TRAP = "[   12.000000] traps: a.out[123] trap invalid opcode ip:400 sp:7f\n"
+
+
+def console_log(lines, events, seed=0):
+    """
+    Boot log like text with events inserted at random lines.
+    """
+    rand = random.Random(seed)
+    text = ["[ %10.6f] message %d of the kernel\n" % (i / 1000.0, i)
+            for i in xrange(lines)]
+    for event in events:
+        text.insert(rand.randint(0, len(text)), event)
+    return "".join(text)
+
+
+class StreamMatcherTest(unittest.TestCase):
+
+    def test_chunks(self):
+        log = console_log(2000, [CRASH, TRAP, TRAP.replace("123", "456")])
+        expected = re.findall("|".join("(?:%s)" % _[1] for _ in PATTERNS),
+                              log, re.DOTALL | re.MULTILINE | re.I)
+        self.assertEqual(len(expected), 3)
+        rand = random.Random(1)
+        for chunk_max in (1, 7, 64, 4096, len(log)):
+            matcher = console_scanner.StreamMatcher(
+                PATTERNS, re.DOTALL | re.MULTILINE | re.I)
+            pos = 0
+            while pos < len(log):
+                size = rand.randint(1, chunk_max)
+                matcher.feed(log[pos:pos + size])
+                pos += size
+            self.assertEqual(matcher.matches, expected)
+            self.assertTrue(len(matcher.carry) < 100)
+
+    def test_window(self):
+        matcher = console_scanner.StreamMatcher(PATTERNS, re.DOTALL,
+                                                window=1000)
+        self.assertEqual(matcher.feed("BUG: soft lockup\n"), [])
+        self.assertEqual(matcher.carry, "BUG: soft lockup\n")
+        self.assertEqual(matcher.feed("---[ end trace 1 ]---\n"),
+                         ["BUG: soft lockup\n---[ end trace 1 ]---"])
+        # The end of the message came too late
+        matcher.feed("BUG: soft lockup\n")
+        matcher.feed("x" * 2000 + "\n")
+        self.assertEqual(len(matcher.carry), 1000)
+        matcher.feed("---[ end trace 2 ]---\n")
+        self.assertEqual(len(matcher.matches), 1)
+
+
+class ConsoleScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "serial.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_update(self):
+        scanner = console_scanner.ConsoleScanner(self.path, chunk_size=100)
+        scanner.add_matcher("crash", console_scanner.StreamMatcher(
+            PATTERNS[:1], re.DOTALL))
+        scanner.add_matcher("trap", console_scanner.StreamMatcher(
+            PATTERNS[1:], re.MULTILINE))
+        self.assertEqual(scanner.update(), {"crash": [], "trap": []})
+        log = open(self.path, "w")
+        log.write(console_log(100, [TRAP]) + CRASH[:200])
+        log.flush()
+        self.assertEqual(scanner.update(), {"crash": [], "trap": [TRAP]})
+        self.assertEqual(scanner.offset, os.path.getsize(self.path))
+        log.write(CRASH[200:])
+        log.close()
+        self.assertEqual(scanner.update(), {"crash": [CRASH[15:-1]],
+                                            "trap": []})
+        self.assertEqual(scanner.matchers["trap"].matches, [TRAP])
+        # New log with the same name
+        open(self.path, "w").write(TRAP)
+        self.assertEqual(scanner.update()["trap"], [TRAP])
+        self.assertEqual(scanner.matchers["crash"].matches, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
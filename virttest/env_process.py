@@ -27,6 +27,7 @@ import utils_net
 import utils_disk
 import nfs
 import libvirt_vm
+import utils_libguestfs
 from autotest.client import local_host
 
 
@@ -335,6 +336,7 @@ def postprocess_vm(test, params, env, name):
         return
 
     # Close all SSH sessions that might be active to this VM
+    vm.invalidate_sessions()
     for s in vm.remote_sessions[:]:
         try:
             s.close()
@@ -555,6 +557,13 @@ def preprocess(test, params, env):
             except ValueError, msg:
                 raise error.TestNAError(msg.message)
 
+    # Run the children of aexpect sessions by a single shared server
+    aexpect.SHARED_SERVER = (params.get("aexpect_shared_server",
+                                        "no") == "yes")
+    # Reuse launched guestfish appliances in libguestfs helpers
+    utils_libguestfs.GUESTFISH_POOL = (params.get("libguestfs_pool",
+                                                  "no") == "yes")
+
     vm_type = params.get('vm_type')
 
     setup_pb = False
@@ -840,6 +849,9 @@ def postprocess(test, params, env):
     error.context("postprocessing")
     err = ""
 
+    # Don't leave appliances running on the images
+    utils_libguestfs.close_pooled_sessions()
+
     # Postprocess all VMs and images
     try:
         process(test, params, env, postprocess_image, postprocess_vm,
@@ -957,6 +969,10 @@ def postprocess(test, params, env):
     # Terminate the tcpdump thread
     env.stop_tcpdump()
 
+    # Stop SSH connection masters, guests may be rebooted or destroyed
+    # before they are used again
+    remote.close_ssh_masters()
+
     # Kill all aexpect tail threads
     aexpect.kill_tail_threads()
 
@@ -0,0 +1,250 @@
+"""
+Persistent index of file hashes.
+
+Hashing big files (install ISOs, images) means reading them completely, so
+computed hashes are stored together with identity of the file (device,
+inode, size and mtime) and reused while the file stays unchanged. The index
+is a JSON file in the data dir shared by all test workers. Readers never
+block, updates are serialized by a lock file and the index is replaced by
+atomic rename.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import json
+import fcntl
+import logging
+from autotest.client import utils
+import data_dir
+
+
+INDEX_BASENAME = "hash_index.json"
+# Path of the index, None means INDEX_BASENAME in the data dir
+INDEX_PATH = None
+
+
+def get_index_path():
+    if INDEX_PATH is not None:
+        return INDEX_PATH
+    return os.path.join(data_dir.get_data_dir(), INDEX_BASENAME)
+
+
+def file_id(st):
+    """
+    :param st: Result of os.stat() of file.
+    :return: Identity of file content (device, inode, size, mtime in ns).
+    """
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return [st.st_dev, st.st_ino, st.st_size, mtime_ns]
+
+
+def hash_name(method, size=None):
+    """
+    :return: Name of hash of the first size bytes (or whole file).
+    """
+    if size:
+        return "%s_%d" % (method, size)
+    return method
+
+
+class HashIndex(object):
+
+    """
+    Index of file hashes. Entries are keyed by device and inode of file,
+    so all paths (links) of one file share the entry.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: Path of index file, see get_index_path() for default.
+        """
+        if path is None:
+            path = get_index_path()
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._entries = {}
+        self._index_stat = None
+
+    def _load(self):
+        """
+        Read the index again if it was replaced by another process.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._entries = {}
+            self._index_stat = None
+            return
+        index_stat = (st.st_ino, st.st_size, st.st_mtime)
+        if index_stat == self._index_stat:
+            return
+        try:
+            index_file = open(self.path)
+            try:
+                self._entries = json.load(index_file)
+            finally:
+                index_file.close()
+        except (IOError, ValueError), e:
+            logging.warning("Ignoring broken hash index %s: %s", self.path, e)
+            self._entries = {}
+        self._index_stat = index_stat
+
+    def _update(self, func):
+        """
+        Modify the index under lock.
+
+        :param func: Function which modifies dict of entries in place.
+        """
+        lockfile = open(self.lock_path, "w")
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        try:
+            self._load()
+            func(self._entries)
+            tmp_path = "%s.%d" % (self.path, os.getpid())
+            index_file = open(tmp_path, "w")
+            try:
+                json.dump(self._entries, index_file, indent=1,
+                          sort_keys=True)
+            finally:
+                index_file.close()
+            os.rename(tmp_path, self.path)
+            self._index_stat = None
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    @staticmethod
+    def _key(fid):
+        return "%d:%d" % (fid[0], fid[1])
+
+    def lookup(self, path, method="md5", size=None):
+        """
+        :param path: Path to file.
+        :param method: Hash method (md5, sha1, ...).
+        :param size: Hash only the first size bytes of file.
+        :return: Recorded hash or None if it's unknown or the file changed.
+        """
+        try:
+            fid = file_id(os.stat(path))
+        except OSError:
+            return None
+        self._load()
+        entry = self._entries.get(self._key(fid))
+        if entry is None or entry["id"] != fid:
+            return None
+        return entry["hashes"].get(hash_name(method, size))
+
+    def record(self, path, hash_value, method="md5", size=None):
+        """
+        Record hash of file. Failure to write the index is only logged,
+        the index is an optimization.
+
+        :param path: Path to file.
+        :param hash_value: Hash of the file.
+        :param method: Hash method (md5, sha1, ...).
+        :param size: Hash is of the first size bytes of file.
+        """
+        fid = file_id(os.stat(path))
+        name = hash_name(method, size)
+
+        def _record(entries):
+            key = self._key(fid)
+            entry = entries.get(key)
+            if entry is None or entry["id"] != fid:
+                entry = {"id": fid, "hashes": {}}
+                entries[key] = entry
+            entry["path"] = os.path.realpath(path)
+            entry["hashes"][name] = hash_value
+
+        try:
+            self._update(_record)
+        except (IOError, OSError), e:
+            logging.debug("Failed to record hash of %s: %s", path, e)
+
+    def get_hash(self, path, method="md5", size=None):
+        """
+        Get hash of file, computed only if the index doesn't know it.
+
+        :param path: Path to file.
+        :param method: Hash method (md5, sha1, ...).
+        :param size: Hash only the first size bytes of file.
+        """
+        hash_value = self.lookup(path, method, size)
+        if hash_value is None:
+            hash_value = utils.hash_file(path, size, method=method)
+            self.record(path, hash_value, method, size)
+        else:
+            logging.debug("Using indexed %s of %s", hash_name(method, size),
+                          path)
+        return hash_value
+
+    def verify_all(self):
+        """
+        Compute again all hashes in the index. Entries of removed or
+        changed files and entries whose hashes don't match (content
+        changed without change of mtime) are removed from the index.
+
+        :return: Tuple of lists of paths (verified, mismatched, stale).
+        """
+        self._load()
+        verified, mismatched, stale = [], [], []
+        invalid = []
+        for key, entry in sorted(self._entries.items()):
+            path = entry["path"]
+            try:
+                fid = file_id(os.stat(path))
+            except OSError:
+                fid = None
+            if fid != entry["id"]:
+                stale.append(path)
+                invalid.append((key, entry["id"]))
+                continue
+            for name, hash_value in sorted(entry["hashes"].items()):
+                method, _, size = name.partition("_")
+                actual = utils.hash_file(path, int(size or 0) or None,
+                                         method=method)
+                if actual != hash_value:
+                    logging.error("%s of %s doesn't match: %s (indexed %s)",
+                                  name, path, actual, hash_value)
+                    mismatched.append(path)
+                    invalid.append((key, entry["id"]))
+                    break
+            else:
+                verified.append(path)
+
+        def _remove(entries):
+            for key, fid in invalid:
+                # Keep entries updated by others in the meantime
+                if key in entries and entries[key]["id"] == fid:
+                    del entries[key]
+
+        if invalid:
+            self._update(_remove)
+        return verified, mismatched, stale
+
+
+_indexes = {}
+
+
+def get_index():
+    """
+    :return: HashIndex object of the shared index.
+    """
+    path = get_index_path()
+    if path not in _indexes:
+        _indexes[path] = HashIndex(path)
+    return _indexes[path]
+
+
+def get_file_hash(path, method="md5", size=None):
+    """
+    Get hash of file using the shared index.
+
+    :param path: Path to file.
+    :param method: Hash method (md5, sha1, ...).
+    :param size: Hash only the first size bytes of file.
+    """
+    return get_index().get_hash(path, method, size)
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import common
+import hash_index
+
+
+class HashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmpdir, "index.json")
+        self.index = hash_index.HashIndex(self.index_path)
+        self.path = os.path.join(self.tmpdir, "image.iso")
+        self._write("a" * 2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, data, mtime=None):
+        image = open(self.path, "w")
+        image.write(data)
+        image.close()
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_get_hash(self):
+        md5 = hashlib.md5("a" * 2000).hexdigest()
+        self.assertEqual(self.index.lookup(self.path), None)
+        self.assertEqual(self.index.get_hash(self.path), md5)
+        self.assertEqual(self.index.lookup(self.path), md5)
+        self.assertEqual(self.index.lookup(self.path, "sha1"), None)
+        self.assertEqual(self.index.get_hash(self.path, "sha1"),
+                         hashlib.sha1("a" * 2000).hexdigest())
+        # Index is shared by other processes through the file
+        other = hash_index.HashIndex(self.index_path)
+        self.assertEqual(other.lookup(self.path), md5)
+        link = os.path.join(self.tmpdir, "link.iso")
+        os.link(self.path, link)
+        self.assertEqual(other.lookup(link), md5)
+
+    def test_changed_file(self):
+        self._write("a" * 2000, 1000)
+        self.index.get_hash(self.path)
+        self._write("b" * 2000, 1000.5)
+        self.assertEqual(self.index.lookup(self.path), None)
+        self.assertEqual(self.index.get_hash(self.path),
+                         hashlib.md5("b" * 2000).hexdigest())
+
+    def test_verify_all(self):
+        self._write("a" * 2000, 1000)
+        self.index.get_hash(self.path)
+        self.index.get_hash(self.path, "md5", 1000)
+        other = os.path.join(self.tmpdir, "other.iso")
+        open(other, "w").write("other")
+        self.index.get_hash(other)
+        verified, mismatched, stale = self.index.verify_all()
+        self.assertEqual(sorted(verified), sorted([self.path, other]))
+        self.assertEqual((mismatched, stale), ([], []))
+
+        os.unlink(other)
+        self._write("b" * 2000, 1000)
+        verified, mismatched, stale = self.index.verify_all()
+        self.assertEqual((verified, mismatched, stale),
+                         ([], [self.path], [other]))
+        self.assertEqual(self.index.lookup(self.path), None)
+        self.assertEqual(self.index.verify_all(), ([], [], []))
+
+    def test_broken_index(self):
+        open(self.index_path, "w").write("{broken")
+        self.assertEqual(self.index.lookup(self.path), None)
+        self.index.get_hash(self.path)
+        self.assertTrue(self.index.lookup(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,7 +17,7 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if rg:
             f = self.send_head_range(rg[0], rg[1])
             if f:
-                self.copyfile_range(f, self.wfile, rg[0], rg[1])
+                self.copyfile_range(f, self.wfile, rg[0], self.range_end)
                 f.close()
         else:
             f = self.send_head()
@@ -33,21 +33,34 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             if rg.startswith(range_discard):
                 rg = rg[len(range_discard):]
                 begin, end = rg.split('-')
-                return (int(begin), int(end))
+                # "bytes=100-" means from byte 100 to the end of file.
+                if end:
+                    end = int(end)
+                else:
+                    end = None
+                return (int(begin), end)
         return None
 
     def copyfile_range(self, source_file, output_file, range_begin, range_end):
         """
         Copies a range of a file to destination.
         """
+        if range_end is None:
+            self.copyfile(source_file, output_file)
+            return
         range_size = range_end - range_begin + 1
         source_file.seek(range_begin)
-        buf = source_file.read(range_size)
-        output_file.write(buf)
+        while range_size > 0:
+            buf = source_file.read(min(range_size, 1048576))
+            if not buf:
+                break
+            output_file.write(buf)
+            range_size -= len(buf)
 
     def send_head_range(self, range_begin, range_end):
         path = self.translate_path(self.path)
         f = None
+        self.range_end = range_end
         if os.path.isdir(path):
             for index in "index.html", "index.htm":
                 index = os.path.join(path, index)
@@ -65,8 +78,15 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         except IOError:
             self.send_error(404, "File not found")
             return None
+        file_size = os.fstat(f.fileno())[6]
+        if range_end is None or range_end >= file_size:
+            range_end = file_size - 1
+        if range_begin > range_end:
+            f.close()
+            self.send_error(416, "Requested Range Not Satisfiable")
+            return None
+        self.range_end = range_end
         self.send_response(206, "Partial Content")
-        file_size = str(os.fstat(f.fileno())[6])
         range_size = str(range_end - range_begin + 1)
         self.send_header("Accept-Ranges", "bytes")
         self.send_header("Content-Length", range_size)
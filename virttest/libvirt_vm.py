@@ -22,8 +22,10 @@ import remote
 import virsh
 import libvirt_xml
 import data_dir
+import hash_index
 import xml_utils
 import utils_selinux
+import utils_libguestfs
 
 
 def normalize_connect_uri(connect_uri):
@@ -975,6 +977,7 @@ class VM(virt_vm.BaseVM):
                                                        output_params=output_params)
             # Cause serial_console.close() to close open log file
             self.serial_console.set_log_file(output_filename)
+            self.set_console_output_limit(self.serial_console)
 
     def set_root_serial_console(self, device, remove=False):
         """
@@ -1424,6 +1427,9 @@ class VM(virt_vm.BaseVM):
         params = self.params
         root_dir = self.root_dir
 
+        # Guestfish appliances must not keep the images open
+        utils_libguestfs.close_pooled_sessions()
+
         # Verify the md5sum of the ISO images
         for cdrom in params.objects("cdroms"):
             if params.get("medium") == "import":
@@ -1445,19 +1451,20 @@ class VM(virt_vm.BaseVM):
                 elif cdrom_params.get("md5sum_1m"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "first MB of ISO file...")
-                    actual_hash = utils.hash_file(iso, 1048576, method="md5")
+                    actual_hash = hash_index.get_file_hash(iso, "md5",
+                                                           1048576)
                     expected_hash = cdrom_params.get("md5sum_1m")
                     compare = True
                 elif cdrom_params.get("md5sum"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "ISO file...")
-                    actual_hash = utils.hash_file(iso, method="md5")
+                    actual_hash = hash_index.get_file_hash(iso, "md5")
                     expected_hash = cdrom_params.get("md5sum")
                     compare = True
                 elif cdrom_params.get("sha1sum"):
                     logging.debug("Comparing expected SHA1 sum with SHA1 sum "
                                   "of ISO file...")
-                    actual_hash = utils.hash_file(iso, method="sha1")
+                    actual_hash = hash_index.get_file_hash(iso, "sha1")
                     expected_hash = cdrom_params.get("sha1sum")
                     compare = True
                 if compare:
@@ -1582,6 +1589,7 @@ class VM(virt_vm.BaseVM):
         """
         logging.info("Migrating VM %s from %s to %s" %
                      (self.name, self.connect_uri, dest_uri))
+        self.invalidate_sessions()
         result = virsh.migrate(self.name, dest_uri, option,
                                extra, uri=self.connect_uri,
                                ignore_status=ignore_status,
@@ -1666,6 +1674,7 @@ class VM(virt_vm.BaseVM):
         :param free_mac_addresses: If vm is undefined with libvirt, also
                                    release/reset associated mac address
         """
+        self.invalidate_sessions()
         try:
             # Is it already dead?
             if self.is_alive():
@@ -1854,7 +1863,8 @@ class VM(virt_vm.BaseVM):
 
     def get_cpu_topology_in_vm(self):
         cpu_topology = {}
-        cpu_info = utils_misc.get_cpu_info(self.wait_for_login())
+        with self.leased_session() as session:
+            cpu_info = utils_misc.get_cpu_info(session, close_session=False)
         if cpu_info:
             cpu_topology['sockets'] = cpu_info['Socket(s)']
             cpu_topology['cores'] = cpu_info['Core(s) per socket']
@@ -1886,6 +1896,7 @@ class VM(virt_vm.BaseVM):
         :return: A new shell session object.
         """
         error.base_context("rebooting '%s'" % self.name, logging.info)
+        self.invalidate_sessions()
         error.context("before reboot")
         session = session or self.login(timeout=timeout)
         error.context()
@@ -1920,6 +1931,7 @@ class VM(virt_vm.BaseVM):
         logging.debug("Starting vm '%s'", self.name)
         result = virsh.start(self.name, uri=self.connect_uri)
         if not result.exit_status:
+            self.start_time = time.time()
             # Wait for the domain to be created
             has_started = utils_misc.wait_for(func=self.is_alive, timeout=60,
                                               text=("waiting for domain %s "
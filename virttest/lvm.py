@@ -23,6 +23,7 @@ Required params:
 """
 import os
 import re
+import json
 import math
 import logging
 import utils_misc
@@ -33,6 +34,12 @@ from autotest.client.shared import utils
 
 UNIT = "B"
 COMMON_OPTS = "--noheading --nosuffix --unit=%s" % UNIT
+# Fields of the state snapshot (see LVMReport), other attributes are queried
+# by separate lvm commands.
+REPORT_FIELDS = (("pv", ("pv_name", "pv_size", "vg_name")),
+                 ("vg", ("vg_name", "vg_size")),
+                 ("lv", ("lv_name", "lv_size", "vg_name", "lv_path")),
+                 ("seg", ("lv_name", "vg_name", "devices")))
 
 
 def normalize_data_size(size):
@@ -55,6 +62,155 @@ def cmd_output(cmd, res="[\w/]+"):
     return None
 
 
+class LVMReport(object):
+
+    """
+    Snapshot of LVM state (pvs, vgs and lvs) taken by one
+    ``lvm fullreport`` command (or by pvs/vgs/lvs commands when fullreport
+    is not supported). Attributes not present in the snapshot are queried
+    once and kept with the snapshot.
+    """
+
+    def __init__(self):
+        self.pvs = {}       # pv_name: {field: value}
+        self.vgs = {}       # vg_name: {field: value}
+        self.lvs = {}       # (vg_name, lv_name): {field: value}
+        self.extra = {}     # (kind, name, attr): value
+        if not self.__load_fullreport():
+            self.__load_reports()
+
+    def __add_row(self, kind, row):
+        if kind == "pv":
+            self.pvs[row["pv_name"]] = row
+        elif kind == "vg":
+            self.vgs[row["vg_name"]] = row
+        elif kind in ("lv", "seg"):
+            lv = self.lvs.setdefault((row["vg_name"], row["lv_name"]), {})
+            devices = row.pop("devices", "")
+            lv.update(row)
+            if devices:
+                lv["devices"] = ",".join(filter(None, [lv.get("devices"),
+                                                       devices]))
+
+    def __load_fullreport(self):
+        """
+        :return: True when the snapshot was loaded from lvm fullreport
+        """
+        cmd = ("lvm fullreport --reportformat json --units %s --nosuffix" %
+               UNIT)
+        for kind, fields in REPORT_FIELDS:
+            cmd += " --configreport %s -o %s" % (kind, ",".join(fields))
+        result = utils.run(cmd, ignore_status=True, verbose=False)
+        if result.exit_status != 0:
+            logging.debug("lvm fullreport not available: %s",
+                          result.stderr.strip())
+            return False
+        try:
+            reports = json.loads(result.stdout)["report"]
+        except (ValueError, KeyError, TypeError):
+            logging.debug("Unable to parse lvm fullreport output")
+            return False
+        for report in reports:
+            for kind, _ in REPORT_FIELDS:
+                for row in report.get(kind, []):
+                    self.__add_row(kind, dict((str(key), str(value))
+                                              for key, value in row.items()))
+        return True
+
+    def __load_reports(self):
+        for kind, fields in REPORT_FIELDS:
+            if kind == "seg":   # lvs shows devices of all segments
+                continue
+            if kind == "lv":
+                fields += ("devices",)
+            cmd = "lvm %ss -o %s --separator '|' %s" % (kind, ",".join(fields),
+                                                        COMMON_OPTS)
+            output = utils.system_output(cmd, verbose=False)
+            for line in output.splitlines():
+                values = [_.strip() for _ in line.split("|")]
+                if len(values) == len(fields):
+                    self.__add_row(kind, dict(zip(fields, values)))
+
+    def get_row(self, kind, name):
+        """
+        :param kind: 'pv', 'vg' or 'lv'
+        :param name: pv_name, vg_name or (vg_name, lv_name)
+        :return: dict of fields of the volume or None
+        """
+        if kind == "pv":
+            row = self.pvs.get(name)
+            if row is None:
+                row = self.pvs.get(os.path.realpath(name))
+            return row
+        elif kind == "vg":
+            return self.vgs.get(name)
+        return self.lvs.get(name)
+
+    def get_attr(self, kind, name, attr, cmd, res="[\w/]+"):
+        """
+        Get attribute of volume from snapshot, attributes which are not
+        in snapshot are queried by cmd.
+
+        :param kind: 'pv', 'vg' or 'lv'
+        :param name: pv_name, vg_name or (vg_name, lv_name)
+        :param attr: attribute name;
+        :param cmd: command printing the attribute;
+        :param res: regular expression to reading the attribute;
+        :return: string or None
+        """
+        if not attr:
+            return None
+        fields = dict(REPORT_FIELDS)[kind]
+        if kind == "lv":
+            fields += ("devices",)
+        if attr not in fields:
+            key = (kind, name, attr)
+            if key not in self.extra:
+                self.extra[key] = cmd_output(cmd, res)
+            return self.extra[key]
+        row = self.get_row(kind, name)
+        if row is None:
+            return None
+        val = re.findall(res, row.get(attr, ""))
+        if val:
+            return val[0]
+        return None
+
+
+_report = None
+
+
+def get_report():
+    """
+    :return: LVMReport, it's taken again only after invalidate_report()
+    """
+    global _report
+    if _report is None:
+        _report = LVMReport()
+    return _report
+
+
+def invalidate_report():
+    """
+    Drop the LVM state snapshot, call it after each change of LVM state.
+    """
+    global _report
+    _report = None
+
+
+def lvm_system(cmd):
+    """
+    Run command changing LVM state and invalidate the state snapshot;
+
+    :param cmd: command;
+    :raise: CmdError when command exit code not equal 0;
+    """
+    try:
+        return utils.system(cmd)
+    finally:
+        invalidate_report()
+
+
 class Volume(object):
 
     def __init__(self, name, size):
@@ -113,7 +269,7 @@ class PhysicalVolume(Volume):
             raise error.TestError("Physical device not found")
         self.umount()
         cmd = "pvcreate %s %s" % (extra_args, self.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("Create physical volume: %s", self.name)
         return self.path
 
@@ -125,7 +281,7 @@ class PhysicalVolume(Volume):
         :raise: CmdError
         """
         cmd = "lvm pvremove %s %s" % (extra_args, self.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("logical physical volume (%s) removed", self.name)
 
     def resize(self, size, extra_args="-ff --yes"):
@@ -140,7 +296,7 @@ class PhysicalVolume(Volume):
                                                                    size,
                                                                    UNIT,
                                                                    self.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         self.size = size
         logging.info("resize volume %s to %s B" % (self.name, self.size))
 
@@ -161,7 +317,7 @@ class PhysicalVolume(Volume):
         :return: string or None
         """
         cmd = "lvm pvs -o %s %s %s" % (attr, COMMON_OPTS, self.name)
-        return super(PhysicalVolume, self).get_attr(cmd, attr)
+        return get_report().get_attr("pv", self.name, attr, cmd)
 
     def set_vg(self, vg):
         """
@@ -197,7 +353,7 @@ class VolumeGroup(object):
                 except:
                     pv.vg.remove()
             cmd += " %s" % pv.name
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("Create new volumegroup %s", self.name)
         return self.name
 
@@ -208,7 +364,7 @@ class VolumeGroup(object):
         :param extra_args: extra argurments for lvm command;
         """
         cmd = "lvm vgremove %s %s" % (extra_args, self.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("logical volume-group(%s) removed", self.name)
 
     def get_attr(self, attr):
@@ -219,7 +375,7 @@ class VolumeGroup(object):
         :return: string or None;
         """
         cmd = "lvm vgs -o %s %s %s" % (attr, COMMON_OPTS, self.name)
-        return cmd_output(cmd)
+        return get_report().get_attr("vg", self.name, attr, cmd)
 
     def append_lv(self, lv):
         """
@@ -241,7 +397,7 @@ class VolumeGroup(object):
         if not isinstance(pv, PhysicalVolume):
             raise TypeError("Need a PhysicalVolume object")
         cmd = "lvm vgreduce %s %s %s" % (extra_args, self.name, pv.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         self.pvs.remove(pv)
         logging.info("reduce volume %s from volume group %s" % (pv.name,
                                                                 self.name))
@@ -256,7 +412,7 @@ class VolumeGroup(object):
         if not isinstance(pv, PhysicalVolume):
             raise TypeError("Need a PhysicalVolume object")
         cmd = "lvm vgextend %s %s" % (self.name, pv.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         self.pvs.append(pv)
         logging.info("add volume %s to volumegroup %s" % (pv.name, self.name))
 
@@ -288,7 +444,7 @@ class LogicalVolume(Volume):
                                                  UNIT,
                                                  self.name,
                                                  vg_name)
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("create logical volume %s", self.path)
         return self.get_attr("lv_path")
 
@@ -300,7 +456,7 @@ class LogicalVolume(Volume):
         """
         self.umount()
         cmd = "lvm lvremove %s %s/%s" % (extra_args, self.vg.name, self.name)
-        utils.system(cmd)
+        lvm_system(cmd)
         logging.info("logical volume(%s) removed", self.name)
 
     def resize(self, size, extra_args="-ff"):
@@ -320,7 +476,7 @@ class LogicalVolume(Volume):
         else:
             size = normalize_data_size(size)
         cmd = "lvm lvresize -n -L %s%s %s %s" % (size, UNIT, path, extra_args)
-        utils.system(cmd)
+        lvm_system(cmd)
         self.size = size
         logging.info("resize logical volume %s size to %s" % (self.path,
                                                               self.size))
@@ -346,7 +502,8 @@ class LogicalVolume(Volume):
         :raise: CmdError when command exit code not equal 0;
         """
         cmd = "lvm lvs -o %s %s %s" % (attr, COMMON_OPTS, self.path)
-        return super(LogicalVolume, self).get_attr(cmd, attr)
+        return get_report().get_attr("lv", (self.vg.name, self.name), attr,
+                                     cmd)
 
 
 class LVM(object):
@@ -354,9 +511,8 @@ class LVM(object):
     def __init__(self, params):
         os_dep.command("lvm")
         self.params = self.__format_params(params)
-        self.pvs = self.__reload_pvs()
-        self.vgs = self.__reload_vgs()
-        self.lvs = self.__reload_lvs()
+        self.__index = {}
+        self.__reload()
         self.trash = []
 
     def generate_id(self, params):
@@ -415,54 +571,37 @@ class LVM(object):
             self.trash.remove(vol)
             logging.info("Uninstall volume %s", vol.name)
 
-    def __reload_lvs(self):
+    def __reload(self):
         """
-        Create LogicalVolume objects for exist Logical volumes;
-
-        :return: list of Volume object
+        Create PhysicalVolume, VolumeGroup and LogicalVolume objects for
+        exist volumes from one LVM state snapshot;
         """
-        lvs = []
-        cmd = "lvm lvs -o lv_name,lv_size,vg_name %s" % COMMON_OPTS
-        output = utils.system_output(cmd)
-        for line in output.splitlines():
-            lv_name, lv_size, vg_name = line.split()
-            vg = self.get_vol(vg_name, "vgs")
-            lv = LogicalVolume(lv_name, lv_size, vg)
-            vg.append_lv(lv)
-            lvs.append(lv)
-        return lvs
+        report = get_report()
+        self.pvs = []
+        for pv_name, row in sorted(report.pvs.items()):
+            self.pvs.append(PhysicalVolume(pv_name, row["pv_size"]))
+        self.__index["pvs"] = dict((pv.name, pv) for pv in self.pvs)
 
-    def __reload_vgs(self):
-        """
-        Create VolumeGroup objects for exist volumegroups;
-
-        :return: list of Volume object
-        """
-        vgs = []
-        cmd = "lvm vgs -opv_name,vg_name,vg_size %s" % COMMON_OPTS
-        output = utils.system_output(cmd)
-        for line in output.splitlines():
-            pv_name, vg_name, vg_size = line.split()
-            pv = self.get_vol(pv_name, "pvs")
-            vg = VolumeGroup(vg_name, vg_size, [pv])
-            pv.set_vg(vg)
-            vgs.append(vg)
-        return vgs
-
-    def __reload_pvs(self):
-        """
-        Create PhysicalVolume objects for exist physical volumes;
+        self.vgs = []
+        for vg_name, row in sorted(report.vgs.items()):
+            pvs = [self.__index["pvs"][pv_name]
+                   for pv_name, pv_row in sorted(report.pvs.items())
+                   if pv_row.get("vg_name") == vg_name]
+            vg = VolumeGroup(vg_name, row["vg_size"], pvs)
+            for pv in pvs:
+                pv.set_vg(vg)
+            self.vgs.append(vg)
+        self.__index["vgs"] = dict((vg.name, vg) for vg in self.vgs)
 
-        :return: list of Volume object
-        """
-        pvs = []
-        cmd = "lvm pvs -opv_name,pv_size %s" % COMMON_OPTS
-        output = utils.system_output(cmd)
-        for line in output.splitlines():
-            pv_name, pv_size = line.split()
-            pv = PhysicalVolume(pv_name, pv_size)
-            pvs.append(pv)
-        return pvs
+        self.lvs = []
+        for (vg_name, lv_name), row in sorted(report.lvs.items()):
+            vg = self.__index["vgs"].get(vg_name)
+            if vg is None or lv_name.startswith("["):   # hidden lv
+                continue
+            lv = LogicalVolume(lv_name, row["lv_size"], vg)
+            vg.append_lv(lv)
+            self.lvs.append(lv)
+        self.__index["lvs"] = dict((lv.name, lv) for lv in self.lvs)
 
     def get_vol(self, vname, vtype):
         """
@@ -473,10 +612,7 @@ class LVM(object):
         :return: Volume object or None;
         """
         if vtype:
-            vols = getattr(self, vtype)
-            for vol in vols:
-                if vol.name == vname:
-                    return vol
+            return self.__index[vtype].get(vname)
         return None
 
     def setup_pv(self, vg):
@@ -488,10 +624,12 @@ class LVM(object):
         :return: list of PhysicalVolume object;
         """
         pvs = []
-        cmd = "lvm pvs -opv_name,pv_size %s %s" % (COMMON_OPTS, vg.name)
-        output = utils.system_output(cmd)
-        for line in output.splitlines():
-            pv_name, pv_size = line.split()
+        vg_pvs = []
+        if vg is not None:
+            vg_pvs = [(pv_name, row["pv_size"]) for pv_name, row
+                      in sorted(get_report().pvs.items())
+                      if row.get("vg_name") == vg.name]
+        for pv_name, pv_size in vg_pvs:
             pv = self.get_vol(pv_name, "pvs")
             if pv is None:
                 pv = PhysicalVolume(pv_name, pv_size)
@@ -604,6 +742,7 @@ class LVM(object):
         if lvm_reload_cmd:
             utils.system(lvm_reload_cmd, ignore_status=True)
             logging.info("reload lvm monitor service")
+        invalidate_report()
 
 
 class EmulatedLVM(LVM):
@@ -705,3 +844,4 @@ class EmulatedLVM(LVM):
             cmd = "rm -f %s" % emulate_image_file
             utils.system(cmd, ignore_status=True)
             logging.info("remove emulate image file %s", emulate_image_file)
+            invalidate_report()
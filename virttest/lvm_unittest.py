@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import json
+import unittest
+
+import common
+import lvm
+
+
+FULLREPORT = {"report": [
+    {"vg": [{"vg_name": "vg_test", "vg_size": "2143289344"}],
+     "pv": [{"pv_name": "/dev/loop0", "pv_size": "1069547520",
+             "vg_name": "vg_test"},
+            {"pv_name": "/dev/loop1", "pv_size": "1069547520",
+             "vg_name": "vg_test"}],
+     "lv": [{"lv_name": "lv_test", "lv_size": "1073741824",
+             "vg_name": "vg_test", "lv_path": "/dev/vg_test/lv_test"}],
+     "seg": [{"lv_name": "lv_test", "vg_name": "vg_test",
+              "devices": "/dev/loop0(0)"},
+             {"lv_name": "lv_test", "vg_name": "vg_test",
+              "devices": "/dev/loop1(0)"}]},
+    {"vg": [],
+     "pv": [{"pv_name": "/dev/sdb", "pv_size": "1073741824",
+             "vg_name": ""}],
+     "lv": [], "seg": []}]}
+
+REPORTS = {
+    "pvs": "  /dev/loop0|1069547520|vg_test\n"
+           "  /dev/loop1|1069547520|vg_test\n"
+           "  /dev/sdb|1073741824|\n",
+    "vgs": "  vg_test|2143289344\n",
+    "lvs": "  lv_test|1073741824|vg_test|/dev/vg_test/lv_test|/dev/loop0(0)\n"
+           "  lv_test|1073741824|vg_test|/dev/vg_test/lv_test|/dev/loop1(0)\n"}
+
+
+class FakeResult(object):
+
+    def __init__(self, stdout="", exit_status=0):
+        self.stdout = stdout
+        self.stderr = ""
+        self.exit_status = exit_status
+
+
+class LVMReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+        self.fullreport = True
+        self.orig = (lvm.utils.run, lvm.utils.system_output,
+                     lvm.utils.system)
+        lvm.utils.run = self.fake_run
+        lvm.utils.system_output = self.fake_system_output
+        lvm.utils.system = self.commands.append
+        lvm.invalidate_report()
+
+    def tearDown(self):
+        (lvm.utils.run, lvm.utils.system_output,
+         lvm.utils.system) = self.orig
+        lvm.invalidate_report()
+
+    def fake_run(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        if cmd.startswith("lvm fullreport"):
+            if self.fullreport:
+                return FakeResult(json.dumps(FULLREPORT))
+            return FakeResult(exit_status=3)
+        if cmd.startswith("lvm lvs -o lv_kernel_major"):
+            return FakeResult("  253\n")
+        return FakeResult(exit_status=5)
+
+    def fake_system_output(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        return REPORTS[cmd.split()[1]]
+
+    def check_report(self):
+        report = lvm.get_report()
+        self.assertTrue(lvm.get_report() is report)
+        self.assertEqual(sorted(report.pvs),
+                         ["/dev/loop0", "/dev/loop1", "/dev/sdb"])
+        self.assertEqual(report.vgs.keys(), ["vg_test"])
+        self.assertEqual(report.lvs[("vg_test", "lv_test")]["devices"],
+                         "/dev/loop0(0),/dev/loop1(0)")
+
+        vg = lvm.VolumeGroup("vg_test", 0, [])
+        lv = lvm.LogicalVolume("lv_test", 0, vg)
+        self.assertTrue(vg.exists())
+        self.assertFalse(lvm.VolumeGroup("vg_missing", 0, []).exists())
+        self.assertEqual(lv.get_attr("lv_path"), "/dev/vg_test/lv_test")
+        self.assertEqual(lv.get_attr("devices"), "/dev/loop0")
+        self.assertEqual(lvm.PhysicalVolume("/dev/sdb", 0).get_attr("pv_size"),
+                         "1073741824")
+        self.assertEqual(lv.get_attr("lv_kernel_major"), "253")
+        self.assertEqual(lv.get_attr("lv_kernel_major"), "253")
+
+    def test_fullreport(self):
+        self.check_report()
+        self.assertEqual(len(self.commands), 2)
+        self.assertTrue(self.commands[0].startswith("lvm fullreport"))
+
+    def test_fallback(self):
+        self.fullreport = False
+        self.check_report()
+        self.assertEqual([_.split()[:2] for _ in self.commands],
+                         [["lvm", "fullreport"], ["lvm", "pvs"],
+                          ["lvm", "vgs"], ["lvm", "lvs"], ["lvm", "lvs"]])
+
+    def test_lvm_volumes(self):
+        lvm_obj = lvm.LVM({"image_name": "images/test", "image_size": "1G",
+                           "vg_name": "vg_test", "lv_name": "lv_test"})
+        self.assertEqual(len(self.commands), 1)
+        vg = lvm_obj.get_vol("vg_test", "vgs")
+        self.assertEqual([pv.name for pv in vg.pvs],
+                         ["/dev/loop0", "/dev/loop1"])
+        self.assertTrue(vg.pvs[0].vg is vg)
+        self.assertTrue(lvm_obj.get_vol("/dev/sdb", "pvs").vg is None)
+        lv = lvm_obj.get_vol("lv_test", "lvs")
+        self.assertEqual(vg.lvs, [lv])
+        self.assertEqual(lvm_obj.get_vol("lv_missing", "lvs"), None)
+
+    def test_invalidation(self):
+        lv = lvm.LogicalVolume("lv_test", "1G",
+                               lvm.VolumeGroup("vg_test", 0, []))
+        lv.get_attr("lv_path")
+        lv.get_attr("lv_size")
+        self.assertEqual(len(self.commands), 1)
+        lv.remove()
+        self.assertEqual(self.commands[-1],
+                         "lvm lvremove -ff --yes vg_test/lv_test")
+        lv.get_attr("lv_path")
+        self.assertEqual(len(self.commands), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
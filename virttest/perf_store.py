@@ -0,0 +1,567 @@
+"""
+Local store of performance results and their statistical comparison.
+
+Results of performance tests (tables like the .RHS files of netperf, ffsb,
+... : text lines and lines of '|' separated numbers) are stored in a SQLite
+database, one value per row, indexed by sample (a set of repetitions of
+the same test in the same environment). Samples are loaded back as arrays
+of shape (repetitions, rows, columns) and averages, standard deviations
+and t-tests of all cells are computed at once with numpy. Without numpy,
+ListTable computes the averages and standard deviations cell by cell and
+there are no t-tests.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import re
+import math
+import time
+import sqlite3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample_id INTEGER PRIMARY KEY,
+    test TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created REAL,
+    repeats INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (test, name));
+CREATE TABLE IF NOT EXISTS attributes (
+    sample_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (sample_id, key));
+CREATE TABLE IF NOT EXISTS layout (
+    sample_id INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    text TEXT,
+    PRIMARY KEY (sample_id, row));
+CREATE TABLE IF NOT EXISTS results (
+    sample_id INTEGER NOT NULL,
+    repeat INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (sample_id, repeat, row, col));
+"""
+
+# Lines with letters are headers, the same rule as tools/regression.py uses
+_TEXT_LINE = re.compile("[a-zA-Z]")
+
+
+class PerfStoreError(Exception):
+    pass
+
+
+def parse_line(line):
+    """
+    Parse one line of a results table.
+
+    :param line: Line of results.
+    :return: List of float values of a '|' separated line of numbers, None
+             for text lines.
+    """
+    line = line.strip()
+    if _TEXT_LINE.search(line):
+        return None
+    try:
+        return [float(value) for value in line.split("|")]
+    except ValueError:
+        return None
+
+
+class ResultStore(object):
+
+    """
+    SQLite store of performance results.
+    """
+
+    def __init__(self, path=":memory:", timeout=60):
+        """
+        :param path: Path of the database file, created when missing.
+        :param timeout: How long to wait for other writers of the database.
+        """
+        if path != ":memory:":
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _sample_id(self, test, sample, create=False):
+        row = self.conn.execute("SELECT sample_id FROM samples "
+                                "WHERE test=? AND name=?",
+                                (test, sample)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create:
+            raise PerfStoreError("No sample %s of test %s in %s" %
+                                 (sample, test, self.path))
+        return self.conn.execute("INSERT INTO samples (test, name, created) "
+                                 "VALUES (?, ?, ?)",
+                                 (test, sample, time.time())).lastrowid
+
+    def add_results(self, test, sample, lines, attributes=None):
+        """
+        Add one repetition of a test to a sample.
+
+        :param test: Name of the test (for example 'netperf').
+        :param sample: Name of the sample (for example the job name).
+        :param lines: Lines of the results table.
+        :param attributes: Dict of attributes of the sample (versions, ...).
+        :return: Index of the repetition.
+        """
+        with self.conn:
+            sample_id = self._sample_id(test, sample, create=True)
+            repeat = self.conn.execute("SELECT repeats FROM samples "
+                                       "WHERE sample_id=?",
+                                       (sample_id,)).fetchone()[0]
+            self.conn.execute("UPDATE samples SET repeats=? "
+                              "WHERE sample_id=?", (repeat + 1, sample_id))
+            values = []
+            texts = []
+            for row, line in enumerate(lines):
+                parsed = parse_line(line)
+                if parsed is None:
+                    texts.append((sample_id, row, line.strip()))
+                else:
+                    values.extend((sample_id, repeat, row, col, value)
+                                  for col, value in enumerate(parsed))
+            if repeat == 0:
+                self.conn.executemany("INSERT INTO layout VALUES (?, ?, ?)",
+                                      texts)
+            self.conn.executemany("INSERT INTO results VALUES "
+                                  "(?, ?, ?, ?, ?)", values)
+            if attributes:
+                self.conn.executemany("INSERT OR REPLACE INTO attributes "
+                                      "VALUES (?, ?, ?)",
+                                      [(sample_id, key, str(value))
+                                       for key, value in attributes.items()])
+        return repeat
+
+    def import_files(self, test, sample, paths):
+        """
+        Add result files (one file per repetition) to a sample.
+
+        Lines starting with '### key:value' are stored as attributes.
+
+        :param paths: List of paths of result files.
+        """
+        for path in paths:
+            lines = []
+            attributes = {}
+            for line in open(path):
+                line = line.strip()
+                if line.startswith("### ") and ":" in line:
+                    key, value = line[4:].split(":", 1)
+                    attributes[key.strip()] = value
+                else:
+                    lines.append(line)
+            self.add_results(test, sample, lines, attributes)
+
+    def get_samples(self, test=None):
+        """
+        :return: List of (test, sample name) tuples.
+        """
+        if test is None:
+            cursor = self.conn.execute("SELECT test, name FROM samples "
+                                       "ORDER BY sample_id")
+        else:
+            cursor = self.conn.execute("SELECT test, name FROM samples "
+                                       "WHERE test=? ORDER BY sample_id",
+                                       (test,))
+        return cursor.fetchall()
+
+    def get_attributes(self, test, sample):
+        """
+        :return: Dict of attributes of the sample.
+        """
+        sample_id = self._sample_id(test, sample)
+        return dict(self.conn.execute("SELECT key, value FROM attributes "
+                                      "WHERE sample_id=?", (sample_id,)))
+
+    def get_layout(self, test, sample):
+        """
+        :return: Dict {row: text} of text lines of the sample.
+        """
+        sample_id = self._sample_id(test, sample)
+        return dict(self.conn.execute("SELECT row, text FROM layout "
+                                      "WHERE sample_id=?", (sample_id,)))
+
+    def get_values(self, test, sample):
+        """
+        :return: List of (repeat, row, col, value) of all repetitions.
+        """
+        sample_id = self._sample_id(test, sample)
+        return self.conn.execute("SELECT repeat, row, col, value "
+                                 "FROM results WHERE sample_id=?",
+                                 (sample_id,)).fetchall()
+
+    def remove_sample(self, test, sample):
+        with self.conn:
+            sample_id = self._sample_id(test, sample)
+            for table in ("results", "layout", "attributes", "samples"):
+                self.conn.execute("DELETE FROM %s WHERE sample_id=?" % table,
+                                  (sample_id,))
+
+
+class ListTable(object):
+
+    """
+    Repetitions of a results table as lists, the statistics are computed
+    cell by cell. Used when numpy is not installed.
+
+    values is a list of repetitions, each a list of rows of values (empty for
+    text rows, NaN for missing cells of shorter lines). texts is a dict
+    {row: text} of text lines and widths the number of values of each row
+    (0 for text rows).
+    """
+
+    def __init__(self, texts, values, widths):
+        self.texts = texts
+        self.values = values
+        self.widths = widths
+
+    @classmethod
+    def from_values(cls, texts, values):
+        """
+        Create table from (repeat, row, col, value) tuples and text rows.
+        """
+        rows = len(texts) and max(texts) + 1
+        repeats = 0
+        for repeat, row, col, _ in values:
+            rows = max(rows, row + 1)
+            repeats = max(repeats, repeat + 1)
+        widths = [0] * rows
+        for _, row, col, _ in values:
+            widths[row] = max(widths[row], col + 1)
+        array = [[[float("nan")] * width for width in widths]
+                 for _ in xrange(repeats)]
+        for repeat, row, col, value in values:
+            array[repeat][row][col] = value
+        return cls(texts, array, widths)
+
+    @classmethod
+    def from_store(cls, store, test, sample):
+        return cls.from_values(store.get_layout(test, sample),
+                               store.get_values(test, sample))
+
+    @classmethod
+    def from_lines(cls, repeats):
+        """
+        Create table from lists of lines, one list per repetition. Text
+        lines are taken from the first repetition.
+        """
+        texts = {}
+        values = []
+        for repeat, lines in enumerate(repeats):
+            for row, line in enumerate(lines):
+                parsed = parse_line(line)
+                if parsed is None:
+                    if repeat == 0:
+                        texts[row] = line.strip()
+                    continue
+                values.extend((repeat, row, col, value)
+                              for col, value in enumerate(parsed))
+        return cls.from_values(texts, values)
+
+    def __len__(self):
+        return len(self.widths)
+
+    @property
+    def repeats(self):
+        return len(self.values)
+
+    def _cells(self):
+        """
+        :return: Iterator of (row, col, list of values of all repetitions).
+        """
+        for row, width in enumerate(self.widths):
+            for col in xrange(width):
+                yield row, col, [repeat[row][col] for repeat in self.values]
+
+    def _empty(self):
+        return [[0.0] * width for width in self.widths]
+
+    def mean(self, avg_update=None):
+        """
+        Average of all cells over repetitions.
+
+        :param avg_update: Columns computed as ratio of other averages,
+                'dst,numerator,denominator|...' (see tools/perf.conf).
+        :return: List of rows of averages.
+        """
+        avg = self._empty()
+        for row, col, values in self._cells():
+            avg[row][col] = sum(values) / len(values)
+        if avg_update:
+            for update in avg_update.split("|"):
+                dst, num, den = [int(_) for _ in update.split(",")]
+                for row in avg:
+                    if dst < len(row):
+                        row[dst] = _divide(_get(row, num), _get(row, den))
+        return avg
+
+    def sd(self):
+        """
+        Standard deviation of all cells over repetitions, 0 when it can't be
+        computed (one repetition, zero average).
+
+        :return: List of rows of standard deviations.
+        """
+        sd = self._empty()
+        n = self.repeats
+        if n < 2:
+            return sd
+        for row, col, values in self._cells():
+            avg = sum(values) / n
+            sqsum = sum(value ** 2 for value in values)
+            var = (sqsum - n * avg ** 2) / (n - 1)
+            if avg != 0 and var > 0:
+                sd[row][col] = math.sqrt(var)
+        return sd
+
+    def format(self, array, fmt="%f"):
+        """
+        Format array (rows, columns) back to results lines.
+
+        :param fmt: Format string or function formatting one value.
+        :return: List of lines, text rows are kept.
+        """
+        if not callable(fmt):
+            fmt = fmt.__mod__
+        lines = []
+        if hasattr(array, "tolist"):
+            array = array.tolist()
+        for row, width in enumerate(self.widths):
+            if row in self.texts:
+                lines.append(self.texts[row])
+            else:
+                lines.append("|".join([fmt(value)
+                                       for value in array[row][:width]]))
+        return lines
+
+    def raw_lines(self):
+        """
+        :return: List of lines of each repetition.
+        """
+        def fmt(value):
+            if value != value:
+                return "nan"
+            if value == int(value):
+                return "%d" % value
+            return "%f" % value
+        return [self.format(repeat, fmt) for repeat in self.values]
+
+    def numeric_groups(self, separator="Category"):
+        """
+        Indexes of numeric rows, split by text rows containing separator.
+
+        :return: List of lists of row indexes.
+        """
+        groups = [[]]
+        for row in xrange(len(self.widths)):
+            if row in self.texts:
+                if separator in self.texts[row] and row != 0:
+                    groups.append([])
+            else:
+                groups[-1].append(row)
+        return groups
+
+
+def _get(row, col):
+    if col < len(row):
+        return row[col]
+    return float("nan")
+
+
+def _divide(num, den):
+    """
+    num / den, infinite or NaN (0 / 0) on division by zero like numpy.
+    """
+    if den != 0:
+        return num / den
+    if num != num or num == 0:
+        return float("nan")
+    return math.copysign(float("inf"), num) * math.copysign(1.0, den)
+
+
+class SampleTable(ListTable):
+
+    """
+    Repetitions of a results table as an array. Requires numpy.
+
+    values is an array (repeats, rows, columns), text rows and missing cells
+    of shorter lines are NaN. texts is a dict {row: text} of text lines and
+    widths the number of values of each row (0 for text rows).
+    """
+
+    @classmethod
+    def from_values(cls, texts, values):
+        """
+        Create table from (repeat, row, col, value) tuples and text rows.
+        """
+        rows = len(texts) and max(texts) + 1
+        if values:
+            values = numpy.array(values, dtype=float)
+            repeats, rows_, cols = values[:, :3].max(axis=0).astype(int) + 1
+            rows = max(rows, rows_)
+            array = numpy.empty((repeats, rows, cols))
+            array.fill(numpy.nan)
+            index = values[:, :3].astype(int)
+            array[index[:, 0], index[:, 1], index[:, 2]] = values[:, 3]
+            widths = numpy.zeros(rows, dtype=int)
+            numpy.maximum.at(widths, index[:, 1], index[:, 2] + 1)
+        else:
+            array = numpy.empty((0, rows, 0))
+            widths = numpy.zeros(rows, dtype=int)
+        return cls(texts, array, widths.tolist())
+
+    @property
+    def repeats(self):
+        return self.values.shape[0]
+
+    def mean(self, avg_update=None):
+        """
+        Average of all cells over repetitions.
+
+        :param avg_update: Columns computed as ratio of other averages,
+                'dst,numerator,denominator|...' (see tools/perf.conf).
+        :return: Array (rows, columns).
+        """
+        avg = self.values.mean(axis=0)
+        if avg_update:
+            for update in avg_update.split("|"):
+                dst, num, den = [int(_) for _ in update.split(",")]
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    avg[:, dst] = avg[:, num] / avg[:, den]
+        return avg
+
+    def sd(self):
+        """
+        Standard deviation of all cells over repetitions, 0 when it can't be
+        computed (one repetition, zero average).
+
+        :return: Array (rows, columns).
+        """
+        n = self.repeats
+        if n < 2:
+            return numpy.zeros(self.values.shape[1:])
+        avg = self.values.mean(axis=0)
+        var = ((self.values ** 2).sum(axis=0) - n * avg ** 2) / (n - 1)
+        with numpy.errstate(invalid='ignore'):
+            invalid = (avg == 0) | ~(var > 0)
+        var[invalid] = 0
+        return numpy.sqrt(var)
+
+
+def _betacf(a, b, x, iterations=200, eps=3e-14, fpmin=1e-300):
+    """
+    Continued fraction of the incomplete beta function (vectorized over x).
+    """
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = numpy.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d[abs(d) < fpmin] = fpmin
+    d = 1.0 / d
+    h = d.copy()
+    for m in xrange(1, iterations + 1):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d[abs(d) < fpmin] = fpmin
+        c = 1.0 + aa / c
+        c[abs(c) < fpmin] = fpmin
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d[abs(d) < fpmin] = fpmin
+        c = 1.0 + aa / c
+        c[abs(c) < fpmin] = fpmin
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if not (abs(delta - 1.0) >= eps).any():
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b) of an array of x.
+    """
+    x = numpy.asarray(x, dtype=float)
+    result = numpy.empty_like(x)
+    result.fill(numpy.nan)
+    result[x <= 0] = 0.0
+    result[x >= 1] = 1.0
+    inside = (x > 0) & (x < 1)
+    xi = x[inside]
+    front = numpy.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                      a * numpy.log(xi) + b * numpy.log(1.0 - xi))
+    direct = xi < (a + 1.0) / (a + b + 2.0)
+    values = numpy.empty_like(xi)
+    values[direct] = (front[direct] *
+                      _betacf(a, b, xi[direct]) / a)
+    values[~direct] = 1.0 - (front[~direct] *
+                             _betacf(b, a, 1.0 - xi[~direct]) / b)
+    result[inside] = values
+    return result
+
+
+def t_pvalue(t, df):
+    """
+    Two-sided p-value of Student's t statistics.
+
+    :param t: Array of t statistics (NaN gives NaN).
+    :param df: Degrees of freedom.
+    """
+    t = numpy.asarray(t, dtype=float)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return betainc(df / 2.0, 0.5, df / (df + t ** 2))
+
+
+def ttest_ind(a, b, axis=0):
+    """
+    Unpaired t-test with pooled variance (as scipy.stats.ttest_ind).
+
+    :return: Tuple (t, p) of arrays.
+    """
+    a = numpy.asarray(a, dtype=float)
+    b = numpy.asarray(b, dtype=float)
+    n1 = a.shape[axis]
+    n2 = b.shape[axis]
+    df = n1 + n2 - 2.0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        svar = ((n1 - 1) * a.var(axis, ddof=1) +
+                (n2 - 1) * b.var(axis, ddof=1)) / df
+        t = ((a.mean(axis) - b.mean(axis)) /
+             numpy.sqrt(svar * (1.0 / n1 + 1.0 / n2)))
+    return t, t_pvalue(t, df)
+
+
+def ttest_rel(a, b, axis=0):
+    """
+    Paired t-test (as scipy.stats.ttest_rel).
+
+    :return: Tuple (t, p) of arrays.
+    """
+    d = numpy.asarray(a, dtype=float) - numpy.asarray(b, dtype=float)
+    n = d.shape[axis]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        t = d.mean(axis) / numpy.sqrt(d.var(axis, ddof=1) / n)
+    return t, t_pvalue(t, n - 1.0)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import common
+import perf_store
+
+
+REPEATS = [["Category:TCP_STREAM",
+            "size|sessions|throughput|cpu",
+            "64|1|900.5|10.0",
+            "64|4|1000|12.0",
+            "Category:TCP_MAERTS",
+            "size|sessions|throughput|cpu",
+            "64|1|500|8"],
+           ["Category:TCP_STREAM",
+            "size|sessions|throughput|cpu",
+            "64|1|910.5|10.0",
+            "64|4|1100|11.0",
+            "Category:TCP_MAERTS",
+            "size|sessions|throughput|cpu",
+            "64|1|520|8"]]
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "perf", "results.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_results(self):
+        store = perf_store.ResultStore(self.path)
+        for lines in REPEATS:
+            store.add_results("netperf", "job1", lines,
+                              {"kvm_version": "3.10"})
+        self.assertEqual(store.add_results("netperf", "job2", REPEATS[0]), 0)
+        store.close()
+
+        store = perf_store.ResultStore(self.path)
+        self.assertEqual(store.get_samples(),
+                         [("netperf", "job1"), ("netperf", "job2")])
+        self.assertEqual(store.get_attributes("netperf", "job1"),
+                         {"kvm_version": "3.10"})
+        self.assertEqual(sorted(store.get_layout("netperf", "job1")),
+                         [0, 1, 4, 5])
+        self.assertEqual(len(store.get_values("netperf", "job1")), 24)
+        self.assertRaises(perf_store.PerfStoreError, store.get_values,
+                          "ffsb", "job1")
+        store.remove_sample("netperf", "job1")
+        self.assertEqual(store.get_samples("netperf"), [("netperf", "job2")])
+
+    def test_import_files(self):
+        paths = []
+        for i, lines in enumerate(REPEATS):
+            paths.append(os.path.join(self.tmpdir, "netperf-%d.RHS" % i))
+            open(paths[-1], "w").write("### kvm_version:3.10\n" +
+                                       "\n".join(lines) + "\n")
+        store = perf_store.ResultStore()
+        store.import_files("netperf", "job1", paths)
+        self.assertEqual(store.get_attributes("netperf", "job1"),
+                         {"kvm_version": "3.10"})
+        table = perf_store.ListTable.from_store(store, "netperf", "job1")
+        self.assertEqual(table.raw_lines(),
+                         perf_store.ListTable.from_lines(REPEATS).raw_lines())
+        if perf_store.numpy is None:
+            return
+        table = perf_store.SampleTable.from_store(store, "netperf", "job1")
+        self.assertEqual(table.raw_lines(),
+                         perf_store.SampleTable.from_lines(
+                             REPEATS).raw_lines())
+
+
+class ListTableTest(unittest.TestCase):
+
+    table_class = perf_store.ListTable
+
+    def setUp(self):
+        self.table = self.table_class.from_lines(REPEATS)
+
+    def test_table(self):
+        self.assertEqual(self.table.repeats, 2)
+        self.assertEqual(self.table.widths, [0, 0, 4, 4, 0, 0, 4])
+        self.assertEqual(self.table.numeric_groups(), [[2, 3], [6]])
+        self.assertEqual(self.table.raw_lines()[0][2], "64|1|900.500000|10")
+
+    def test_statistics(self):
+        avg = self.table.mean("3,2,3")
+        lines = self.table.format(avg)
+        self.assertEqual(lines[0], "Category:TCP_STREAM")
+        self.assertEqual(lines[2],
+                         "64.000000|1.000000|905.500000|90.550000")
+        sd = self.table.sd()
+        self.assertEqual(self.table.format(sd)[3],
+                         "0.000000|0.000000|70.710678|0.707107")
+
+    def test_missing_cells(self):
+        table = self.table_class.from_lines([["1|2|3", "4|0"],
+                                             ["3|4", "6|0|2"]])
+        self.assertEqual(table.raw_lines()[1], ["3|4|nan", "6|0|2"])
+        self.assertEqual(table.format(table.mean("1,0,1|2,1,1")),
+                         ["2.000000|0.666667|1.000000", "5.000000|inf|nan"])
+        self.assertEqual(table.format(table.sd()),
+                         ["1.414214|1.414214|0.000000",
+                          "1.414214|0.000000|0.000000"])
+
+
+class SampleTableTest(ListTableTest):
+
+    table_class = perf_store.SampleTable
+
+    def setUp(self):
+        if perf_store.numpy is None:
+            self.skipTest("numpy is not installed")
+        super(SampleTableTest, self).setUp()
+
+    def test_same_as_list_table(self):
+        tables = [table_class.from_lines(REPEATS + [REPEATS[0]])
+                  for table_class in (perf_store.ListTable,
+                                      perf_store.SampleTable)]
+        for table in tables:
+            self.assertEqual(table.raw_lines(), tables[0].raw_lines())
+            self.assertEqual(table.format(table.mean("3,2,3")),
+                             tables[0].format(tables[0].mean("3,2,3")))
+            self.assertEqual(table.format(table.sd()),
+                             tables[0].format(tables[0].sd()))
+
+    def test_ttest(self):
+        numpy = perf_store.numpy
+        # Values of scipy.stats.t.sf(t, df) * 2
+        self.assertTrue(numpy.allclose(
+            perf_store.t_pvalue([2.0, 1.0, -3.5, 0.0, numpy.inf], 10),
+            [0.07338803, 0.34089313, 0.00572651, 1.0, 0.0]))
+        t, p = perf_store.ttest_ind([[1, 9], [2, 9], [3, 9], [4, 9], [5, 9]],
+                                    [[2, 9], [3, 9], [4, 9], [5, 9], [9, 9]])
+        self.assertAlmostEqual(t[0], -1.1428571)
+        self.assertAlmostEqual(p[0], 0.2861446)
+        self.assertTrue(numpy.isnan(p[1]))
+        t, p = perf_store.ttest_rel([1, 2, 3, 4, 5.0], [2, 3.5, 4, 5, 9.0])
+        self.assertAlmostEqual(t, -2.9154759)
+        self.assertAlmostEqual(p, 0.0434395)
+
+
+if __name__ == '__main__':
+    unittest.main()
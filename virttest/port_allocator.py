@@ -0,0 +1,186 @@
+"""
+Allocation of host ports shared by all virt-test processes.
+
+Probing a port (utils_misc.is_port_free) only tells the port is free now,
+it stays free until qemu binds it, so VM creation used to be serialized by
+one big lock. The allocator records leases of allocated ports in a file
+instead. Leased ports are skipped by other allocations until they are
+released by their owner, the lease expires (the port is bound by then) or
+the process holding the lease dies.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import json
+import time
+import fcntl
+import errno
+import logging
+import utils_misc
+
+
+LEASE_FILENAME = os.path.join('/tmp', 'virt-test-port-leases.json')
+# Seconds the port is reserved for its owner to start listening on it
+LEASE_TIME = 600
+
+
+class PortAllocator(object):
+
+    """
+    Allocator of host ports with leases stored in a JSON file. The file is
+    modified only under lock of file path + ".lock".
+    """
+
+    def __init__(self, path=LEASE_FILENAME, lease_time=LEASE_TIME):
+        """
+        :param path: Path of lease file.
+        :param lease_time: Time in seconds after which leases expire.
+        """
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.lease_time = lease_time
+
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    def _read_leases(self):
+        try:
+            lease_file = open(self.path)
+            try:
+                leases = json.load(lease_file)
+            finally:
+                lease_file.close()
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((port, lease) for port, lease in leases.items()
+                    if lease["expires"] > now and
+                    self._pid_alive(lease["pid"]))
+
+    def _write_leases(self, leases):
+        tmp_path = "%s.%d" % (self.path, os.getpid())
+        lease_file = open(tmp_path, "w")
+        try:
+            json.dump(leases, lease_file)
+        finally:
+            lease_file.close()
+        os.rename(tmp_path, self.path)
+
+    def _modify(self, func):
+        """
+        Call func(leases) under lock and write the modified leases.
+
+        :return: Return value of func.
+        """
+        lockfile = open(self.lock_path, "a")
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        try:
+            leases = self._read_leases()
+            ret = func(leases)
+            self._write_leases(leases)
+            return ret
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def allocate(self, start_port, end_port, count=1, owner=None,
+                 address="localhost"):
+        """
+        Lease count of host free ports in the range [start_port, end_port).
+
+        :param start_port: First port that will be checked.
+        :param end_port: Port immediately after the last one that will be
+                         checked.
+        :param count: Number of ports.
+        :param owner: Name of owner (e.g. VM instance) used to release ports.
+        :param address: Address on which ports are checked.
+        :return: List of ports, shorter than count if the range is
+                 exhausted.
+        """
+        def _allocate(leases):
+            ports = []
+            expires = time.time() + self.lease_time
+            for port in xrange(start_port, end_port):
+                if len(ports) >= count:
+                    break
+                if (str(port) not in leases and
+                        utils_misc.is_port_free(port, address)):
+                    leases[str(port)] = {"pid": os.getpid(), "owner": owner,
+                                         "expires": expires}
+                    ports.append(port)
+            return ports
+
+        ports = self._modify(_allocate)
+        if len(ports) < count:
+            logging.warning("Only %d of %d ports free in range %d-%d",
+                            len(ports), count, start_port, end_port)
+        return ports
+
+    def release(self, ports=None, owner=None):
+        """
+        Release leases of ports.
+
+        :param ports: List of ports, None means all ports of owner.
+        :param owner: Release only ports leased by owner.
+        """
+        def _release(leases):
+            for port, lease in leases.items():
+                if ports is not None and int(port) not in ports:
+                    continue
+                if owner is not None and lease["owner"] != owner:
+                    continue
+                del leases[port]
+
+        self._modify(_release)
+
+    def leases(self):
+        """
+        :return: Dict of valid leases {port: lease}.
+        """
+        return dict((int(port), lease)
+                    for port, lease in self._read_leases().items())
+
+
+_allocator = None
+
+
+def get_allocator():
+    global _allocator
+    if _allocator is None:
+        _allocator = PortAllocator()
+    return _allocator
+
+
+def allocate_ports(start_port, end_port, count, owner=None,
+                   address="localhost"):
+    """
+    Lease count of host free ports in the range [start_port, end_port).
+    See PortAllocator.allocate().
+    """
+    return get_allocator().allocate(start_port, end_port, count, owner,
+                                    address)
+
+
+def allocate_port(start_port, end_port, owner=None, address="localhost"):
+    """
+    Lease a host free port in the range [start_port, end_port).
+
+    :return: Port or None if there is no free port in the range.
+    """
+    ports = allocate_ports(start_port, end_port, 1, owner, address)
+    if ports:
+        return ports[0]
+    return None
+
+
+def release_ports(owner):
+    """
+    Release all ports leased by owner.
+    """
+    get_allocator().release(owner=owner)
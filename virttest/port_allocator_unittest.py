@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import common
+import port_allocator
+
+
+class PortAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "leases.json")
+        self.allocator = port_allocator.PortAllocator(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_allocate_release(self):
+        ports = self.allocator.allocate(16000, 16100, 3, "vm1")
+        self.assertEqual(len(ports), 3)
+        # Leases are shared through the file
+        other = port_allocator.PortAllocator(self.path)
+        other_ports = other.allocate(16000, 16100, 3, "vm2")
+        self.assertEqual(len(other_ports), 3)
+        self.assertFalse(set(ports) & set(other_ports))
+        self.assertEqual(sorted(self.allocator.leases()),
+                         sorted(ports + other_ports))
+
+        other.release(owner="vm1")
+        self.assertEqual(sorted(other.leases()), sorted(other_ports))
+        self.assertEqual(self.allocator.allocate(16000, 16100, 3, "vm3"),
+                         ports)
+
+    def test_exhausted(self):
+        self.assertEqual(len(self.allocator.allocate(16000, 16002, 5)), 2)
+        self.assertEqual(self.allocator.allocate(16000, 16002, 1), [])
+
+    def test_invalid_leases(self):
+        expires = time.time() + 100
+        dead_pid = os.fork()
+        if not dead_pid:
+            os._exit(0)
+        os.waitpid(dead_pid, 0)
+        leases = {"16000": {"pid": os.getpid(), "owner": None,
+                            "expires": time.time() - 1},
+                  "16001": {"pid": dead_pid, "owner": None,
+                            "expires": expires},
+                  "16002": {"pid": os.getpid(), "owner": None,
+                            "expires": expires}}
+        json.dump(leases, open(self.path, "w"))
+        self.assertEqual(self.allocator.leases().keys(), [16002])
+        self.assertEqual(self.allocator.allocate(16000, 16003, 3),
+                         [16000, 16001])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,11 @@ a given file size or record size, and then generate a series of 2D and 3D
 graphs. The graph generation functionality depends on gnuplot, and if it
 is not present, functionality degrates gracefully.
 
+When numpy is available, results are parsed into arrays and the geometric
+means and run comparisons are computed on whole arrays, which makes the
+analysis of large result sets (many files, many runs) fast. Without numpy
+the same results are computed in pure python.
+
 :copyright: Red Hat 2010
 """
 import os
@@ -20,10 +25,17 @@ from autotest.client.shared import error
 from autotest.client import utils, os_dep
 import utils_misc
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 _LABELS = ['file_size', 'record_size', 'write', 'rewrite', 'read', 'reread',
            'randread', 'randwrite', 'bkwdread', 'recordrewrite', 'strideread',
            'fwrite', 'frewrite', 'fread', 'freread']
+# Smaller matrices are compared faster element by element
+_ARRAY_COMPARE_SIZE = 1000
 
 
 def geometric_mean(values):
@@ -41,9 +53,132 @@ def geometric_mean(values):
     n = len(values)
     if n == 0:
         return None
+    if numpy is not None:
+        return float(numpy.exp(numpy.log(numpy.array(values,
+                                                     dtype=float)).mean()))
     return math.exp(sum([math.log(x) for x in values]) / n)
 
 
+def parse_results(fileobj):
+    """
+    Parse an IOzone results file into an array.
+
+    Only lines with 15 integer fields (the result lines) are used. The file
+    is read in one pass and converted by numpy at once.
+
+    :param fileobj: File object that will be parsed.
+    :return: numpy array n x 15 with the IOzone results of the file.
+    """
+    rows = []
+    for line in fileobj:
+        fields = line.split()
+        if len(fields) == 15 and fields[0].isdigit():
+            rows.append(line)
+    data = numpy.fromstring(" ".join(rows), dtype=numpy.int64, sep=" ")
+    if data.size != len(rows) * 15:
+        # Some of the lines are not results, check them one by one
+        data = []
+        for line in rows:
+            try:
+                data.extend([int(i) for i in line.split()])
+            except ValueError:
+                continue
+        data = numpy.array(data, dtype=numpy.int64)
+    return data.reshape(-1, 15)
+
+
+class IOzoneAggregator(object):
+
+    """
+    Streaming geometric means of IOzone throughput results.
+
+    Results are added array by array (usually one array per results file),
+    only the sums of logarithms and counts are kept, so any number of files
+    can be aggregated in constant memory. Requires numpy.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.log_sum = numpy.zeros(13)
+        # label -> {size: [count, log_sum]}
+        self.sizes = {'file_size': {}, 'record_size': {}}
+
+    def add(self, results):
+        """
+        Add results to the aggregation.
+
+        :param results: numpy array n x 15 (see parse_results).
+        """
+        if not len(results):
+            return
+        old_settings = numpy.seterr(divide='ignore')
+        try:
+            logs = numpy.log(results[:, 2:].astype(float))
+        finally:
+            numpy.seterr(**old_settings)
+        self.count += len(results)
+        self.log_sum += logs.sum(axis=0)
+        for label, sizes in self.sizes.iteritems():
+            column = results[:, _LABELS.index(label)]
+            keys, inverse = numpy.unique(column, return_inverse=True)
+            log_sums = numpy.column_stack([
+                numpy.bincount(inverse, weights=logs[:, i],
+                               minlength=len(keys)) for i in xrange(13)])
+            counts = numpy.bincount(inverse)
+            for key, count, log_sum in zip(keys.tolist(), counts.tolist(),
+                                           log_sums):
+                if key in sizes:
+                    sizes[key][0] += count
+                    sizes[key][1] += log_sum
+                else:
+                    sizes[key] = [count, log_sum]
+
+    def process_results(self, label=None):
+        """
+        Return the averages in the same format as
+        IOzoneAnalyzer.process_results().
+
+        :param label: 'file_size', 'record_size' or None for the average of
+                all results.
+        :return: A list of lines with geometric averages in MB/s.
+        """
+        if label is None:
+            if not self.count:
+                return []
+            averages = numpy.exp(self.log_sum / self.count) / 1024.0
+            return [averages.astype(numpy.int64).tolist()]
+        sizes = sorted(self.sizes[label])
+        if not sizes:
+            return []
+        counts = numpy.array([self.sizes[label][size][0] for size in sizes],
+                             dtype=float)
+        log_sums = numpy.array([self.sizes[label][size][1]
+                                for size in sizes])
+        averages = numpy.exp(log_sums / counts[:, None]) / 1024.0
+        return [[size] + line for size, line in
+                zip(sizes, averages.astype(numpy.int64).tolist())]
+
+
+def aggregate_files(paths):
+    """
+    Aggregate the results of many IOzone results files.
+
+    Files are parsed and added one by one, so only one file is held in
+    memory at a time.
+
+    :param paths: List of paths to IOzone results files.
+    :return: IOzoneAggregator with the results of all the files.
+    """
+    aggregator = IOzoneAggregator()
+    for path in paths:
+        fileobj = open(path, 'r')
+        try:
+            aggregator.add(parse_results(fileobj))
+        finally:
+            fileobj.close()
+    return aggregator
+
+
 def compare_matrices(matrix1, matrix2, treshold=0.05):
     """
     Compare 2 matrices nxm and return a matrix nxm with comparison data
@@ -53,6 +188,9 @@ def compare_matrices(matrix1, matrix2, treshold=0.05):
     :param treshold: Any difference bigger than this percent treshold will be
             reported.
     """
+    if (numpy is not None and matrix1 and matrix2 and
+            len(matrix1) * len(matrix1[0]) >= _ARRAY_COMPARE_SIZE):
+        return _compare_arrays(matrix1, matrix2, treshold)
     improvements = 0
     regressions = 0
     same = 0
@@ -69,7 +207,7 @@ def compare_matrices(matrix1, matrix2, treshold=0.05):
                 improvements += 1
                 new_line.append("+" + str((100 * ratio - 1) - 100))
             else:
-                same + 1
+                same += 1
                 if line1.index(element1) == 0:
                     new_line.append(element1)
                 else:
@@ -81,6 +219,41 @@ def compare_matrices(matrix1, matrix2, treshold=0.05):
     return (new_matrix, improvements, regressions, total)
 
 
+def _compare_arrays(matrix1, matrix2, treshold):
+    """
+    numpy implementation of compare_matrices().
+    """
+    rows = min(len(matrix1), len(matrix2))
+    columns = min(len(matrix1[0]), len(matrix2[0]))
+    array1 = numpy.array([line[:columns] for line in matrix1[:rows]],
+                         dtype=float)
+    array2 = numpy.array([line[:columns] for line in matrix2[:rows]],
+                         dtype=float)
+    ratio = array2 / array1
+    regressed = ratio < (1 - treshold)
+    improved = ratio > (1 + treshold)
+    improvements = int(improved.sum())
+    regressions = int(regressed.sum())
+    total = ratio.size
+    differences = ((100 * ratio - 1) - 100).tolist()
+
+    new_matrix = []
+    for i, line in enumerate(differences):
+        new_line = []
+        for j, difference in enumerate(line):
+            if regressed[i, j]:
+                new_line.append(difference)
+            elif improved[i, j]:
+                new_line.append("+" + str(difference))
+            elif j == 0:
+                new_line.append(matrix1[i][0])
+            else:
+                new_line.append(".")
+        new_matrix.append(new_line)
+
+    return (new_matrix, improvements, regressions, total)
+
+
 class IOzoneAnalyzer(object):
 
     """
@@ -91,8 +264,8 @@ class IOzoneAnalyzer(object):
     * Summary of throughput for all file sizes
     * Summary of throughput for all record sizes
 
-    If more than one file is provided to the analyzer object, a comparison
-    between the two runs is made, searching for regressions in performance.
+    If more than one file is provided to the analyzer object, each run is
+    compared with the first one, searching for regressions in performance.
     """
 
     def __init__(self, list_files, output_dir):
@@ -320,22 +493,36 @@ class IOzoneAnalyzer(object):
             fileobj = open(path, 'r')
             logging.info('FILE: %s', path)
 
-            results = self.parse_file(fileobj)
-
-            overall_results = self.process_results(results)
-            record_size_results = self.process_results(results, 'record_size')
-            file_size_results = self.process_results(results, 'file_size')
+            if numpy is not None:
+                aggregator = IOzoneAggregator()
+                aggregator.add(parse_results(fileobj))
+                overall_results = aggregator.process_results()
+                record_size_results = aggregator.process_results(
+                    'record_size')
+                file_size_results = aggregator.process_results('file_size')
+            else:
+                results = self.parse_file(fileobj)
+                overall_results = self.process_results(results)
+                record_size_results = self.process_results(results,
+                                                           'record_size')
+                file_size_results = self.process_results(results,
+                                                         'file_size')
+            fileobj.close()
             self.report(
                 overall_results, record_size_results, file_size_results)
 
-            if len(self.list_files) == 2:
+            if len(self.list_files) > 1:
                 overall.append(overall_results)
                 record_size.append(record_size_results)
                 file_size.append(file_size_results)
 
-        if len(self.list_files) == 2:
-            record_comparison = compare_matrices(*record_size)
-            file_comparison = compare_matrices(*file_size)
+        for i in xrange(1, len(record_size)):
+            if len(self.list_files) > 2:
+                logging.info('COMPARISON: %s against %s', self.list_files[i],
+                             self.list_files[0])
+            record_comparison = compare_matrices(record_size[0],
+                                                 record_size[i])
+            file_comparison = compare_matrices(file_size[0], file_size[i])
             self.report_comparison(record_comparison, file_comparison)
 
 
@@ -483,10 +670,6 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
-    if len(args) > 2:
-        parser.print_help()
-        sys.exit(1)
-
     o = os.path.join(os.getcwd(),
                      "iozone-graphs-%s" % time.strftime('%Y-%m-%d-%H.%M.%S'))
     if not os.path.isdir(o):
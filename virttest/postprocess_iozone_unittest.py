@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import common
+import postprocess_iozone
+
+
+def iozone_output(seed, file_sizes=(64, 128, 256, 512),
+                  record_sizes=(4, 8, 16, 32, 64)):
+    """
+    Return text of a synthetic IOzone output.
+    """
+    rand = random.Random(seed)
+    lines = ["\tIozone: Performance Test of File I/O",
+             "\tOPS Mode. Output is in operations per second.",
+             "              KB  reclen   write rewrite    read    reread"]
+    for file_size in file_sizes:
+        for record_size in record_sizes:
+            if record_size > file_size:
+                continue
+            values = [file_size, record_size]
+            values += [rand.randint(100000, 4000000) for _ in xrange(13)]
+            lines.append(" ".join("%8d" % value for value in values))
+    lines.append("")
+    lines.append("iozone test complete.")
+    return "\n".join(lines) + "\n"
+
+
+class IOzoneAnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = postprocess_iozone.numpy
+        self.tmpdir = tempfile.mkdtemp()
+        self.analyzer = postprocess_iozone.IOzoneAnalyzer([], self.tmpdir)
+
+    def tearDown(self):
+        postprocess_iozone.numpy = self.numpy
+        shutil.rmtree(self.tmpdir)
+
+    def pure_results(self, results, label=None):
+        postprocess_iozone.numpy = None
+        try:
+            return self.analyzer.process_results(results, label)
+        finally:
+            postprocess_iozone.numpy = self.numpy
+
+    def assertAlmostEqualMatrix(self, matrix1, matrix2):
+        # int() of geometric means may differ by rounding of the logarithms
+        self.assertEqual(len(matrix1), len(matrix2))
+        for line1, line2 in zip(matrix1, matrix2):
+            self.assertEqual(len(line1), len(line2))
+            for value1, value2 in zip(line1, line2):
+                self.assertTrue(abs(value1 - value2) <= 1,
+                                "%s != %s" % (line1, line2))
+
+    def test_parse(self):
+        text = iozone_output(1) + "1 2 3 4 5 6 7 8 9 10 11 12 13 14 x\n"
+        results = self.analyzer.parse_file(StringIO.StringIO(text))
+        self.assertEqual(len(results), 20)
+        if self.numpy is None:
+            return
+        array = postprocess_iozone.parse_results(StringIO.StringIO(text))
+        self.assertEqual(array.shape, (20, 15))
+        self.assertEqual(array.tolist(), results)
+
+    def test_aggregation(self):
+        if self.numpy is None:
+            return
+        texts = [iozone_output(seed) for seed in xrange(3)]
+        results = []
+        aggregator = postprocess_iozone.IOzoneAggregator()
+        for text in texts:
+            aggregator.add(postprocess_iozone.parse_results(
+                StringIO.StringIO(text)))
+            results += self.analyzer.parse_file(StringIO.StringIO(text))
+        for label in (None, 'file_size', 'record_size'):
+            self.assertAlmostEqualMatrix(aggregator.process_results(label),
+                                         self.pure_results(results, label))
+        self.assertEqual([line[0] for line in
+                          aggregator.process_results('record_size')],
+                         [4, 8, 16, 32, 64])
+
+        paths = []
+        for i, text in enumerate(texts):
+            paths.append(os.path.join(self.tmpdir, "iozone-%d" % i))
+            open(paths[-1], "w").write(text)
+        self.assertEqual(postprocess_iozone.aggregate_files(
+            paths).process_results('file_size'),
+            aggregator.process_results('file_size'))
+
+    def test_compare_matrices(self):
+        matrix1 = [[4, 100, 200, 300], [8, 100, 200, 300]]
+        matrix2 = [[4, 90, 202, 400], [8, 100, 100, 300]]
+        expected = ([[4, -11.0, ".", "+32.3333333333"],
+                     [8, ".", -51.0, "."]], 1, 2, 8)
+        self.assertEqual(postprocess_iozone.compare_matrices(matrix1,
+                                                             matrix2),
+                         expected)
+        if self.numpy is not None:
+            self.assertEqual(postprocess_iozone._compare_arrays(matrix1,
+                                                                matrix2,
+                                                                0.05),
+                             expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -355,14 +355,9 @@ class QSparseBus(object):
         :param device: qdevices.QBaseDevice device
         :return: True when removed, False when the device wasn't found
         """
-        if device in self.bus.itervalues():
-            remove = None
-            for key, item in self.bus.iteritems():
-                if item is device:
-                    remove = key
-                    break
-            if remove is not None:
-                del(self.bus[remove])
+        for key, item in self.bus.iteritems():
+            if item is device:
+                del(self.bus[key])
                 return True
         return False
 
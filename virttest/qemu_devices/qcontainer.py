@@ -22,6 +22,78 @@ import qdevices
 import shutil
 
 
+def _remove_from_index(index, key, item):
+    """
+    Remove item (identity) from list index[key], drop empty lists.
+    """
+    items = index.get(key)
+    if items is None:
+        return
+    for i, _item in enumerate(items):
+        if _item is item:
+            del items[i]
+            break
+    if not items:
+        del index[key]
+
+
+def _params_diff(device, device2, dynamic):
+    """
+    :return: {param: (value, value2)} of params which differ, missing
+             params are None, values of dynamic params are "DYN" unless
+             dynamic is set.
+    """
+    def _value(dev, param):
+        if not dynamic and param in dev.dynamic_params:
+            return "DYN"
+        return dev.params.get(param)
+
+    out = {}
+    for param in set(device.params.keys()) | set(device2.params.keys()):
+        value = _value(device, param)
+        value2 = _value(device2, param)
+        if value != value2:
+            out[param] = (value, value2)
+    return out
+
+
+class DevContainerDiff(object):
+
+    """
+    Difference of two DevContainers (see DevContainer.diff())
+    """
+
+    def __init__(self, dynamic=False):
+        self.dynamic = dynamic  # whether dynamic params were compared
+        self.added = []     # devices present only in the other container
+        self.removed = []   # devices present only in this container
+        self.changed = []   # (device, other_device, {param: (val, val2)})
+
+    def __nonzero__(self):
+        """ :return: True when containers differ """
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        out = []
+        for device in self.removed:
+            out.append("- %s" % device.str_short())
+        for device in self.added:
+            out.append("+ %s" % device.str_short())
+        for device, device2, params in self.changed:
+            if params:
+                out.append("~ %s: %s" % (device.str_short(), ", ".join(
+                    "%s=%s->%s" % (param, params[param][0],
+                                   params[param][1])
+                    for param in sorted(params))))
+            else:
+                out.append("~ %s: %s -> %s" % (device.str_short(),
+                                               device.cmdline_cached(
+                                                   self.dynamic),
+                                               device2.cmdline_cached(
+                                                   self.dynamic)))
+        return "\n".join(out)
+
+
 #
 # Device container (device representation of VM)
 # This class represents VM by storing all devices and their connections (buses)
@@ -96,6 +168,22 @@ class DevContainer(object):
         self.strict_mode = strict_mode == 'yes'
         self.__devices = []
         self.__buses = []
+        # Indexes of devices and buses, maintained by __add_*/__remove_*
+        self.__device_ids = {}          # id(device): device
+        self.__device_aids = {}         # aid: device
+        self.__device_qids = {}         # qid: [devices]
+        self.__device_qid_keys = {}     # id(device): qid it's indexed by
+        self.__qids_version = qdevices.QBaseDevice.qid_version
+        self.__device_attrs = {}        # (attribute, value): [devices]
+        self.__device_buses = {}        # id(device): [parent buses]
+        self.__aid_next = {}            # qid: lowest possibly free aid suffix
+        self.__bus_types = {}           # type: [buses]
+        self.__bus_aobjects = {}        # aobject: [buses]
+        self.__bus_ids = {}             # busid: [buses]
+        self.__version = 0              # incremented on insert/remove
+        self.__param_index = {}         # param: {value: [devices]} or None
+        self.__param_index_version = None
+        self.__cmdline_cache = {}       # dynamic: (version, cmdline)
         self.__qemu_binary = qemu_binary
         self.__execute_qemu_last = None
         self.__execute_qemu_out = ""
@@ -108,12 +196,10 @@ class DevContainer(object):
         :raise KeyError: In case no match was found
         """
         if isinstance(item, qdevices.QBaseDevice):
-            if item in self.__devices:
+            if self.__find(item) is not None:
                 return item
-        elif item:
-            for device in self.__devices:
-                if device.get_aid() == item:
-                    return device
+        elif item and item in self.__device_aids:
+            return self.__device_aids[item]
         raise KeyError("Device %s is not in %s" % (item, self))
 
     def get(self, item):
@@ -124,14 +210,132 @@ class DevContainer(object):
         if item in self:
             return self[item]
 
+    def __find(self, device):
+        """
+        :param device: qdevices.QBaseDevice device
+        :return: The same or equal device stored in this container or None
+        """
+        if id(device) in self.__device_ids:
+            return device
+        stored = self.__device_aids.get(device.get_aid())
+        if stored is not None and stored == device:
+            return stored
+        for stored in self.__devices:
+            if stored == device:
+                return stored
+        return None
+
+    def __add_device(self, device):
+        """ Append device and add it into indexes """
+        self.__devices.append(device)
+        self.__device_ids[id(device)] = device
+        self.__device_aids[device.get_aid()] = device
+        self.__device_qids.setdefault(device.get_qid(), []).append(device)
+        self.__device_qid_keys[id(device)] = device.get_qid()
+        for attr in ('type', 'aobject'):
+            key = (attr, getattr(device, attr))
+            self.__device_attrs.setdefault(key, []).append(device)
+        self.__version += 1
+
+    def __remove_device(self, device):
+        """ Remove device (stored object) from list and indexes """
+        for i, stored in enumerate(self.__devices):
+            if stored is device:
+                del self.__devices[i]
+                break
+        del self.__device_ids[id(device)]
+        self.__device_buses.pop(id(device), None)
+        aid = device.get_aid()
+        if self.__device_aids.get(aid) is device:
+            del self.__device_aids[aid]
+            prefix, _, suffix = aid.rpartition("__")
+            if suffix.isdigit():
+                self.__aid_next[prefix] = min(self.__aid_next.get(prefix, 0),
+                                              int(suffix))
+        self.__update_qids()
+        _remove_from_index(self.__device_qids,
+                           self.__device_qid_keys.pop(id(device)), device)
+        for attr in ('type', 'aobject'):
+            _remove_from_index(self.__device_attrs,
+                               (attr, getattr(device, attr)), device)
+        self.__version += 1
+
+    def __update_qids(self):
+        """
+        Re-key devices, whose qid changed since they were indexed. It's
+        needed only after set_param('id') of a stored device.
+        """
+        if self.__qids_version == qdevices.QBaseDevice.qid_version:
+            return
+        for device in self.__devices:
+            qid = device.get_qid()
+            old_qid = self.__device_qid_keys[id(device)]
+            if qid != old_qid:
+                _remove_from_index(self.__device_qids, old_qid, device)
+                self.__device_qids.setdefault(qid, []).append(device)
+                self.__device_qid_keys[id(device)] = qid
+        self.__qids_version = qdevices.QBaseDevice.qid_version
+
+    def __add_bus(self, bus):
+        """ Insert bus (as the first one) and add it into indexes """
+        self.__buses.insert(0, bus)
+        self.__bus_types.setdefault(bus.type, []).insert(0, bus)
+        self.__bus_aobjects.setdefault(bus.aobject, []).insert(0, bus)
+        self.__bus_ids.setdefault(bus.busid, []).insert(0, bus)
+
+    def __remove_bus(self, bus):
+        """ Remove bus from list and indexes """
+        self.__buses.remove(bus)
+        _remove_from_index(self.__bus_types, bus.type, bus)
+        _remove_from_index(self.__bus_aobjects, bus.aobject, bus)
+        _remove_from_index(self.__bus_ids, bus.busid, bus)
+
+    def __get_param_index(self, param):
+        """
+        :param param: Name of device param
+        :return: Index {value: [devices]} of param or None when some value
+                 is not hashable. Indexes are rebuilt lazily after any
+                 device or params change.
+        """
+        version = (self.__version, qdevices.QBaseDevice.params_version)
+        if self.__param_index_version != version:
+            self.__param_index = {}
+            self.__param_index_version = version
+        if param not in self.__param_index:
+            index = {}
+            try:
+                for device in self.__devices:
+                    if param in device.params:
+                        index.setdefault(device.params[param],
+                                         []).append(device)
+            except TypeError:   # unhashable value
+                index = None
+            self.__param_index[param] = index
+        return self.__param_index[param]
+
     def get_by_properties(self, filt):
         """
         Return list of matching devices
         :param filt: filter {'property': 'value', ...}
         :type filt: dict
         """
+        candidates = self.__devices
+        for key, value in filt.iteritems():
+            try:
+                if key == 'aid':
+                    devices = [self.__device_aids[value]]
+                elif key in ('type', 'aobject'):
+                    devices = self.__device_attrs.get((key, value), [])
+                else:
+                    continue
+            except (KeyError, TypeError):
+                if key == 'aid' and value is not None:
+                    return []
+                continue
+            if len(devices) < len(candidates):
+                candidates = devices
         out = []
-        for device in self.__devices:
+        for device in candidates:
             for key, value in filt.iteritems():
                 if not hasattr(device, key):
                     break
@@ -147,8 +351,19 @@ class DevContainer(object):
         :param filt: filter {'param': 'value', ...}
         :type filt: dict
         """
+        candidates = self.__devices
+        for key, value in filt.iteritems():
+            index = self.__get_param_index(key)
+            if index is None:
+                continue
+            try:
+                devices = index.get(value, [])
+            except TypeError:
+                continue
+            if len(devices) < len(candidates):
+                candidates = devices
         out = []
-        for device in self.__devices:
+        for device in candidates:
             for key, value in filt.iteritems():
                 if key not in device.params:
                     break
@@ -186,12 +401,14 @@ class DevContainer(object):
                 # One child might be already removed from other child's bus
                 if dev in self:
                     self.remove(dev, True)
-        if device in self.__devices:    # It might be removed from child bus
-            for bus in self.__buses:        # Remove from parent_buses
+        device = self.__find(device)
+        if device is not None:  # It might be removed from child bus
+            # Remove from parent_buses
+            for bus in self.__device_buses.get(id(device), self.__buses):
                 bus.remove(device)
             for bus in device.child_bus:    # Remove child buses from vm buses
-                self.__buses.remove(bus)
-            self.__devices.remove(device)   # Remove from list of devices
+                self.__remove_bus(bus)
+            self.__remove_device(device)    # Remove from list of devices
 
     def wash_the_device_out(self, device):
         """
@@ -199,9 +416,8 @@ class DevContainer(object):
         :param device: qdevices.QBaseDevice device
         """
         # remove device from parent buses
-        for bus in self.__buses:
-            if device in bus:
-                bus.remove(device)
+        for bus in self.__device_buses.pop(id(device), self.__buses):
+            bus.remove(device)
         # remove child devices
         for bus in device.child_bus:
             for dev in device.get_children():
@@ -209,10 +425,11 @@ class DevContainer(object):
                     self.remove(dev, True)
             # remove child_buses from self.__buses
             if bus in self.__buses:
-                self.__buses.remove(bus)
+                self.__remove_bus(bus)
         # remove device from self.__devices
-        if device in self.__devices:
-            self.__devices.remove(device)
+        device = self.__find(device)
+        if device is not None:
+            self.__remove_device(device)
 
     def __len__(self):
         """ :return: Number of inserted devices """
@@ -225,12 +442,10 @@ class DevContainer(object):
         :return: True - yes, False - no
         """
         if isinstance(item, qdevices.QBaseDevice):
-            if item in self.__devices:
+            if self.__find(item) is not None:
                 return True
         elif item:
-            for device in self.__devices:
-                if device.get_aid() == item:
-                    return True
+            return item in self.__device_aids
         return False
 
     def __iter__(self):
@@ -258,10 +473,21 @@ class DevContainer(object):
                        "_DevContainer__state",
                        "allow_hotplugged_vm"):
                 continue
+            if key in self.__index_attrs:
+                continue
             if key not in qdev2 or qdev2[key] != value:
                 return False
         return True
 
+    # Indexes of devices/buses, compared as part of devices/buses
+    __index_attrs = tuple("_DevContainer__%s" % _ for _ in
+                          ("device_ids", "device_aids", "device_qids",
+                           "device_qid_keys", "qids_version", "device_attrs",
+                           "device_buses", "aid_next",
+                           "bus_types", "bus_aobjects", "bus_ids", "version",
+                           "param_index", "param_index_version",
+                           "cmdline_cache"))
+
     def __ne__(self, qdev2):
         """ Are the VM representation different? """
         return not self.__eq__(qdev2)
@@ -296,12 +522,10 @@ class DevContainer(object):
         :param qid: qemu id
         :return: List of items with matching qemu id
         """
-        ret = []
         if qid:
-            for device in self:
-                if device.get_qid() == qid:
-                    ret.append(device)
-        return ret
+            self.__update_qids()
+            return list(self.__device_qids.get(qid, []))
+        return []
 
     def str_short(self):
         """ Short string representation of all devices """
@@ -360,9 +584,10 @@ class DevContainer(object):
         """
         if qid and qid not in self:
             return qid
-        i = 0
+        i = self.__aid_next.get(qid, 0)
         while "%s__%d" % (qid, i) in self:
             i += 1
+        self.__aid_next[qid] = i + 1
         return "%s__%d" % (qid, i)
 
     def has_option(self, option):
@@ -427,8 +652,20 @@ class DevContainer(object):
         :return: All matching buses
         :rtype: List of QSparseBus
         """
+        bus_type = bus_spec.get('type')
+        candidates = self.__buses
+        if bus_type and not isinstance(bus_type, (tuple, list)):
+            candidates = self.__bus_types.get(bus_type, [])
+        elif not (type_test and bus_type):
+            # All items have to match, use the most specific index
+            for key, index in (('busid', self.__bus_ids),
+                               ('aobject', self.__bus_aobjects)):
+                value = bus_spec.get(key)
+                if key in bus_spec and not isinstance(value, (tuple, list)):
+                    candidates = index.get(value, [])
+                    break
         buses = []
-        for bus in self.__buses:
+        for bus in candidates:
             if bus.match_bus(bus_spec, type_test):
                 buses.append(bus)
         return buses
@@ -489,6 +726,7 @@ class DevContainer(object):
             for device in added_devices:
                 self.wash_the_device_out(device)
 
+        self.__device_buses.setdefault(id(device), [])
         if strict_mode is None:
             _strict_mode = self.strict_mode
         if strict_mode is True:
@@ -523,6 +761,8 @@ class DevContainer(object):
                     continue
                 bus_returns.append(bus.insert(device, strict_mode))
                 if isinstance(bus_returns[-1], list):   # we are done
+                    self.__device_buses.setdefault(id(device),
+                                                   []).append(bus)
                     # The bus might require additional devices plugged first
                     try:
                         added_devices.extend(self.insert(bus_returns[-1]))
@@ -540,14 +780,14 @@ class DevContainer(object):
             raise DeviceInsertError(device, err, self)
         # 3
         for bus in device.child_bus:
-            self.__buses.insert(0, bus)
+            self.__add_bus(bus)
         # 4
         if device.get_qid() and self.get_by_qid(device.get_qid()):
             err = "Devices qid %s already used in VM\n" % device.get_qid()
             clean(device, added_devices)
             raise DeviceInsertError(device, err, self)
         device.set_aid(self.__create_unique_aid(device.get_qid()))
-        self.__devices.append(device)
+        self.__add_device(device)
         added_devices.append(device)
         return added_devices
 
@@ -651,8 +891,8 @@ class DevContainer(object):
         if "%s" not in bus_pattern:
             bus_pattern = bus_pattern + "%s"
         missing_buses = [bus_pattern % i for i in xrange(bus_count)]
-        for bus in self.__buses:
-            if bus.type == bus_type and re.match(bus_pattern % '\d+',
+        for bus in self.__bus_types.get(bus_type, []):
+            if re.match(bus_pattern % '\d+',
                                                  bus.busid):
                 if bus.busid in missing_buses:
                     missing_buses.remove(bus.busid)
@@ -678,19 +918,47 @@ class DevContainer(object):
 
     def cmdline(self, dynamic=True):
         """
-        Creates cmdline arguments for creating all defined devices
+        Creates cmdline arguments for creating all defined devices. Devices
+        cache their cmdlines, only devices changed since the last call are
+        rendered again.
         :return: cmdline of all devices (without qemu-cmd itself)
         """
-        out = ""
+        version = (self.__version, qdevices.QBaseDevice.params_version)
+        cached = self.__cmdline_cache.get(dynamic)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        out = []
         for device in self.__devices:
-            if dynamic:
-                _out = device.cmdline()
-            else:
-                _out = device.cmdline_nd()
+            _out = device.cmdline_cached(dynamic)
             if _out:
-                out += " %s" % _out
-        if out:
-            return out[1:]
+                out.append(_out)
+        out = " ".join(out) or None
+        self.__cmdline_cache[dynamic] = (version, out)
+        return out
+
+    def diff(self, qdev2, dynamic=False):
+        """
+        Structural difference between this and other container (eg. source
+        and destination of migration). Devices are paired by aid.
+        :param qdev2: The other DevContainer
+        :param dynamic: Compare values of dynamic params too
+        :return: DevContainerDiff, which is False when devices are alike
+        """
+        result = DevContainerDiff(dynamic)
+        for device in self.__devices:
+            device2 = qdev2.get(device.get_aid())
+            if device2 is None:
+                result.removed.append(device)
+                continue
+            params = _params_diff(device, device2, dynamic)
+            if (params or device.type != device2.type or
+                    device.cmdline_cached(dynamic) !=
+                    device2.cmdline_cached(dynamic)):
+                result.changed.append((device, device2, params))
+        for device2 in qdev2:
+            if device2.get_aid() not in self.__device_aids:
+                result.added.append(device2)
+        return result
 
     def hook_fill_scsi_hbas(self, params):
         """
@@ -59,6 +59,13 @@ class QBaseDevice(object):
 
     """ Base class of qemu objects """
 
+    # Incremented on every change of params of any device, invalidates
+    # params indexes and cmdline caches of DevContainers.
+    params_version = 0
+    # Incremented when id of a device stored in a DevContainer (with aid)
+    # changes, DevContainers re-key their qid indexes then.
+    qid_version = 0
+
     def __init__(self, dev_type="QBaseDevice", params=None, aobject=None,
                  parent_bus=None, child_bus=None):
         """
@@ -68,6 +75,7 @@ class QBaseDevice(object):
         :param parent_bus: list of dicts specifying the parent bus
         :param child_bus: list of buses, which this device provides
         """
+        self._cmdline_cache = {}    # dynamic: rendered cmdline
         self.aid = None         # unique per VM id
         self.type = dev_type    # device type
         self.aobject = aobject  # related autotest object
@@ -114,6 +122,9 @@ class QBaseDevice(object):
         :param option_type: type of the option (bool)
         :param dynamic: if true value is changed to DYN for not_dynamic compare
         """
+        self.params_changed()
+        if option == 'id' and self.aid is not None:
+            QBaseDevice.qid_version += 1
         if dynamic:
             if option not in self.dynamic_params:
                 self.dynamic_params.append(option)
@@ -136,6 +147,14 @@ class QBaseDevice(object):
             if option in self.dynamic_params:
                 self.dynamic_params.remove(option)
 
+    def params_changed(self):
+        """
+        Drop cached cmdline of this device and indexes of params. It's called
+        by set_param(), call it after modifying self.params directly.
+        """
+        QBaseDevice.params_version += 1
+        self._cmdline_cache.clear()
+
     def get_param(self, option, default=None):
         """ :return: object param """
         return self.params.get(option, default)
@@ -146,6 +165,9 @@ class QBaseDevice(object):
 
     def __delitem__(self, option):
         """ deletes self.params[option] """
+        self.params_changed()
+        if option == 'id' and self.aid is not None:
+            QBaseDevice.qid_version += 1
         del(self.params[option])
 
     def __len__(self):
@@ -249,6 +271,24 @@ class QBaseDevice(object):
         """
         self.cmdline()
 
+    def cmdline_cached(self, dynamic=True):
+        """
+        Cached version of cmdline() (or cmdline_nd()). The rendered cmdline
+        is reused until params of this device change.
+
+        :param dynamic: Render cmdline() when True, cmdline_nd() otherwise
+        :return: cmdline command to define this device
+        """
+        try:
+            return self._cmdline_cache[dynamic]
+        except KeyError:
+            if dynamic:
+                out = self.cmdline()
+            else:
+                out = self.cmdline_nd()
+            self._cmdline_cache[dynamic] = out
+            return out
+
     # pylint: disable=E0202
     def hotplug(self, monitor):
         """ :return: the output of monitor.cmd() hotplug command """
@@ -349,6 +389,19 @@ class QStringDevice(QBaseDevice):
         if cmdline_nd is None:
             self._cmdline_nd = cmdline
 
+    # Templates are modified directly (eg. tapfds update in qemu_vm), drop
+    # the cached cmdline when they change.
+    def __set_cmdline(self, cmdline):
+        self.__cmdline = cmdline
+        self.params_changed()
+
+    def __set_cmdline_nd(self, cmdline_nd):
+        self.__cmdline_nd = cmdline_nd
+        self.params_changed()
+
+    _cmdline = property(lambda self: self.__cmdline, __set_cmdline)
+    _cmdline_nd = property(lambda self: self.__cmdline_nd, __set_cmdline_nd)
+
     def cmdline(self):
         """ :return: cmdline command to define this device """
         try:
@@ -1032,6 +1032,121 @@ fdc
                             "%s\n%s\n%s" % (out.str_long(), dev.str_long(),
                                             qdev.str_long()))
 
+    def test_qdev_indexes(self):
+        """ Test lookups stay consistent with inserts, changes and removals """
+        qdev = self.create_qdev('vm1')
+        bus = qbuses.QPCIBus('pci.0', 'pci', 'a_pci0')
+        qdev.insert(qdevices.QDevice(params={'id': 'pci0'}, child_bus=bus))
+        devs = [qdevices.QDevice('virtio-blk-pci', {'id': 'disk%d' % i},
+                                 aobject='image%d' % i,
+                                 parent_bus={'aobject': 'a_pci0'})
+                for i in xrange(5)]
+        qdev.insert(devs)
+        anon = [qdevices.QDevice('ahci') for _ in xrange(3)]
+        qdev.insert(anon)
+        self.assertEqual([_.get_aid() for _ in anon], ['__0', '__1', '__2'])
+
+        self.assertEqual(qdev.get_by_qid('disk3'), [devs[3]])
+        self.assertEqual(qdev['disk3'], devs[3])
+        self.assertEqual(qdev.get_by_properties({'aobject': 'image2'}),
+                         [devs[2]])
+        self.assertEqual(qdev.get_by_properties({'aid': 'disk1',
+                                                 'aobject': 'image1'}),
+                         [devs[1]])
+        self.assertEqual(qdev.get_by_properties({'aid': 'missing'}), [])
+        self.assertEqual(qdev.get_by_params({'driver': 'virtio-blk-pci'}),
+                         devs)
+        self.assertEqual(qdev.get_buses({'aobject': 'a_pci0'}), [bus])
+        self.assertEqual(qdev.get_buses({'type': 'pci'}), [bus])
+
+        # Params changed after the insertion
+        devs[0].set_param('serial', 'abc')
+        self.assertEqual(qdev.get_by_params({'serial': 'abc'}), [devs[0]])
+        devs[0].set_param('serial', None)
+        self.assertEqual(qdev.get_by_params({'serial': 'abc'}), [])
+        # qid changed after the insertion
+        devs[1].set_param('id', 'renamed')
+        self.assertEqual(qdev.get_by_qid('renamed'), [devs[1]])
+        self.assertEqual(qdev.get_by_qid('disk1'), [])
+        self.assertRaises(qcontainer.DeviceError, qdev.insert,
+                          qdevices.QDevice('ahci', {'id': 'renamed'}))
+        qdev.remove(devs[1])
+        self.assertEqual(qdev.get_by_qid('renamed'), [])
+        devs[1].set_param('id', 'disk1')
+        qdev.insert(devs[1])
+        self.assertEqual(qdev.get_by_qid('disk1'), [devs[1]])
+
+        qdev.remove(devs[3])
+        self.assertEqual(qdev.get_by_qid('disk3'), [])
+        self.assertFalse('disk3' in qdev)
+        self.assertFalse(devs[3] in bus)
+        # devs[1] was re-inserted as the last one
+        self.assertEqual(qdev.get_by_params({'driver': 'virtio-blk-pci'}),
+                         [devs[0], devs[2], devs[4], devs[1]])
+        qdev.remove(anon[1])
+        dev = qdevices.QDevice('ahci')
+        qdev.insert(dev)
+        self.assertEqual(dev.get_aid(), '__1')
+        qdev.remove(qdev['pci0'])
+        self.assertEqual(qdev.get_buses({'type': 'pci'}), [])
+        self.assertEqual(qdev.get_by_params({'driver': 'virtio-blk-pci'}),
+                         [])
+
+    def test_qdev_cmdline_cache(self):
+        """ Test cached cmdlines are updated after changes """
+        qdev = self.create_qdev('vm1')
+        dev = qdevices.QDevice('virtio-blk-pci', {'id': 'disk0'})
+        string = qdevices.QStringDevice('str', {'fd': 3},
+                                        cmdline='-net fd=%(fd)s')
+        qdev.insert([dev, string])
+        out = qdev.cmdline()
+        self.assertTrue(out.endswith("-device virtio-blk-pci,id=disk0 "
+                                     "-net fd=3"), out)
+        self.assertTrue(qdev.cmdline() is out)
+
+        dev.set_param('serial', 'abc', dynamic=True)
+        self.assertTrue(qdev.cmdline().endswith(
+            "-device virtio-blk-pci,id=disk0,serial=abc -net fd=3"))
+        self.assertTrue(qdev.cmdline(False).endswith(
+            "-device virtio-blk-pci,id=disk0,serial=DYN -net fd=3"))
+        string.params['fd'] = 5
+        string.params_changed()
+        self.assertTrue(qdev.cmdline().endswith("-net fd=5"))
+        string._cmdline = "-net fd=%(fd)s,vhost=on"
+        self.assertTrue(qdev.cmdline().endswith("-net fd=5,vhost=on"))
+        qdev.remove(string)
+        self.assertTrue(qdev.cmdline().endswith("serial=abc"))
+
+    def test_qdev_diff(self):
+        """ Test structural diff of containers """
+        qdev1 = self.create_qdev('vm1')
+        qdev2 = self.create_qdev('vm1')
+        self.assertFalse(qdev1.diff(qdev2))
+        for qdev in (qdev1, qdev2):
+            qdev.insert(qdevices.QDevice('virtio-blk-pci', {'id': 'disk0'}))
+            qdev.insert(qdevices.QDevice('e1000', {'id': 'nic0'}))
+        self.assertFalse(qdev1.diff(qdev2))
+
+        qdev1['nic0'].set_param('mac', '9a:00:00:00:00:01', dynamic=True)
+        qdev2['nic0'].set_param('mac', '9a:00:00:00:00:02', dynamic=True)
+        self.assertFalse(qdev1.diff(qdev2))
+        diff = qdev1.diff(qdev2, dynamic=True)
+        self.assertEqual(len(diff.changed), 1)
+        self.assertEqual(diff.changed[0][:2], (qdev1['nic0'], qdev2['nic0']))
+        self.assertEqual(diff.changed[0][2], {'mac': ('9a:00:00:00:00:01',
+                                                      '9a:00:00:00:00:02')})
+
+        qdev1['disk0'].set_param('serial', 'abc')
+        qdev2.remove('nic0')
+        qdev2.insert(qdevices.QDevice('ahci', {'id': 'ahci0'}))
+        diff = qdev1.diff(qdev2)
+        self.assertEqual(diff.removed, [qdev1['nic0']])
+        self.assertEqual(diff.added, [qdev2['ahci0']])
+        self.assertEqual([_[0] for _ in diff.changed], [qdev1['disk0']])
+        self.assertEqual(diff.changed[0][2], {'serial': ('abc', None)})
+        self.assertEqual(str(diff), "- nic0\n+ ahci0\n"
+                                    "~ disk0: serial=abc->None")
+
     def test_qdev_equal(self):
         qdev1 = self.create_qdev('vm1', allow_hotplugged_vm='no')
         qdev2 = self.create_qdev('vm1', allow_hotplugged_vm='no')
@@ -6,9 +6,9 @@ Interfaces and helpers for the virtio_serial ports.
 from threading import Thread
 from collections import deque
 import aexpect
+import hashlib
 import logging
 import os
-import random
 import select
 import socket
 import time
@@ -17,6 +17,8 @@ import data_dir
 
 
 SOCKET_SIZE = 2048
+# Block length of the stream threads (ThStream*)
+STREAM_BLOCKLEN = 65536
 
 
 class VirtioPortException(Exception):
@@ -550,6 +552,9 @@ class ThSendCheck(Thread):
         else:
             rand_a = 0
             rand_b = 255
+        # Maps random bytes to characters from rand_a to rand_b - 1
+        charset = "".join(chr(rand_a + i % (rand_b - rand_a))
+                          for i in xrange(256))
         while not self.exitevent.isSet():
             # FIXME: workaround the problem with qemu-kvm stall when too
             # much data is sent without receiving
@@ -578,12 +583,9 @@ class ThSendCheck(Thread):
             if ret[1]:
                 # Generate blocklen of random data add them to the FIFO
                 # and send them over virtio_console
-                buf = ""
-                for _ in range(self.blocklen):
-                    char = "%c" % random.randrange(rand_a, rand_b)
-                    buf += char
-                    for queue in self.queues:
-                        queue.append(char)
+                buf = os.urandom(self.blocklen).translate(charset)
+                for queue in self.queues:
+                    queue.extend(buf)
                 target = self.idx + self.blocklen
                 while not self.exitevent.isSet() and self.idx < target:
                     try:
@@ -651,6 +653,7 @@ class ThRecv(Thread):
         self.port.settimeout(0.1)
         self.exitevent = event
         self.blocklen = blocklen
+        self.buf = bytearray(blocklen)
         self.idx = 0
         self.quiet = quiet
         self.ret_code = 1    # sets to 0 when finish properly
@@ -661,7 +664,7 @@ class ThRecv(Thread):
             while not self.exitevent.isSet():
                 # TODO: Workaround, it didn't work with select :-/
                 try:
-                    self.idx += len(self.port.recv(self.blocklen))
+                    self.idx += self.port.recv_into(self.buf)
                 except socket.timeout:
                     pass
             self.port.settimeout(self._port_timeout)
@@ -999,3 +1002,180 @@ class ThRecvCheck(Thread):
         logging.debug("ThRecvCheck %s: exit(%d)", self.getName(),
                       self.idx)
         self.ret_code = 0
+
+
+def _send_all(sock, data, exit_event):
+    """
+    Send all data to a socket with timeout, checking exit_event on timeouts.
+
+    :param data: memoryview of the data.
+    :return: Number of sent bytes (less than len(data) when exit_event
+             was set).
+    """
+    offset = 0
+    length = len(data)
+    while offset < length:
+        try:
+            offset += sock.send(data[offset:])
+        except socket.timeout:
+            if exit_event.isSet():
+                break
+    return offset
+
+
+class ThStreamSend(Thread):
+
+    """
+    Sender of random data from a preallocated buffer. The buffer is sent
+    without copies, the md5 sum of the sent stream is computed on the fly.
+    """
+
+    def __init__(self, sock, exit_event, size=0, blocklen=STREAM_BLOCKLEN,
+                 checksum=True):
+        """
+        :param sock: Destination socket (eg. port.sock).
+        :param exit_event: Exit event.
+        :param size: Number of bytes to send, 0 sends until exit_event.
+        :param blocklen: Block length.
+        :param checksum: Compute md5 sum of the sent data (self.md5).
+        """
+        Thread.__init__(self)
+        self.sock = sock
+        self.exitevent = exit_event
+        self.size = size
+        self.buf = bytearray(os.urandom(blocklen))
+        self.md5 = checksum and hashlib.md5() or None
+        self.idx = 0
+        self.elapsed = 0.0
+        self.ret_code = 1    # sets to 0 when finish properly
+
+    def run(self):
+        logging.debug("ThStreamSend %s: run", self.getName())
+        view = memoryview(self.buf)
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(1)
+        start = time.time()
+        try:
+            while not self.exitevent.isSet():
+                length = len(view)
+                if self.size:
+                    length = min(length, self.size - self.idx)
+                    if not length:
+                        break
+                sent = _send_all(self.sock, view[:length], self.exitevent)
+                if self.md5:
+                    self.md5.update(view[:sent])
+                self.idx += sent
+        finally:
+            self.elapsed = time.time() - start
+            self.sock.settimeout(timeout)
+        logging.debug("ThStreamSend %s: exit(%d)", self.getName(), self.idx)
+        self.ret_code = 0
+
+
+class ThStreamRecv(Thread):
+
+    """
+    Receiver of data into a preallocated buffer, the md5 sum of the received
+    stream is computed on the fly.
+    """
+
+    def __init__(self, sock, exit_event, size=0, blocklen=STREAM_BLOCKLEN,
+                 checksum=True):
+        """
+        :param sock: Source socket (eg. port.sock).
+        :param exit_event: Exit event.
+        :param size: Number of bytes to receive, 0 receives until
+                     exit_event or the end of the stream.
+        :param blocklen: Block length.
+        :param checksum: Compute md5 sum of the received data (self.md5).
+        """
+        Thread.__init__(self)
+        self.sock = sock
+        self.exitevent = exit_event
+        self.size = size
+        self.buf = bytearray(blocklen)
+        self.md5 = checksum and hashlib.md5() or None
+        self.idx = 0
+        self.elapsed = 0.0
+        self.ret_code = 1    # sets to 0 when finish properly
+
+    def run(self):
+        logging.debug("ThStreamRecv %s: run", self.getName())
+        view = memoryview(self.buf)
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(1)
+        start = time.time()
+        try:
+            while not self.exitevent.isSet():
+                length = len(view)
+                if self.size:
+                    length = min(length, self.size - self.idx)
+                    if not length:
+                        break
+                try:
+                    received = self.sock.recv_into(view, length)
+                except socket.timeout:
+                    continue
+                if not received:
+                    break
+                if self.md5:
+                    self.md5.update(view[:received])
+                self.idx += received
+        finally:
+            self.elapsed = time.time() - start
+            self.sock.settimeout(timeout)
+        logging.debug("ThStreamRecv %s: exit(%d)", self.getName(), self.idx)
+        self.ret_code = 0
+
+
+class ThStreamLoopback(Thread):
+
+    """
+    Forwards data from one socket to others through a preallocated buffer
+    (host side loopback).
+    """
+
+    def __init__(self, in_sock, out_socks, exit_event,
+                 blocklen=STREAM_BLOCKLEN):
+        """
+        :param in_sock: Source socket.
+        :param out_socks: List of destination sockets.
+        :param exit_event: Exit event.
+        :param blocklen: Block length.
+        """
+        Thread.__init__(self)
+        self.in_sock = in_sock
+        self.out_socks = out_socks
+        self.exitevent = exit_event
+        self.buf = bytearray(blocklen)
+        self.idx = 0
+        self.ret_code = 1    # sets to 0 when finish properly
+
+    def run(self):
+        logging.debug("ThStreamLoopback %s: run", self.getName())
+        view = memoryview(self.buf)
+        socks = [self.in_sock] + self.out_socks
+        timeouts = [sock.gettimeout() for sock in socks]
+        for sock in socks:
+            sock.settimeout(1)
+        try:
+            while not self.exitevent.isSet():
+                try:
+                    received = self.in_sock.recv_into(view)
+                except socket.timeout:
+                    continue
+                if not received:
+                    # Pass the end of the stream on
+                    for sock in self.out_socks:
+                        sock.shutdown(socket.SHUT_WR)
+                    break
+                for sock in self.out_socks:
+                    _send_all(sock, view[:received], self.exitevent)
+                self.idx += received
+        finally:
+            for sock, timeout in zip(socks, timeouts):
+                sock.settimeout(timeout)
+        logging.debug("ThStreamLoopback %s: exit(%d)", self.getName(),
+                      self.idx)
+        self.ret_code = 0
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import time
+import socket
+import threading
+import unittest
+from collections import deque
+
+import common
+import qemu_virtio_port
+
+
+class FakePort(object):
+
+    """
+    Host side of a port connected to a local socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
+class StreamThreadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def socketpair(self):
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socks.extend(pair)
+        return pair
+
+    def test_loopback(self):
+        size = 5 * 1024 * 1024 + 3
+        exit_event = threading.Event()
+        send_a, send_b = self.socketpair()
+        recv_a, recv_b = self.socketpair()
+        sender = qemu_virtio_port.ThStreamSend(send_a, exit_event, size,
+                                               blocklen=10000)
+        loopback = qemu_virtio_port.ThStreamLoopback(send_b, [recv_a],
+                                                     exit_event)
+        receiver = qemu_virtio_port.ThStreamRecv(recv_b, exit_event)
+        for thread in (receiver, loopback, sender):
+            thread.start()
+        sender.join(60)
+        send_a.shutdown(socket.SHUT_WR)
+        # The end of the stream is passed through the loopback
+        receiver.join(60)
+        loopback.join(60)
+        self.assertEqual([sender.ret_code, loopback.ret_code,
+                          receiver.ret_code], [0, 0, 0])
+        self.assertEqual(sender.idx, size)
+        self.assertEqual(receiver.idx, size)
+        self.assertEqual(loopback.idx, size)
+        self.assertEqual(receiver.md5.hexdigest(), sender.md5.hexdigest())
+
+    def test_exit_event(self):
+        exit_event = threading.Event()
+        send_a, send_b = self.socketpair()
+        sender = qemu_virtio_port.ThStreamSend(send_a, exit_event)
+        receiver = qemu_virtio_port.ThStreamRecv(send_b, exit_event,
+                                                 checksum=False)
+        sender.start()
+        time.sleep(0.5)
+        # Nobody reads, the sender waits
+        self.assertTrue(sender.isAlive())
+        receiver.start()
+        time.sleep(0.2)
+        exit_event.set()
+        sender.join(5)
+        receiver.join(5)
+        self.assertFalse(sender.isAlive() or receiver.isAlive())
+        self.assertTrue(receiver.idx > 0)
+        self.assertEqual(receiver.md5, None)
+
+    def test_check_threads(self):
+        exit_event = threading.Event()
+        send_a, send_b = self.socketpair()
+        queue = deque()
+        sender = qemu_virtio_port.ThSendCheck(FakePort(send_a), exit_event,
+                                              [queue], blocklen=4096,
+                                              reduced_set=True)
+        receiver = qemu_virtio_port.ThRecvCheck(FakePort(send_b), queue,
+                                                exit_event, blocklen=4096)
+        receiver.start()
+        sender.start()
+        time.sleep(1)
+        exit_event.set()
+        sender.join(5)
+        receiver.join(5)
+        self.assertEqual([sender.ret_code, receiver.ret_code], [0, 0])
+        self.assertTrue(receiver.idx > 4096)
+        self.assertTrue(sender.idx - receiver.idx <= len(queue))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,9 +21,12 @@ import aexpect
 import qemu_virtio_port
 import remote
 import data_dir
+import hash_index
+import port_allocator
 import utils_net
 import arch
 import storage
+import utils_libguestfs
 
 
 class QemuSegFaultError(virt_vm.VMError):
@@ -210,8 +213,9 @@ class VM(virt_vm.BaseVM):
         """
         Verify if the userspace component (qemu) crashed.
         """
-        if "(core dumped)" in self.process.get_output():
-            for line in self.process.get_output().splitlines():
+        output = self.process.get_output()
+        if "(core dumped)" in output:
+            for line in output.splitlines():
                 if "(core dumped)" in line:
                     raise QemuSegFaultError(line)
 
@@ -219,8 +223,8 @@ class VM(virt_vm.BaseVM):
         """
         Verify KVM internal error.
         """
-        if "KVM internal error." in self.process.get_output():
-            out = self.process.get_output()
+        out = self.process.get_output()
+        if "KVM internal error." in out:
             out = out[out.find("KVM internal error."):]
             raise KVMInternalError(out)
 
@@ -844,7 +848,8 @@ class VM(virt_vm.BaseVM):
             spice_help = ""
             if devices.has_option("spice-help"):
                 spice_help = commands.getoutput("%s -device \\?" % qemu_binary)
-            s_port = str(utils_misc.find_free_port(*port_range))
+            s_port = str(port_allocator.allocate_port(*port_range,
+                                                      owner=self.instance))
             self.spice_options['spice_port'] = s_port
             cmd += " port=%s" % s_port
             for param in spice_params.split():
@@ -895,7 +900,8 @@ class VM(virt_vm.BaseVM):
                     spice_opts.append(opt_string % tmp)
                 elif fallback:
                     spice_opts.append(fallback)
-            s_port = str(utils_misc.find_free_port(*port_range))
+            s_port = str(port_allocator.allocate_port(*port_range,
+                                                      owner=self.instance))
             if optget("spice_port") == "generate":
                 if not self.is_alive():
                     self.spice_options['spice_port'] = s_port
@@ -925,7 +931,8 @@ class VM(virt_vm.BaseVM):
 
             if optget("spice_ssl") == "yes":
                 # SSL only part
-                t_port = str(utils_misc.find_free_port(*tls_port_range))
+                t_port = str(port_allocator.allocate_port(
+                    *tls_port_range, owner=self.instance))
                 if optget("spice_tls_port") == "generate":
                     if not self.is_alive():
                         self.spice_options['spice_tls_port'] = t_port
@@ -2103,6 +2110,7 @@ class VM(virt_vm.BaseVM):
             output_func=utils_misc.log_line,
             output_params=("serial-%s-%s.log" % (tmp_serial, self.name),),
             prompt=self.params.get("shell_prompt", "[\#\$]"))
+        self.set_console_output_limit(self.serial_console)
         del tmp_serial
 
     def create_virtio_console(self):
@@ -2119,6 +2127,7 @@ class VM(virt_vm.BaseVM):
                     output_func=utils_misc.log_line,
                     output_params=(logfile,),
                     prompt=self.params.get("shell_prompt", "[\#\$]"))
+                self.set_console_output_limit(self.virtio_console)
                 return
         if self.virtio_ports:
             logging.warning("No virtio console created in VM. Virtio ports: %s", self.virtio_ports)
@@ -2185,6 +2194,7 @@ class VM(virt_vm.BaseVM):
                                   " This shouldn't happens." % (len(devs),
                                                                 netdev_id))
                 devs[0].params.update(net_params)
+                devs[0].params_changed()
 
     def update_vga_global_default(self, params, migrate=None):
         """
@@ -2274,6 +2284,9 @@ class VM(virt_vm.BaseVM):
         params = self.params
         root_dir = self.root_dir
 
+        # Guestfish appliances must not keep the images open
+        utils_libguestfs.close_pooled_sessions()
+
         # Verify the md5sum of the ISO images
         for cdrom in params.objects("cdroms"):
             cdrom_params = params.object_params(cdrom)
@@ -2292,19 +2305,20 @@ class VM(virt_vm.BaseVM):
                 elif cdrom_params.get("md5sum_1m"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "first MB of ISO file...")
-                    actual_hash = utils.hash_file(iso, 1048576, method="md5")
+                    actual_hash = hash_index.get_file_hash(iso, "md5",
+                                                           1048576)
                     expected_hash = cdrom_params.get("md5sum_1m")
                     compare = True
                 elif cdrom_params.get("md5sum"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "ISO file...")
-                    actual_hash = utils.hash_file(iso, method="md5")
+                    actual_hash = hash_index.get_file_hash(iso, "md5")
                     expected_hash = cdrom_params.get("md5sum")
                     compare = True
                 elif cdrom_params.get("sha1sum"):
                     logging.debug("Comparing expected SHA1 sum with SHA1 sum "
                                   "of ISO file...")
-                    actual_hash = utils.hash_file(iso, method="sha1")
+                    actual_hash = hash_index.get_file_hash(iso, "sha1")
                     expected_hash = cdrom_params.get("sha1sum")
                     compare = True
                 if compare:
@@ -2314,16 +2328,18 @@ class VM(virt_vm.BaseVM):
                         raise virt_vm.VMHashMismatchError(actual_hash,
                                                           expected_hash)
 
-        # Make sure the following code is not executed by more than one thread
-        # at the same time
+        # Make sure host resources (TAP devices, assignable devices, ...) are
+        # not set up by more than one process at the same time. Ports are
+        # leased by port_allocator, so the lock is released before qemu is
+        # started.
         lockfile = open(CREATE_LOCK_FILENAME, "w+")
         fcntl.lockf(lockfile, fcntl.LOCK_EX)
 
         try:
             # Handle port redirections
             redir_names = params.objects("redirs")
-            host_ports = utils_misc.find_free_ports(
-                5000, 6000, len(redir_names))
+            host_ports = port_allocator.allocate_ports(
+                5000, 6000, len(redir_names), self.instance)
 
             old_redirs = {}
             if self.redirs:
@@ -2432,7 +2448,8 @@ class VM(virt_vm.BaseVM):
 
             # Find available VNC port, if needed
             if params.get("display") == "vnc":
-                self.vnc_port = utils_misc.find_free_port(5900, 6100)
+                self.vnc_port = port_allocator.allocate_port(
+                    5900, 6100, self.instance)
 
             # Find random UUID if specified 'uuid = random' in config file
             if params.get("uuid") == "random":
@@ -2448,242 +2465,243 @@ class VM(virt_vm.BaseVM):
                                   self.pa_pci_ids)
                 else:
                     raise virt_vm.VMPAError(pa_type)
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
 
-            if (name is None and params is None and root_dir is None and
-                    self.devices is not None):
-                self.update_system_dependent_devs()
-            # Make qemu command
-            try:
-                self.devices = self.make_create_command()
-                self.update_vga_global_default(params, migration_mode)
-                logging.debug(self.devices.str_short())
-                logging.debug(self.devices.str_bus_short())
-                qemu_command = self.devices.cmdline()
-            except error.TestNAError:
-                # TestNAErrors should be kept as-is so we generate SKIP
-                # results instead of bogus FAIL results
-                raise
-            except Exception:
-                for nic in self.virtnet:
-                    self._nic_tap_remove_helper(nic)
-                # TODO: log_last_traceback is being moved into autotest.
-                # use autotest.client.shared.base_utils when it's completed.
-                if 'log_last_traceback' in utils.__dict__:
-                    utils.log_last_traceback('Fail to create qemu command:')
-                else:
-                    utils_misc.log_last_traceback('Fail to create qemu'
-                                                  'command:')
-                raise virt_vm.VMStartError(self.name, 'Error occurred while '
-                                           'executing make_create_command(). '
-                                           'Check the log for traceback.')
-
-            # Add migration parameters if required
-            if migration_mode in ["tcp", "rdma", "x-rdma"]:
-                self.migration_port = utils_misc.find_free_port(5200, 6000)
-                qemu_command += (" -incoming " + migration_mode +
-                                 ":0:%d" % self.migration_port)
-            elif migration_mode == "unix":
-                self.migration_file = "/tmp/migration-unix-%s" % self.instance
-                qemu_command += " -incoming unix:%s" % self.migration_file
-            elif migration_mode == "exec":
-                if migration_exec_cmd is None:
-                    self.migration_port = utils_misc.find_free_port(5200, 6000)
-                    qemu_command += (' -incoming "exec:nc -l %s"' %
-                                     self.migration_port)
-                else:
-                    qemu_command += (' -incoming "exec:%s"' %
-                                     migration_exec_cmd)
-            elif migration_mode == "fd":
-                qemu_command += ' -incoming "fd:%d"' % (migration_fd)
-
-            p9_fs_driver = params.get("9p_fs_driver")
-            if p9_fs_driver == "proxy":
-                proxy_helper_name = params.get("9p_proxy_binary",
-                                               "virtfs-proxy-helper")
-                proxy_helper_cmd = utils_misc.get_path(root_dir,
-                                                       proxy_helper_name)
-                if not proxy_helper_cmd:
-                    raise virt_vm.VMConfigMissingError(self.name,
-                                                       "9p_proxy_binary")
-
-                p9_export_dir = params.get("9p_export_dir")
-                if not p9_export_dir:
-                    raise virt_vm.VMConfigMissingError(self.name,
-                                                       "9p_export_dir")
-
-                proxy_helper_cmd += " -p " + p9_export_dir
-                proxy_helper_cmd += " -u 0 -g 0"
-                p9_socket_name = params.get("9p_socket_name")
-                proxy_helper_cmd += " -s " + p9_socket_name
-                proxy_helper_cmd += " -n"
-
-                logging.info("Running Proxy Helper:\n%s", proxy_helper_cmd)
-                self.process = aexpect.run_tail(proxy_helper_cmd,
-                                                None,
-                                                logging.info,
-                                                "[9p proxy helper]",
-                                                auto_close=False)
-            else:
-                logging.info("Running qemu command (reformatted):\n%s",
-                             qemu_command.replace(" -", " \\\n    -"))
-                self.qemu_command = qemu_command
-                self.process = aexpect.run_tail(qemu_command,
-                                                None,
-                                                logging.info,
-                                                "[qemu output] ",
-                                                auto_close=False)
-
-            logging.info("Created qemu process with parent PID %d",
-                         self.process.get_pid())
-            self.start_time = time.time()
-            self.start_monotonic_time = utils_misc.monotonic_time()
-
-            # test doesn't need to hold tapfd's open
+        if (name is None and params is None and root_dir is None and
+                self.devices is not None):
+            self.update_system_dependent_devs()
+        # Make qemu command
+        try:
+            self.devices = self.make_create_command()
+            self.update_vga_global_default(params, migration_mode)
+            logging.debug(self.devices.str_short())
+            logging.debug(self.devices.str_bus_short())
+            qemu_command = self.devices.cmdline()
+        except error.TestNAError:
+            # TestNAErrors should be kept as-is so we generate SKIP
+            # results instead of bogus FAIL results
+            raise
+        except Exception:
             for nic in self.virtnet:
-                if 'tapfds' in nic:  # implies bridge/tap
-                    try:
-                        for i in nic.tapfds.split(':'):
-                            os.close(int(i))
-                        # qemu process retains access via open file
-                        # remove this attribute from virtnet because
-                        # fd numbers are not always predictable and
-                        # vm instance must support cloning.
-                        del nic['tapfds']
-                    # File descriptor is already closed
-                    except OSError:
-                        pass
-                if 'vhostfds' in nic:
-                    try:
-                        for i in nic.vhostfds.split(':'):
-                            os.close(int(i))
-                        del nic['vhostfds']
-                    except OSError:
-                        pass
-
-            # Make sure qemu is not defunct
-            if self.process.is_defunct():
-                logging.error("Bad things happened, qemu process is defunct")
-                err = ("Qemu is defunct.\nQemu output:\n%s"
-                       % self.process.get_output())
-                self.destroy()
-                raise virt_vm.VMStartError(self.name, err)
-
-            # Make sure the process was started successfully
-            if not self.process.is_alive():
-                status = self.process.get_status()
-                output = self.process.get_output().strip()
-                migration_in_course = migration_mode is not None
-                unknown_protocol = "unknown migration protocol" in output
-                if migration_in_course and unknown_protocol:
-                    e = VMMigrateProtoUnsupportedError(migration_mode, output)
-                else:
-                    e = virt_vm.VMCreateError(qemu_command, status, output)
-                self.destroy()
-                raise e
+                self._nic_tap_remove_helper(nic)
+            # TODO: log_last_traceback is being moved into autotest.
+            # use autotest.client.shared.base_utils when it's completed.
+            if 'log_last_traceback' in utils.__dict__:
+                utils.log_last_traceback('Fail to create qemu command:')
+            else:
+                utils_misc.log_last_traceback('Fail to create qemu'
+                                              'command:')
+            raise virt_vm.VMStartError(self.name, 'Error occurred while '
+                                       'executing make_create_command(). '
+                                       'Check the log for traceback.')
+
+        # Add migration parameters if required
+        if migration_mode in ["tcp", "rdma", "x-rdma"]:
+            self.migration_port = port_allocator.allocate_port(5200, 6000,
+                                                               self.instance)
+            qemu_command += (" -incoming " + migration_mode +
+                             ":0:%d" % self.migration_port)
+        elif migration_mode == "unix":
+            self.migration_file = "/tmp/migration-unix-%s" % self.instance
+            qemu_command += " -incoming unix:%s" % self.migration_file
+        elif migration_mode == "exec":
+            if migration_exec_cmd is None:
+                self.migration_port = port_allocator.allocate_port(
+                    5200, 6000, self.instance)
+                qemu_command += (' -incoming "exec:nc -l %s"' %
+                                 self.migration_port)
+            else:
+                qemu_command += (' -incoming "exec:%s"' %
+                                 migration_exec_cmd)
+        elif migration_mode == "fd":
+            qemu_command += ' -incoming "fd:%d"' % (migration_fd)
+
+        p9_fs_driver = params.get("9p_fs_driver")
+        if p9_fs_driver == "proxy":
+            proxy_helper_name = params.get("9p_proxy_binary",
+                                           "virtfs-proxy-helper")
+            proxy_helper_cmd = utils_misc.get_path(root_dir,
+                                                   proxy_helper_name)
+            if not proxy_helper_cmd:
+                raise virt_vm.VMConfigMissingError(self.name,
+                                                   "9p_proxy_binary")
 
-            # Establish monitor connections
-            self.monitors = []
-            for m_name in params.objects("monitors"):
-                m_params = params.object_params(m_name)
+            p9_export_dir = params.get("9p_export_dir")
+            if not p9_export_dir:
+                raise virt_vm.VMConfigMissingError(self.name,
+                                                   "9p_export_dir")
+
+            proxy_helper_cmd += " -p " + p9_export_dir
+            proxy_helper_cmd += " -u 0 -g 0"
+            p9_socket_name = params.get("9p_socket_name")
+            proxy_helper_cmd += " -s " + p9_socket_name
+            proxy_helper_cmd += " -n"
+
+            logging.info("Running Proxy Helper:\n%s", proxy_helper_cmd)
+            self.process = aexpect.run_tail(proxy_helper_cmd,
+                                            None,
+                                            logging.info,
+                                            "[9p proxy helper]",
+                                            auto_close=False)
+        else:
+            logging.info("Running qemu command (reformatted):\n%s",
+                         qemu_command.replace(" -", " \\\n    -"))
+            self.qemu_command = qemu_command
+            self.process = aexpect.run_tail(qemu_command,
+                                            None,
+                                            logging.info,
+                                            "[qemu output] ",
+                                            auto_close=False)
+
+        logging.info("Created qemu process with parent PID %d",
+                     self.process.get_pid())
+        self.start_time = time.time()
+        self.start_monotonic_time = utils_misc.monotonic_time()
+
+        # test doesn't need to hold tapfd's open
+        for nic in self.virtnet:
+            if 'tapfds' in nic:  # implies bridge/tap
                 try:
-                    monitor = qemu_monitor.wait_for_create_monitor(self,
-                                                                   m_name,
-                                                                   m_params,
-                                                                   timeout)
-                except qemu_monitor.MonitorConnectError, detail:
-                    logging.error(detail)
-                    self.destroy()
-                    raise
-
-                # Add this monitor to the list
-                self.monitors.append(monitor)
-
-            # Create serial ports.
-            for serial in params.objects("serials"):
-                self.serial_ports.append(serial)
-
-            # Create virtio_ports (virtio_serialports and virtio_consoles)
-            i = 0
-            self.virtio_ports = []
-            for port in params.objects("virtio_ports"):
-                port_params = params.object_params(port)
-                if port_params.get('virtio_port_chardev') == "spicevmc":
-                    filename = 'dev%s' % port
-                else:
-                    filename = self.get_virtio_port_filename(port)
-                port_name = port_params.get('virtio_port_name_prefix', None)
-                if port_name:   # If port_name_prefix was used
-                    port_name = port_name + str(i)
-                else:           # Implicit name - port
-                    port_name = port
-                if port_params.get('virtio_port_type') in ("console",
-                                                           "virtio_console"):
-                    self.virtio_ports.append(
-                        qemu_virtio_port.VirtioConsole(port, port_name,
-                                                       filename))
-                else:
-                    self.virtio_ports.append(
-                        qemu_virtio_port.VirtioSerial(port, port_name,
-                                                      filename))
-                i += 1
-            self.create_virtio_console()
-
-            # Get the output so far, to see if we have any problems with
-            # KVM modules or with hugepage setup.
-            output = self.process.get_output()
-
-            if re.search("Could not initialize KVM", output, re.IGNORECASE):
-                e = virt_vm.VMKVMInitError(
-                    qemu_command, self.process.get_output())
-                self.destroy()
-                raise e
+                    for i in nic.tapfds.split(':'):
+                        os.close(int(i))
+                    # qemu process retains access via open file
+                    # remove this attribute from virtnet because
+                    # fd numbers are not always predictable and
+                    # vm instance must support cloning.
+                    del nic['tapfds']
+                # File descriptor is already closed
+                except OSError:
+                    pass
+            if 'vhostfds' in nic:
+                try:
+                    for i in nic.vhostfds.split(':'):
+                        os.close(int(i))
+                    del nic['vhostfds']
+                except OSError:
+                    pass
 
-            if "alloc_mem_area" in output:
-                e = virt_vm.VMHugePageError(
-                    qemu_command, self.process.get_output())
+        # Make sure qemu is not defunct
+        if self.process.is_defunct():
+            logging.error("Bad things happened, qemu process is defunct")
+            err = ("Qemu is defunct.\nQemu output:\n%s"
+                   % self.process.get_output())
+            self.destroy()
+            raise virt_vm.VMStartError(self.name, err)
+
+        # Make sure the process was started successfully
+        if not self.process.is_alive():
+            status = self.process.get_status()
+            output = self.process.get_output().strip()
+            migration_in_course = migration_mode is not None
+            unknown_protocol = "unknown migration protocol" in output
+            if migration_in_course and unknown_protocol:
+                e = VMMigrateProtoUnsupportedError(migration_mode, output)
+            else:
+                e = virt_vm.VMCreateError(qemu_command, status, output)
+            self.destroy()
+            raise e
+
+        # Establish monitor connections
+        self.monitors = []
+        for m_name in params.objects("monitors"):
+            m_params = params.object_params(m_name)
+            try:
+                monitor = qemu_monitor.wait_for_create_monitor(self,
+                                                               m_name,
+                                                               m_params,
+                                                               timeout)
+            except qemu_monitor.MonitorConnectError, detail:
+                logging.error(detail)
                 self.destroy()
-                raise e
+                raise
 
-            logging.debug("VM appears to be alive with PID %s", self.get_pid())
-            vcpu_thread_pattern = self.params.get("vcpu_thread_pattern",
-                                                  r"thread_id.?[:|=]\s*(\d+)")
-            self.vcpu_threads = self.get_vcpu_pids(vcpu_thread_pattern)
+            # Add this monitor to the list
+            self.monitors.append(monitor)
 
-            vhost_thread_pattern = params.get("vhost_thread_pattern",
-                                              r"\w+\s+(\d+)\s.*\[vhost-%s\]")
-            self.vhost_threads = self.get_vhost_threads(vhost_thread_pattern)
+        # Create serial ports.
+        for serial in params.objects("serials"):
+            self.serial_ports.append(serial)
+
+        # Create virtio_ports (virtio_serialports and virtio_consoles)
+        i = 0
+        self.virtio_ports = []
+        for port in params.objects("virtio_ports"):
+            port_params = params.object_params(port)
+            if port_params.get('virtio_port_chardev') == "spicevmc":
+                filename = 'dev%s' % port
+            else:
+                filename = self.get_virtio_port_filename(port)
+            port_name = port_params.get('virtio_port_name_prefix', None)
+            if port_name:   # If port_name_prefix was used
+                port_name = port_name + str(i)
+            else:           # Implicit name - port
+                port_name = port
+            if port_params.get('virtio_port_type') in ("console",
+                                                       "virtio_console"):
+                self.virtio_ports.append(
+                    qemu_virtio_port.VirtioConsole(port, port_name,
+                                                   filename))
+            else:
+                self.virtio_ports.append(
+                    qemu_virtio_port.VirtioSerial(port, port_name,
+                                                  filename))
+            i += 1
+        self.create_virtio_console()
+
+        # Get the output so far, to see if we have any problems with
+        # KVM modules or with hugepage setup.
+        output = self.process.get_output()
+
+        if re.search("Could not initialize KVM", output, re.IGNORECASE):
+            e = virt_vm.VMKVMInitError(
+                qemu_command, self.process.get_output())
+            self.destroy()
+            raise e
+
+        if "alloc_mem_area" in output:
+            e = virt_vm.VMHugePageError(
+                qemu_command, self.process.get_output())
+            self.destroy()
+            raise e
+
+        logging.debug("VM appears to be alive with PID %s", self.get_pid())
+        vcpu_thread_pattern = self.params.get("vcpu_thread_pattern",
+                                              r"thread_id.?[:|=]\s*(\d+)")
+        self.vcpu_threads = self.get_vcpu_pids(vcpu_thread_pattern)
 
-            self.create_serial_console()
+        vhost_thread_pattern = params.get("vhost_thread_pattern",
+                                          r"\w+\s+(\d+)\s.*\[vhost-%s\]")
+        self.vhost_threads = self.get_vhost_threads(vhost_thread_pattern)
 
-            for key, value in self.logs.items():
-                outfile = "%s-%s.log" % (key, name)
-                self.logsessions[key] = aexpect.Tail(
-                    "nc -U %s" % value,
-                    auto_close=False,
-                    output_func=utils_misc.log_line,
-                    output_params=(outfile,))
-                self.logsessions[key].set_log_file(outfile)
+        self.create_serial_console()
 
-            if params.get("paused_after_start_vm") != "yes":
-                # start guest
-                if self.monitor.verify_status("paused"):
-                    try:
-                        self.monitor.cmd("cont")
-                    except qemu_monitor.QMPCmdError, e:
-                        if ((e.data['class'] == "MigrationExpected") and
-                                (migration_mode is not None)):
-                            logging.debug("Migration did not start yet...")
-                        else:
-                            raise e
+        for key, value in self.logs.items():
+            outfile = "%s-%s.log" % (key, name)
+            self.logsessions[key] = aexpect.Tail(
+                "nc -U %s" % value,
+                auto_close=False,
+                output_func=utils_misc.log_line,
+                output_params=(outfile,))
+            self.logsessions[key].set_log_file(outfile)
 
-            # Update mac and IP info for assigned device
-            # NeedFix: Can we find another way to get guest ip?
-            if params.get("mac_changeable") == "yes":
-                utils_net.update_mac_ip_address(self, params)
+        if params.get("paused_after_start_vm") != "yes":
+            # start guest
+            if self.monitor.verify_status("paused"):
+                try:
+                    self.monitor.cmd("cont")
+                except qemu_monitor.QMPCmdError, e:
+                    if ((e.data['class'] == "MigrationExpected") and
+                            (migration_mode is not None)):
+                        logging.debug("Migration did not start yet...")
+                    else:
+                        raise e
 
-        finally:
-            fcntl.lockf(lockfile, fcntl.LOCK_UN)
-            lockfile.close()
+        # Update mac and IP info for assigned device
+        # NeedFix: Can we find another way to get guest ip?
+        if params.get("mac_changeable") == "yes":
+            utils_net.update_mac_ip_address(self, params)
 
     def wait_for_status(self, status, timeout, first=0.0, step=1.0, text=None):
         """
@@ -2826,6 +2844,8 @@ class VM(virt_vm.BaseVM):
             except OSError:
                 pass
 
+        port_allocator.release_ports(self.instance)
+
         if free_mac_addresses:
             for nic_index in xrange(0, len(self.virtnet)):
                 self.free_mac_address(nic_index)
@@ -2853,6 +2873,7 @@ class VM(virt_vm.BaseVM):
         :param free_mac_addresses: If True, the MAC addresses used by the VM
                 will be freed.
         """
+        self.invalidate_sessions()
         try:
             # Is it already dead?
             if self.is_dead():
@@ -3508,6 +3529,7 @@ class VM(virt_vm.BaseVM):
             raise virt_vm.VMMigrateProtoUnknownError(protocol)
 
         error.base_context("migrating '%s'" % self.name)
+        self.invalidate_sessions()
 
         local = dest_host == "localhost"
         mig_fd_name = None
@@ -3723,6 +3745,7 @@ class VM(virt_vm.BaseVM):
             return not session.is_responsive(timeout=self.CLOSE_SESSION_TIMEOUT)
 
         error.base_context("rebooting '%s'" % self.name, logging.info)
+        self.invalidate_sessions()
         error.context("before reboot")
         error.context()
         if method == "shell":
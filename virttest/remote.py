@@ -3,9 +3,13 @@ Functions and classes used for logging into guests and transferring files.
 """
 import logging
 import time
+import errno
+import socket
+import select
 import re
 import os
 import shutil
+import hashlib
 import tempfile
 import aexpect
 import utils_misc
@@ -19,6 +23,19 @@ from autotest.client import utils
 import data_dir
 
 
+# Directory of control sockets of SSH connection masters
+SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(),
+                               "virt-test-ssh-%d" % os.getuid())
+# Seconds an idle SSH connection master is kept running
+SSH_CONTROL_PERSIST = 600
+# Delays (seconds) between login attempts: first, growth factor and maximum
+LOGIN_DELAY_FIRST = 0.25
+LOGIN_DELAY_FACTOR = 1.5
+LOGIN_DELAY_MAX = 2.0
+# Clients connecting to a TCP port which can be probed before spawning them
+PROBED_CLIENTS = ("ssh", "telnet")
+
+
 class LoginError(Exception):
 
     def __init__(self, msg, output):
@@ -61,6 +78,18 @@ class LoginBadClientError(LoginError):
         return "Unknown remote shell client: %r" % self.client
 
 
+class LoginPortClosedError(LoginError):
+
+    def __init__(self, host, port):
+        LoginError.__init__(self, None, None)
+        self.host = host
+        self.port = port
+
+    def __str__(self):
+        return "Port %s of %s does not accept connections" % (self.port,
+                                                                self.host)
+
+
 class SCPError(Exception):
 
     def __init__(self, msg, output):
@@ -196,9 +225,166 @@ def handle_prompts(session, username, password, prompt, timeout=10,
     return output
 
 
+class SSHMaster(object):
+
+    """
+    SSH connection master (OpenSSH ControlMaster) of a host, port and user.
+
+    ssh and scp commands run with options() reuse the authenticated
+    connection of the master instead of connecting and authenticating
+    again. When the master is gone, they fall back to a new connection.
+    """
+
+    def __init__(self, host, port, username, persist=SSH_CONTROL_PERSIST):
+        """
+        :param host: Hostname or IP address
+        :param port: Port to connect to
+        :param username: Username
+        :param persist: Seconds the master runs when it's not used.
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.persist = persist
+        # Length of socket paths is limited, a hash is used as the name
+        name = hashlib.sha1("%s@%s:%s" % (username, host, port)).hexdigest()
+        self.control_path = os.path.join(SSH_CONTROL_DIR, name[:16])
+        # Operation name: list of durations in seconds
+        self.timings = {}
+
+    def options(self):
+        """
+        Return ssh/scp options to use the connection of the master.
+        """
+        return "-o ControlMaster=no -o ControlPath=%s" % self.control_path
+
+    def _control(self, command):
+        cmd = ("ssh -o ControlPath=%s -O %s -p %s %s@%s" %
+               (self.control_path, command, self.port, self.username,
+                self.host))
+        return utils.run(cmd, ignore_status=True, verbose=False).exit_status
+
+    def record(self, operation, duration):
+        """
+        Record the duration of an operation done through the master.
+
+        :param operation: Name of the operation (login, scp_to, ...).
+        :param duration: Duration in seconds.
+        """
+        self.timings.setdefault(operation, []).append(duration)
+        logging.debug("SSH %s to %s@%s:%s took %.3f s", operation,
+                      self.username, self.host, self.port, duration)
+
+    def start(self, password, timeout=10):
+        """
+        Start the master in the background, authenticating with password.
+
+        :param password: Password to send in reply to the password prompt.
+        :param timeout: The maximal time duration (in seconds) to wait for
+                each step of the login procedure.
+        :raise LoginTimeoutError: If timeout expires
+        :raise LoginAuthenticationError: If authentication fails
+        :raise LoginProcessTerminatedError: If ssh fails to connect
+        """
+        if not os.path.isdir(SSH_CONTROL_DIR):
+            os.makedirs(SSH_CONTROL_DIR, 0700)
+        # -f makes ssh go to background once authenticated
+        cmd = ("ssh -f -N -o ControlMaster=yes -o ControlPath=%s "
+               "-o ControlPersist=%d -o ServerAliveInterval=5 "
+               "-o ServerAliveCountMax=3 -o UserKnownHostsFile=/dev/null "
+               "-o StrictHostKeyChecking=no "
+               "-o PreferredAuthentications=password -p %s %s@%s" %
+               (self.control_path, self.persist, self.port, self.username,
+                self.host))
+        logging.debug("SSH master command: '%s'", cmd)
+        start = time.time()
+        password_sent = False
+        session = aexpect.Expect(cmd)
+        try:
+            while True:
+                try:
+                    match, text = session.read_until_last_line_matches(
+                        [r"[Aa]re you sure", r"[Pp]assword:\s*$"],
+                        timeout=timeout, internal_timeout=0.5)
+                    if match == 0:
+                        session.sendline("yes")
+                    elif password_sent:
+                        raise LoginAuthenticationError(
+                            "Got password prompt twice", text)
+                    else:
+                        session.sendline(password)
+                        password_sent = True
+                except aexpect.ExpectTimeoutError, e:
+                    raise LoginTimeoutError(e.output)
+                except aexpect.ExpectProcessTerminatedError, e:
+                    if e.status != 0:
+                        raise LoginProcessTerminatedError(e.status, e.output)
+                    break
+        finally:
+            session.close()
+        self.record("master", time.time() - start)
+
+    def is_alive(self):
+        """
+        Return True if the master is running.
+        """
+        return (os.path.exists(self.control_path) and
+                self._control("check") == 0)
+
+    def close(self):
+        """
+        Stop the master.
+        """
+        if os.path.exists(self.control_path):
+            self._control("exit")
+
+
+# (host, port, username): SSHMaster
+_ssh_masters = {}
+
+
+def get_ssh_master(host, port, username, password, timeout=10):
+    """
+    Return the running SSH connection master of host, port and user, start
+    it if needed.
+
+    :param host: Hostname or IP address
+    :param port: Port to connect to
+    :param username: Username
+    :param password: Password
+    :param timeout: The maximal time duration (in seconds) to wait for
+            each step of the login procedure.
+    :return: SSHMaster or None if the master couldn't be started.
+    """
+    key = (host, str(port), username)
+    master = _ssh_masters.get(key)
+    # A master killed without cleanup leaves the socket behind, ssh then
+    # connects without it
+    if master is not None and os.path.exists(master.control_path):
+        return master
+    master = SSHMaster(host, port, username)
+    try:
+        master.start(password, timeout)
+    except LoginError, e:
+        logging.debug("Could not start SSH master for %s@%s:%s: %s",
+                      username, host, port, e)
+        return None
+    _ssh_masters[key] = master
+    return master
+
+
+def close_ssh_masters():
+    """
+    Stop all SSH connection masters started by get_ssh_master().
+    """
+    for master in _ssh_masters.values():
+        master.close()
+    _ssh_masters.clear()
+
+
 def remote_login(client, host, port, username, password, prompt, linesep="\n",
                  log_filename=None, timeout=10, interface=None,
-                 status_test_command="echo $?"):
+                 status_test_command="echo $?", multiplex=False):
     """
     Log into a remote host (guest) using SSH/Telnet/Netcat.
 
@@ -219,6 +405,8 @@ def remote_login(client, host, port, username, password, prompt, linesep="\n",
     :param status_test_command: Command to be used for getting the last
             exit status of commands run inside the shell (used by
             cmd_status_output() and friends).
+    :param multiplex: Log in through the SSH connection master of the host
+            (ssh only, see get_ssh_master()).
 
     :raise LoginError: If using ipv6 linklocal but not assign a interface that
                        the neighbour attache
@@ -231,11 +419,16 @@ def remote_login(client, host, port, username, password, prompt, linesep="\n",
             raise LoginError("When using ipv6 linklocal an interface must "
                              "be assigned")
         host = "%s%%%s" % (host, interface)
+    master = None
     if client == "ssh":
+        if multiplex:
+            master = get_ssh_master(host, port, username, password, timeout)
         cmd = ("ssh -o UserKnownHostsFile=/dev/null "
                "-o StrictHostKeyChecking=no "
                "-o PreferredAuthentications=password -p %s %s@%s" %
                (port, username, host))
+        if master is not None:
+            cmd = cmd.replace("ssh ", "ssh %s " % master.options(), 1)
     elif client == "telnet":
         cmd = "telnet -l %s %s %s" % (username, host, port)
     elif client == "nc":
@@ -244,6 +437,7 @@ def remote_login(client, host, port, username, password, prompt, linesep="\n",
         raise LoginBadClientError(client)
 
     logging.debug("Login command: '%s'", cmd)
+    start = time.time()
     session = aexpect.ShellSession(cmd, linesep=linesep, prompt=prompt,
                                    status_test_command=status_test_command)
     try:
@@ -251,6 +445,8 @@ def remote_login(client, host, port, username, password, prompt, linesep="\n",
     except Exception:
         session.close()
         raise
+    if master is not None:
+        master.record("login", time.time() - start)
     if log_filename:
         session.set_output_func(utils_misc.log_line)
         session.set_output_params((log_filename,))
@@ -275,7 +471,8 @@ class AexpectIOWrapperOut(messenger.StdIOWrapperOutBase64):
 
 
 def remote_commander(client, host, port, username, password, prompt,
-                     linesep="\n", log_filename=None, timeout=10, path=None):
+                     linesep="\n", log_filename=None, timeout=10, path=None,
+                     framing=messenger.FRAMING_BINARY):
     """
     Log into a remote host (guest) using SSH/Telnet/Netcat.
 
@@ -292,6 +489,8 @@ def remote_commander(client, host, port, username, password, prompt,
             each step of the login procedure (i.e. the "Are you sure" prompt
             or the password prompt)
     :param path: The path to place where remote_runner.py is placed.
+    :param framing: Framing of messages negotiated with remote runner
+            (messenger.FRAMING_LEGACY or messenger.FRAMING_BINARY).
     :raise LoginBadClientError: If an unknown client is requested
     :raise: Whatever handle_prompts() raises
     :return: A ShellSession object.
@@ -328,40 +527,114 @@ def remote_commander(client, host, port, username, password, prompt,
     outw = AexpectIOWrapperOut(session)
     # Create commander
 
-    cmd = remote_master.CommanderMaster(inw, outw, False)
+    cmd = remote_master.CommanderMaster(inw, outw, False, framing)
     return cmd
 
 
+def is_port_open(host, port, timeout=1.0, interface=None):
+    """
+    Check whether a TCP port accepts connections.
+
+    A non-blocking connect is used so the check costs a single round trip
+    (or timeout when the packets are dropped) and no client process.
+
+    :param host: Hostname or IP address
+    :param port: Port to connect to
+    :param timeout: Time (seconds) to wait for the connection
+    :param interface: The interface of an ipv6 linklocal address
+    :return: True if a connection to any address of host was established.
+    """
+    if host and host.lower().startswith("fe80") and interface:
+        host = "%s%%%s" % (host, interface)
+    try:
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.error, e:
+        logging.debug("Cannot resolve %s: %s", host, e)
+        return False
+    for family, socktype, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.setblocking(0)
+            status = sock.connect_ex(sockaddr)
+            if status in (errno.EINPROGRESS, errno.EAGAIN):
+                if select.select([], [sock], [], timeout)[1]:
+                    status = sock.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_ERROR)
+                else:
+                    status = errno.ETIMEDOUT
+            if status == 0:
+                return True
+        finally:
+            sock.close()
+    return False
+
+
+def login_delays(first=LOGIN_DELAY_FIRST, factor=LOGIN_DELAY_FACTOR,
+                 maximum=LOGIN_DELAY_MAX):
+    """
+    Generate growing delays between login attempts.
+
+    Guests usually start accepting logins shortly after their network comes
+    up, short delays at first catch that moment and the growth keeps slow
+    boots from being polled too often.
+
+    :param first: First delay (seconds)
+    :param factor: Growth factor of the delay
+    :param maximum: Maximal delay (seconds)
+    """
+    delay = first
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
 def wait_for_login(client, host, port, username, password, prompt,
                    linesep="\n", log_filename=None, timeout=240,
-                   internal_timeout=10, interface=None):
+                   internal_timeout=10, interface=None, multiplex=False):
     """
     Make multiple attempts to log into a guest until one succeeds or timeouts.
 
+    The client (ssh, telnet) is spawned only when the port accepts
+    connections, the attempts are separated by login_delays().
+
     :param timeout: Total time duration to wait for a successful login
     :param internal_timeout: The maximum time duration (in seconds) to wait for
                              each step of the login procedure (e.g. the
                              "Are you sure" prompt or the password prompt)
     :interface: The interface the neighbours attach to (only use when using ipv6
                 linklocal address.)
+    :param multiplex: Log in through the SSH connection master of the host.
     :see: remote_login()
     :raise: Whatever remote_login() raises
     :return: A ShellSession object.
     """
     logging.debug("Attempting to log into %s:%s using %s (timeout %ds)",
                   host, port, client, timeout)
-    end_time = time.time() + timeout
+    start = time.time()
+    end_time = start + timeout
+    attempts = 0
+    delays = login_delays()
     while time.time() < end_time:
-        try:
-            return remote_login(client, host, port, username, password, prompt,
-                                linesep, log_filename, internal_timeout,
-                                interface)
-        except LoginError, e:
-            logging.debug(e)
-        time.sleep(2)
+        if (client not in PROBED_CLIENTS or
+                is_port_open(host, port, min(internal_timeout, 2),
+                             interface)):
+            attempts += 1
+            try:
+                session = remote_login(client, host, port, username,
+                                       password, prompt, linesep,
+                                       log_filename, internal_timeout,
+                                       interface, multiplex=multiplex)
+                logging.debug("Logged into %s:%s after %d attempts "
+                              "(%.2f s)", host, port, attempts,
+                              time.time() - start)
+                return session
+            except LoginError, e:
+                logging.debug(e)
+        time.sleep(min(delays.next(), max(end_time - time.time(), 0)))
     # Timeout expired; try one more time but don't catch exceptions
     return remote_login(client, host, port, username, password, prompt,
-                        linesep, log_filename, internal_timeout, interface)
+                        linesep, log_filename, internal_timeout, interface,
+                        multiplex=multiplex)
 
 
 def _remote_scp(session, password_list, transfer_timeout=600, login_timeout=20):
@@ -471,7 +744,8 @@ def remote_scp(command, password_list, log_filename=None, transfer_timeout=600,
 
 
 def scp_to_remote(host, port, username, password, local_path, remote_path,
-                  limit="", log_filename=None, timeout=600, interface=None):
+                  limit="", log_filename=None, timeout=600, interface=None,
+                  multiplex=False):
     """
     Copy files to a remote host (guest) through scp.
 
@@ -486,6 +760,7 @@ def scp_to_remote(host, port, username, password, local_path, remote_path,
             to complete.
     :interface: The interface the neighbours attach to (only use when using ipv6
                 linklocal address.)
+    :param multiplex: Copy through the SSH connection master of the host.
     :raise: Whatever remote_scp() raises
     """
     if (limit):
@@ -502,13 +777,23 @@ def scp_to_remote(host, port, username, password, local_path, remote_path,
                "-o PreferredAuthentications=password -r %s "
                "-P %s %s %s@\[%s\]:%s" %
                (limit, port, local_path, username, host, remote_path))
+    master = None
+    if multiplex:
+        master = get_ssh_master(host, port, username, password)
+    if master is not None:
+        command = command.replace("scp ", "scp %s " % master.options(), 1)
     password_list = []
     password_list.append(password)
-    return remote_scp(command, password_list, log_filename, timeout)
+    start = time.time()
+    result = remote_scp(command, password_list, log_filename, timeout)
+    if master is not None:
+        master.record("scp_to", time.time() - start)
+    return result
 
 
 def scp_from_remote(host, port, username, password, remote_path, local_path,
-                    limit="", log_filename=None, timeout=600, interface=None):
+                    limit="", log_filename=None, timeout=600, interface=None,
+                    multiplex=False):
     """
     Copy files from a remote host (guest).
 
@@ -523,6 +808,7 @@ def scp_from_remote(host, port, username, password, remote_path, local_path,
             to complete.
     :interface: The interface the neighbours attach to (only use when using ipv6
                 linklocal address.)
+    :param multiplex: Copy through the SSH connection master of the host.
     :raise: Whatever remote_scp() raises
     """
     if (limit):
@@ -538,9 +824,17 @@ def scp_from_remote(host, port, username, password, remote_path, local_path,
                "-o PreferredAuthentications=password -r %s "
                "-P %s %s@\[%s\]:%s %s" %
                (limit, port, username, host, remote_path, local_path))
+    master = None
+    if multiplex:
+        master = get_ssh_master(host, port, username, password)
+    if master is not None:
+        command = command.replace("scp ", "scp %s " % master.options(), 1)
     password_list = []
     password_list.append(password)
+    start = time.time()
     remote_scp(command, password_list, log_filename, timeout)
+    if master is not None:
+        master.record("scp_from", time.time() - start)
 
 
 def scp_between_remotes(src, dst, port, s_passwd, d_passwd, s_name, d_name,
@@ -745,7 +1039,8 @@ def udp_copy_between_remotes(src, dst, s_port, s_passwd, d_passwd,
 
 def copy_files_to(address, client, username, password, port, local_path,
                   remote_path, limit="", log_filename=None,
-                  verbose=False, timeout=600, interface=None):
+                  verbose=False, timeout=600, interface=None,
+                  multiplex=False):
     """
     Copy files to a remote host (guest) using the selected client.
 
@@ -762,12 +1057,14 @@ def copy_files_to(address, client, username, password, port, local_path,
             complete.
     :interface: The interface the neighbours attach to (only use when using ipv6
                 linklocal address.)
+    :param multiplex: Copy through the SSH connection master of the host
+            (SCP only).
     :raise: Whatever remote_scp() raises
     """
     if client == "scp":
         scp_to_remote(address, port, username, password, local_path,
                       remote_path, limit, log_filename, timeout,
-                      interface=interface)
+                      interface=interface, multiplex=multiplex)
     elif client == "rss":
         log_func = None
         if verbose:
@@ -784,7 +1081,8 @@ def copy_files_to(address, client, username, password, port, local_path,
 
 def copy_files_from(address, client, username, password, port, remote_path,
                     local_path, limit="", log_filename=None,
-                    verbose=False, timeout=600, interface=None):
+                    verbose=False, timeout=600, interface=None,
+                    multiplex=False):
     """
     Copy files from a remote host (guest) using the selected client.
 
@@ -801,12 +1099,14 @@ def copy_files_from(address, client, username, password, port, remote_path,
                     complete.
     :interface: The interface the neighbours attach to (only use when using ipv6
                 linklocal address.)
+    :param multiplex: Copy through the SSH connection master of the host
+            (SCP only).
     :raise: Whatever ``remote_scp()`` raises
     """
     if client == "scp":
         scp_from_remote(address, port, username, password, remote_path,
                         local_path, limit, log_filename, timeout,
-                        interface=interface)
+                        interface=interface, multiplex=multiplex)
     elif client == "rss":
         log_func = None
         if verbose:
@@ -11,11 +11,35 @@ import logging
 import select
 import cPickle
 import time
+import struct
+import zlib
 import remote_interface
 import cStringIO
 import base64
 
 
+# Original framing: 10 char decimal length followed by pickled message.
+FRAMING_LEGACY = "legacy"
+# Binary framing: fixed 6 byte header (magic, flags, length) followed by
+# payload which may be compressed and split into several chunks.
+FRAMING_BINARY = "binary"
+FRAMINGS = (FRAMING_LEGACY, FRAMING_BINARY)
+
+_FRAME_HEADER = struct.Struct("!BBI")
+_FRAME_MAGIC = 0xb5
+_FRAME_ZLIB = 0x01   # Payload of message is compressed by zlib.
+_FRAME_MORE = 0x02   # Another chunk of the same message follows.
+
+# Size of reading from the underlying IO object.
+READ_SIZE = 65536
+# Messages bigger than this are split to more frames.
+CHUNK_SIZE = 1024 * 1024
+# Messages bigger than this are compressed (when it pays off).
+COMPRESS_THRESHOLD = 65536
+# Size of beginning of message used for guess of compression ratio.
+COMPRESS_SAMPLE = 16384
+
+
 class IOWrapper(object):
 
     """
@@ -149,7 +173,31 @@ class StdIOWrapperOut(StdIOWrapper):
     """
 
     def write(self, data):
-        os.write(self._obj, data)
+        written = os.write(self._obj, data)
+        while written < len(data):  # Pipe could accept only part of data.
+            written += os.write(self._obj, buffer(data, written))
+
+
+class SocketWrapper(IOWrapper, DataWrapper):
+
+    """
+    Basic implementation of IOWrapper for connected sockets.
+    """
+
+    def close(self):
+        self._obj.close()
+
+    def fileno(self):
+        return self._obj.fileno()
+
+    def read(self, max_len, timeout=None):
+        if timeout is not None:
+            return self._wait_for_data(max_len, timeout)
+        else:
+            return self._obj.recv(max_len)
+
+    def write(self, data):
+        self._obj.sendall(data)
 
 
 class StdIOWrapperInBase64(StdIOWrapperIn, DataWrapperBase64):
@@ -192,25 +240,60 @@ class Messenger(object):
     by communication canal wrapped by IOWrapper class. Pickling is used
     for communication and thus it is possible to communicate every picleable
     object.
+
+    Two framings of messages are supported. FRAMING_LEGACY is compatible
+    with old runners, FRAMING_BINARY has smaller header, compresses big
+    messages and sends them in chunks. Both sides have to use the same
+    framing, see set_framing().
     """
 
-    def __init__(self, stdin, stdout):
+    def __init__(self, stdin, stdout, framing=FRAMING_LEGACY,
+                 compress_threshold=COMPRESS_THRESHOLD, chunk_size=CHUNK_SIZE):
         """
         :params stdin: Object for read data from communication interface.
         :type stdin: IOWrapper
         :params stdout: Object for write data to communication interface.
         :type stdout: IOWrapper
+        :param framing: Framing of messages (FRAMING_LEGACY, FRAMING_BINARY)
+        :param compress_threshold: Compress binary framed messages bigger
+                                   than this. None disables compression.
+        :param chunk_size: Max size of one chunk of binary framed message.
         """
         self.stdin = stdin
         self.stdout = stdout
+        self.framing = None
+        self.set_framing(framing)
+        self.compress_threshold = compress_threshold
+        self.chunk_size = chunk_size
+        # Data which was read from stdin but not consumed yet.
+        self._rbuf = ""
 
         # Unfortunately only static length of data length is supported.
         self.enc_len_length = len(stdout.encode("0" * 10))
+        self.enc_header_length = len(stdout.encode("\0" * _FRAME_HEADER.size))
 
     def close(self):
         self.stdin.close()
         self.stdout.close()
 
+    def set_framing(self, framing):
+        """
+        Switch framing of messages. Other side have to switch framing
+        at the same point of communication.
+
+        :param framing: One of FRAMINGS.
+        """
+        if framing not in FRAMINGS:
+            raise MessengerError("Unknown framing %s" % (framing))
+        self.framing = framing
+
+    def buffered(self):
+        """
+        :return: True if there is read data which were not processed yet.
+                 select() on stdin doesn't see this data.
+        """
+        return len(self._rbuf) > 0
+
     def format_msg(self, data):
         """
         Format message where first 10 char is length of message and rest is
@@ -221,10 +304,40 @@ class Messenger(object):
         len_enc = self.stdout.encode("%10d" % len(pdata))
         return "%s%s" % (len_enc, pdata)
 
+    def format_frames(self, data):
+        """
+        Format message to binary frames. Every frame starts by header
+        (magic, flags, length of encoded chunk) followed by chunk of pickled
+        and optionally compressed message.
+
+        :return: Generator of encoded frames.
+        """
+        pdata = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        flags = 0
+        if (self.compress_threshold is not None and
+                len(pdata) >= self.compress_threshold):
+            # Don't waste time by compression of incompressible data.
+            sample = pdata[:COMPRESS_SAMPLE]
+            if len(zlib.compress(sample, 1)) < len(sample) * 0.9:
+                pdata = zlib.compress(pdata, 1)
+                flags |= _FRAME_ZLIB
+        pos = 0
+        while True:
+            chunk = self.stdout.encode(pdata[pos:pos + self.chunk_size])
+            pos += self.chunk_size
+            more = 0
+            if pos < len(pdata):
+                more = _FRAME_MORE
+            header = _FRAME_HEADER.pack(_FRAME_MAGIC, flags | more, len(chunk))
+            yield self.stdout.encode(header) + chunk
+            if not more:
+                break
+
     def flush_stdin(self):
         """
         Flush all input data from communication interface.
         """
+        self._rbuf = ""
         const = 16384
         r, _, _ = select.select([self.stdin.fileno()], [], [], 1)
         while r:
@@ -236,7 +349,47 @@ class Messenger(object):
         """
         Write formated message to communication interface.
         """
-        self.stdout.write(self.format_msg(data))
+        if self.framing == FRAMING_BINARY:
+            for frame in self.format_frames(data):
+                self.stdout.write(frame)
+        else:
+            self.stdout.write(self.format_msg(data))
+
+    def _read_exact(self, length, endtime=None):
+        """
+        Read exactly length of chars from stdin. Data are read in big blocks
+        and rest is kept for next reading.
+
+        :param length: Length of data.
+        :param endtime: Time when reading should fail. None means wait
+                        forever.
+        :return: Data, "" when other side is closed or None when timeouted.
+        """
+        if len(self._rbuf) >= length:
+            data = self._rbuf[:length]
+            self._rbuf = self._rbuf[length:]
+            return data
+
+        parts = [self._rbuf]
+        readed = len(self._rbuf)
+        self._rbuf = ""
+        while readed < length:
+            timeout = None
+            if endtime is not None:
+                timeout = max(endtime - time.time(), 0)
+            d = self.stdin.read(max(length - readed, READ_SIZE), timeout)
+            if d is None:
+                self._rbuf = "".join(parts)
+                return None
+            if len(d) == 0:
+                return d
+            parts.append(d)
+            readed += len(d)
+        data = "".join(parts)
+        if readed > length:
+            self._rbuf = data[length:]
+            data = data[:length]
+        return data
 
     def _read_until_len(self, timeout=None):
         """
@@ -245,25 +398,58 @@ class Messenger(object):
 
         :param timeout: timeout of reading.
         """
-        data = ""
-
         endtime = None
         if timeout is not None:
             endtime = time.time() + timeout
 
-        while (len(data) < self.enc_len_length and
-               (endtime is None or time.time() < endtime)):
-            d = self.stdin.read(1, timeout)
-            if d is None:
-                return None
-            if len(d) == 0:
-                return d
-            data += d
-        if len(data) < self.enc_len_length:
-            return None
+        data = self._read_exact(self.enc_len_length, endtime)
+        if not data:
+            return data
 
         return self.stdout.decode(data)
 
+    def _read_legacy(self, timeout=None):
+        """
+        Read message in FRAMING_LEGACY.
+
+        :return: Pickled message, "" or None see _read_exact.
+        """
+        data = self._read_until_len(timeout)
+        if not data:
+            return data
+        cmd_len = int(data)
+        return self.stdin.decode(self._read_exact(cmd_len))
+
+    def _read_frames(self, timeout=None):
+        """
+        Read all chunks of message in FRAMING_BINARY.
+
+        :return: Pickled message, "" or None see _read_exact.
+        """
+        endtime = None
+        if timeout is not None:
+            endtime = time.time() + timeout
+
+        chunks = []
+        flags = _FRAME_MORE
+        while flags & _FRAME_MORE:
+            header = self._read_exact(self.enc_header_length, endtime)
+            if not header:
+                if chunks:
+                    raise MessengerError("Message was not finished.")
+                return header
+            endtime = None  # Rest of message have to come.
+            magic, flags, length = _FRAME_HEADER.unpack(
+                self.stdin.decode(header))
+            if magic != _FRAME_MAGIC:
+                raise MessengerError("Wrong frame header %r." % (header))
+            chunks.append(self.stdin.decode(self._read_exact(length)))
+
+        data = "".join(chunks)
+        if flags & _FRAME_ZLIB:
+            data = zlib.decompress(data)
+        return data
+
     def read_msg(self, timeout=None):
         """
         Read data from com interface.
@@ -274,25 +460,23 @@ class Messenger(object):
                  (False, None) when other side is closed.
                  (None, None) when reading is timeouted.
         """
-        data = self._read_until_len(timeout)
-        if data is None:
-            return (None, None)
-        if len(data) == 0:
-            return (False, None)
         rdata = None
         try:
-            cmd_len = int(data)
-            rdata = ""
-            rdata_len = 0
-            while (rdata_len < cmd_len):
-                rdata += self.stdin.read(cmd_len - rdata_len)
-                rdata_len = len(rdata)
-            rdataIO = cStringIO.StringIO(self.stdin.decode(rdata))
+            if self.framing == FRAMING_BINARY:
+                rdata = self._read_frames(timeout)
+            else:
+                rdata = self._read_legacy(timeout)
+            if rdata is None:
+                return (None, None)
+            if len(rdata) == 0:
+                return (False, None)
+            rdataIO = cStringIO.StringIO(rdata)
             unp = cPickle.Unpickler(rdataIO)
             unp.find_global = _map_path
             data = unp.load()
         except Exception, e:
-            logging.error("ERROR data:%s rdata:%s" % (data, rdata))
+            logging.error("ERROR framing:%s rdata:%r" % (self.framing,
+                                                        rdata))
             try:
                 self.write_msg(remote_interface.MessengerError("Communication "
                                                                "failed.%s" % (e)))
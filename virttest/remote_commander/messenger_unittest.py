@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+import os
+import unittest
+
+import messenger
+
+
+class MessengerFramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fds = os.pipe()
+
+    def tearDown(self):
+        for fd in self.fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _messenger(self, framing, base64=False, **kargs):
+        in_cls, out_cls = messenger.StdIOWrapperIn, messenger.StdIOWrapperOut
+        if base64:
+            in_cls = messenger.StdIOWrapperInBase64
+            out_cls = messenger.StdIOWrapperOutBase64
+        return messenger.Messenger(in_cls(self.fds[0]), out_cls(self.fds[1]),
+                                   framing, **kargs)
+
+    def _roundtrip(self, msg, messages):
+        for data in messages:
+            msg.write_msg(data)
+        for data in messages:
+            self.assertEqual(msg.read_msg(1), (True, data))
+        self.assertFalse(msg.buffered())
+
+    def test_legacy(self):
+        msg = self._messenger(messenger.FRAMING_LEGACY)
+        self._roundtrip(msg, ["start", {"a": [1, 2]}, "x" * 1000])
+
+    def test_binary(self):
+        msg = self._messenger(messenger.FRAMING_BINARY, chunk_size=100)
+        self._roundtrip(msg, ["start", {"a": [1, 2]}, "x" * 1000])
+
+    def test_binary_base64_compressed(self):
+        msg = self._messenger(messenger.FRAMING_BINARY, True,
+                              compress_threshold=10, chunk_size=7)
+        data = "compressible " * 100
+        frames = list(msg.format_frames(data))
+        self.assertTrue(len("".join(frames)) < len(data))
+        self._roundtrip(msg, [data, "y"])
+
+    def test_incompressible(self):
+        msg = self._messenger(messenger.FRAMING_BINARY, compress_threshold=10)
+        data = os.urandom(32768)
+        self.assertTrue(len("".join(msg.format_frames(data))) > len(data))
+        self._roundtrip(msg, [data])
+
+    def test_timeout(self):
+        msg = self._messenger(messenger.FRAMING_BINARY)
+        self.assertEqual(msg.read_msg(0.1), (None, None))
+        frame = "".join(msg.format_frames("data"))
+        os.write(self.fds[1], frame[:3])
+        self.assertEqual(msg.read_msg(0.1), (None, None))
+        os.write(self.fds[1], frame[3:])
+        self.assertEqual(msg.read_msg(0.1), (True, "data"))
+
+    def test_closed(self):
+        msg = self._messenger(messenger.FRAMING_BINARY)
+        os.close(self.fds[1])
+        self.assertEqual(msg.read_msg(1), (False, None))
+
+    def test_unknown_framing(self):
+        self.assertRaises(messenger.MessengerError, self._messenger, "foo")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ Created on Dec 6, 2013
 import sys
 import time
 import inspect
+import logging
 import remote_interface
 import messenger
 
@@ -119,6 +120,27 @@ class CmdMaster(object):
         """
         self.commander.wait_response(self, timeout)
 
+    def done(self):
+        """
+        :return: True if command is finished.
+        """
+        return self._basecmd.is_finished()
+
+    def result(self, timeout=60):
+        """
+        Wait for finish of command and return its results. Works as future
+        for commands started with "pool" prefix.
+
+        :param timeout: Timeout of waiting for results.
+        :raise CmdTraceBack: When command raised exception on remote side.
+        :return: Results of command.
+        """
+        self.commander.gather([self], timeout, return_exceptions=True)
+        results = self._basecmd.results
+        if isinstance(results, Exception):
+            raise results
+        return results
+
     def __getattr__(self, name):
         """
         Shortcut to encapsulated basecmd.
@@ -193,10 +215,12 @@ class CommanderMaster(messenger.Messenger):
     slave part.
     """
 
-    def __init__(self, stdin, stdout, debug=False):
+    def __init__(self, stdin, stdout, debug=False, framing=None):
         """
         :type stdin: IOWrapper with implemented write function.
         :type stout: IOWrapper with implemented read function.
+        :param framing: Framing negotiated with slave after start
+                        (messenger.FRAMINGS). None keeps legacy framing.
         """
         super(CommanderMaster, self).__init__(stdin, stdout)
         self.cmds = {}
@@ -208,6 +232,26 @@ class CommanderMaster(messenger.Messenger):
         if not succ or msg != "Started":
             raise remote_interface.CommanderError("Remote commander"
                                                   " not started.")
+        if framing is not None and framing != self.framing:
+            self.negotiate_framing(framing)
+
+    def negotiate_framing(self, framing):
+        """
+        Switch framing of communication on both sides. Slave switches
+        framing right after it sends the answer.
+
+        :param framing: One of messenger.FRAMINGS.
+        :return: Framing used after negotiation.
+        """
+        try:
+            cmd = self.manage.negotiate_framing(framing)
+        except remote_interface.CommanderError, e:
+            # Old runner which doesn't know binary framing.
+            logging.warning("Framing %s was not accepted by remote side: %s",
+                            framing, e)
+            return self.framing
+        self.set_framing(cmd.results)
+        return self.framing
 
     def close(self):
         try:
@@ -266,7 +310,8 @@ class CommanderMaster(messenger.Messenger):
             if (self.debug):
                 print cmd.func, cmd.results, cmd._finished
 
-            if isinstance(cmd.results, Exception):
+            # Exceptions of pool commands are raised by CmdMaster.result()
+            if isinstance(cmd.results, Exception) and cmd.func[0] != "pool":
                 raise cmd.results
             if cmd.cmd_id in self.cmds:
                 self.cmds[cmd.cmd_id].basecmd.update(cmd)
@@ -293,6 +338,9 @@ class CommanderMaster(messenger.Messenger):
         """
         self.cmds[cmd.basecmd.cmd_id] = cmd
         self.write_msg(cmd.basecmd)
+        if cmd.basecmd.func[0] == "pool":
+            # Results are collected by cmd.result() or gather().
+            return cmd
         while (1):
             if cmd.basecmd.func[0] not in ["async", "nohup"]:
                 # If not async wait for finish.
@@ -358,3 +406,59 @@ class CommanderMaster(messenger.Messenger):
 
         if r_cmd is None:
             raise CmdTimeout(timeout)
+
+    def gather(self, cmds, timeout=60, return_exceptions=False):
+        """
+        Wait until all commands are finished. Commands should be started
+        with "pool" prefix, e.g. ``cmds = [commander.pool.os.stat(path)
+        for path in paths]``. All of them are processed in parallel by
+        remote side over one connection.
+
+        :param cmds: List of CmdMaster.
+        :param timeout: Timeout of waiting for all commands.
+        :param return_exceptions: Return exceptions raised by commands
+                                  in results instead of raising them.
+        :raise CmdTimeout: When some command is not finished in timeout.
+        :return: List of results in the same order as cmds.
+        """
+        time_step = None
+        if timeout is not None:
+            time_step = timeout / 10.0
+        pending = [cmd for cmd in cmds if not cmd.done()]
+        w = wait_timeout(timeout)
+        while pending and next(w, False):
+            self.listen_messenger(time_step)
+            pending = [cmd for cmd in pending if not cmd.done()]
+        if pending:
+            raise CmdTimeout("%ss waiting for %d commands (%s, ...)" %
+                             (timeout, len(pending),
+                              ".".join(pending[0].func)))
+
+        results = []
+        for cmd in cmds:
+            self.cmds.pop(cmd.cmd_id, None)
+            res = cmd._basecmd.results
+            if isinstance(res, Exception) and not return_exceptions:
+                raise res
+            results.append(res)
+        return results
+
+    def pool_map(self, func_name, args_list, timeout=60,
+                 return_exceptions=False):
+        """
+        Call remote function for every item of args_list in parallel.
+
+        :param func_name: Name of remote function e.g. "os.path.getsize"
+        :param args_list: List of arguments, items which are not tuple are
+                          passed as single argument.
+        :return: List of results. See gather().
+        """
+        func = getattr(self, "pool")
+        for name in func_name.split("."):
+            func = getattr(func, name)
+        cmds = []
+        for args in args_list:
+            if not isinstance(args, tuple):
+                args = (args,)
+            cmds.append(func(*args))
+        return self.gather(cmds, timeout, return_exceptions)
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import messenger
+import remote_interface
+import remote_master
+
+
+class CommanderPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        runner = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "remote_runner.py")
+        self.proc = subprocess.Popen([sys.executable, runner, "agent"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.commander = remote_master.CommanderMaster(
+            messenger.StdIOWrapperIn(os.dup(self.proc.stdout.fileno())),
+            messenger.StdIOWrapperOut(os.dup(self.proc.stdin.fileno())),
+            False, messenger.FRAMING_BINARY)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.commander.close()
+        self.proc.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pool_map(self):
+        paths = []
+        for i in range(50):
+            path = os.path.join(self.tmpdir, "file%d" % i)
+            open(path, "w").write("x" * i)
+            paths.append(path)
+        sizes = self.commander.pool_map("os.path.getsize", paths)
+        self.assertEqual(sizes, range(50))
+
+    def test_parallel(self):
+        start = time.time()
+        cmds = [self.commander.pool.time.sleep(0.5) for _ in range(8)]
+        self.assertEqual(self.commander.gather(cmds), [None] * 8)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_futures(self):
+        slow = self.commander.pool.time.sleep(0.5)
+        fast = self.commander.pool.os.path.exists(self.tmpdir)
+        self.assertTrue(fast.result())
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(), None)
+
+    def test_exception(self):
+        missing = os.path.join(self.tmpdir, "missing")
+        cmd = self.commander.pool.os.stat(missing)
+        self.assertRaises(remote_interface.CmdTraceBack, cmd.result)
+        results = self.commander.pool_map("os.path.exists",
+                                          [missing, self.tmpdir])
+        self.assertEqual(results, [False, True])
+        results = self.commander.pool_map("os.listdir", [missing],
+                                          return_exceptions=True)
+        self.assertTrue(isinstance(results[0], remote_interface.CmdTraceBack))
+
+    def test_pool_size(self):
+        self.commander.manage.set_pool_size(1)
+        start = time.time()
+        cmds = [self.commander.pool.time.sleep(0.2) for _ in range(3)]
+        self.commander.gather(cmds)
+        self.assertTrue(time.time() - start >= 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,11 +19,21 @@ import string
 import random
 import shutil
 import signal
+import threading
+import Queue
 
 import remote_interface
 import messenger as ms
 
 
+# Default number of threads for commands started with "pool" prefix.
+POOL_SIZE = 8
+
+# Commands communicate with runner over private pipes thus they can always
+# use binary framing. Compression is useless for local pipes.
+CMD_FRAMING = ms.FRAMING_BINARY
+
+
 def daemonize(pipe_root_path="/tmp"):
     """
     Init daemon.
@@ -268,6 +278,7 @@ class CmdSlave(object):
         self.stderr_pipe = None
         self.async = False
         self.nohup = False
+        self.pool = False
         self.manage = False
         self.msg = None
 
@@ -290,7 +301,7 @@ class CmdSlave(object):
         """
         Parse name sended from master.
 
-        format: ``["manage|async|nohup| ", "fnname1", "fnname2", ...]``
+        format: ``["manage|async|nohup|pool| ", "fnname1", "fnname2", ...]``
 
         :param func_name: Function name
         :param commander: Where to execute the command (remote or local)
@@ -304,6 +315,9 @@ class CmdSlave(object):
         if func_name[0] == "nohup":  # start command in new daemon process.
             self.nohup = True
             func_name = func_name[1:]
+        if func_name[0] == "pool":  # start command in worker thread.
+            self.pool = True
+            func_name = func_name[1:]
         if hasattr(commander, func_name[0]):
             obj = getattr(commander, func_name[0])
         elif func_name[0] in commander.globals:
@@ -330,6 +344,8 @@ class CmdSlave(object):
         elif self.async:  # start command in new process
             self.basecmd.results = self.__call_async__(commander)
             self.basecmd._async = True
+        elif self.pool:  # start command in worker thread of commander
+            commander.pool_submit(self)
         elif self.nohup:   # start command in new daemon process
             if self.basecmd.cmd_hash is None:
                 self.basecmd.cmd_hash = gen_tmp_dir("/tmp")
@@ -344,7 +360,8 @@ class CmdSlave(object):
         if self.pid == 0:  # Child process make commands
             commander._close_cmds_stdios(self)
             self.msg = ms.Messenger(ms.StdIOWrapperIn(self.r_pipe),
-                                    ms.StdIOWrapperOut(self.w_pipe))
+                                    ms.StdIOWrapperOut(self.w_pipe),
+                                    CMD_FRAMING, None)
             try:
                 self.basecmd.results = self.obj(*self.basecmd.args,
                                                 **self.basecmd.kargs)
@@ -358,7 +375,8 @@ class CmdSlave(object):
             sys.exit(0)
         else:  # Parent process create communication interface to child process
             self.msg = ms.Messenger(ms.StdIOWrapperIn(self.r_pipe),
-                                    ms.StdIOWrapperOut(self.w_pipe))
+                                    ms.StdIOWrapperOut(self.w_pipe),
+                                    CMD_FRAMING, None)
 
     def __call_nohup__(self, commander):
         (pid, self.r_path, self.w_path, self.stdin_path, self.stdout_path,
@@ -369,7 +387,8 @@ class CmdSlave(object):
              stdout_pipe, stderr_pipe) = create_process_cmd()
             if self.pid == 0:  # Child process make commands
                 self.msg = ms.Messenger(ms.StdIOWrapperIn(r_pipe),
-                                        ms.StdIOWrapperOut(w_pipe))
+                                        ms.StdIOWrapperOut(w_pipe),
+                                        CMD_FRAMING, None)
                 try:
                     self.basecmd.results = self.obj(*self.basecmd.args,
                                                     **self.basecmd.kargs)
@@ -438,7 +457,8 @@ class CmdSlave(object):
                         data = os.read(r, 16384)
                         os.write(io_map[r], data)
                 self.msg = ms.Messenger(ms.StdIOWrapperIn(self.r_pipe),
-                                        ms.StdIOWrapperOut(self.w_pipe))
+                                        ms.StdIOWrapperOut(self.w_pipe),
+                                        CMD_FRAMING, None)
                 self.msg.write_msg(CmdFinish())
                 exit(0)
         else:  # main process open communication named pipes.
@@ -448,7 +468,8 @@ class CmdSlave(object):
             self.stderr_pipe = os.open(self.stderr_path, os.O_RDONLY)
             self.stdin_pipe = os.open(self.stdin_path, os.O_WRONLY)
             self.msg = ms.Messenger(ms.StdIOWrapperIn(self.r_pipe),
-                                    ms.StdIOWrapperOut(self.w_pipe))
+                                    ms.StdIOWrapperOut(self.w_pipe),
+                                    CMD_FRAMING, None)
 
     def work(self):
         """
@@ -468,6 +489,19 @@ class CmdSlave(object):
         else:
             self.basecmd.results = msg
 
+    def work_pool(self):
+        """
+        Run command in worker thread. Results (or traceback) are stored
+        to basecmd and sent to master by main thread.
+        """
+        try:
+            self.basecmd.results = self.obj(*self.basecmd.args,
+                                            **self.basecmd.kargs)
+        except Exception:
+            err_msg = traceback.format_exc()
+            self.basecmd.results = remote_interface.CmdTraceBack(err_msg)
+        self.basecmd._finished = True
+
     def recover_paths(self):
         """
         Helper function for reconnect to daemon/nohup process.
@@ -490,7 +524,8 @@ class CmdSlave(object):
             self.stdout_pipe = os.open(self.stdout_path, os.O_RDONLY)
             self.stderr_pipe = os.open(self.stderr_path, os.O_RDONLY)
             self.msg = ms.Messenger(ms.StdIOWrapperIn(self.r_pipe),
-                                    ms.StdIOWrapperOut(self.w_pipe))
+                                    ms.StdIOWrapperOut(self.w_pipe),
+                                    CMD_FRAMING, None)
 
     def finish(self, commander):
         """
@@ -503,6 +538,80 @@ class CmdSlave(object):
         del commander.cmds[self.cmd_id]
 
 
+class WorkerPool(object):
+
+    """
+    Pool of threads which run commands started with "pool" prefix. It allows
+    to run many short commands (stat of files, reading of small files, ...)
+    in parallel without fork of process for every command. Finished commands
+    are announced by byte written to notify pipe, thus the main loop of
+    commander can wait for them by select.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        """
+        :param size: Number of worker threads.
+        """
+        self.size = size
+        self.notify_r, self.notify_w = os.pipe()
+        self._todo = Queue.Queue()
+        self._done = Queue.Queue()
+        self._threads = []
+        for _ in range(size):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            cmd = self._todo.get()
+            if cmd is None:
+                return
+            cmd.work_pool()
+            self._done.put(cmd)
+            os.write(self.notify_w, "x")
+
+    def submit(self, cmd):
+        """
+        Queue command for processing in worker thread.
+
+        :type cmd: CmdSlave
+        """
+        self._todo.put(cmd)
+
+    def _drain(self):
+        cmds = []
+        while True:
+            try:
+                cmds.append(self._done.get_nowait())
+            except Queue.Empty:
+                return cmds
+
+    def finished(self):
+        """
+        Should be called when notify_r is readable.
+
+        :return: List of commands finished from last call.
+        """
+        os.read(self.notify_r, 16384)
+        return self._drain()
+
+    def close(self):
+        """
+        Stop worker threads. Queued commands are finished first.
+
+        :return: List of commands finished and not returned by finished().
+        """
+        for _ in self._threads:
+            self._todo.put(None)
+        for thread in self._threads:
+            thread.join()
+        os.close(self.notify_r)
+        os.close(self.notify_w)
+        return self._drain()
+
+
 class CommanderSlave(ms.Messenger):
 
     """
@@ -520,6 +629,9 @@ class CommanderSlave(ms.Messenger):
         self.locals = {}
         self.o_stdout = o_stdout
         self.o_stderr = o_stderr
+        self._pending_framing = None
+        self.pool = None
+        self.pool_size = POOL_SIZE
 
     def cmd_loop(self):
         """
@@ -536,17 +648,43 @@ class CommanderSlave(ms.Messenger):
                 stderrs = [cmd.stderr_pipe for cmd in self.cmds.values()
                            if cmd.stderr_pipe is not None]
 
-                r, _, _ = select.select(stdios + r_pipes + stdouts + stderrs, [], [])
+                # Messengers read data in blocks. Already read messages are
+                # not visible for select.
+                buffered = [cmd.r_pipe for cmd in self.cmds.values()
+                            if cmd.r_pipe is not None and
+                            cmd.msg is not None and cmd.msg.buffered()]
+                if self.buffered():
+                    buffered.append(self.stdin)
+                timeout = None
+                if buffered:
+                    timeout = 0
+
+                if self.pool is not None:
+                    stdios.append(self.pool.notify_r)
+
+                r, _, _ = select.select(stdios + r_pipes + stdouts + stderrs,
+                                        [], [], timeout)
+                r += [fd for fd in buffered if fd not in r]
 
                 if self.stdin in r:  # command from controller
                     cmd = CmdSlave(self.read_msg()[1])
                     self.cmds[cmd.cmd_id] = cmd
                     try:
                         cmd(self)
-                        self.write_msg(cmd.basecmd)
+                        if not cmd.pool:  # Pool cmd is sent when finished.
+                            self.write_msg(cmd.basecmd)
                     except Exception:
                         err_msg = traceback.format_exc()
                         self.write_msg(remote_interface.CommanderError(err_msg))
+                    if self._pending_framing is not None:
+                        # Master switches framing after it gets the answer.
+                        self.set_framing(self._pending_framing)
+                        self._pending_framing = None
+
+                if self.pool is not None and self.pool.notify_r in r:
+                    for cmd in self.pool.finished():
+                        cmd.finish(self)
+                        self.write_msg(cmd.basecmd)
 
                 if self.o_stdout in r:  # Send message from stdout
                     msg = os.read(self.o_stdout, 16384)
@@ -581,6 +719,16 @@ class CommanderSlave(ms.Messenger):
             err_msg = traceback.format_exc()
             self.write_msg(remote_interface.CommanderError(err_msg))
 
+    def pool_submit(self, cmd):
+        """
+        Run cmd in worker pool. Pool is started with first command.
+
+        :type cmd: CmdSlave
+        """
+        if self.pool is None:
+            self.pool = WorkerPool(self.pool_size)
+        self.pool.submit(cmd)
+
     def _close_cmds_stdios(self, exclude_cmd):
         for cmd in self.cmds.values():
             if cmd is not exclude_cmd:
@@ -637,6 +785,36 @@ class CommanderSlaveCmds(CommanderSlave):
                                                exc_traceback))
                 print "FAIL: Guest command exception."
 
+    def negotiate_framing(self, framing):
+        """
+        Second side of framing negotiation from master. Framing is switched
+        after the answer to this command is sent.
+
+        :param framing: One of messenger.FRAMINGS
+        :return: Framing which will be used.
+        """
+        if framing not in ms.FRAMINGS:
+            raise ms.MessengerError("Unknown framing %s" % (framing))
+        self._pending_framing = framing
+        return framing
+
+    def set_pool_size(self, size):
+        """
+        Set number of worker threads for commands with "pool" prefix.
+        Running pool is stopped after all its commands finish and new
+        one is started with next pool command.
+
+        :param size: Number of threads.
+        :return: Number of threads.
+        """
+        self.pool_size = size
+        if self.pool is not None:
+            for cmd in self.pool.close():
+                cmd.finish(self)
+                self.write_msg(cmd.basecmd)
+            self.pool = None
+        return size
+
     def send_msg(self, msg, cmd_id):
         """
         Send msg to cmd with id == cmd_id
@@ -2,6 +2,10 @@
 
 import unittest
 import os
+import time
+import shutil
+import socket
+import tempfile
 
 import common
 import remote
@@ -88,5 +92,110 @@ class RemoteFileTest(unittest.TestCase):
         test_data = self._read_test_file()
         self.assertEqual(test_data, self.default_data)
 
+
+class SSHMasterTest(unittest.TestCase):
+
+    """
+    Multiplexed sessions and copies. The login tests need sshd on localhost
+    and credentials in $VIRT_TEST_SSH_USER (default root) and
+    $VIRT_TEST_SSH_PASSWORD.
+    """
+
+    def setUp(self):
+        self.username = os.environ.get("VIRT_TEST_SSH_USER", "root")
+        self.password = os.environ.get("VIRT_TEST_SSH_PASSWORD")
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        remote.close_ssh_masters()
+        shutil.rmtree(self.tmpdir)
+
+    def test_options(self):
+        master = remote.SSHMaster("fe80::5054:ff:fe12:3456%eth0", 22, "root")
+        self.assertTrue(master.control_path.startswith(
+            remote.SSH_CONTROL_DIR))
+        self.assertTrue(len(master.control_path) < 100)
+        self.assertTrue(master.options().endswith(master.control_path))
+        self.assertFalse(master.is_alive())
+
+    def test_localhost(self):
+        if self.password is None:
+            self.skipTest("VIRT_TEST_SSH_PASSWORD is not set")
+        session = remote.remote_login("ssh", "localhost", 22, self.username,
+                                      self.password, r"[\#\$]\s*$",
+                                      multiplex=True)
+        session.close()
+        master = remote.get_ssh_master("localhost", 22, self.username,
+                                       self.password)
+        self.assertTrue(master.is_alive())
+        local_path = os.path.join(self.tmpdir, "file")
+        open(local_path, "w").write("data")
+        remote_path = os.path.join(self.tmpdir, "copy")
+        remote.scp_to_remote("localhost", 22, self.username, self.password,
+                             local_path, remote_path, multiplex=True)
+        remote.scp_from_remote("localhost", 22, self.username, self.password,
+                               remote_path, local_path + "2",
+                               multiplex=True)
+        self.assertEqual(open(local_path + "2").read(), "data")
+        self.assertEqual(sorted(master.timings),
+                         ["login", "master", "scp_from", "scp_to"])
+        remote.close_ssh_masters()
+        self.assertFalse(master.is_alive())
+
+
+class WaitForLoginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.logins = []
+        self.orig_remote_login = remote.remote_login
+        remote.remote_login = self.remote_login
+
+    def tearDown(self):
+        remote.remote_login = self.orig_remote_login
+        self.listener.close()
+
+    def remote_login(self, client, host, port, *args, **dargs):
+        self.logins.append(client)
+        if len(self.logins) < 3:
+            raise remote.LoginTimeoutError("")
+        return "session"
+
+    def test_port_probe(self):
+        self.assertFalse(remote.is_port_open("127.0.0.1", self.port))
+        self.listener.listen(1)
+        self.assertTrue(remote.is_port_open("127.0.0.1", self.port))
+        self.assertTrue(remote.is_port_open("localhost", self.port))
+        self.assertFalse(remote.is_port_open("no-such-host.invalid",
+                                             self.port))
+
+    def test_delays(self):
+        delays = remote.login_delays(0.5, 2, 3)
+        self.assertEqual([delays.next() for _ in xrange(4)], [0.5, 1, 2, 3])
+
+    def test_closed_port(self):
+        # The client is spawned only for the last attempt
+        self.assertRaises(remote.LoginError, remote.wait_for_login,
+                          "ssh", "127.0.0.1", self.port, "root", "", "#",
+                          timeout=1)
+        self.assertEqual(self.logins, ["ssh"])
+        # Clients without a port to probe
+        self.assertEqual(remote.wait_for_login("nc", "127.0.0.1", self.port,
+                                               "root", "", "#", timeout=5),
+                         "session")
+        self.assertEqual(len(self.logins), 3)
+
+    def test_open_port(self):
+        self.listener.listen(5)
+        start = time.time()
+        self.assertEqual(remote.wait_for_login("ssh", "127.0.0.1", self.port,
+                                               "root", "", "#", timeout=30),
+                         "session")
+        self.assertEqual(len(self.logins), 3)
+        self.assertTrue(time.time() - start < 2)
+
+
 if __name__ == "__main__":
     unittest.main()
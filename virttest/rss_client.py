@@ -12,9 +12,19 @@ import time
 import sys
 import os
 import glob
+import threading
+import Queue
 
 # Globals
 CHUNKSIZE = 65536
+# Limits of chunk size accepted by server
+MIN_CHUNKSIZE = 512
+MAX_CHUNKSIZE = 1048576
+# Size of socket reads, rest of data is kept for next _receive()
+RECV_SIZE = 262144
+# Socket timeout is updated only if it differs more than this from the
+# remaining time (settimeout() costs syscalls on every packet)
+TIMEOUT_SLACK = 1.0
 
 # Protocol message constants
 RSS_MAGIC = 0x525353
@@ -82,13 +92,72 @@ class FileTransferNotFoundError(FileTransferError):
     pass
 
 
+class TransferStats(object):
+
+    """
+    Per file and aggregate throughput of file transfers.
+    """
+
+    def __init__(self):
+        self.files = []
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add_file(self, filename, size, duration):
+        """
+        Record transferred file.
+
+        :param filename: Path of file on the local side.
+        :param size: Size of file in bytes.
+        :param duration: Time of transfer in seconds.
+        """
+        self.files.append((filename, size, duration))
+
+    def merge(self, other):
+        """
+        Add files of other stats (e.g. of parallel connection).
+        """
+        self.files.extend(other.files)
+
+    def finish(self):
+        self.end_time = time.time()
+
+    @property
+    def total_bytes(self):
+        return sum(f[1] for f in self.files)
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def throughput(self):
+        """
+        :return: Aggregate throughput in MB/s (wall clock time).
+        """
+        return self.total_bytes / 1048576. / max(self.elapsed, 1e-6)
+
+    def file_throughputs(self):
+        """
+        :return: List of (filename, MB/s) of every file.
+        """
+        return [(f[0], f[1] / 1048576. / max(f[2], 1e-6))
+                for f in self.files]
+
+    def __str__(self):
+        return ("%d files, %.3f MB in %.3f s (%.3f MB/sec)" %
+                (len(self.files), self.total_bytes / 1048576., self.elapsed,
+                 self.throughput))
+
+
 class FileTransferClient(object):
 
     """
     Connect to a RSS (remote shell server) and transfer files.
     """
 
-    def __init__(self, address, port, log_func=None, timeout=20):
+    def __init__(self, address, port, log_func=None, timeout=20,
+                 chunk_size=CHUNKSIZE):
         """
         Connect to a server.
 
@@ -97,8 +166,15 @@ class FileTransferClient(object):
         :param log_func: If provided, transfer stats will be passed to this
                 function during the transfer
         :param timeout: Time duration to wait for connection to succeed
+        :param chunk_size: Size of file chunks (MIN_CHUNKSIZE-MAX_CHUNKSIZE)
         :raise FileTransferConnectError: Raised if the connection fails
         """
+        if not MIN_CHUNKSIZE <= chunk_size <= MAX_CHUNKSIZE:
+            raise FileTransferError("Invalid chunk size %s" % chunk_size)
+        self.chunk_size = chunk_size
+        self._rbuf = ""
+        self._timeout = timeout
+        self.stats = TransferStats()
         family = ":" in address and socket.AF_INET6 or socket.AF_INET
         self._socket = socket.socket(family, socket.SOCK_STREAM)
         self._socket.settimeout(timeout)
@@ -116,7 +192,7 @@ class FileTransferClient(object):
         except FileTransferTimeoutError:
             raise FileTransferConnectError("Timeout expired while waiting to "
                                            "receive magic number")
-        self._send(struct.pack("=i", CHUNKSIZE))
+        self._send(struct.pack("=i", chunk_size))
         self._log_func = log_func
         self._last_time = time.time()
         self._last_transferred = 0
@@ -131,11 +207,16 @@ class FileTransferClient(object):
         """
         self._socket.close()
 
+    def _set_timeout(self, timeout):
+        if timeout <= 0:
+            raise socket.timeout
+        if abs(self._timeout - timeout) > TIMEOUT_SLACK:
+            self._socket.settimeout(timeout)
+            self._timeout = timeout
+
     def _send(self, sr, timeout=60):
         try:
-            if timeout <= 0:
-                raise socket.timeout
-            self._socket.settimeout(timeout)
+            self._set_timeout(timeout)
             self._socket.sendall(sr)
         except socket.timeout:
             raise FileTransferTimeoutError("Timeout expired while sending "
@@ -144,20 +225,27 @@ class FileTransferClient(object):
             raise FileTransferSocketError("Could not send data to server", e)
 
     def _receive(self, size, timeout=60):
-        strs = []
+        if len(self._rbuf) >= size:
+            data = self._rbuf[:size]
+            self._rbuf = self._rbuf[size:]
+            return data
+        strs = [self._rbuf]
+        size -= len(self._rbuf)
+        self._rbuf = ""
         end_time = time.time() + timeout
         try:
             while size > 0:
-                timeout = end_time - time.time()
-                if timeout <= 0:
-                    raise socket.timeout
-                self._socket.settimeout(timeout)
-                data = self._socket.recv(size)
+                self._set_timeout(end_time - time.time())
+                # Read more than needed, next msg or packet usually follows.
+                data = self._socket.recv(max(size, RECV_SIZE))
                 if not data:
                     raise FileTransferProtocolError("Connection closed "
                                                     "unexpectedly while "
                                                     "receiving data from "
                                                     "server")
+                if len(data) > size:
+                    self._rbuf = data[size:]
+                    data = data[:size]
                 strs.append(data)
                 size -= len(data)
         except socket.timeout:
@@ -181,11 +269,22 @@ class FileTransferClient(object):
                 self._last_transferred = self.transferred
 
     def _send_packet(self, sr, timeout=60):
-        self._send(struct.pack("=I", len(sr)))
-        self._send(sr, timeout)
+        # Length and data are sent together, see _pack_packet().
+        self._send(self._pack_packet(sr), timeout)
         self.transferred += len(sr) + 4
         self._report_stats("Sent")
 
+    @staticmethod
+    def _pack_packet(sr, msg=None):
+        """
+        :param sr: Data of packet.
+        :param msg: If provided, msg which is sent before packet.
+        :return: Packet (optionally preceded by msg) ready to send.
+        """
+        if msg is None:
+            return struct.pack("=I", len(sr)) + sr
+        return struct.pack("=II", msg, len(sr)) + sr
+
     def _receive_packet(self, timeout=60):
         size = struct.unpack("=I", self._receive(4))[0]
         sr = self._receive(size, timeout)
@@ -196,38 +295,52 @@ class FileTransferClient(object):
     def _send_file_chunks(self, filename, timeout=60):
         if self._log_func:
             self._log_func("Sending file %s" % filename)
+        start = time.time()
+        size = 0
+        # Header and data of chunk share one buffer and go by one send.
+        packet = bytearray(4 + self.chunk_size)
+        view = memoryview(packet)
         f = open(filename, "rb")
         try:
             try:
-                end_time = time.time() + timeout
+                end_time = start + timeout
                 while True:
-                    data = f.read(CHUNKSIZE)
-                    self._send_packet(data, end_time - time.time())
-                    if len(data) < CHUNKSIZE:
+                    length = f.readinto(view[4:])
+                    struct.pack_into("=I", packet, 0, length)
+                    self._send(view[:4 + length], end_time - time.time())
+                    size += length
+                    self.transferred += length + 4
+                    self._report_stats("Sent")
+                    if length < self.chunk_size:
                         break
             except FileTransferError, e:
                 e.filename = filename
                 raise
         finally:
             f.close()
+        self.stats.add_file(filename, size, time.time() - start)
 
     def _receive_file_chunks(self, filename, timeout=60):
         if self._log_func:
             self._log_func("Receiving file %s" % filename)
+        start = time.time()
+        size = 0
         f = open(filename, "wb")
         try:
             try:
-                end_time = time.time() + timeout
+                end_time = start + timeout
                 while True:
                     data = self._receive_packet(end_time - time.time())
                     f.write(data)
-                    if len(data) < CHUNKSIZE:
+                    size += len(data)
+                    if len(data) < self.chunk_size:
                         break
             except FileTransferError, e:
                 e.filename = filename
                 raise
         finally:
             f.close()
+        self.stats.add_file(filename, size, time.time() - start)
 
     def _send_msg(self, msg, timeout=60):
         self._send(struct.pack("=I", msg))
@@ -257,7 +370,8 @@ class FileUploadClient(FileTransferClient):
     Connect to a RSS (remote shell server) and upload files or directory trees.
     """
 
-    def __init__(self, address, port, log_func=None, timeout=20):
+    def __init__(self, address, port, log_func=None, timeout=20,
+                 chunk_size=CHUNKSIZE):
         """
         Connect to a server.
 
@@ -266,6 +380,7 @@ class FileUploadClient(FileTransferClient):
         :param log_func: If provided, transfer stats will be passed to this
                 function during the transfer
         :param timeout: Time duration to wait for connection to succeed
+        :param chunk_size: Size of file chunks (MIN_CHUNKSIZE-MAX_CHUNKSIZE)
         :raise FileTransferConnectError: Raised if the connection fails
         :raise FileTransferProtocolError: Raised if an incorrect magic number
                 is received
@@ -273,17 +388,17 @@ class FileUploadClient(FileTransferClient):
                 be sent to the server
         """
         super(FileUploadClient, self).__init__(
-            address, port, log_func, timeout)
+            address, port, log_func, timeout, chunk_size)
         self._send_msg(RSS_UPLOAD)
 
     def _upload_file(self, path, end_time):
         if os.path.isfile(path):
-            self._send_msg(RSS_CREATE_FILE)
-            self._send_packet(os.path.basename(path))
+            self._send(self._pack_packet(os.path.basename(path),
+                                         RSS_CREATE_FILE))
             self._send_file_chunks(path, end_time - time.time())
         elif os.path.isdir(path):
-            self._send_msg(RSS_CREATE_DIR)
-            self._send_packet(os.path.basename(path))
+            self._send(self._pack_packet(os.path.basename(path),
+                                         RSS_CREATE_DIR))
             for filename in os.listdir(path):
                 self._upload_file(os.path.join(path, filename), end_time)
             self._send_msg(RSS_LEAVE_DIR)
@@ -323,13 +438,27 @@ class FileUploadClient(FileTransferClient):
                                         message to the client
         :note: Other exceptions can be raised.
         """
+        self.upload_paths(glob.glob(src_pattern), dst_path, timeout,
+                          src_pattern)
+
+    def upload_paths(self, paths, dst_path, timeout=600, src_pattern=None):
+        """
+        Send list of files or directory trees to the server.
+
+        :param paths: Local paths of files or directories.
+        :param dst_path: A path in the server's filesystem where the files will
+                         be saved
+        :param timeout: Time duration in seconds to wait for the transfer to
+                        complete
+        :param src_pattern: Pattern which was expanded to paths (for error
+                            messages only)
+        :see: upload()
+        """
         end_time = time.time() + timeout
         try:
             try:
-                self._send_msg(RSS_SET_PATH)
-                self._send_packet(dst_path)
-                matches = glob.glob(src_pattern)
-                for filename in matches:
+                self._send(self._pack_packet(dst_path, RSS_SET_PATH))
+                for filename in paths:
                     self._upload_file(os.path.abspath(filename), end_time)
                 self._send_msg(RSS_DONE)
             except FileTransferTimeoutError:
@@ -338,7 +467,7 @@ class FileUploadClient(FileTransferClient):
                 self._handle_transfer_error()
             else:
                 # If nothing was transferred, raise an exception
-                if not matches:
+                if not paths:
                     raise FileTransferNotFoundError("Pattern %s does not "
                                                     "match any files or "
                                                     "directories" %
@@ -365,7 +494,8 @@ class FileDownloadClient(FileTransferClient):
     Connect to a RSS (remote shell server) and download files or directory trees.
     """
 
-    def __init__(self, address, port, log_func=None, timeout=20):
+    def __init__(self, address, port, log_func=None, timeout=20,
+                 chunk_size=CHUNKSIZE):
         """
         Connect to a server.
 
@@ -374,6 +504,7 @@ class FileDownloadClient(FileTransferClient):
         :param log_func: If provided, transfer stats will be passed to this
                 function during the transfer
         :param timeout: Time duration to wait for connection to succeed
+        :param chunk_size: Size of file chunks (MIN_CHUNKSIZE-MAX_CHUNKSIZE)
         :raise FileTransferConnectError: Raised if the connection fails
         :raise FileTransferProtocolError: Raised if an incorrect magic number
                 is received
@@ -381,7 +512,7 @@ class FileDownloadClient(FileTransferClient):
                 be sent to the server
         """
         super(FileDownloadClient, self).__init__(
-            address, port, log_func, timeout)
+            address, port, log_func, timeout, chunk_size)
         self._send_msg(RSS_DOWNLOAD)
 
     def download(self, src_pattern, dst_path, timeout=600):
@@ -426,8 +557,7 @@ class FileDownloadClient(FileTransferClient):
         dir_count = 0
         try:
             try:
-                self._send_msg(RSS_SET_PATH)
-                self._send_packet(src_pattern)
+                self._send(self._pack_packet(src_pattern, RSS_SET_PATH))
             except FileTransferError:
                 self._handle_transfer_error()
             while True:
@@ -497,10 +627,155 @@ def download(address, port, src_pattern, dst_path, log_func=None, timeout=60,
     client.close()
 
 
+def _tree_size(path):
+    if os.path.isdir(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
+    return os.path.getsize(path)
+
+
+def adaptive_chunk_size(max_file_size):
+    """
+    Choose chunk size big enough for the largest file (fewer packets and
+    syscalls) but not wasting memory of server for small files.
+
+    :param max_file_size: Size of the largest transferred file.
+    """
+    chunk_size = CHUNKSIZE
+    while chunk_size < max_file_size and chunk_size < MAX_CHUNKSIZE:
+        chunk_size *= 2
+    return chunk_size
+
+
+def _run_parallel(jobs, streams, worker):
+    """
+    Run worker(jobs_queue, stats) in streams threads.
+
+    :return: Merged TransferStats of all threads.
+    :raise: First exception raised by some worker.
+    """
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+    errors = []
+    stats = TransferStats()
+
+    def run():
+        try:
+            stats.merge(worker(todo))
+        except Exception:
+            errors.append(sys.exc_info())
+            # Stop other threads as soon as possible
+            while not todo.empty():
+                try:
+                    todo.get_nowait()
+                except Queue.Empty:
+                    break
+
+    threads = [threading.Thread(target=run)
+               for _ in range(max(1, min(streams, len(jobs))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.finish()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return stats
+
+
+def upload_parallel(address, port, src_pattern, dst_path, streams=4,
+                    log_func=None, timeout=600, connect_timeout=20,
+                    chunk_size=None):
+    """
+    Connect to server by several connections and upload files matching
+    src_pattern concurrently. Matched files and directory trees are
+    distributed to connections by size. dst_path has to be existing
+    directory if more files match.
+
+    :param streams: Max number of parallel connections.
+    :param chunk_size: Size of chunks, None chooses it by the size of files.
+    :return: TransferStats with per file and aggregate throughput.
+    :see: FileUploadClient.upload()
+    """
+    matches = [os.path.abspath(path) for path in glob.glob(src_pattern)]
+    if not matches:
+        raise FileTransferNotFoundError("Pattern %s does not match any files "
+                                        "or directories" % src_pattern)
+    sizes = dict((path, _tree_size(path)) for path in matches)
+    if chunk_size is None:
+        chunk_size = adaptive_chunk_size(max(sizes.values()))
+    # The largest first, every group gets the next one when it's free.
+    jobs = sorted(matches, key=sizes.get, reverse=True)
+    end_time = time.time() + timeout
+
+    def worker(todo):
+        client = FileUploadClient(address, port, log_func, connect_timeout,
+                                  chunk_size)
+        try:
+            while True:
+                try:
+                    path = todo.get_nowait()
+                except Queue.Empty:
+                    return client.stats
+                client.upload_paths([path], dst_path,
+                                    end_time - time.time(), src_pattern)
+        finally:
+            client.close()
+
+    stats = _run_parallel(jobs, streams, worker)
+    if log_func:
+        log_func("Uploaded %s" % stats)
+    return stats
+
+
+def download_parallel(address, port, src_patterns, dst_path, streams=4,
+                      log_func=None, timeout=600, connect_timeout=20,
+                      chunk_size=MAX_CHUNKSIZE):
+    """
+    Connect to server by several connections and download files matching
+    src_patterns concurrently (every pattern by one connection).
+
+    :param src_patterns: List of paths or wildcard patterns in the server's
+                         filesystem.
+    :param dst_path: Local directory where files will be saved
+    :param streams: Max number of parallel connections.
+    :return: TransferStats with per file and aggregate throughput.
+    :see: FileDownloadClient.download()
+    """
+    end_time = time.time() + timeout
+
+    def worker(todo):
+        client = FileDownloadClient(address, port, log_func, connect_timeout,
+                                    chunk_size)
+        try:
+            while True:
+                try:
+                    pattern = todo.get_nowait()
+                except Queue.Empty:
+                    return client.stats
+                client.download(pattern, dst_path, end_time - time.time())
+        finally:
+            client.close()
+
+    stats = _run_parallel(src_patterns, streams, worker)
+    if log_func:
+        log_func("Downloaded %s" % stats)
+    return stats
+
+
 def main():
     import optparse
 
-    usage = "usage: %prog [options] address port src_pattern dst_path"
+    usage = ("usage: %prog [options] address port src_pattern dst_path\n\n"
+             "With --streams and --download, src_pattern can be comma "
+             "separated list of patterns.")
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-d", "--download",
                       action="store_true", dest="download",
@@ -514,6 +789,9 @@ def main():
     parser.add_option("-t", "--timeout",
                       type="int", dest="timeout", default=3600,
                       help="transfer timeout")
+    parser.add_option("-s", "--streams",
+                      type="int", dest="streams", default=1,
+                      help="number of parallel connections")
     options, args = parser.parse_args()
     if options.download == options.upload:
         parser.error("you must specify either -d or -u")
@@ -528,7 +806,16 @@ def main():
             print s
         logger = p
 
-    if options.download:
+    if options.streams > 1:
+        if options.download:
+            stats = download_parallel(address, port, src_pattern.split(","),
+                                      dst_path, options.streams, logger,
+                                      options.timeout)
+        else:
+            stats = upload_parallel(address, port, src_pattern, dst_path,
+                                    options.streams, logger, options.timeout)
+        print stats
+    elif options.download:
         download(address, port, src_pattern, dst_path, logger, options.timeout)
     elif options.upload:
         upload(address, port, src_pattern, dst_path, logger, options.timeout)
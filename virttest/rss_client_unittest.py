@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import common
+import rss_client
+import rss_server
+
+
+class RSSClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = rss_server.FileTransferServer()
+        self.server.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+        self.dst = os.path.join(self.tmpdir, "dst")
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+        self.files = {"empty": "",
+                      "small": "small file",
+                      "chunk": "c" * rss_client.CHUNKSIZE,
+                      "big": os.urandom(3 * rss_client.CHUNKSIZE + 17)}
+        for name, data in self.files.items():
+            open(os.path.join(self.src, name), "w").write(data)
+        os.mkdir(os.path.join(self.src, "subdir"))
+        open(os.path.join(self.src, "subdir", "file"), "w").write("sub")
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _check_dst(self, path):
+        for name, data in self.files.items():
+            self.assertEqual(open(os.path.join(path, name)).read(), data)
+        self.assertEqual(open(os.path.join(path, "subdir", "file")).read(),
+                         "sub")
+
+    def test_upload(self):
+        client = rss_client.FileUploadClient("127.0.0.1", self.server.port)
+        client.upload(self.src, self.dst)
+        client.close()
+        self._check_dst(os.path.join(self.dst, "src"))
+        self.assertEqual(len(client.stats.files), len(self.files) + 1)
+
+    def test_download(self):
+        client = rss_client.FileDownloadClient("127.0.0.1", self.server.port,
+                                               chunk_size=1024)
+        client.download(os.path.join(self.src, "*"), self.dst)
+        client.download(os.path.join(self.src, "small"),
+                        os.path.join(self.dst, "renamed"))
+        client.close()
+        self._check_dst(self.dst)
+        self.assertEqual(open(os.path.join(self.dst, "renamed")).read(),
+                         self.files["small"])
+
+    def test_not_found(self):
+        self.assertRaises(rss_client.FileTransferNotFoundError,
+                          rss_client.download, "127.0.0.1", self.server.port,
+                          os.path.join(self.src, "missing"), self.dst)
+
+    def test_upload_parallel(self):
+        stats = rss_client.upload_parallel("127.0.0.1", self.server.port,
+                                           os.path.join(self.src, "*"),
+                                           self.dst, streams=3)
+        self._check_dst(self.dst)
+        self.assertEqual(stats.total_bytes,
+                         sum(len(d) for d in self.files.values()) + 3)
+        self.assertEqual(len(stats.file_throughputs()), len(self.files) + 1)
+
+    def test_download_parallel(self):
+        patterns = [os.path.join(self.src, name) for name in self.files]
+        patterns.append(os.path.join(self.src, "subdir"))
+        stats = rss_client.download_parallel("127.0.0.1", self.server.port,
+                                             patterns, self.dst, streams=2)
+        self._check_dst(self.dst)
+        self.assertEqual(len(stats.files), len(self.files) + 1)
+
+    def test_adaptive_chunk_size(self):
+        self.assertEqual(rss_client.adaptive_chunk_size(10),
+                         rss_client.CHUNKSIZE)
+        self.assertEqual(rss_client.adaptive_chunk_size(200000), 262144)
+        self.assertEqual(rss_client.adaptive_chunk_size(1 << 40),
+                         rss_client.MAX_CHUNKSIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+"""
+Python stand-in for the file transfer server of RSS (Remote Shell Server).
+
+It speaks the same protocol as rss.exe (see shared/deps/rss/rss.cpp) and
+allows to test rss_client on a Linux host without Windows guests.
+"""
+
+import os
+import glob
+import struct
+import logging
+import threading
+import SocketServer
+
+import rss_client
+
+
+class RSSServerError(Exception):
+    pass
+
+
+class FileTransferHandler(SocketServer.BaseRequestHandler):
+
+    """
+    Handle one client connection in the same way as TransferThreadEntry()
+    of rss.cpp.
+    """
+
+    def _receive(self, size):
+        strs = []
+        while size > 0:
+            data = self.request.recv(size)
+            if not data:
+                raise RSSServerError("Connection closed by client")
+            strs.append(data)
+            size -= len(data)
+        return "".join(strs)
+
+    def _receive_msg(self):
+        return struct.unpack("=I", self._receive(4))[0]
+
+    def _receive_packet(self):
+        size = self._receive_msg()
+        if size > self.chunk_size:
+            raise RSSServerError("Packet is too long")
+        return self._receive(size)
+
+    def _send_msg(self, msg):
+        self.request.sendall(struct.pack("=I", msg))
+
+    def _send_packet(self, data):
+        self.request.sendall(struct.pack("=I", len(data)) + data)
+
+    def _error(self, msg):
+        self._send_msg(rss_client.RSS_ERROR)
+        self._send_packet(msg)
+        raise RSSServerError(msg)
+
+    def handle(self):
+        try:
+            self._send_msg(rss_client.RSS_MAGIC)
+            self.chunk_size = struct.unpack("=i", self._receive(4))[0]
+            if not (rss_client.MIN_CHUNKSIZE <= self.chunk_size <=
+                    rss_client.MAX_CHUNKSIZE):
+                self._error("Client set invalid chunk size")
+            msg = self._receive_msg()
+            if msg == rss_client.RSS_UPLOAD:
+                self._receive_files()
+            elif msg == rss_client.RSS_DOWNLOAD:
+                self._send_files()
+            else:
+                self._error("Received unexpected msg")
+        except (RSSServerError, EnvironmentError), e:
+            logging.debug("RSS server: client %s disconnected (%s)",
+                          self.client_address, e)
+
+    def _receive_files(self):
+        path = None
+        while True:
+            msg = self._receive_msg()
+            if msg == rss_client.RSS_SET_PATH:
+                path = os.path.expandvars(self._receive_packet())
+                path = path.rstrip(os.sep) or os.sep
+            elif msg == rss_client.RSS_CREATE_FILE:
+                filename = self._receive_packet()
+                if os.path.isdir(path):
+                    path = os.path.join(path, filename)
+                f = open(path, "wb")
+                try:
+                    while True:
+                        data = self._receive_packet()
+                        f.write(data)
+                        if len(data) < self.chunk_size:
+                            break
+                finally:
+                    f.close()
+                path = os.path.dirname(path)
+            elif msg == rss_client.RSS_CREATE_DIR:
+                dirname = self._receive_packet()
+                if os.path.isdir(path):
+                    path = os.path.join(path, dirname)
+                if os.path.exists(path):
+                    if not os.path.isdir(path):
+                        self._error("RSS_CREATE_DIR: path exists and is not "
+                                    "a directory")
+                else:
+                    os.mkdir(path)
+            elif msg == rss_client.RSS_LEAVE_DIR:
+                path = os.path.dirname(path)
+            elif msg == rss_client.RSS_DONE:
+                self._send_msg(rss_client.RSS_OK)
+            else:
+                self._error("Received unexpected msg")
+
+    def _send_file(self, path):
+        self._send_msg(rss_client.RSS_CREATE_FILE)
+        self._send_packet(os.path.basename(path))
+        f = open(path, "rb")
+        try:
+            while True:
+                data = f.read(self.chunk_size)
+                self._send_packet(data)
+                if len(data) < self.chunk_size:
+                    break
+        finally:
+            f.close()
+
+    def _send_tree(self, paths):
+        for path in paths:
+            if os.path.islink(path):
+                continue
+            if os.path.isdir(path):
+                self._send_msg(rss_client.RSS_CREATE_DIR)
+                self._send_packet(os.path.basename(path))
+                self._send_tree([os.path.join(path, name)
+                                 for name in sorted(os.listdir(path))])
+                self._send_msg(rss_client.RSS_LEAVE_DIR)
+            elif os.access(path, os.R_OK):
+                self._send_file(path)
+
+    def _send_files(self):
+        while True:
+            msg = self._receive_msg()
+            if msg != rss_client.RSS_SET_PATH:
+                self._error("Received unexpected msg")
+            pattern = os.path.expandvars(self._receive_packet())
+            self._send_tree(sorted(glob.glob(pattern.rstrip(os.sep))))
+            self._send_msg(rss_client.RSS_DONE)
+
+
+class FileTransferServer(SocketServer.ThreadingTCPServer):
+
+    """
+    File transfer server. Every client is served by its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address="127.0.0.1", port=0):
+        """
+        :param address: Address to listen on.
+        :param port: Port to listen on, 0 picks free port (see self.port).
+        """
+        SocketServer.ThreadingTCPServer.__init__(self, (address, port),
+                                                 FileTransferHandler)
+        self.port = self.server_address[1]
+        self._thread = None
+
+    def start(self):
+        """
+        Serve clients in background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop background thread and close listening socket.
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import optparse
+
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-a", "--address", default="0.0.0.0",
+                      help="address to listen on [default: %default]")
+    parser.add_option("-p", "--port", type="int", default=10023,
+                      help="port to listen on [default: %default]")
+    options, args = parser.parse_args()
+    FileTransferServer(options.address, options.port).serve_forever()
@@ -8,12 +8,16 @@ Helpers for cgroup testing.
 """
 import logging
 import os
+import errno
 import shutil
+import struct
 import subprocess
 import time
 import re
 import random
 import commands
+import ctypes
+import ctypes.util
 from tempfile import mkdtemp
 from autotest.client import utils
 from autotest.client.shared import error
@@ -21,6 +25,16 @@ from virttest import utils_misc
 import service
 
 
+# Properties polled by tests, their files are kept open and re-read from
+# the beginning instead of being opened on each get_property().
+POLLED_PROPERTIES = ("cpuacct.usage", "cpuacct.usage_percpu", "cpuacct.stat",
+                     "cpu.stat", "memory.usage_in_bytes",
+                     "memory.max_usage_in_bytes",
+                     "memory.memsw.usage_in_bytes", "memory.stat",
+                     "blkio.io_service_bytes",
+                     "blkio.throttle.io_service_bytes")
+
+
 class Cgroup(object):
 
     """
@@ -37,6 +51,7 @@ class Cgroup(object):
         self._client = _client
         self.root = None
         self.cgroups = []
+        self._fds = {}      # path: fd of opened POLLED_PROPERTIES
 
     def __del__(self):
         """
@@ -48,6 +63,71 @@ class Cgroup(object):
                 if task:
                     self.set_root_cgroup(int(task))
             self.rm_cgroup(pwd)
+        self.close_fds()
+
+    def close_fds(self, pwd=None):
+        """
+        Close kept open property files
+        :param pwd: close only files of this cgroup directory (default: all)
+        """
+        for path in self._fds.keys():
+            if pwd is None or os.path.dirname(path) == pwd.rstrip('/'):
+                try:
+                    os.close(self._fds.pop(path))
+                except OSError:
+                    pass
+
+    def __read_property(self, path):
+        """
+        Read the whole property file, POLLED_PROPERTIES files are kept open.
+        :param path: path of the property file
+        :return: content of the file
+        """
+        if os.path.basename(path) not in POLLED_PROPERTIES:
+            prop_file = open(path, 'r')
+            try:
+                return prop_file.read()
+            finally:
+                prop_file.close()
+        fd = self._fds.get(path)
+        if fd is not None:
+            try:
+                return self.__read_fd(fd)
+            except OSError:
+                # The cgroup was removed (ENODEV on cgroupfs) and maybe
+                # created again (e.g. by libvirt on VM restart), reopen
+                self.close_fds(os.path.dirname(path))
+        fd = os.open(path, os.O_RDONLY)
+        self._fds[path] = fd
+        return self.__read_fd(fd)
+
+    @staticmethod
+    def __read_fd(fd):
+        """
+        Read the whole file from the beginning
+        :param fd: fd of the property file
+        :return: content of the file
+        """
+        os.lseek(fd, 0, os.SEEK_SET)
+        if os.fstat(fd).st_nlink == 0:
+            raise OSError(errno.ENOENT, "Property file was removed")
+        out = []
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            out.append(data)
+        return "".join(out)
+
+    def __write_property(self, path, value):
+        """
+        Write value into the property file
+        """
+        prop_file = open(path, 'w')
+        try:
+            prop_file.write(value)
+        finally:
+            prop_file.close()
 
     def initialize(self, modules):
         """
@@ -186,6 +266,7 @@ class Cgroup(object):
         """
         if isinstance(pwd, int):
             pwd = self.cgroups[pwd]
+        self.close_fds(pwd)
         try:
             os.rmdir(pwd)
             self.cgroups.remove(pwd)
@@ -197,22 +278,14 @@ class Cgroup(object):
 
     def get_all_cgroups(self):
         """
-        Get all sub cgroups in this controller
+        Get all sub cgroups in this controller (see CgroupHierarchy)
         """
-        lscgroup_cmd = "lscgroup %s:/" % self.module
-        result = utils.run(lscgroup_cmd, ignore_status=True)
-        if result.exit_status:
-            raise error.TestFail(result.stderr.strip())
-        cgroup_list = result.stdout.strip().splitlines()
-        # Remove root cgroup
-        cgroup_list = cgroup_list[1:]
         self.root = get_cgroup_mountpoint(self.module)
-        sub_cgroup_list = []
-        for item in cgroup_list:
-            sub_cg = item.split(":/")[-1]
-            sub_cg_path = os.path.join(self.root, sub_cg) + '/'
-            sub_cgroup_list.append(sub_cg_path)
-        self.cgroups = sub_cgroup_list
+        try:
+            self.cgroups = get_hierarchy(self.root).get_cgroups()
+        except OSError, detail:
+            raise error.TestFail("Listing cgroups of %s failed: %s"
+                                 % (self.module, detail))
         return self.cgroups
 
     def cgdelete_all_cgroups(self):
@@ -244,6 +317,7 @@ class Cgroup(object):
             cmd = "cgdelete %s:%s" % (self.module, cgroup)
             if recursive:
                 cmd += " -r"
+            self.close_fds(cgroup_pwd)
             utils.run(cmd, ignore_status=False)
             self.cgroups.remove(cgroup_pwd)
         except error.CmdError, detail:
@@ -360,7 +434,8 @@ class Cgroup(object):
         try:
             # Remove tailing '\n' from each line
             file_link = os.path.join(pwd, prop)
-            ret = [_[:-1].replace("\t", " ") for _ in open(file_link, 'r')]
+            ret = [_.replace("\t", " ")
+                   for _ in self.__read_property(file_link).splitlines()]
             if ret:
                 return ret
             else:
@@ -408,7 +483,7 @@ class Cgroup(object):
         if isinstance(pwd, int):
             pwd = self.cgroups[pwd]
         try:
-            open(os.path.join(pwd, prop), 'w').write(value)
+            self.__write_property(os.path.join(pwd, prop), value)
         except Exception, inst:
             raise error.TestError("cg.set_property(): %s" % inst)
 
@@ -425,6 +500,43 @@ class Cgroup(object):
                                       "desired = %s, real values = %s"
                                       % (repr(check), repr(_values)))
 
+    def set_properties(self, props, pwd=None, check=True):
+        """
+        Sets several properties and verifies them afterwards, each property
+        file is read only once during the verification.
+        :param props: list of (prop, value) written in this order or dict
+        :param pwd: cgroup directory
+        :param check: check the values after setup
+        """
+        if isinstance(props, dict):
+            props = props.items()
+        if pwd is None:
+            pwd = self.root
+        if isinstance(pwd, int):
+            pwd = self.cgroups[pwd]
+        for prop, value in props:
+            try:
+                self.__write_property(os.path.join(pwd, prop), str(value))
+            except Exception, inst:
+                raise error.TestError("cg.set_properties(): %s: %s"
+                                      % (prop, inst))
+
+        if check:
+            values = {}
+            failures = []
+            for prop, value in props:
+                if prop not in values:
+                    values[prop] = self.get_property(prop, pwd)
+                # Sanitize non printable characters before check
+                value = " ".join(str(value).split())
+                if value not in values[prop]:
+                    failures.append("%s: desired = %s, real values = %s"
+                                    % (prop, repr(value),
+                                       repr(values[prop])))
+            if failures:
+                raise error.TestError("cg.set_properties(): Setting failed: "
+                                      "%s" % "; ".join(failures))
+
     def cgset_property(self, prop, value, pwd=None, check=True, checkprop=None):
         """
         Sets the property value by cgset command
@@ -603,6 +715,178 @@ class CgroupModules(object):
         return self.modules[1][i]
 
 
+class Inotify(object):
+
+    """
+    Minimal non-blocking inotify interface (ctypes binding of libc)
+    """
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        """
+        :raise OSError: When inotify is not available
+        """
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            _errno = ctypes.get_errno()
+            raise OSError(_errno, os.strerror(_errno))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path, mask):
+        """
+        :return: watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            _errno = ctypes.get_errno()
+            raise OSError(_errno, os.strerror(_errno), path)
+        return wd
+
+    def read_events(self):
+        """
+        :return: list of pending (wd, mask, name) events, doesn't block
+        """
+        data = ""
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError, details:
+                if details.errno != errno.EAGAIN:
+                    raise
+                break
+            if not chunk:
+                break
+            data += chunk
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+
+class CgroupHierarchy(object):
+
+    """
+    Index of cgroups (directories) of one hierarchy. The hierarchy is walked
+    only once, later changes are applied from inotify events. When inotify
+    is not available the hierarchy is walked on each query.
+    """
+    WATCH_MASK = (Inotify.IN_CREATE | Inotify.IN_DELETE |
+                  Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO |
+                  Inotify.IN_ONLYDIR)
+
+    def __init__(self, root):
+        """
+        :param root: mount point of the hierarchy
+        """
+        self.root = root.rstrip('/')
+        self._cgroups = None    # set of cgroup paths (without the root)
+        self._watches = {}      # wd: path
+        try:
+            self._inotify = Inotify()
+        except (OSError, AttributeError), details:
+            logging.debug("Cgroup hierarchy %s is not watched: %s",
+                          self.root, details)
+            self._inotify = None
+
+    def _add_tree(self, top):
+        """
+        Add directory top and all its subdirectories into the index
+        """
+        for path, _, _ in os.walk(top):
+            if self._inotify is not None:
+                try:
+                    wd = self._inotify.add_watch(path, self.WATCH_MASK)
+                except OSError:     # removed in the meantime
+                    continue
+                self._watches[wd] = path
+            if path != self.root:
+                self._cgroups.add(path)
+
+    def _remove_tree(self, top):
+        """
+        Remove directory top and all its subdirectories from the index
+        """
+        for path in list(self._cgroups):
+            if path == top or path.startswith(top + '/'):
+                self._cgroups.discard(path)
+        for wd, path in self._watches.items():
+            if path == top or path.startswith(top + '/'):
+                del self._watches[wd]
+
+    def _rescan(self):
+        if not os.path.isdir(self.root):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.root)
+        if self._inotify is not None:
+            self._inotify.read_events()     # drop events of previous scan
+        self._cgroups = set()
+        self._watches = {}
+        self._add_tree(self.root)
+
+    def _update(self):
+        if self._cgroups is None or self._inotify is None:
+            self._rescan()
+            return
+        for wd, mask, name in self._inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._rescan()
+                return
+            if mask & Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches or not mask & Inotify.IN_ISDIR:
+                continue
+            path = os.path.join(self._watches[wd], name)
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                self._add_tree(path)
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self._remove_tree(path)
+
+    def get_cgroups(self):
+        """
+        :return: sorted list of cgroup directories (with tailing '/')
+        """
+        self._update()
+        return [path + '/' for path in sorted(self._cgroups)]
+
+
+_hierarchies = {}
+
+
+def get_hierarchy(root):
+    """
+    :param root: mount point of the hierarchy
+    :return: shared CgroupHierarchy of the root
+    """
+    root = root.rstrip('/')
+    if root not in _hierarchies:
+        _hierarchies[root] = CgroupHierarchy(root)
+    return _hierarchies[root]
+
+
 def get_load_per_cpu(_stats=None):
     """
     Gather load per cpu from /proc/stat
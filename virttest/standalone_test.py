@@ -1,4 +1,5 @@
 import os
+import glob
 import logging
 import imp
 import sys
@@ -21,6 +22,7 @@ import bootstrap
 import storage
 import cartesian_config
 import funcatexit
+import perf_store
 import version
 import qemu_vm
 
@@ -146,6 +148,49 @@ class Test(object):
     def write_test_keyval(self, d):
         utils.write_keyval(self.debugdir, d)
 
+    def write_perf_results(self, lines, attributes=None):
+        """
+        Store one repetition of performance results of this test.
+
+        Results go to the results store of the log directory, the job is
+        the sample (see tools/regression.py). Params perf_store_path and
+        perf_sample override them.
+
+        :param lines: Lines of the results table.
+        :param attributes: Dict of attributes of the sample (versions, ...).
+        """
+        store, test, sample = self._open_perf_store()
+        try:
+            store.add_results(test, sample, lines, attributes)
+        finally:
+            store.close()
+
+    def import_perf_results(self):
+        """
+        Store the .RHS files the test wrote into its results dir (netperf,
+        ffsb, ...) like write_perf_results() does, one file per repetition.
+        """
+        paths = sorted(glob.glob(os.path.join(self.resultsdir, "*.RHS")))
+        if paths:
+            logging.debug("Storing performance results %s", paths)
+            store, test, sample = self._open_perf_store()
+            try:
+                store.import_files(test, sample, paths)
+            finally:
+                store.close()
+
+    def _open_perf_store(self):
+        """
+        :return: (results store, test name, sample name) of this test.
+        """
+        jobdir = os.path.dirname(self.debugdir)
+        path = self.params.get("perf_store_path",
+                               os.path.join(os.path.dirname(jobdir),
+                                            "perf_results.sqlite"))
+        sample = self.params.get("perf_sample", os.path.basename(jobdir))
+        return (perf_store.ResultStore(path),
+                self.params.get("type").split()[0], sample)
+
     def start_file_logging(self):
         self.file_handler = configure_file_logging(self.logfile)
 
@@ -285,6 +330,11 @@ class Test(object):
                         finally:
                             env.save()
                     test_passed = True
+                    try:
+                        self.import_perf_results()
+                    except Exception, e:
+                        logging.error("Failed to store performance "
+                                      "results: %s", e)
                     error_message = funcatexit.run_exitfuncs(env, t_type)
                     if error_message:
                         raise error.TestWarn("funcatexit failed with: %s"
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import shutil
 import unittest
 import tempfile
 import common
@@ -153,5 +154,94 @@ class CgroupTest(unittest.TestCase):
             finally:
                 os.remove(mount_file_path)
 
+
+class FakeCgroupfsTest(unittest.TestCase):
+
+    """
+    Cgroup operations on a fake cgroupfs (plain directories and files)
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="fake_cgroupfs-")
+        self.cg = utils_cgroup.Cgroup("memory", "")
+        self.cg.root = self.root
+
+    def tearDown(self):
+        self.cg.cgroups = []
+        self.cg.close_fds()
+        shutil.rmtree(self.root)
+
+    def _write(self, prop, value, cgroup=""):
+        prop_file = open(os.path.join(self.root, cgroup, prop), "w")
+        prop_file.write(value)
+        prop_file.close()
+
+    def test_polled_property(self):
+        self._write("memory.usage_in_bytes", "4096\n")
+        self._write("memory.stat", "cache 0\nrss\t4096\n")
+        self.assertEqual(self.cg.get_property("memory.usage_in_bytes"),
+                         ["4096"])
+        self.assertEqual(len(self.cg._fds), 1)
+        # The value changes in place, the same fd is re-read
+        self._write("memory.usage_in_bytes", "8192\n")
+        self.assertEqual(self.cg.get_property("memory.usage_in_bytes"),
+                         ["8192"])
+        self.assertEqual(self.cg.get_property("memory.stat"),
+                         ["cache 0", "rss 4096"])
+        self.assertEqual(len(self.cg._fds), 2)
+        self.cg.close_fds(self.root)
+        self.assertEqual(self.cg._fds, {})
+
+    def test_recreated_cgroup(self):
+        pwd = os.path.join(self.root, "vm1") + "/"
+        os.mkdir(pwd)
+        self._write("cpuacct.usage", "100\n", "vm1")
+        self.assertEqual(self.cg.get_property("cpuacct.usage", pwd), ["100"])
+        # The VM is restarted, its cgroup is removed and created again
+        shutil.rmtree(pwd)
+        os.mkdir(pwd)
+        self._write("cpuacct.usage", "5\n", "vm1")
+        self.assertEqual(self.cg.get_property("cpuacct.usage", pwd), ["5"])
+        self.assertEqual(len(self.cg._fds), 1)
+        # Reads of files of removed cgroups fail (ENODEV on cgroupfs)
+        path = os.path.join(pwd, "cpuacct.usage")
+        os.close(self.cg._fds[path])
+        self.cg._fds[path] = os.open(pwd, os.O_RDONLY)
+        self.assertEqual(self.cg.get_property("cpuacct.usage", pwd), ["5"])
+        self.assertEqual(len(self.cg._fds), 1)
+
+    def test_set_properties(self):
+        pwd = self.cg.mk_cgroup(cgroup="vm1")
+        self.cg.set_properties([("memory.limit_in_bytes", 1048576),
+                                ("memory.swappiness", "0")], pwd)
+        self.assertEqual(self.cg.get_property("memory.limit_in_bytes", pwd),
+                         ["1048576"])
+        self.assertEqual(self.cg.get_property("memory.swappiness", pwd),
+                         ["0"])
+        self.assertRaises(error.TestError, self.cg.set_properties,
+                          {"memory.swappiness": "10\n20"}, pwd)
+        self.cg.set_properties({"memory.swappiness": "10\n20"}, pwd,
+                               check=False)
+
+    def test_hierarchy(self):
+        hierarchy = utils_cgroup.CgroupHierarchy(self.root)
+        self.assertEqual(hierarchy.get_cgroups(), [])
+        os.makedirs(os.path.join(self.root, "vm1", "vcpu0"))
+        os.mkdir(os.path.join(self.root, "vm2"))
+        self.assertEqual(hierarchy.get_cgroups(),
+                         [os.path.join(self.root, _) + "/"
+                          for _ in ("vm1", "vm1/vcpu0", "vm2")])
+        os.mkdir(os.path.join(self.root, "vm1", "vcpu0", "emulator"))
+        shutil.rmtree(os.path.join(self.root, "vm2"))
+        self.assertEqual(hierarchy.get_cgroups(),
+                         [os.path.join(self.root, _) + "/"
+                          for _ in ("vm1", "vm1/vcpu0", "vm1/vcpu0/emulator")])
+        os.rename(os.path.join(self.root, "vm1"),
+                  os.path.join(self.root, "vm3"))
+        self.assertEqual(hierarchy.get_cgroups(),
+                         [os.path.join(self.root, _) + "/"
+                          for _ in ("vm3", "vm3/vcpu0", "vm3/vcpu0/emulator")])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,9 @@ import logging
 import signal
 import os
 import re
+import random
+import atexit
+import threading
 
 from autotest.client import os_dep, utils
 from autotest.client.shared import error
@@ -13,6 +16,12 @@ import aexpect
 import propcan
 
 
+# Run guestfish commands of the non-persistent Guestfish and of the virt-cat,
+# virt-copy-* and virt-tar-* helpers (on disk images) by the shared pool of
+# launched appliances (see GuestfishPool), set by the libguestfs_pool param
+GUESTFISH_POOL = False
+
+
 class LibguestfsCmdError(Exception):
 
     """
@@ -161,11 +170,12 @@ class Guestfish(LibguestfsBase):
     Execute guestfish, using a new guestfish shell each time.
     """
 
-    __slots__ = []
+    __slots__ = ['use_pool', 'pool_key']
 
     def __init__(self, disk_img=None, ro_mode=False,
                  libvirt_domain=None, inspector=False,
-                 uri=None, mount_options=None, run_mode="interactive"):
+                 uri=None, mount_options=None, run_mode="interactive",
+                 use_pool=None):
         """
         Initialize guestfish command with options.
 
@@ -176,6 +186,11 @@ class Guestfish(LibguestfsBase):
         :param uri: guestfish's connect uri
         :param mount_options: Mount the named partition or logical volume
                                on the given mountpoint.
+        :param use_pool: Run complete_cmd() commands in a launched appliance
+                         of the shared pool (None: GUESTFISH_POOL). Only
+                         disk_img with ro_mode and inspector are supported,
+                         a read-only appliance (and its mounts) outlives
+                         the command.
         """
         guestfs_exec = "guestfish"
         if lgf_cmd_check(guestfs_exec) is None:
@@ -211,22 +226,94 @@ class Guestfish(LibguestfsBase):
                 guestfs_exec += " --mount %s" % mount_options
 
         super(Guestfish, self).__init__(guestfs_exec)
+        self.__dict_set__('use_pool', use_pool)
+        pool_key = None
+        if (disk_img and run_mode == "interactive" and not libvirt_domain and
+                not uri and mount_options is None):
+            pool_key = GuestfishPool.get_key(disk_img, ro_mode, inspector)
+        self.__dict_set__('pool_key', pool_key)
 
     def complete_cmd(self, command):
         """
         Execute built-in command in a complete guestfish command
         (Not a guestfish session).
         command: guestfish [--options] [commands]
+
+        :param command: ' : ' separated guestfish commands, or their list
         """
         guestfs_exec = self.__dict_get__('lgf_exec')
         ignore_status = self.__dict_get__('ignore_status')
         debug = self.__dict_get__('debug')
         timeout = self.__dict_get__('timeout')
-        if command:
-            guestfs_exec += " %s" % command
-            return lgf_command(guestfs_exec, ignore_status, debug, timeout)
-        else:
+        if not command:
             raise LibguestfsCmdError("No built-in command was passed.")
+        use_pool = self.get('use_pool')
+        if use_pool is None:
+            use_pool = GUESTFISH_POOL
+        pool_key = self.get('pool_key')
+        if use_pool and pool_key:
+            return self._pool_cmd(pool_key, command, ignore_status, timeout)
+        if not isinstance(command, basestring):
+            command = " : ".join(command)
+        guestfs_exec += " %s" % command
+        return lgf_command(guestfs_exec, ignore_status, debug, timeout)
+
+    @staticmethod
+    def _pool_cmd(pool_key, command, ignore_status, timeout):
+        """
+        Run guestfish commands in a pooled appliance.
+
+        :param command: ' : ' separated guestfish commands, or their list
+        :return: CmdResult of all commands, the status is the one of the
+                 first failed command
+        """
+        disk_imgs, ro_mode, inspector = pool_key
+        if isinstance(command, basestring):
+            cmds = _split_cmds(command)
+        else:
+            cmds = [cmd.strip() for cmd in command]
+            command = " : ".join(command)
+        # The pooled appliance is launched already
+        cmds = [cmd for cmd in cmds if cmd not in ("run", "launch")]
+        results = get_guestfish_pool().cmd_batch(disk_imgs, cmds, ro_mode,
+                                                 True, timeout, inspector)
+        stdout = "\n".join(result.stdout for result in results
+                            if result.stdout)
+        exit_status = 0
+        for result in results:
+            if result.exit_status:
+                exit_status = result.exit_status
+                break
+        result = utils.CmdResult(command, stdout, "", exit_status)
+        if exit_status and not ignore_status:
+            raise LibguestfsCmdError(
+                error.CmdError(command, result, "Guestfish Command returned "
+                               "non-zero exit status"))
+        return result
+
+
+def _split_cmds(command):
+    """
+    Split the guestfish command line into commands separated by ' : '
+    outside of quotes.
+
+    :return: list of commands
+    """
+    cmds = []
+    start = 0
+    quote = None
+    for i, char in enumerate(command):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif (char == ":" and command[i - 1:i].isspace() and
+              command[i + 1:i + 2].isspace()):
+            cmds.append(command[start:i].strip())
+            start = i + 1
+    cmds.append(command[start:].strip())
+    return [cmd for cmd in cmds if cmd]
 
 
 class GuestfishSession(aexpect.ShellSession):
@@ -288,6 +375,304 @@ class GuestfishSession(aexpect.ShellSession):
                                  "Guestfish Command returned non-zero exit status")
         return result
 
+    def cmd_batch(self, cmds, timeout=60, internal_timeout=None,
+                  print_func=None):
+        """
+        Send several guestfish commands at once and wait only for the last
+        one. Each command is followed by 'echo' of a marker, which separates
+        outputs of the commands.
+
+        :param cmds: list of guestfish commands
+                     (must not contain newline characters)
+        :param timeout: The duration (in seconds) to wait for all commands
+        :param internal_timeout: The timeout to pass to read_nonblocking
+        :param print_func: A function to be used to print the data being read
+                (should take a string parameter)
+        :return: list of (status, output) tuples, one per command
+        :raise ExpectTimeoutError: Raised if timeout expires
+        :raise ExpectProcessTerminatedError: Raised if the guestfish process
+                terminates while waiting for output
+        """
+        if not cmds:
+            return []
+        token = "%08x" % random.getrandbits(32)
+        markers = ["__virt_test_%s_%d__" % (token, i)
+                   for i in xrange(len(cmds))]
+        data = ""
+        for cmd, marker in zip(cmds, markers):
+            data += "%s%s" % (cmd, self.linesep)
+            data += "echo %s%s" % (marker, self.linesep)
+        logging.debug("Sending %d guestfish commands: %s", len(cmds),
+                      "; ".join(cmds))
+        self.read_nonblocking(0, timeout)
+        self.send(data)
+        _, out = self.read_until_any_line_matches([r"^%s\s*$" % markers[-1]],
+                                                  timeout, internal_timeout,
+                                                  print_func)
+        # Prompt before the first command was read already
+        out = self.remove_command_echo(out, cmds[0])
+        results = []
+        lines = []
+        for line in out.splitlines():
+            if len(results) < len(markers) and (line.strip() ==
+                                                markers[len(results)]):
+                output = "\n".join(lines)
+                status = 0
+                for out_line in lines:
+                    if self.match_patterns(out_line,
+                                           self.ERROR_REGEX_LIST) is not None:
+                        status = 1
+                        break
+                results.append((status, output))
+                lines = []
+            elif not re.match(self.prompt, line):   # prompt + echoed command
+                lines.append(line)
+        return results
+
+
+class GuestfishPool(object):
+
+    """
+    Pool of launched guestfish appliances.
+
+    Read-only sessions are keyed by the list of disk images and inspection
+    (guestfish -i, mounts the guest filesystems) and kept running between
+    calls, so the appliance boots only once. A session is recycled when
+    any of its images changes. Read-write sessions are not kept, an
+    appliance must not keep images open for writing when a VM starts on
+    them; sessions sharing an image with a read-write session are closed
+    before it's launched.
+    """
+
+    def __init__(self, guestfs_exec="guestfish", max_sessions=4,
+                 launch_timeout=600):
+        """
+        :param guestfs_exec: guestfish executable
+        :param max_sessions: Maximal number of running appliances, least
+                             recently used ones are closed first
+        :param launch_timeout: Timeout of appliance launch
+        """
+        self.guestfs_exec = guestfs_exec
+        self.max_sessions = max_sessions
+        self.launch_timeout = launch_timeout
+        # [key, session, images state], least recently used first
+        self.sessions = []
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_key(disk_imgs, ro_mode=False, inspector=False):
+        """
+        :param disk_imgs: Image path or list of paths
+        :param ro_mode: Whether images are opened read-only
+        :param inspector: Whether guest filesystems are mounted (-i)
+        :return: Pool key of the session
+        """
+        if isinstance(disk_imgs, basestring):
+            disk_imgs = [disk_imgs]
+        return (tuple(os.path.realpath(img) for img in disk_imgs),
+                bool(ro_mode), bool(inspector))
+
+    @staticmethod
+    def _images_state(disk_imgs):
+        state = []
+        for img in disk_imgs:
+            try:
+                stat = os.stat(img)
+                state.append((stat.st_dev, stat.st_ino, stat.st_size,
+                              stat.st_mtime))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def _launch(self, key):
+        disk_imgs, ro_mode, inspector = key
+        # unset GUESTFISH_XXX to avoid colors of guestfish shell session
+        guestfs_exec = "".join("unset %s; " % env for env in
+                               ("GUESTFISH_PS1", "GUESTFISH_OUTPUT",
+                                "GUESTFISH_RESTORE", "GUESTFISH_INIT"))
+        guestfs_exec += self.guestfs_exec
+        for img in disk_imgs:
+            guestfs_exec += " -a '%s'" % img
+        if ro_mode:
+            guestfs_exec += " --ro"
+        # guestfish -i launches the appliance on its start
+        launch_cmd = "run"
+        if inspector:
+            guestfs_exec += " -i"
+            launch_cmd = "ping-daemon"
+        session = GuestfishSession(guestfs_exec)
+        try:
+            status, output = session.cmd_batch([launch_cmd],
+                                               self.launch_timeout)[0]
+        except aexpect.ExpectError, detail:
+            session.close()
+            raise LibguestfsCmdError("Guestfish appliance launch failed: %s"
+                                     % detail)
+        if status:
+            session.close()
+            raise LibguestfsCmdError("Guestfish appliance launch failed: %s"
+                                     % output)
+        logging.debug("Guestfish appliance launched for %s (%s)",
+                      ", ".join(disk_imgs), ro_mode and "ro" or "rw")
+        return session
+
+    def close_session(self, session):
+        """
+        Quit the session and remove it from the pool.
+
+        :param session: GuestfishSession returned by get_session()
+        """
+        self.sessions = [entry for entry in self.sessions
+                         if entry[1] is not session]
+        try:
+            session.cmd("quit", timeout=10)
+        except (aexpect.ShellError, aexpect.ExpectError):
+            pass    # guestfish terminated
+        session.close()
+
+    def get_session(self, disk_imgs, ro_mode=False, inspector=False):
+        """
+        :param disk_imgs: Image path or list of paths
+        :param ro_mode: Whether images are opened read-only
+        :param inspector: Whether guest filesystems are mounted (-i)
+        :return: GuestfishSession with launched appliance, a read-write
+                 session is not kept by the pool, the caller closes it
+                 (see close_session())
+        """
+        key = self.get_key(disk_imgs, ro_mode, inspector)
+        state = self._images_state(key[0])
+        with self.lock:
+            if not ro_mode:
+                # Don't let appliances read images written by others
+                for entry in self.sessions[:]:
+                    if set(entry[0][0]) & set(key[0]):
+                        self.close_session(entry[1])
+                return self._launch(key)
+            for entry in self.sessions[:]:
+                if entry[0] == key:
+                    if entry[2] == state and entry[1].is_alive():
+                        self.sessions.remove(entry)
+                        self.sessions.append(entry)
+                        return entry[1]
+                    logging.debug("Recycling guestfish session of %s",
+                                  ", ".join(key[0]))
+                    self.close_session(entry[1])
+            while len(self.sessions) >= self.max_sessions:
+                self.close_session(self.sessions[0][1])
+            session = self._launch(key)
+            self.sessions.append([key, session,
+                                  self._images_state(key[0])])
+            return session
+
+    def cmd_batch(self, disk_imgs, cmds, ro_mode=False, ignore_status=True,
+                  timeout=60, inspector=False):
+        """
+        Execute guestfish commands in one round-trip of a pooled session.
+
+        :param disk_imgs: Image path or list of paths
+        :param cmds: list of guestfish commands
+        :param ro_mode: Whether images are opened read-only
+        :param ignore_status: Raise LibguestfsCmdError when it's False and
+                              some command fails
+        :param timeout: Timeout of all commands
+        :param inspector: Whether guest filesystems are mounted (-i)
+        :return: list of CmdResult objects
+        """
+        with self.lock:
+            session = self.get_session(disk_imgs, ro_mode, inspector)
+            try:
+                outputs = session.cmd_batch(cmds, timeout)
+            except aexpect.ExpectError, detail:
+                self.close_session(session)
+                raise LibguestfsCmdError("Guestfish commands failed: %s"
+                                         % detail)
+            if not ro_mode:
+                # quit syncs the writes
+                self.close_session(session)
+        results = []
+        for cmd, (status, output) in zip(cmds, outputs):
+            result = utils.CmdResult(cmd, output, "", status)
+            if status and not ignore_status:
+                raise LibguestfsCmdError(
+                    error.CmdError(cmd, result, "Guestfish Command returned "
+                                   "non-zero exit status"))
+            results.append(result)
+        return results
+
+    def cmd(self, disk_imgs, cmd, ro_mode=False, ignore_status=True,
+            timeout=60, inspector=False):
+        """
+        Execute guestfish command in a pooled session.
+
+        :return: CmdResult object
+        """
+        return self.cmd_batch(disk_imgs, [cmd], ro_mode, ignore_status,
+                              timeout, inspector)[0]
+
+    def close_all(self, disk_img=None):
+        """
+        Close pooled sessions.
+
+        :param disk_img: Close only sessions using this image (default: all)
+        """
+        with self.lock:
+            for entry in self.sessions[:]:
+                if (disk_img is None or
+                        os.path.realpath(disk_img) in entry[0][0]):
+                    self.close_session(entry[1])
+
+
+_pool = None
+
+
+def get_guestfish_pool():
+    """
+    :return: GuestfishPool shared by helper functions, closed at exit
+    """
+    global _pool
+    if _pool is None:
+        _pool = GuestfishPool()
+        atexit.register(_pool.close_all)
+    return _pool
+
+
+def close_pooled_sessions(disk_img=None):
+    """
+    Close sessions of the shared pool, before a VM starts on the images.
+
+    :param disk_img: Close only sessions using this image (default: all)
+    """
+    if _pool is not None:
+        _pool.close_all(disk_img)
+
+
+def guestfish_cmds(disk_imgs, cmds, ro_mode=False, ignore_status=True,
+                   timeout=60, inspector=False):
+    """
+    Execute guestfish commands in a warm appliance of the shared pool.
+
+    :param disk_imgs: Image path or list of paths
+    :param cmds: list of guestfish commands
+    :param ro_mode: Whether images are opened read-only
+    :param inspector: Whether guest filesystems are mounted (-i)
+    :return: list of CmdResult objects
+    """
+    return get_guestfish_pool().cmd_batch(disk_imgs, cmds, ro_mode,
+                                          ignore_status, timeout, inspector)
+
+
+def _pool_virt_cmd(disk, cmd, ro_mode, ignore_status, timeout):
+    """
+    Run the guestfish equivalent of a virt-* tool on an inspected disk
+    image in the shared pool, if GUESTFISH_POOL is set.
+
+    :return: CmdResult object, or None if the pool is not used.
+    """
+    if not GUESTFISH_POOL:
+        return None
+    return guestfish_cmds(disk, [cmd], ro_mode, ignore_status, timeout,
+                          inspector=True)[0]
+
 
 class GuestfishRemote(object):
 
@@ -4211,6 +4596,11 @@ def virt_cat_cmd(disk_or_domain, file_path, options=None, ignore_status=True,
     """
     # disk_or_domain and file_path are necessary parameters.
     if os.path.isfile(disk_or_domain):
+        if options is None:
+            result = _pool_virt_cmd(disk_or_domain, "cat '%s'" % file_path,
+                                    True, ignore_status, timeout)
+            if result is not None:
+                return result
         disk_or_domain = "-a " + disk_or_domain
     else:
         disk_or_domain = "-d " + disk_or_domain
@@ -4227,6 +4617,12 @@ def virt_tar_in(disk_or_domain, tar_file, destination, is_disk=False,
     "virt-tar-in" unpacks an uncompressed tarball into a virtual machine
     disk image or named libvirt domain.
     """
+    if is_disk is True:
+        result = _pool_virt_cmd(disk_or_domain,
+                                "tar-in %s %s" % (tar_file, destination),
+                                False, ignore_status, timeout)
+        if result is not None:
+            return result
     cmd = "virt-tar-in"
     if is_disk is True:
         cmd += " -a %s" % disk_or_domain
@@ -4241,6 +4637,12 @@ def virt_tar_out(disk_or_domain, directory, tar_file, is_disk=False,
     """
     "virt-tar-out" packs a virtual machine disk image directory into a tarball.
     """
+    if is_disk is True:
+        result = _pool_virt_cmd(disk_or_domain,
+                                "tar-out %s %s" % (directory, tar_file),
+                                True, ignore_status, timeout)
+        if result is not None:
+            return result
     cmd = "virt-tar-out"
     if is_disk is True:
         cmd += " -a %s" % disk_or_domain
@@ -4257,6 +4659,12 @@ def virt_copy_in(disk_or_domain, file, destination, is_disk=False,
     virtual machine disk image or named libvirt domain.
     #TODO: expand file to files
     """
+    if is_disk is True:
+        result = _pool_virt_cmd(disk_or_domain,
+                                "copy-in %s %s" % (file, destination),
+                                False, ignore_status, timeout)
+        if result is not None:
+            return result
     cmd = "virt-copy-in"
     if is_disk is True:
         cmd += " -a %s" % disk_or_domain
@@ -4272,6 +4680,12 @@ def virt_copy_out(disk_or_domain, file_path, localdir, is_disk=False,
     "virt-copy-out" copies files and directories out of a virtual machine
     disk image or named libvirt domain.
     """
+    if is_disk is True:
+        result = _pool_virt_cmd(disk_or_domain,
+                                "copy-out %s %s" % (file_path, localdir),
+                                True, ignore_status, timeout)
+        if result is not None:
+            return result
     cmd = "virt-copy-out"
     if is_disk is True:
         cmd += " -a %s" % disk_or_domain
@@ -1,4 +1,8 @@
 #!/usr/bin/python
+import os
+import sys
+import shutil
+import tempfile
 import unittest
 import logging
 
@@ -73,5 +77,174 @@ class SlotsCheckTest(unittest.TestCase):
                             "unittest...")
 
 
+# Stub of interactive guestfish: prints prompt, echoes the read line (like
+# readline does) and emulates a few commands on an in-memory filesystem.
+# Launches are logged into $GUESTFISH_STUB_LOG.
+GUESTFISH_STUB = r"""
+import os, sys
+args = sys.argv[1:]
+images = [args[i + 1] for i, arg in enumerate(args) if arg == "-a"]
+ro = "--ro" in args
+files = {}
+def launch():
+    open(os.environ["GUESTFISH_STUB_LOG"], "a").write(
+        "%s %s%s\n" % (",".join(images), ro, " -i" * ("-i" in args)))
+if "-i" in args:
+    launch()
+while True:
+    sys.stdout.write("><fs> ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    sys.stdout.write(line)
+    cmd = line.split()
+    if not cmd:
+        continue
+    if cmd[0] == "quit":
+        break
+    elif cmd[0] == "echo":
+        print " ".join(cmd[1:])
+    elif cmd[0] == "run":
+        launch()
+    elif cmd[0] == "write" and not ro:
+        files[cmd[1]] = cmd[2]
+    elif cmd[0] == "cat" and cmd[1] in files:
+        print files[cmd[1]]
+    elif cmd[0] not in ("sync", "ping-daemon"):
+        print "libguestfs: error: %s failed" % cmd[0]
+"""
+
+
+class GuestfishStubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        stub = os.path.join(self.tmpdir, "guestfish")
+        open(stub, "w").write(GUESTFISH_STUB)
+        self.log = os.path.join(self.tmpdir, "launches")
+        os.environ["GUESTFISH_STUB_LOG"] = self.log
+        self.images = []
+        for name in ("a.img", "b.img"):
+            self.images.append(os.path.join(self.tmpdir, name))
+            open(self.images[-1], "w").write(name)
+        self.pool = lgf.GuestfishPool("%s %s" % (sys.executable, stub),
+                                      max_sessions=2)
+
+    def tearDown(self):
+        self.pool.close_all()
+        del os.environ["GUESTFISH_STUB_LOG"]
+        shutil.rmtree(self.tmpdir)
+
+    def launches(self):
+        try:
+            return open(self.log).read().splitlines()
+        except IOError:
+            return []
+
+
+class GuestfishPoolTest(GuestfishStubTest):
+
+    def test_batch(self):
+        results = self.pool.cmd_batch(self.images[0],
+                                      ["write /f hello", "cat /f",
+                                       "cat /missing"])
+        self.assertEqual([_.exit_status for _ in results], [0, 0, 1])
+        self.assertEqual([_.stdout for _ in results[:2]], ["", "hello"])
+        self.assertTrue("error" in results[2].stdout)
+        self.assertRaises(lgf.LibguestfsCmdError, self.pool.cmd,
+                          self.images[0], "cat /missing",
+                          ignore_status=False)
+        # Read-write sessions are not kept
+        self.assertEqual(self.launches(), ["%s False" % self.images[0]] * 2)
+        self.assertEqual(self.pool.sessions, [])
+
+    def test_reuse(self):
+        for _ in range(2):
+            self.pool.cmd(self.images, "cat /f", ro_mode=True)
+        self.assertEqual(len(self.launches()), 1)
+        # a.img is shared with the read-write session
+        self.pool.cmd(self.images[0], "write /f 1")
+        self.assertEqual(len(self.launches()), 2)
+        self.assertEqual(self.pool.sessions, [])
+        self.pool.cmd(self.images, "cat /f", ro_mode=True)
+        self.assertEqual(len(self.launches()), 3)
+
+        # Changed image recycles the session
+        os.utime(self.images[1], (0, 0))
+        self.pool.cmd(self.images, "cat /f", ro_mode=True)
+        self.assertEqual(len(self.launches()), 4)
+        lgf.close_pooled_sessions()
+        self.assertEqual(len(self.pool.sessions), 1)
+        self.pool.close_all(self.images[1])
+        self.assertEqual(self.pool.sessions, [])
+
+    def test_max_sessions(self):
+        self.pool.cmd(self.images[0], "cat /f", ro_mode=True)
+        self.pool.cmd(self.images[1], "cat /f", ro_mode=True)
+        self.pool.cmd(self.images, "cat /f", ro_mode=True)
+        self.assertEqual(len(self.launches()), 3)
+        self.assertEqual([_[0] for _ in self.pool.sessions],
+                         [((self.images[1],), True, False),
+                          (tuple(self.images), True, False)])
+
+
+class GuestfishPooledHelpersTest(GuestfishStubTest):
+
+    def setUp(self):
+        GuestfishStubTest.setUp(self)
+        # guestfish in $PATH is needed by Guestfish()
+        stub = os.path.join(self.tmpdir, "guestfish")
+        open(stub, "w").write("#!%s\n%s" % (sys.executable, GUESTFISH_STUB))
+        os.chmod(stub, 0755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = "%s:%s" % (self.tmpdir, self.path)
+        self.shared_pool = lgf._pool
+        lgf._pool = self.pool
+
+    def tearDown(self):
+        lgf._pool = self.shared_pool
+        lgf.GUESTFISH_POOL = False
+        os.environ["PATH"] = self.path
+        GuestfishStubTest.tearDown(self)
+
+    def test_complete_cmd(self):
+        gf = lgf.Guestfish(disk_img=self.images[0], use_pool=True)
+        result = gf.complete_cmd("run : write /f hello : cat /f")
+        self.assertEqual((result.exit_status, result.stdout), (0, "hello"))
+        result = gf.complete_cmd(["run", "write /f 'a : b'", "cat /f"])
+        self.assertEqual(result.stdout, "'a")
+        # The launched read-only appliance is reused
+        gf = lgf.Guestfish(disk_img=self.images[0], ro_mode=True,
+                           use_pool=True)
+        self.assertEqual(gf.complete_cmd("run : echo 'a : b'").stdout,
+                         "'a : b'")
+        self.assertEqual(gf.complete_cmd("cat /missing").exit_status, 1)
+        self.assertEqual(self.launches(), ["%s False" % self.images[0]] * 2 +
+                         ["%s True" % self.images[0]])
+        lgf.close_pooled_sessions()
+        self.assertEqual(self.pool.sessions, [])
+        # Domains are not pooled
+        gf = lgf.Guestfish(libvirt_domain="test", use_pool=True)
+        self.assertEqual(gf.pool_key, None)
+
+    def test_virt_cmds(self):
+        lgf.GUESTFISH_POOL = True
+        for _ in range(2):
+            result = lgf.virt_cat_cmd(self.images[0], "/missing")
+            self.assertEqual(result.exit_status, 1)
+        lgf.virt_copy_in(self.images[0], "/local", "/", is_disk=True)
+        self.assertEqual(self.launches(),
+                         ["%s True -i" % self.images[0],
+                          "%s False -i" % self.images[0]])
+        self.assertEqual(self.pool.sessions, [])
+
+    def test_split_cmds(self):
+        self.assertEqual(lgf._split_cmds("run : write /f 'a : b' : "
+                                         'echo " : " : cat /f:x'),
+                         ["run", "write /f 'a : b'", 'echo " : "',
+                          "cat /f:x"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1272,11 +1272,12 @@ def cpu_str_to_list(origin_str):
         return cpu_list
 
 
-def get_cpu_info(session=None):
+def get_cpu_info(session=None, close_session=True):
     """
     Return information about the CPU architecture
 
     :param session: session Object
+    :param close_session: Close the session when done.
     :return: A dirt of cpu information
     """
     cpu_info = {}
@@ -1287,7 +1288,8 @@ def get_cpu_info(session=None):
         try:
             output = session.cmd_output(cmd).splitlines()
         finally:
-            session.close()
+            if close_session:
+                session.close()
     cpu_info = dict(map(lambda x: [i.strip() for i in x.split(":")], output))
     return cpu_info
 
@@ -8,7 +8,9 @@ import logging
 import random
 import math
 import time
+import errno
 import shelve
+import threading
 import remote
 import commands
 from autotest.client import utils, os_dep
@@ -332,6 +334,18 @@ class DelLinkError(NetError):
         return e_msg
 
 
+class NetlinkError(NetError):
+
+    def __init__(self, msgtype, err_no):
+        NetError.__init__(self, msgtype, err_no)
+        self.msgtype = msgtype
+        self.err_no = err_no
+
+    def __str__(self):
+        return ("Netlink request %d failed: %s" %
+                (self.msgtype, os.strerror(self.err_no)))
+
+
 def warp_init_del(func):
     def new_func(*args, **argkw):
         globals()["sock"] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -2652,19 +2666,325 @@ class VirtNet(DbNet, ParamsNet):
         return self[nic_index_or_name].ifname
 
 
+def _netlink_unpack(data):
+    """
+    Split data received from a netlink socket into messages.
+
+    :return: List of (msgtype, flags, seq, pid, payload) tuples.
+    """
+    out = []
+    while len(data) >= 16:
+        length, msgtype, flags, seq, pid = struct.unpack('IHHII', data[:16])
+        if length < 16 or len(data) < length:
+            raise NetError("Truncated netlink message")
+        out.append((msgtype, flags, seq, pid, data[16:length]))
+        data = data[(length + 3) & ~3:]
+    return out
+
+
+def _rtattr_pack(rta_type, value):
+    length = 4 + len(value)
+    return (struct.pack('HH', length, rta_type) + value +
+            '\x00' * (((length + 3) & ~3) - length))
+
+
+def _rtattr_unpack(data):
+    """
+    Return dict of routing attribute type: value of packed attributes.
+    """
+    attrs = {}
+    while len(data) >= 4:
+        length, rta_type = struct.unpack('HH', data[:4])
+        if length < 4:
+            break
+        attrs[rta_type] = data[4:length]
+        data = data[(length + 3) & ~3:]
+    return attrs
+
+
+# Seconds a verified MAC -> IP pair is trusted without arping
+NEIGH_VERIFY_TTL = 60.0
+# Seconds to wait for the reply of a netlink request
+NETLINK_TIMEOUT = 5.0
+
+
+class NeighborResolver(object):
+
+    """
+    IPv4 neighbor (ARP) table and routes of the host read over rtnetlink.
+
+    The neighbor table is dumped once and then kept up to date by neighbor
+    notifications of the kernel, so reading it costs no syscalls besides
+    draining the notifications. IP addresses verified to belong to a MAC
+    address are cached for ttl seconds (or until the neighbor table reports
+    another MAC address for the IP), arping is only run on cache misses.
+
+    The resolver is shared by the threads of the process, requests and
+    updates of the tables are serialized by a lock.
+    """
+
+    def __init__(self, ttl=NEIGH_VERIFY_TTL):
+        """
+        :param ttl: Seconds a verified MAC -> IP pair is cached.
+        """
+        self.ttl = ttl
+        # ip: (mac, expiration time)
+        self.verified = {}
+        self.seq = 0
+        self.lock = threading.RLock()
+        self._open()
+
+    def _open(self):
+        self.pid = os.getpid()
+        self.neighbors = {}
+        # Subscribe before the dump, no update is missed in between
+        self.events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    arch.NETLINK_ROUTE)
+        self.events.bind((0, arch.RTMGRP_NEIGH))
+        self.events.setblocking(0)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  arch.NETLINK_ROUTE)
+        self.sock.settimeout(NETLINK_TIMEOUT)
+        self._dump_neighbors()
+
+    def close(self):
+        """
+        Close the netlink sockets.
+        """
+        self.events.close()
+        self.sock.close()
+
+    def _request(self, msgtype, flags, data):
+        """
+        Send a netlink request and return the payloads of the replies.
+
+        :raise NetlinkError: If the kernel refused the request.
+        :raise socket.timeout: If no reply came in NETLINK_TIMEOUT seconds.
+        """
+        with self.lock:
+            self.seq += 1
+            self.sock.send(struct.pack('IHHII', 16 + len(data), msgtype,
+                                       arch.NLM_F_REQUEST | flags, self.seq,
+                                       0) + data)
+            replies = []
+            while True:
+                # Replies of timed out requests have an older seq
+                for rtype, rflags, seq, _, payload in \
+                        _netlink_unpack(self.sock.recv(65536)):
+                    if seq != self.seq:
+                        continue
+                    if rtype == arch.NLMSG_DONE:
+                        return replies
+                    if rtype == arch.NLMSG_ERROR:
+                        err_no = -struct.unpack('i', payload[:4])[0]
+                        if err_no:
+                            raise NetlinkError(msgtype, err_no)
+                        return replies
+                    replies.append((rtype, payload))
+                    if not flags & arch.NLM_F_DUMP:
+                        return replies
+
+    def _dump_neighbors(self):
+        with self.lock:
+            replies = self._request(
+                arch.RTM_GETNEIGH, arch.NLM_F_DUMP,
+                struct.pack('BxxxiHBB', socket.AF_INET, 0, 0, 0, 0))
+            self.neighbors = {}
+            for msgtype, payload in replies:
+                self._apply_neighbor(msgtype, payload)
+
+    def _apply_neighbor(self, msgtype, payload):
+        family, _, state, _, _ = struct.unpack('BxxxiHBB', payload[:12])
+        if family != socket.AF_INET:
+            return
+        attrs = _rtattr_unpack(payload[12:])
+        if arch.NDA_DST not in attrs:
+            return
+        ip = socket.inet_ntoa(attrs[arch.NDA_DST])
+        lladdr = attrs.get(arch.NDA_LLADDR, "")
+        if (msgtype == arch.RTM_DELNEIGH or len(lladdr) != 6 or
+                state & (arch.NUD_INCOMPLETE | arch.NUD_FAILED |
+                         arch.NUD_NOARP)):
+            self.neighbors.pop(ip, None)
+            return
+        mac = ":".join("%02x" % ord(byte) for byte in lladdr)
+        self.neighbors[ip] = mac
+        if self.verified.get(ip, (mac,))[0] != mac:
+            del self.verified[ip]
+
+    def update(self):
+        """
+        Apply the neighbor notifications received since the last update.
+        """
+        if os.getpid() != self.pid:
+            # Forked, the sockets are shared with the parent and the lock
+            # may be held by a thread that doesn't exist in this process
+            self.lock = threading.RLock()
+            with self.lock:
+                self.close()
+                self._open()
+            return
+        with self.lock:
+            while True:
+                try:
+                    data = self.events.recv(65536)
+                except socket.error, e:
+                    if e.errno == errno.EAGAIN:
+                        return
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # Notifications were lost
+                    self._dump_neighbors()
+                    continue
+                for msgtype, _, _, _, payload in _netlink_unpack(data):
+                    if msgtype in (arch.RTM_NEWNEIGH, arch.RTM_DELNEIGH):
+                        self._apply_neighbor(msgtype, payload)
+
+    def get_neighbors(self):
+        """
+        :return: Dict mapping MAC to IP of complete neighbor entries.
+        """
+        with self.lock:
+            self.update()
+            return dict((mac, ip) for ip, mac in self.neighbors.iteritems())
+
+    def get_route_devs(self, ip):
+        """
+        Return names of devices of the route to ip and of default routes,
+        like "ip route get ip; ip route | grep default".
+
+        :param ip: IPv4 address.
+        """
+        oifs = []
+        rtmsg = struct.pack('BBBBBBBBI', socket.AF_INET, 32, 0, 0, 0, 0, 0,
+                            0, 0)
+        try:
+            routes = self._request(arch.RTM_GETROUTE, 0, rtmsg + _rtattr_pack(
+                arch.RTA_DST, socket.inet_aton(ip)))
+        except NetlinkError, e:
+            logging.debug("No route to %s: %s", ip, e)
+            routes = []
+        rtmsg = struct.pack('BBBBBBBBI', socket.AF_INET, 0, 0, 0, 0, 0, 0,
+                            0, 0)
+        for msgtype, payload in self._request(arch.RTM_GETROUTE,
+                                              arch.NLM_F_DUMP, rtmsg):
+            dst_len, table = struct.unpack('xBxxBxxxxxxx', payload[:12])
+            if dst_len == 0 and table == arch.RT_TABLE_MAIN:
+                routes.append((msgtype, payload))
+        for msgtype, payload in routes:
+            oif = _rtattr_unpack(payload[12:]).get(arch.RTA_OIF)
+            if oif is not None:
+                oif = struct.unpack('I', oif)[0]
+                if oif not in oifs:
+                    oifs.append(oif)
+        devs = []
+        with self.lock:
+            for oif in oifs:
+                ifreq = fcntl.ioctl(self.sock, arch.SIOCGIFNAME,
+                                    struct.pack('16si', '', oif))
+                devs.append(ifreq[:16].rstrip('\x00'))
+        return devs
+
+    def verify(self, ip, macs, timeout=60.0):
+        """
+        Make sure ip belongs to one of macs using the neighbor table or
+        arping.
+
+        :param ip: An IP address.
+        :param macs: A list or tuple of MAC addresses.
+        :param timeout: Timeout of arping on each route device.
+        :return: True if ip is assigned to a MAC address in macs.
+        :raise socket.error: If the netlink requests failed or timed out.
+        """
+        macs = [mac.lower() for mac in macs]
+
+        def _verified(mac):
+            self.verified[ip] = (mac, time.time() + self.ttl)
+            return True
+
+        def _lookup():
+            # arping is run without the lock, other threads may verify
+            # their addresses meanwhile
+            with self.lock:
+                self.update()
+                mac, expiration = self.verified.get(ip, (None, 0))
+                if mac in macs and expiration > time.time():
+                    return True
+                if self.neighbors.get(ip) in macs:
+                    return _verified(self.neighbors[ip])
+            return False
+
+        def _arping(regex, arping_cmd):
+            if _lookup():
+                return True
+            o = commands.getoutput(arping_cmd)
+            match = regex.search(o)
+            if not match:
+                logging.debug("Verify arping result failed: %s" % o)
+                return False
+            with self.lock:
+                return _verified(match.group(1).lower())
+
+        if _lookup():
+            return True
+        devs = self.get_route_devs(ip)
+        if not devs:
+            logging.debug("No dev in route table to %s", ip)
+            return False
+        mac_regex = "|".join("(%s)" % mac for mac in macs)
+        regex = re.compile(r"\b%s\b.*\b(%s)\b" % (ip, mac_regex), re.I)
+        arping_bin = utils_misc.find_command("arping")
+        for dev in devs:
+            arping_cmd = "%s -f -c 3 -I %s %s" % (arping_bin, dev, ip)
+            if utils_misc.wait_for(lambda: _arping(regex, arping_cmd),
+                                   timeout=timeout):
+                return True
+        return False
+
+
+_neighbor_resolver = None
+
+
+def get_neighbor_resolver():
+    """
+    Return the NeighborResolver shared in this process.
+
+    :return: NeighborResolver or None if rtnetlink can't be used.
+    """
+    global _neighbor_resolver
+    if _neighbor_resolver is None:
+        try:
+            _neighbor_resolver = NeighborResolver()
+        except (socket.error, AttributeError, NetError), e:
+            logging.debug("Neighbor table not available over rtnetlink: %s",
+                          e)
+            _neighbor_resolver = False
+    return _neighbor_resolver or None
+
+
 def parse_arp():
     """
-    Read /proc/net/arp, return a mapping of MAC to IP
+    Read the ARP cache (rtnetlink or /proc/net/arp), return a mapping of MAC
+    to IP
 
     :return: dict mapping MAC to IP
     """
+    resolver = get_neighbor_resolver()
+    if resolver is not None:
+        try:
+            return resolver.get_neighbors()
+        except socket.error, e:
+            logging.debug("Reading the neighbor table over rtnetlink failed:"
+                          " %s, using /proc/net/arp", e)
+
     ret = {}
     arp_cache = file('/proc/net/arp').readlines()
 
     for line in arp_cache:
-        mac = line.split()[3]
-        ip = line.split()[0]
-        flag = line.split()[2]
+        fields = line.split()
+        mac = fields[3]
+        ip = fields[0]
+        flag = fields[2]
 
         # Skip the header
         if mac.count(":") != 5:
@@ -2684,10 +3004,21 @@ def verify_ip_address_ownership(ip, macs, timeout=60.0):
     Use arping and the ARP cache to make sure a given IP address belongs to one
     of the given MAC addresses.
 
+    When rtnetlink is available, the check is done by the shared
+    NeighborResolver, which caches verified addresses.
+
     :param ip: An IP address.
     :param macs: A list or tuple of MAC addresses.
     :return: True if ip is assigned to a MAC address in macs.
     """
+    resolver = get_neighbor_resolver()
+    if resolver is not None:
+        try:
+            return resolver.verify(ip, macs, timeout)
+        except socket.error, e:
+            logging.debug("Verifying %s over rtnetlink failed: %s, falling "
+                          "back to arping", ip, e)
+
     def __arping(regex, arping_cmd, ip):
         # Compile a regex that matches the given IP address and any of the
         # given MAC addresses from arping output
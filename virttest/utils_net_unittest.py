@@ -7,6 +7,9 @@ import sys
 import random
 import os
 import shelve
+import socket
+import struct
+import threading
 
 import common
 from autotest.client import utils
@@ -677,5 +680,126 @@ class TestVmNetSubclasses(unittest.TestCase):
             pass
 
 
+class TestNeighborResolver(unittest.TestCase):
+
+    MAC = "52:54:00:12:34:56"
+
+    def setUp(self):
+        # Resolver without netlink sockets
+        self.resolver = utils_net.NeighborResolver.__new__(
+            utils_net.NeighborResolver)
+        self.resolver.ttl = 60
+        self.resolver.verified = {}
+        self.resolver.neighbors = {}
+        self.resolver.seq = 0
+        self.resolver.lock = threading.RLock()
+        self.resolver.update = lambda: None
+
+    @staticmethod
+    def neighbor(ip, mac, state=0x02, family=socket.AF_INET):
+        lladdr = "".join(chr(int(byte, 16)) for byte in mac.split(":"))
+        return (struct.pack('BxxxiHBB', family, 2, state, 0, 1) +
+                utils_net._rtattr_pack(1, socket.inet_pton(family, ip)) +
+                utils_net._rtattr_pack(2, lladdr))
+
+    def test_unpack(self):
+        payload = self.neighbor("10.0.0.2", self.MAC)
+        data = "".join(struct.pack('IHHII', 16 + len(payload), 28, 0, seq,
+                                   0) + payload for seq in (1, 2))
+        messages = utils_net._netlink_unpack(data)
+        self.assertEqual([_[2] for _ in messages], [1, 2])
+        attrs = utils_net._rtattr_unpack(messages[1][4][12:])
+        self.assertEqual(attrs[1], socket.inet_aton("10.0.0.2"))
+
+    def test_neighbor_updates(self):
+        resolver = self.resolver
+        resolver._apply_neighbor(28, self.neighbor("10.0.0.2", self.MAC))
+        resolver._apply_neighbor(28, self.neighbor("10.0.0.3", self.MAC,
+                                                   state=0x01))
+        resolver._apply_neighbor(28, self.neighbor("::1", self.MAC,
+                                                   family=socket.AF_INET6))
+        self.assertEqual(resolver.get_neighbors(), {self.MAC: "10.0.0.2"})
+        self.assertTrue(resolver.verify("10.0.0.2", [self.MAC.upper()]))
+        self.assertTrue("10.0.0.2" in resolver.verified)
+        # Verified pairs are used when the neighbor entry is gone
+        resolver._apply_neighbor(29, self.neighbor("10.0.0.2", self.MAC))
+        self.assertEqual(resolver.get_neighbors(), {})
+        self.assertTrue(resolver.verify("10.0.0.2", [self.MAC]))
+        # and dropped when the IP moves to another MAC
+        resolver._apply_neighbor(28, self.neighbor("10.0.0.2",
+                                                   "52:54:00:00:00:01"))
+        self.assertEqual(resolver.verified, {})
+
+    def test_concurrent_requests(self):
+        class FakeSocket(object):
+
+            """
+            Netlink socket answering the last request with one reply.
+            """
+
+            def __init__(self):
+                self.sent = []
+
+            def send(self, data):
+                self.sent.append(struct.unpack('IHHII', data[:16])[3])
+                time.sleep(0.001)
+
+            def recv(self, bufsize):
+                seq = self.sent.pop(0)
+                time.sleep(0.001)
+                return (struct.pack('IHHII', 20, 24, 0, seq, 0) +
+                        struct.pack('I', seq))
+
+        resolver = self.resolver
+        resolver.sock = FakeSocket()
+        replies = []
+
+        def request():
+            for _ in xrange(20):
+                replies.append(resolver._request(26, 0, ""))
+
+        threads = [threading.Thread(target=request) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(replies), 80)
+        seqs = [struct.unpack('I', reply[0][1])[0] for reply in replies]
+        self.assertEqual(sorted(seqs), range(1, 81))
+
+    def test_request_timeout(self):
+        class FakeSocket(object):
+
+            def send(self, data):
+                pass
+
+            def recv(self, bufsize):
+                raise socket.timeout("timed out")
+
+        resolver = self.resolver
+        resolver.sock = FakeSocket()
+        resolver.update = lambda: resolver._dump_neighbors()
+        self.assertRaises(socket.timeout, resolver.get_neighbors)
+        # Callers fall back to /proc/net/arp
+        saved_resolver = utils_net._neighbor_resolver
+        utils_net._neighbor_resolver = resolver
+        try:
+            self.assertTrue(isinstance(utils_net.parse_arp(), dict))
+        finally:
+            utils_net._neighbor_resolver = saved_resolver
+
+    def test_rtnetlink(self):
+        resolver = utils_net.get_neighbor_resolver()
+        if resolver is None:
+            self.skipTest("rtnetlink is not available")
+        arp = {}
+        for line in open("/proc/net/arp").readlines()[1:]:
+            fields = line.split()
+            if fields[2] != "0x0":
+                arp[fields[3]] = fields[0]
+        self.assertEqual(resolver.get_neighbors(), arp)
+        self.assertEqual(resolver.get_route_devs("127.0.0.1")[0], "lo")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,7 @@
 import os
 import logging
 import re
+import time
 from autotest.client import utils
 import remote
 import aexpect
@@ -44,6 +45,300 @@ class NetperfTestError(NetperfError):
         return e_msg
 
 
+# Omni output selectors printed as KEY=value by collected sessions
+NETPERF_SELECTORS = ("THROUGHPUT", "THROUGHPUT_UNITS", "ELAPSED_TIME",
+                     "LOCAL_CPU_UTIL", "REMOTE_CPU_UTIL", "TRANSACTION_RATE",
+                     "MIN_LATENCY", "MEAN_LATENCY", "P50_LATENCY",
+                     "P90_LATENCY", "P99_LATENCY", "MAX_LATENCY")
+
+_INTERIM_RE = re.compile(r"Interim result:\s*([\d.]+)\s+(\S+)\s+over\s+"
+                         r"([\d.]+)\s+seconds\s+ending at\s+([\d.]+)")
+_KEYVAL_RE = re.compile(r"^([A-Z][A-Z0-9_]*)=(.*)$")
+_SESSION_TAG = "@@netperf"
+_SESSION_LINE_RE = re.compile(r"%s(\d+) (.*)$" % _SESSION_TAG)
+_SESSION_DONE = "__netperf_done__"
+_SESSIONS_END = "__netperf_end__"
+
+
+class NetperfInterim(object):
+
+    """
+    One interim result of netperf demo mode (-D).
+    """
+
+    def __init__(self, session, throughput, units, interval, end_time):
+        self.session = session
+        self.throughput = throughput
+        self.units = units
+        self.interval = interval
+        self.end_time = end_time
+
+    def __repr__(self):
+        return ("NetperfInterim(session=%d, throughput=%s %s, interval=%s)" %
+                (self.session, self.throughput, self.units, self.interval))
+
+
+class NetperfSession(object):
+
+    """
+    Results of one netperf session: interim results, final values printed
+    by the omni output selectors and other output lines.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.interim = []
+        self.values = {}
+        self.output = []
+        self.status = None
+
+    def add_line(self, line):
+        """
+        Parse one line of output of the session.
+
+        :return: NetperfInterim for interim results, None otherwise.
+        """
+        line = line.strip()
+        match = _INTERIM_RE.search(line)
+        if match:
+            throughput, units, interval, end_time = match.groups()
+            record = NetperfInterim(self.index, float(throughput), units,
+                                    float(interval), float(end_time))
+            self.interim.append(record)
+            return record
+        if line.startswith(_SESSION_DONE):
+            self.status = int(line.split()[-1])
+            return None
+        match = _KEYVAL_RE.match(line)
+        if match:
+            key, value = match.groups()
+            try:
+                self.values[key] = float(value)
+            except ValueError:
+                self.values[key] = value.strip()
+        elif line:
+            self.output.append(line)
+        return None
+
+    @property
+    def throughput(self):
+        """
+        Final throughput, or average of interim results when netperf didn't
+        report it.
+        """
+        if "THROUGHPUT" in self.values:
+            return self.values["THROUGHPUT"]
+        if self.interim:
+            return (sum(_.throughput * _.interval for _ in self.interim) /
+                    sum(_.interval for _ in self.interim))
+        return None
+
+    @property
+    def units(self):
+        if "THROUGHPUT_UNITS" in self.values:
+            return self.values["THROUGHPUT_UNITS"]
+        if self.interim:
+            return self.interim[-1].units
+        return None
+
+    def latency(self):
+        """
+        :return: Dict {'min', 'mean', 'p50', 'p90', 'p99', 'max'} of
+                 reported latencies (netperf needs -j for percentiles).
+        """
+        latency = {}
+        for key in ("MIN", "MEAN", "P50", "P90", "P99", "MAX"):
+            value = self.values.get("%s_LATENCY" % key)
+            if isinstance(value, float) and value >= 0:
+                latency[key.lower()] = value
+        return latency
+
+    def interim_stats(self):
+        """
+        :return: Tuple (min, mean, max) of interim throughputs or None.
+        """
+        if not self.interim:
+            return None
+        values = [_.throughput for _ in self.interim]
+        return min(values), sum(values) / len(values), max(values)
+
+
+class NetperfResults(object):
+
+    """
+    Results of parallel netperf sessions.
+    """
+
+    def __init__(self, session_num):
+        self.sessions = [NetperfSession(i) for i in xrange(session_num)]
+
+    def __getitem__(self, index):
+        return self.sessions[index]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _values(self, key):
+        values = [_.values.get(key) for _ in self.sessions]
+        return [_ for _ in values if isinstance(_, float)]
+
+    @property
+    def throughput(self):
+        """ Sum of throughputs of all sessions """
+        values = [_.throughput for _ in self.sessions]
+        values = [_ for _ in values if _ is not None]
+        if not values:
+            return None
+        return sum(values)
+
+    @property
+    def units(self):
+        for session in self.sessions:
+            if session.units:
+                return session.units
+        return None
+
+    def cpu_util(self, side="LOCAL"):
+        """
+        Mean CPU utilization reported by the sessions.
+
+        :param side: 'LOCAL' or 'REMOTE'.
+        """
+        values = self._values("%s_CPU_UTIL" % side.upper())
+        values = [_ for _ in values if _ >= 0]
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def failed(self):
+        """
+        :return: List of sessions which didn't finish successfully.
+        """
+        return [_ for _ in self.sessions if _.status != 0]
+
+    def summary(self):
+        """
+        :return: Dict with aggregated throughput, CPU utilization and
+                 latencies of each session.
+        """
+        return {"sessions": len(self.sessions),
+                "throughput": self.throughput,
+                "units": self.units,
+                "local_cpu": self.cpu_util("LOCAL"),
+                "remote_cpu": self.cpu_util("REMOTE"),
+                "latency": [_.latency() for _ in self.sessions],
+                "failed": [_.index for _ in self.failed()]}
+
+
+class NetperfCollector(object):
+
+    """
+    Runs parallel netperf sessions in one shell session and parses their
+    output while they run.
+
+    All sessions are started by one command, every output line is tagged
+    with the index of its session, so interim results (netperf -D) are
+    parsed as they come and final values are read as KEY=value lines
+    (omni -k output selectors).
+    """
+
+    def __init__(self, session, netperf_path="netperf"):
+        """
+        :param session: Shell session (aexpect.ShellSession) to run netperf.
+        :param netperf_path: Path of netperf in the session.
+        """
+        self.session = session
+        self.netperf_path = netperf_path
+
+    def get_cmd(self, server_address, test_option="", session_num=1,
+                interval=1, cmd_prefix="", selectors=NETPERF_SELECTORS):
+        """
+        :return: Shell command running session_num tagged netperf sessions.
+        """
+        options = test_option.split(" -- ", 1)
+        if len(options) == 1 and test_option.strip().endswith("--"):
+            options = [test_option.strip()[:-2], ""]
+        netperf_cmd = "%s %s -H %s" % (cmd_prefix, self.netperf_path,
+                                       server_address)
+        if interval:
+            netperf_cmd += " -D %s" % interval
+        netperf_cmd += " %s -- -k %s" % (options[0], ",".join(selectors))
+        if len(options) > 1:
+            netperf_cmd += " %s" % options[1]
+        sessions = " ".join([str(_) for _ in xrange(session_num)])
+        # The end marker is quoted so the echoed command doesn't contain it
+        end_marker = '"%s""%s"' % (_SESSIONS_END[:9], _SESSIONS_END[9:])
+        return ("for i in %s; do (%s 2>&1; echo %s $?) | "
+                "while read -r l; do echo \"%s$i $l\"; done & done; wait; "
+                "echo %s" % (sessions, netperf_cmd.strip(), _SESSION_DONE,
+                             _SESSION_TAG, end_marker))
+
+    def run(self, server_address, test_option="", session_num=1,
+            interval=1, timeout=1200, cmd_prefix="",
+            selectors=NETPERF_SELECTORS, callback=None):
+        """
+        Run parallel netperf sessions and collect their results.
+
+        :param server_address: Remote netserver address
+        :param test_option: Netperf test option (global -- test option)
+        :param session_num: Number of parallel sessions
+        :param interval: Interval of interim results in seconds, 0 disables
+                         the demo mode
+        :param timeout: Timeout of the whole run
+        :param cmd_prefix: Prefix in netperf command
+        :param selectors: Omni output selectors collected from each session
+        :param callback: Function called with each NetperfInterim record as
+                         soon as it's read
+        :return: NetperfResults
+        """
+        results = NetperfResults(int(session_num))
+        cmd = self.get_cmd(server_address, test_option, int(session_num),
+                           interval, cmd_prefix, selectors)
+        logging.info("Start %s netperf sessions with cmd: '%s'",
+                     session_num, cmd)
+        self.session.read_nonblocking(0, timeout)
+        self.session.sendline(cmd)
+        end_time = time.time() + timeout
+        pending = ""
+        finished = False
+        while not finished:
+            data = self.session.read_nonblocking(0.1, 1)
+            if not data and not self.session.is_alive():
+                raise NetperfTestError("Shell session terminated while "
+                                       "running netperf")
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                # The shell prompt may precede the tags
+                line = line.strip()
+                if line.endswith(_SESSIONS_END):
+                    finished = True
+                match = _SESSION_LINE_RE.search(line)
+                if match is None:
+                    continue
+                index, text = match.groups()
+                record = results[int(index)].add_line(text)
+                if record is not None and callback is not None:
+                    callback(record)
+            if not finished and time.time() > end_time:
+                self.session.send("\x03")
+                try:
+                    self.session.read_up_to_prompt(timeout=10)
+                except aexpect.ExpectError:
+                    pass
+                raise NetperfTestError("Netperf sessions not finished in "
+                                       "%s s" % timeout)
+        if not re.search(self.session.prompt, pending):
+            try:
+                self.session.read_up_to_prompt(timeout=10)
+            except aexpect.ExpectError:
+                pass
+        for session in results.failed():
+            logging.warn("Netperf session %d failed (%s): %s", session.index,
+                         session.status, "\n".join(session.output))
+        return results
+
+
 class NetperfPackage(remote.Remote_Package):
 
     def __init__(self, address, netperf_path, md5sum="", netperf_source="",
@@ -391,6 +686,24 @@ class NetperfClient(Netperf):
             for num in xrange(int(session_num)):
                 self.session.cmd_output_safe("%s &" % netperf_cmd)
 
+    def collect(self, server_address, test_option="", session_num=1,
+                interval=1, timeout=1200, cmd_prefix="",
+                selectors=NETPERF_SELECTORS, callback=None):
+        """
+        Run parallel netperf sessions and parse their results while they
+        run, see NetperfCollector.run().
+
+        :return: NetperfResults
+        """
+        if self.client == "nc":
+            raise NetperfTestError("Collecting results is not supported "
+                                   "with client 'nc'")
+        collector = NetperfCollector(self.session, self.netperf_path)
+        self.results = collector.run(server_address, test_option,
+                                     session_num, interval, timeout,
+                                     cmd_prefix, selectors, callback)
+        return self.results
+
     def is_netperf_running(self):
         return self.is_target_running(os.path.basename(self.netperf_path))
 
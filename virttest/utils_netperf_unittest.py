@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import common
+import aexpect
+import utils_netperf
+
+
+# Stand-in of netperf: sends data to the server (-H, -p) for -l seconds,
+# prints demo mode interim results every -D seconds and the values of the
+# -k output selectors at the end.
+NETPERF_STUB = r'''
+import sys, time, socket
+args = sys.argv[1:]
+opts = {"-D": "1", "-l": "1", "-p": "12865", "-k": ""}
+while args:
+    arg = args.pop(0)
+    if arg in opts or arg in ("-H", "-t"):
+        opts[arg] = args.pop(0)
+if opts["-H"] == "fail":
+    sys.stderr.write("establish control: are you sure there is a netserver "
+                     "listening on fail?\n")
+    sys.exit(1)
+sock = socket.create_connection((opts["-H"], int(opts["-p"])))
+data = "x" * 65536
+interval = float(opts["-D"])
+start = last = time.time()
+sent = total = 0
+while time.time() - start < float(opts["-l"]):
+    sock.sendall(data)
+    sent += len(data)
+    now = time.time()
+    if now - last >= interval:
+        print ("Interim result: %7.2f 10^6bits/s over %.3f seconds ending "
+               "at %.3f" % (sent * 8 / (now - last) / 1e6, now - last, now))
+        sys.stdout.flush()
+        total += sent
+        sent = 0
+        last = now
+sock.close()
+elapsed = time.time() - start
+values = {"THROUGHPUT": "%.2f" % ((total + sent) * 8 / elapsed / 1e6),
+          "THROUGHPUT_UNITS": "10^6bits/s", "ELAPSED_TIME": "%.2f" % elapsed,
+          "LOCAL_CPU_UTIL": "12.50", "REMOTE_CPU_UTIL": "-1.00",
+          "P50_LATENCY": "40", "P99_LATENCY": "95", "MAX_LATENCY": "120"}
+for key in opts["-k"].split(","):
+    if key in values:
+        print "%s=%s" % (key, values[key])
+'''
+
+
+class LoopbackServer(threading.Thread):
+
+    """
+    Netserver stand-in: reads and drops all data of accepted connections.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+
+    def run(self):
+        while True:
+            conn = self.sock.accept()[0]
+            self.connections += 1
+            reader = threading.Thread(target=self.drain, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def drain(self, conn):
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+
+class NetperfCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.netperf = os.path.join(self.tmpdir, "netperf")
+        open(self.netperf, "w").write(NETPERF_STUB)
+        self.server = LoopbackServer()
+        self.server.start()
+        self.session = aexpect.ShellSession("/bin/sh", prompt=r"^[\#\$] $")
+        self.collector = utils_netperf.NetperfCollector(
+            self.session, "%s %s" % (sys.executable, self.netperf))
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cmd(self):
+        cmd = self.collector.get_cmd("10.0.0.1", "-t TCP_RR -- -r 1,1", 2,
+                                     selectors=("THROUGHPUT",))
+        self.assertTrue(cmd.startswith("for i in 0 1; do ("))
+        self.assertTrue("-H 10.0.0.1 -D 1 -t TCP_RR -- -k THROUGHPUT -r 1,1 "
+                        "2>&1;" in cmd)
+
+    def test_collect(self):
+        records = []
+        results = self.collector.run("127.0.0.1",
+                                     "-l 2 -p %d" % self.server.port,
+                                     session_num=3, interval=0.5,
+                                     timeout=60, callback=records.append)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results.failed(), [])
+        self.assertEqual(sorted(set(_.session for _ in records)), [0, 1, 2])
+        for session in results.sessions:
+            self.assertTrue(len(session.interim) >= 2)
+            self.assertTrue(session.throughput > 0)
+            self.assertEqual(session.latency(),
+                             {"p50": 40.0, "p99": 95.0, "max": 120.0})
+            minimum, mean, maximum = session.interim_stats()
+            self.assertTrue(minimum <= mean <= maximum)
+        summary = results.summary()
+        self.assertAlmostEqual(summary["throughput"],
+                               sum(_.throughput for _ in results.sessions))
+        self.assertEqual(summary["units"], "10^6bits/s")
+        self.assertEqual(summary["local_cpu"], 12.5)
+        self.assertEqual(summary["remote_cpu"], None)
+
+    def test_failed_session(self):
+        results = self.collector.run("fail", session_num=2, timeout=60)
+        self.assertEqual([_.index for _ in results.failed()], [0, 1])
+        self.assertTrue("netserver" in results[0].output[0])
+        self.assertEqual(results.throughput, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -36,6 +36,7 @@ from autotest.client.tools import scan_results
 from virttest import qemu_virtio_port
 from virttest import aexpect, utils_misc, virt_vm, data_dir, utils_net
 from virttest import storage, asset, bootstrap, remote
+from virttest import utils_transfer
 import virttest
 
 # Import submodules, should not be considered as unused import
@@ -429,7 +430,7 @@ def run_file_transfer(test, params, env):
     Transfer a file back and forth between host and guest.
 
     1) Boot up a VM.
-    2) Create a large file by dd on host.
+    2) Create a large file of incompressible data on host.
     3) Copy this file from host to guest.
     4) Copy this file from guest to host.
     5) Check if file transfers ended good.
@@ -443,27 +444,24 @@ def run_file_transfer(test, params, env):
     login_timeout = int(params.get("login_timeout", 360))
 
     error.context("Login to guest", logging.info)
-    session = vm.wait_for_login(timeout=login_timeout)
+    session = vm.lease_session(timeout=login_timeout)
 
     dir_name = test.tmpdir
     transfer_timeout = int(params.get("transfer_timeout"))
     tmp_dir = params.get("tmp_dir", "/tmp/")
     clean_cmd = params.get("clean_cmd", "rm -f")
     filesize = int(params.get("filesize", 4000))
-    count = int(filesize / 10)
-    if count == 0:
-        count = 1
 
     host_path = os.path.join(dir_name, "tmp-%s" %
                              utils_misc.generate_random_string(8))
     host_path2 = host_path + ".2"
-    cmd = "dd if=/dev/zero of=%s bs=10M count=%d" % (host_path, count)
     guest_path = (tmp_dir + "file_transfer-%s" %
                   utils_misc.generate_random_string(8))
 
     try:
         error.context("Creating %dMB file on host" % filesize, logging.info)
-        utils.run(cmd)
+        md5 = utils_transfer.write_file(host_path,
+                                        filesize * utils_transfer.MEGABYTE)
 
         error.context("Transferring file host -> guest,"
                       " timeout: %ss" % transfer_timeout, logging.info)
@@ -485,8 +483,7 @@ def run_file_transfer(test, params, env):
 
         error.context("Compare md5sum between original file and"
                       " transferred file", logging.info)
-        if (utils.hash_file(host_path, method="md5") !=
-                utils.hash_file(host_path2, method="md5")):
+        if md5 != utils_transfer.hash_file(host_path2):
             raise error.TestFail("File changed after transfer host -> guest "
                                  "and guest -> host")
 
@@ -503,7 +500,56 @@ def run_file_transfer(test, params, env):
             os.remove(host_path2)
         except OSError:
             pass
+        vm.release_session(session)
+
+
+def run_transfer_benchmark(test, params, env):
+    """
+    Benchmark transfers of incompressible data between host and guest.
+
+    Params:
+    transfer_transports: Transports (scp, rss, nc, virtio), see
+                         utils_transfer.vm_transports().
+    transfer_sizes: Sizes of the transfers in MB.
+    transfer_repeats: Transfers of every size, transport and direction.
+
+    Throughput statistics are written to the perf results of the test
+    (Category:<transport> <direction> tables, see utils_transfer).
+
+    :param test: QEMU test object.
+    :param params: Dictionary with the test parameters.
+    :param env: Dictionary with test environment.
+    """
+    vm = env.get_vm(params["main_vm"])
+    vm.verify_alive()
+    login_timeout = int(params.get("login_timeout", 360))
+    transfer_timeout = int(params.get("transfer_timeout", 600))
+    session = vm.wait_for_login(timeout=login_timeout)
+    endpoint = utils_transfer.SessionEndpoint(
+        session, params.get("tmp_dir", "/tmp/"), transfer_timeout)
+    transports = utils_transfer.vm_transports(
+        vm, endpoint, params.objects("transfer_transports") or ["scp"],
+        transfer_timeout)
+    sizes = [int(float(size) * utils_transfer.MEGABYTE)
+             for size in params.objects("transfer_sizes") or ["64"]]
+    benchmark = utils_transfer.TransferBenchmark(
+        endpoint, transports, sizes, int(params.get("transfer_repeats", 3)),
+        test.tmpdir)
+    try:
+        error.context("Running transfer benchmark", logging.info)
+        benchmark.run()
+    finally:
+        benchmark.close()
         session.close()
+    lines = benchmark.table()
+    for line in lines:
+        logging.info(line)
+    if hasattr(test, "write_perf_results"):
+        test.write_perf_results(lines)
+    failures = benchmark.failures()
+    if failures:
+        raise error.TestFail("Transferred data changed: %s" %
+                             ", ".join(str(result) for result in failures))
 
 
 @error.context_aware
@@ -618,9 +664,9 @@ def run_virtio_serial_file_transfer(test, params, env, port_name=None,
                                    "tmp-%s" % utils_misc.generate_random_string(8))
 
     if sender == "host" or sender == "both":
-        cmd = "dd if=/dev/zero of=%s bs=1M count=%d" % (host_data_file, count)
         error.context("Creating %dMB file on host" % filesize, logging.info)
-        utils.run(cmd)
+        utils_transfer.write_file(host_data_file,
+                                  filesize * utils_transfer.MEGABYTE)
     else:
         guest_file_create_cmd = "dd if=/dev/zero of=%s bs=1M count=%d"
         guest_file_create_cmd = params.get("guest_file_create_cmd",
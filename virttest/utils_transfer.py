@@ -0,0 +1,791 @@
+"""
+Benchmark of data transfers between the host and guests.
+
+Transferred data are incompressible (blocks of a random pool, every block
+stamped with its index) and their md5 sums are computed while the data are
+generated, sent or received, so no file is read again just to be checked.
+Guests compute their sums on the fly too (tee | md5sum).
+
+Transports:
+
+scp, rss     File copies by remote.copy_files_to() and copy_files_from().
+nc           TCP stream between a host socket and nc in the guest.
+virtio       Stream between the host socket of a virtio-serial port and its
+             device in the guest.
+loopback     Stream over a socket pair to a local process.
+
+With LocalEndpoint (a host directory standing in for the guest) and the
+loopback and rss (served by rss_server.py) transports the suite runs
+without any guest, see tools/transfer_benchmark.py.
+
+Only Linux guests are supported by SessionEndpoint.
+
+:copyright: Red Hat 2014
+"""
+
+import os
+import re
+import math
+import time
+import socket
+import struct
+import hashlib
+import logging
+import posixpath
+import subprocess
+
+import remote
+import rss_server
+
+
+# Size of the blocks of generated and received data
+BLOCK_SIZE = 1 << 18
+# Size of the random pool the generated blocks are taken from
+POOL_SIZE = 1 << 22
+MEGABYTE = 1 << 20
+# Default guest ports of the transports
+DEFAULT_PORTS = {"scp": 22, "rss": 10023, "nc": 8888}
+
+_pool = None
+
+
+class TransferError(Exception):
+    pass
+
+
+def _random_pool():
+    global _pool
+    if _pool is None:
+        _pool = os.urandom(POOL_SIZE)
+    return _pool
+
+
+class DataStream(object):
+
+    """
+    Incompressible data generated in blocks, the md5 sum of the data is
+    computed on the fly. A stream can be iterated over only once.
+    """
+
+    def __init__(self, size, block_size=BLOCK_SIZE):
+        """
+        :param size: Size of the data in bytes.
+        :param block_size: Size of the blocks (at most POOL_SIZE / 2).
+        """
+        self.size = size
+        self.block_size = min(block_size, POOL_SIZE / 2)
+        self.md5 = hashlib.md5()
+
+    def __iter__(self):
+        pool = _random_pool()
+        span = POOL_SIZE - self.block_size
+        remaining = self.size
+        index = 0
+        while remaining > 0:
+            length = min(self.block_size, remaining)
+            # Consecutive blocks come from distant parts of the pool
+            offset = (index * 2654435761) % span
+            block = (struct.pack("=Q", index)[:length] +
+                     pool[offset + 8:offset + length])
+            self.md5.update(block)
+            yield block
+            remaining -= length
+            index += 1
+
+    def hexdigest(self):
+        """
+        :return: md5 sum of the data generated so far.
+        """
+        return self.md5.hexdigest()
+
+
+def write_file(path, size, block_size=BLOCK_SIZE):
+    """
+    Write incompressible data to a file.
+
+    :param path: Path of the file.
+    :param size: Size of the file in bytes.
+    :return: md5 sum of the file.
+    """
+    stream = DataStream(size, block_size)
+    fileobj = open(path, "wb")
+    try:
+        for block in stream:
+            fileobj.write(block)
+    finally:
+        fileobj.close()
+    return stream.hexdigest()
+
+
+def hash_file(path, block_size=BLOCK_SIZE):
+    """
+    :return: md5 sum of a file.
+    """
+    md5 = hashlib.md5()
+    fileobj = open(path, "rb")
+    try:
+        while True:
+            data = fileobj.read(block_size)
+            if not data:
+                break
+            md5.update(data)
+    finally:
+        fileobj.close()
+    return md5.hexdigest()
+
+
+def send_stream(sock, stream):
+    """
+    Send all blocks of a DataStream to a socket.
+    """
+    for block in stream:
+        sock.sendall(block)
+
+
+def receive_stream(sock, size, block_size=BLOCK_SIZE):
+    """
+    Receive exactly size bytes from a socket into a preallocated buffer.
+
+    :return: md5 sum of the received data.
+    :raise TransferError: If the peer closed the connection too early.
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    remaining = size
+    while remaining:
+        count = sock.recv_into(view, min(block_size, remaining))
+        if not count:
+            raise TransferError("Connection closed, %d bytes were not "
+                                "received" % remaining)
+        md5.update(view[:count])
+        remaining -= count
+    return md5.hexdigest()
+
+
+def _parse_md5(output):
+    match = re.search(r"\b[0-9a-f]{32}\b", output)
+    if match is None:
+        raise TransferError("No md5 sum in output: %r" % output)
+    return match.group(0)
+
+
+class LocalEndpoint(object):
+
+    """
+    Host directory standing in for a guest (loopback mode).
+    """
+
+    address = "127.0.0.1"
+
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def create_file(self, path, size):
+        """
+        Create a file of incompressible data.
+
+        :return: md5 sum of the file.
+        """
+        return write_file(path, size)
+
+    def hash_file(self, path):
+        return hash_file(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class SessionEndpoint(object):
+
+    """
+    Linux guest reached by a shell session.
+    """
+
+    def __init__(self, session, tmp_dir="/tmp", timeout=600):
+        """
+        :param session: Shell session of the guest.
+        :param tmp_dir: Guest directory of the transferred files.
+        :param timeout: Timeout of commands creating and checking files.
+        """
+        self.session = session
+        self.tmp_dir = tmp_dir
+        self.timeout = timeout
+
+    def path(self, name):
+        return posixpath.join(self.tmp_dir, name)
+
+    def create_file(self, path, size):
+        """
+        Create a file of random data, md5 sum is computed while writing it.
+
+        :return: md5 sum of the file.
+        """
+        return _parse_md5(self.session.cmd_output(
+            "head -c %d /dev/urandom | tee %s | md5sum" % (size, path),
+            timeout=self.timeout))
+
+    def hash_file(self, path):
+        return _parse_md5(self.session.cmd_output("md5sum %s" % path,
+                                                  timeout=self.timeout))
+
+    def remove(self, path):
+        self.session.cmd_output("rm -f %s" % path)
+
+    def start(self, cmd):
+        """
+        Start a command, its output is returned by finish().
+        """
+        self.session.sendline(cmd)
+
+    def finish(self, timeout):
+        """
+        Wait for the command started by start() to finish.
+
+        :return: Output of the command.
+        """
+        return self.session.read_up_to_prompt(timeout=timeout)
+
+
+class TransferResult(object):
+
+    """
+    Result of one transfer.
+    """
+
+    def __init__(self, transport, direction, size, elapsed, sent_md5,
+                 received_md5):
+        """
+        :param transport: Name of the transport.
+        :param direction: "upload" (host -> guest) or "download".
+        :param size: Transferred bytes.
+        :param elapsed: Duration of the transfer in seconds.
+        :param sent_md5: md5 sum of the sent data.
+        :param received_md5: md5 sum of the received data.
+        """
+        self.transport = transport
+        self.direction = direction
+        self.size = size
+        self.elapsed = elapsed
+        self.sent_md5 = sent_md5
+        self.received_md5 = received_md5
+
+    @property
+    def ok(self):
+        return self.sent_md5 == self.received_md5
+
+    @property
+    def throughput(self):
+        """
+        :return: Throughput in MB/s.
+        """
+        return self.size / float(MEGABYTE) / max(self.elapsed, 1e-9)
+
+    def as_dict(self):
+        return {"transport": self.transport, "direction": self.direction,
+                "size": self.size, "elapsed": self.elapsed,
+                "throughput": self.throughput, "ok": self.ok}
+
+    def __str__(self):
+        return ("%s %s of %.1f MB: %.3f s, %.2f MB/s%s" %
+                (self.transport, self.direction, self.size / float(MEGABYTE),
+                 self.elapsed, self.throughput,
+                 not self.ok and ", CHECKSUM MISMATCH" or ""))
+
+
+class Transport(object):
+
+    """
+    Way of moving data between the host and an endpoint.
+    """
+
+    name = None
+
+    def __init__(self, endpoint, timeout=600):
+        """
+        :param endpoint: LocalEndpoint or SessionEndpoint.
+        :param timeout: Timeout of one transfer.
+        """
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def upload(self, size, remote_path, workdir):
+        """
+        Transfer size bytes of new data from the host to remote_path.
+
+        :param workdir: Host directory for temporary files.
+        :return: TransferResult object.
+        """
+        raise NotImplementedError
+
+    def download(self, size, remote_path, workdir):
+        """
+        Transfer size bytes of new data from remote_path to the host.
+
+        :param workdir: Host directory for temporary files.
+        :return: TransferResult object.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RemoteCopyTransport(Transport):
+
+    """
+    File copies by remote.copy_files_to() and copy_files_from().
+    """
+
+    def __init__(self, endpoint, client, address, port, username="",
+                 password="", timeout=600, multiplex=False):
+        """
+        :param client: File transfer client ("scp" or "rss").
+        :param address: Address of the guest.
+        :param port: Port of the transfer server of the guest.
+        """
+        Transport.__init__(self, endpoint, timeout)
+        self.name = client
+        self.address = address
+        self.port = port
+        self.username = username
+        self.password = password
+        self.multiplex = multiplex
+
+    @staticmethod
+    def _local_path(remote_path, workdir):
+        # Differs from remote_path even if workdir is the endpoint directory
+        return os.path.join(workdir,
+                            "host-%s" % posixpath.basename(remote_path))
+
+    def upload(self, size, remote_path, workdir):
+        local_path = self._local_path(remote_path, workdir)
+        sent_md5 = write_file(local_path, size)
+        try:
+            start = time.time()
+            remote.copy_files_to(self.address, self.name, self.username,
+                                 self.password, self.port, local_path,
+                                 remote_path, timeout=self.timeout,
+                                 multiplex=self.multiplex)
+            elapsed = time.time() - start
+        finally:
+            os.remove(local_path)
+        return TransferResult(self.name, "upload", size, elapsed, sent_md5,
+                              self.endpoint.hash_file(remote_path))
+
+    def download(self, size, remote_path, workdir):
+        sent_md5 = self.endpoint.create_file(remote_path, size)
+        local_path = self._local_path(remote_path, workdir)
+        try:
+            start = time.time()
+            remote.copy_files_from(self.address, self.name, self.username,
+                                   self.password, self.port, remote_path,
+                                   local_path, timeout=self.timeout,
+                                   multiplex=self.multiplex)
+            elapsed = time.time() - start
+            received_md5 = hash_file(local_path)
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        return TransferResult(self.name, "download", size, elapsed, sent_md5,
+                              received_md5)
+
+
+class StreamTransport(Transport):
+
+    """
+    Stream between a host socket and a command of the endpoint, no host
+    files are involved.
+
+    Subclasses define the commands receiving the stream into a file
+    (printing its md5 sum) and sending a file, and how the host socket is
+    connected.
+    """
+
+    def upload_command(self, path, size):
+        raise NotImplementedError
+
+    def download_command(self, path):
+        raise NotImplementedError
+
+    def _start(self, cmd, upload):
+        self.endpoint.start(cmd)
+
+    def _wait(self):
+        return self.endpoint.finish(self.timeout)
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _disconnect(self, sock):
+        sock.close()
+
+    def upload(self, size, remote_path, workdir):
+        self._start(self.upload_command(remote_path, size), True)
+        sock = self._connect()
+        try:
+            stream = DataStream(size)
+            start = time.time()
+            send_stream(sock, stream)
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            received_md5 = _parse_md5(self._wait())
+            elapsed = time.time() - start
+        finally:
+            self._disconnect(sock)
+        return TransferResult(self.name, "upload", size, elapsed,
+                              stream.hexdigest(), received_md5)
+
+    def download(self, size, remote_path, workdir):
+        sent_md5 = self.endpoint.create_file(remote_path, size)
+        self._start(self.download_command(remote_path), False)
+        sock = self._connect()
+        try:
+            start = time.time()
+            received_md5 = receive_stream(sock, size)
+            elapsed = time.time() - start
+        finally:
+            self._disconnect(sock)
+        self._wait()
+        return TransferResult(self.name, "download", size, elapsed, sent_md5,
+                              received_md5)
+
+
+class NcTransport(StreamTransport):
+
+    """
+    TCP stream between a host socket and nc listening in the guest.
+    """
+
+    name = "nc"
+
+    def __init__(self, endpoint, address, port, guest_port=None,
+                 timeout=600, connect_timeout=10):
+        """
+        :param address: Address of the guest.
+        :param port: Port the host connects to.
+        :param guest_port: Port nc listens on in the guest (differs from
+                           port with redirected user networking).
+        """
+        StreamTransport.__init__(self, endpoint, timeout)
+        self.address = address
+        self.port = port
+        self.guest_port = guest_port or port
+        self.connect_timeout = connect_timeout
+
+    def upload_command(self, path, size):
+        return ("nc -l %d < /dev/null | tee %s | md5sum" %
+                (self.guest_port, path))
+
+    def download_command(self, path):
+        return "nc -l %d < %s" % (self.guest_port, path)
+
+    def _connect(self):
+        end_time = time.time() + self.connect_timeout
+        for delay in remote.login_delays(0.05, 1.5, 0.5):
+            try:
+                return socket.create_connection((self.address, self.port),
+                                                self.connect_timeout)
+            except socket.error:
+                if time.time() > end_time:
+                    raise
+            time.sleep(delay)
+
+
+class VirtioSerialTransport(StreamTransport):
+
+    """
+    Stream over a virtio-serial port (qemu_virtio_port.VirtioSerial).
+    """
+
+    name = "virtio"
+
+    def __init__(self, endpoint, port, timeout=600):
+        """
+        :param port: VirtioSerial object of the VM.
+        """
+        StreamTransport.__init__(self, endpoint, timeout)
+        self.port = port
+
+    def upload_command(self, path, size):
+        return ("head -c %d /dev/virtio-ports/%s | tee %s | md5sum" %
+                (size, self.port.name, path))
+
+    def download_command(self, path):
+        return "cat %s > /dev/virtio-ports/%s" % (path, self.port.name)
+
+    def _connect(self):
+        self.port.open()
+        return self.port.sock
+
+    def _disconnect(self, sock):
+        self.port.close()
+
+
+class LoopbackTransport(StreamTransport):
+
+    """
+    Stream over a socket pair to a local process, the other end of the pair
+    is its stdin or stdout.
+    """
+
+    name = "loopback"
+
+    def __init__(self, endpoint, timeout=600):
+        StreamTransport.__init__(self, endpoint, timeout)
+        self._process = None
+        self._sock = None
+
+    def upload_command(self, path, size):
+        return "tee %s | md5sum" % path
+
+    def download_command(self, path):
+        return "cat %s" % path
+
+    def _start(self, cmd, upload):
+        self._sock, peer = socket.socketpair()
+        try:
+            if upload:
+                self._process = subprocess.Popen(cmd, shell=True,
+                                                 stdin=peer.fileno(),
+                                                 stdout=subprocess.PIPE)
+            else:
+                self._process = subprocess.Popen(cmd, shell=True,
+                                                 stdout=peer.fileno())
+        finally:
+            peer.close()
+
+    def _connect(self):
+        return self._sock
+
+    def _wait(self):
+        output = self._process.communicate()[0]
+        self._process = None
+        return output or ""
+
+
+class LoopbackRSSTransport(RemoteCopyTransport):
+
+    """
+    rss file copies to a local rss_server.FileTransferServer.
+    """
+
+    def __init__(self, endpoint, timeout=600):
+        self.server = rss_server.FileTransferServer()
+        self.server.start()
+        RemoteCopyTransport.__init__(self, endpoint, "rss", "127.0.0.1",
+                                     self.server.port, timeout=timeout)
+
+    def close(self):
+        self.server.stop()
+
+
+def loopback_transports(endpoint, names, timeout=600):
+    """
+    Create transports for a LocalEndpoint.
+
+    :param names: Names of the transports ("loopback", "rss").
+    :return: List of Transport objects.
+    """
+    transports = []
+    for name in names:
+        if name == "loopback":
+            transports.append(LoopbackTransport(endpoint, timeout))
+        elif name == "rss":
+            transports.append(LoopbackRSSTransport(endpoint, timeout))
+        else:
+            raise TransferError("Transport '%s' can't run in loopback "
+                                "mode" % name)
+    return transports
+
+
+def vm_transports(vm, endpoint, names, timeout=600):
+    """
+    Create transports to a VM.
+
+    Guest ports are taken from params transfer_<name>_port (defaults in
+    DEFAULT_PORTS), the virtio-serial port from param transfer_virtio_port
+    (first virtio-serial port of the VM by default).
+
+    :param vm: VM object.
+    :param endpoint: SessionEndpoint of the VM.
+    :param names: Names of the transports ("scp", "rss", "nc", "virtio").
+    :return: List of Transport objects.
+    """
+    params = vm.params
+    username = params.get("username", "")
+    password = params.get("password", "")
+    transports = []
+    for name in names:
+        if name == "virtio":
+            port_name = params.get("transfer_virtio_port")
+            ports = [port for port in getattr(vm, "virtio_ports", [])
+                     if port.is_console == "no" and
+                     port_name in (None, port.name)]
+            if not ports:
+                raise TransferError("VM %s has no virtio-serial port for "
+                                    "transfers" % vm.name)
+            transports.append(VirtioSerialTransport(endpoint, ports[0],
+                                                    timeout))
+            continue
+        if name not in DEFAULT_PORTS:
+            raise TransferError("Unknown transport '%s'" % name)
+        guest_port = int(params.get("transfer_%s_port" % name,
+                                    DEFAULT_PORTS[name]))
+        address = vm.get_address()
+        port = vm.get_port(guest_port)
+        if name == "nc":
+            transports.append(NcTransport(endpoint, address, port,
+                                          guest_port, timeout))
+        else:
+            transports.append(RemoteCopyTransport(
+                endpoint, name, address, port, username, password, timeout,
+                multiplex=vm.ssh_multiplex()))
+    return transports
+
+
+def _percentile(values, fraction):
+    """
+    Percentile of sorted values with linear interpolation.
+    """
+    position = (len(values) - 1) * fraction
+    low = int(math.floor(position))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def throughput_stats(values):
+    """
+    Statistics of a throughput distribution.
+
+    :param values: Throughputs (MB/s).
+    :return: Dict with samples, min, median, mean, p90, max and sd.
+    """
+    values = sorted(values)
+    stats = {"samples": len(values)}
+    if not values:
+        return stats
+    mean = sum(values) / len(values)
+    sd = 0.0
+    if len(values) > 1:
+        sd = math.sqrt(sum((value - mean) ** 2 for value in values) /
+                       (len(values) - 1))
+    stats.update({"min": values[0], "median": _percentile(values, 0.5),
+                  "mean": mean, "p90": _percentile(values, 0.9),
+                  "max": values[-1], "sd": sd})
+    return stats
+
+
+class TransferBenchmark(object):
+
+    """
+    Repeated transfers of data of several sizes over several transports.
+    """
+
+    DIRECTIONS = ("upload", "download")
+    STATS = ("min", "median", "mean", "p90", "max", "sd")
+
+    def __init__(self, endpoint, transports, sizes, repeats=3,
+                 workdir="/tmp", directions=DIRECTIONS):
+        """
+        :param endpoint: LocalEndpoint or SessionEndpoint.
+        :param transports: List of Transport objects.
+        :param sizes: Sizes of the transferred data in bytes.
+        :param repeats: Number of transfers of every size, transport and
+                        direction.
+        :param workdir: Host directory for temporary files.
+        :param directions: Directions of the transfers.
+        """
+        self.endpoint = endpoint
+        self.transports = transports
+        self.sizes = sizes
+        self.repeats = repeats
+        self.workdir = workdir
+        self.directions = directions
+        self.results = []
+
+    def run(self):
+        """
+        Run all transfers.
+
+        :return: List of TransferResult objects (also in self.results).
+        """
+        for size in self.sizes:
+            for transport in self.transports:
+                remote_path = self.endpoint.path("transfer-benchmark-%s" %
+                                                 transport.name)
+                try:
+                    for direction in self.directions:
+                        for _ in xrange(self.repeats):
+                            result = getattr(transport, direction)(
+                                size, remote_path, self.workdir)
+                            logging.info(result)
+                            self.results.append(result)
+                finally:
+                    self.endpoint.remove(remote_path)
+        return self.results
+
+    def failures(self):
+        """
+        :return: Results with a checksum mismatch.
+        """
+        return [result for result in self.results if not result.ok]
+
+    def summary(self):
+        """
+        Throughput statistics of all transports, directions and sizes,
+        ordered by transport and direction (in the order of the runs) and
+        size.
+
+        :return: List of dicts of throughput_stats() with the transport,
+                 direction, size and number of failures.
+        """
+        groups = {}
+        categories = {}
+        for result in self.results:
+            key = (result.transport, result.direction, result.size)
+            groups.setdefault(key, []).append(result)
+            categories.setdefault(key[:2], len(categories))
+        summary = []
+        for key in sorted(groups, key=lambda key: (categories[key[:2]],
+                                                   key[2])):
+            results = groups[key]
+            stats = throughput_stats([result.throughput
+                                      for result in results])
+            stats.update({"transport": key[0], "direction": key[1],
+                          "size": key[2],
+                          "failures": len([result for result in results
+                                           if not result.ok])})
+            summary.append(stats)
+        return summary
+
+    def table(self):
+        """
+        Summary as lines of a results table (see perf_store): a category
+        line for every transport and direction followed by lines of
+        size (MB)|samples|failures|min|median|mean|p90|max|sd (MB/s).
+        """
+        lines = []
+        category = None
+        for stats in self.summary():
+            if (stats["transport"], stats["direction"]) != category:
+                category = (stats["transport"], stats["direction"])
+                lines.append("Category:%s %s" % category)
+                lines.append("size|samples|failures|" + "|".join(self.STATS))
+            lines.append("|".join(
+                ["%g" % (stats["size"] / float(MEGABYTE)),
+                 "%d" % stats["samples"], "%d" % stats["failures"]] +
+                ["%.2f" % stats[name] for name in self.STATS]))
+        return lines
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
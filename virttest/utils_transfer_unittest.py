@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import zlib
+import socket
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+import common
+import perf_store
+import utils_transfer
+
+
+class DataStreamTest(unittest.TestCase):
+
+    def test_stream(self):
+        stream = utils_transfer.DataStream(3 * 1024 * 1024 + 5,
+                                           block_size=65536)
+        data = "".join(stream)
+        self.assertEqual(len(data), 3 * 1024 * 1024 + 5)
+        self.assertEqual(stream.hexdigest(), hashlib.md5(data).hexdigest())
+        # Nothing to gain by compression, blocks are not repeated
+        self.assertTrue(len(zlib.compress(data, 1)) > len(data) * 0.99)
+        blocks = [data[i:i + 65536] for i in xrange(0, len(data), 65536)]
+        self.assertEqual(len(set(blocks)), len(blocks))
+
+    def test_receive(self):
+        sender, receiver = socket.socketpair()
+        stream = utils_transfer.DataStream(1000000)
+        thread = threading.Thread(target=utils_transfer.send_stream,
+                                  args=(sender, stream))
+        thread.start()
+        md5 = utils_transfer.receive_stream(receiver, 1000000,
+                                            block_size=4096)
+        thread.join()
+        self.assertEqual(md5, stream.hexdigest())
+        sender.close()
+        self.assertRaises(utils_transfer.TransferError,
+                          utils_transfer.receive_stream, receiver, 1)
+        receiver.close()
+
+    def test_stats(self):
+        stats = utils_transfer.throughput_stats([4.0, 1.0, 3.0, 2.0])
+        self.assertEqual(stats["samples"], 4)
+        self.assertEqual((stats["min"], stats["max"]), (1.0, 4.0))
+        self.assertEqual(stats["median"], 2.5)
+        self.assertAlmostEqual(stats["p90"], 3.7)
+        self.assertAlmostEqual(stats["sd"], 1.2909944)
+
+
+class LoopbackBenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.endpoint = utils_transfer.LocalEndpoint(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run(self):
+        transports = utils_transfer.loopback_transports(
+            self.endpoint, ["loopback", "rss"], timeout=60)
+        benchmark = utils_transfer.TransferBenchmark(
+            self.endpoint, transports, [100000, 2 * 1024 * 1024], repeats=2,
+            workdir=self.tmpdir)
+        try:
+            results = benchmark.run()
+        finally:
+            benchmark.close()
+        self.assertEqual(len(results), 16)
+        self.assertEqual(benchmark.failures(), [])
+        summary = benchmark.summary()
+        self.assertEqual(len(summary), 8)
+        self.assertEqual(summary[0]["transport"], "loopback")
+        self.assertEqual(summary[0]["samples"], 2)
+        table = [perf_store.parse_line(line) for line in benchmark.table()]
+        self.assertEqual(len(table), 16)
+        self.assertEqual(table[:2], [None, None])
+        self.assertEqual(len(table[3]), 9)
+        self.assertEqual(table[3][:3], [2, 2, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@ import glob
 import os
 import re
 import socket
+import threading
 from autotest.client import utils
 from autotest.client.shared import error
 import utils_misc
@@ -13,6 +14,47 @@ import traceback
 import ppm_utils
 import data_dir
 import copy
+import hashlib
+import contextlib
+import aexpect
+import console_scanner
+
+
+# Params identifying the test and controlling pre/post processing, they
+# don't change the VM so they are left out of params fingerprints
+FINGERPRINT_IGNORED_PARAMS = ("name", "shortname", "type", "dep",
+                              "_name_map_file", "_short_name_map_file",
+                              "start_vm", "restart_vm",
+                              "check_vm_needs_restart", "iterations",
+                              "kill_unresponsive_vms")
+FINGERPRINT_IGNORED_PREFIXES = ("pre_command", "post_command", "kill_vm")
+
+# (trigger, regex) patterns of serial console messages, see console_scanner
+KERNEL_CRASH_PATTERNS = [
+    ("BUG:", r"BUG:.*?---\[ end trace .*? \]---"),
+    ("cut here", r"----------\[ cut here.*? BUG .*?\[ end trace .*? \]---"),
+    ("general protection fault:", r"general protection fault:.*? RSP.*?>")]
+ILLEGAL_INSTRUCTION_PATTERNS = [
+    ("trap invalid opcode", r".*trap invalid opcode.*\n")]
+
+
+def params_fingerprint(params, *extra):
+    """
+    Stable hash of params relevant for a VM.
+
+    :param params: Dict of VM params.
+    :param extra: Other values to include in the hash (VM name, ...).
+    :return: Hex digest.
+    """
+    digest = hashlib.sha1()
+    for key in sorted(params):
+        if (key in FINGERPRINT_IGNORED_PARAMS or
+                key.startswith(FINGERPRINT_IGNORED_PREFIXES)):
+            continue
+        digest.update("%s=%r\0" % (key, params[key]))
+    for value in extra:
+        digest.update("%r\0" % (value,))
+    return digest.hexdigest()
 
 
 class VMError(Exception):
@@ -452,6 +494,55 @@ class CpuInfo(object):
         self.threads = threads
 
 
+class SerialLoginRacer(threading.Thread):
+
+    """
+    Thread logging into a VM via its serial console while the caller keeps
+    trying to log in over the network.
+
+    A serial login tells the guest is up (and records the first login
+    time) early; session is the shared serial console of the VM, it must
+    not be closed by the caller.
+    """
+
+    def __init__(self, vm, end_time, internal_timeout=10,
+                 username=None, password=None):
+        """
+        :param vm: VM object.
+        :param end_time: Time (as time.time()) to give up the attempts.
+        :param internal_timeout: Timeout to pass to serial_login().
+        """
+        threading.Thread.__init__(self, name="serial-login-%s" % vm.name)
+        self.daemon = True
+        self.vm = vm
+        self.end_time = end_time
+        self.internal_timeout = internal_timeout
+        self.username = username
+        self.password = password
+        self.session = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        delays = remote.login_delays()
+        while not self.stopped.is_set() and time.time() < self.end_time:
+            try:
+                self.session = self.vm.serial_login(self.internal_timeout,
+                                                    self.username,
+                                                    self.password)
+                return
+            except Exception, e:
+                logging.debug("Serial login into '%s' failed: %s",
+                              self.vm.name, e)
+            self.stopped.wait(delays.next())
+
+    def stop(self, timeout=None):
+        """
+        Stop the attempts and wait for the thread to finish.
+        """
+        self.stopped.set()
+        self.join(timeout)
+
+
 class BaseVM(object):
 
     """
@@ -501,6 +592,8 @@ class BaseVM(object):
     COPY_FILES_TIMEOUT = 600
     MIGRATE_TIMEOUT = 3600
     REBOOT_TIMEOUT = 240
+    # Time a pooled session has to answer with a shell prompt
+    SESSION_CHECK_TIMEOUT = 5
 
     def __init__(self, name, params):
         self.name = name
@@ -563,10 +656,22 @@ class BaseVM(object):
         """
         Verifies whether the current virt_install commandline matches the
         requested one, based on the test parameters.
+
+        The command lines are only compared when the params fingerprint
+        differs from the one stored by the last successful check (or the VM
+        params or network changed since).
         """
         if not self.is_alive():
             return True
 
+        fingerprint = (params_fingerprint(params, name, basedir),
+                       params_fingerprint(self.params, self.name, basedir,
+                                          str(self.virtnet)))
+        if fingerprint == getattr(self, "params_fingerprint", None):
+            logging.debug("VM params fingerprint in env matches requested, "
+                          "continuing.")
+            return False
+
         try:
             need_restart = (self.make_create_command() !=
                             self.make_create_command(name, params, basedir))
@@ -591,6 +696,7 @@ class BaseVM(object):
             else:
                 logging.debug(
                     "VM params in env do match requested, continuing.")
+                self.params_fingerprint = fingerprint
                 return False
 
     def verify_alive(self):
@@ -654,20 +760,23 @@ class BaseVM(object):
             macs = self.virtnet.mac_list()
             if not arp_ip:
                 arp_ip = self.address_cache.get(nic.mac.upper())
-            if (not arp_ip or
-                    not utils_net.verify_ip_address_ownership(arp_ip, macs) or
-                    os.geteuid() != 0):
+            verified = (arp_ip and
+                        utils_net.verify_ip_address_ownership(arp_ip, macs))
+            if not verified or os.geteuid() != 0:
                 # For non-root, tcpdump won't work for finding IP address,
                 # or IP missed in address_cache, try to find it from arp table.
                 ip_map = utils_net.parse_arp()
-                arp_ip = ip_map.get(nic.mac.lower())
+                if ip_map.get(nic.mac.lower()) != arp_ip:
+                    arp_ip = ip_map.get(nic.mac.lower())
+                    verified = False
             if not arp_ip:
                 raise VMIPAddressMissingError(nic.mac)
 
             nic_params = self.params.object_params(nic.nic_name)
             pci_assignable = nic_params.get("pci_assignable") != "no"
 
-            if not utils_net.verify_ip_address_ownership(arp_ip, macs):
+            if (not verified and
+                    not utils_net.verify_ip_address_ownership(arp_ip, macs)):
                 # SR-IOV/Macvtap cards may not be in same subnet with the cards
                 # used by host by default, so arp checks won't work. Therefore,
                 # do not raise VMAddressVerificationError when SR-IOV is used.
@@ -822,6 +931,48 @@ class BaseVM(object):
         except KeyError:
             pass  # continue to not exist
 
+    def set_console_output_limit(self, session):
+        """
+        Limit the disk space used by the output file of a console session
+        according to the console_log_segment_size (MB, 0 for no limit),
+        console_log_segments and console_log_compress params.
+
+        :param session: aexpect session of the console.
+        """
+        segment_size = int(float(self.params.get("console_log_segment_size",
+                                                 0)) * 1048576)
+        if segment_size:
+            session.set_output_limit(
+                segment_size, int(self.params.get("console_log_segments", 4)),
+                self.params.get("console_log_compress") == "yes")
+
+    def scan_serial_console(self):
+        """
+        Scan the serial console output written since the last scan for
+        kernel crashes and illegal instructions.
+
+        :return: console_scanner.ConsoleScanner of the serial console with
+                 "kernel_crash" and "illegal_instruction" matchers or None
+                 when there is no serial console.
+        """
+        if self.serial_console is None:
+            return None
+        filename = self.serial_console.output_filename
+        scanner = getattr(self, "console_scanner", None)
+        if scanner is None or scanner.filename != filename:
+            scanner = console_scanner.ConsoleScanner(
+                filename,
+                store=getattr(self.serial_console, "output_store", None))
+            scanner.add_matcher("kernel_crash", console_scanner.StreamMatcher(
+                KERNEL_CRASH_PATTERNS, re.DOTALL | re.MULTILINE | re.I))
+            scanner.add_matcher("illegal_instruction",
+                                console_scanner.StreamMatcher(
+                                    ILLEGAL_INSTRUCTION_PATTERNS,
+                                    re.MULTILINE))
+            self.console_scanner = scanner
+        scanner.update()
+        return scanner
+
     def verify_kernel_crash(self):
         """
         Find kernel crash message on the VM serial console.
@@ -829,15 +980,11 @@ class BaseVM(object):
         :raise: VMDeadKernelCrashError, in case a kernel crash message was
                 found.
         """
-        panic_re = [r"BUG:.*---\[ end trace .* \]---"]
-        panic_re.append(r"----------\[ cut here.* BUG .*\[ end trace .* \]---")
-        panic_re.append(r"general protection fault:.* RSP.*>")
-        panic_re = "|".join(panic_re)
-        if self.serial_console is not None:
-            data = self.serial_console.get_output()
-            match = re.search(panic_re, data, re.DOTALL | re.MULTILINE | re.I)
-            if match is not None:
-                raise VMDeadKernelCrashError(match.group(0))
+        scanner = self.scan_serial_console()
+        if scanner is not None:
+            matches = scanner.matchers["kernel_crash"].matches
+            if matches:
+                raise VMDeadKernelCrashError(matches[0])
 
     def verify_bsod(self, scrdump_file):
         # For windows guest
@@ -860,13 +1007,11 @@ class BaseVM(object):
 
         :raise: VMInvalidInstructionCode, in case a wrong instruction code.
         """
-        if self.serial_console is not None:
-            data = self.serial_console.get_output()
-            match = re.findall(r".*trap invalid opcode.*\n", data,
-                               re.MULTILINE)
-
-            if match:
-                raise VMInvalidInstructionCode(match)
+        scanner = self.scan_serial_console()
+        if scanner is not None:
+            matches = scanner.matchers["illegal_instruction"].matches
+            if matches:
+                raise VMInvalidInstructionCode(list(matches))
 
     def get_params(self):
         """
@@ -895,6 +1040,13 @@ class BaseVM(object):
         return [self.get_virtio_port_filename(v) for v in
                 self.params.objects("virtio_ports")]
 
+    def ssh_multiplex(self):
+        """
+        Return True if SSH sessions and copies share a connection master
+        (param ssh_multiplex = yes).
+        """
+        return self.params.get("ssh_multiplex", "no") == "yes"
+
     @error.context_aware
     def login(self, nic_index=0, timeout=LOGIN_TIMEOUT,
               username=None, password=None):
@@ -926,7 +1078,8 @@ class BaseVM(object):
         session = remote.remote_login(client, address, port, username,
                                       password, prompt, linesep,
                                       log_filename, timeout,
-                                      interface=neigh_attach_if)
+                                      interface=neigh_attach_if,
+                                      multiplex=self.ssh_multiplex())
         session.set_status_test_command(self.params.get("status_test_command",
                                                         ""))
         self.remote_sessions.append(session)
@@ -996,6 +1149,10 @@ class BaseVM(object):
         """
         Make multiple attempts to log into the guest via SSH/Telnet/Netcat.
 
+        With param login_race_serial = yes, the serial console login runs in
+        parallel; its success is recorded as the first login and speeds up
+        the network attempts, a network session is still returned.
+
         :param nic_index: The index of the NIC to connect to.
         :param timeout: Time (seconds) to keep trying to log in.
         :param internal_timeout: Timeout to pass to login().
@@ -1009,17 +1166,41 @@ class BaseVM(object):
         logging.debug("Attempting to log into '%s' (timeout %ds)", self.name,
                       timeout)
         end_time = time.time() + timeout
-        while time.time() < end_time:
-            try:
-                return self.login(nic_index, internal_timeout,
-                                  username, password)
-            except (remote.LoginError, VMError), e:
-                self.verify_alive()
-                e = str(e)
-                if e not in error_messages:
-                    logging.debug(e)
-                    error_messages.append(e)
-            time.sleep(2)
+        racer = None
+        if self.params.get("login_race_serial", "no") == "yes":
+            racer = SerialLoginRacer(self, end_time, internal_timeout,
+                                     username, password)
+            racer.start()
+        delays = remote.login_delays()
+        try:
+            while time.time() < end_time:
+                try:
+                    self.check_shell_port(nic_index)
+                    session = self.login(nic_index, internal_timeout,
+                                         username, password)
+                    self.record_first_login()
+                    return session
+                except (remote.LoginError, VMError), e:
+                    self.verify_alive()
+                    e = str(e)
+                    if e not in error_messages:
+                        logging.debug(e)
+                        error_messages.append(e)
+                if racer and racer.session:
+                    # The guest is up, keep waiting for its network with
+                    # short delays; callers close the returned session, so
+                    # the shared serial console is never returned
+                    logging.debug("Logged into '%s' via serial console, "
+                                  "waiting for network login", self.name)
+                    self.record_first_login()
+                    racer.join()
+                    racer = None
+                    delays = remote.login_delays()
+                time.sleep(delays.next())
+        finally:
+            if racer:
+                # Don't leave the thread driving the serial console
+                racer.stop()
         # Timeout expired
         logging.info("Try to get guest network status.")
         s_session = self.wait_for_serial_login(30, internal_timeout,
@@ -1056,6 +1237,122 @@ class BaseVM(object):
             # Try one more time but don't catch exceptions
             return self.login(nic_index, internal_timeout, username, password)
 
+    def check_shell_port(self, nic_index=0, timeout=2):
+        """
+        Check the shell port of the guest accepts connections.
+
+        Spawning a ssh/telnet client and waiting for it to fail is much more
+        expensive than a connect, so wait_for_login() skips its attempts
+        while the port is closed.
+
+        :param nic_index: The index of the NIC to connect to.
+        :param timeout: Time (seconds) to wait for the connection.
+        :raise remote.LoginPortClosedError: If the port is closed.
+        :raise VMAddressError: If the address of the guest is unknown.
+        """
+        if self.params.get("shell_client") not in remote.PROBED_CLIENTS:
+            return
+        address = self.get_address(nic_index)
+        interface = None
+        if address and address.lower().startswith("fe80"):
+            interface = utils_net.get_neigh_attch_interface(address)
+        port = self.get_port(int(self.params.get("shell_port")))
+        if not remote.is_port_open(address, port, timeout, interface):
+            raise remote.LoginPortClosedError(address, port)
+
+    def record_first_login(self):
+        """
+        Record the time from the start of the VM to its first login session.
+
+        The time is kept in self.first_login_time (seconds).
+        """
+        start_time = getattr(self, "start_time", 0)
+        if not start_time or getattr(self, "first_login_start",
+                                     None) == start_time:
+            return
+        self.first_login_start = start_time
+        self.first_login_time = time.time() - start_time
+        logging.info("First login into '%s' %.2f s after its start",
+                     self.name, self.first_login_time)
+
+    def _get_session_pool(self):
+        """
+        Return dict of nic_index: list of idle logged in sessions.
+        """
+        # VMs restored from older env files don't have the pool
+        if not hasattr(self, 'session_pool'):
+            self.session_pool = {}
+        return self.session_pool
+
+    def lease_session(self, nic_index=0, timeout=LOGIN_WAIT_TIMEOUT):
+        """
+        Return a logged in session from the session pool of the VM, log in
+        if there is no usable session in the pool. Give the session back with
+        release_session() instead of closing it.
+
+        :param nic_index: The index of the NIC to connect to.
+        :param timeout: Time (seconds) to keep trying to log in.
+        :return: A ShellSession object.
+        """
+        idle = self._get_session_pool().get(nic_index, [])
+        while idle:
+            session = idle.pop()
+            # A prompt round-trip is cheaper than session.is_responsive(),
+            # which always waits for half a second
+            try:
+                if session.is_alive():
+                    session.cmd_output("",
+                                       timeout=self.SESSION_CHECK_TIMEOUT)
+                    return session
+            except aexpect.ShellError, e:
+                logging.debug("Pooled session of '%s' is not usable: %s",
+                              self.name, e)
+            session.close()
+        return self.wait_for_login(nic_index, timeout)
+
+    def release_session(self, session, nic_index=0):
+        """
+        Put a session got from lease_session() back to the session pool. The
+        session is closed when it's dead or the pool is full (param
+        session_pool_size, default 2).
+
+        :param session: ShellSession object.
+        :param nic_index: The index of the NIC the session is connected to.
+        """
+        idle = self._get_session_pool().setdefault(nic_index, [])
+        if (session.is_alive() and
+                len(idle) < int(self.params.get("session_pool_size", 2))):
+            idle.append(session)
+        else:
+            session.close()
+
+    @contextlib.contextmanager
+    def leased_session(self, nic_index=0, timeout=LOGIN_WAIT_TIMEOUT):
+        """
+        Context manager of a pooled session. The session is released at the
+        end of the block, or closed if the block raised an exception.
+
+        :param nic_index: The index of the NIC to connect to.
+        :param timeout: Time (seconds) to keep trying to log in.
+        """
+        session = self.lease_session(nic_index, timeout)
+        try:
+            yield session
+        except Exception:
+            session.close()
+            raise
+        self.release_session(session, nic_index)
+
+    def invalidate_sessions(self):
+        """
+        Close all pooled sessions, needed when the guest is rebooted,
+        migrated or destroyed.
+        """
+        for idle in self._get_session_pool().values():
+            for session in idle:
+                session.close()
+        self.session_pool = {}
+
     @error.context_aware
     def copy_files_to(self, host_path, guest_path, nic_index=0, limit="",
                       verbose=False, timeout=COPY_FILES_TIMEOUT,
@@ -1087,7 +1384,8 @@ class BaseVM(object):
                          utils_misc.generate_random_string(4)))
         remote.copy_files_to(address, client, username, password, port,
                              host_path, guest_path, limit, log_filename,
-                             verbose, timeout, interface=neigh_attach_if)
+                             verbose, timeout, interface=neigh_attach_if,
+                             multiplex=self.ssh_multiplex())
         utils_misc.close_log_file(log_filename)
 
     @error.context_aware
@@ -1121,7 +1419,8 @@ class BaseVM(object):
                          utils_misc.generate_random_string(4)))
         remote.copy_files_from(address, client, username, password, port,
                                guest_path, host_path, limit, log_filename,
-                               verbose, timeout, interface=neigh_attach_if)
+                               verbose, timeout, interface=neigh_attach_if,
+                               multiplex=self.ssh_multiplex())
         utils_misc.close_log_file(log_filename)
 
     def create_serial_console(self):
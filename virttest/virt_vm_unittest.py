@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+import os
+import time
+import threading
+import shutil
+import pickle
+import socket
+import tempfile
+import unittest
+
+import common
+import aexpect
+import remote
+import virt_vm
+
+
+class FakeVM(virt_vm.BaseVM):
+
+    """
+    VM with a fake command line made of its params.
+    """
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.virtnet = []
+        self.commands = 0
+
+    def is_alive(self):
+        return True
+
+    def make_create_command(self, name=None, params=None, root_dir=None):
+        self.commands += 1
+        if params is None:
+            params = self.params
+        return " ".join("%s=%s" % (key, params[key])
+                        for key in sorted(params) if key.startswith("mem"))
+
+
+class NeedsRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {"mem": "1024", "shortname": "boot", "cdroms": "cd1"}
+        self.vm = FakeVM("vm1", dict(self.params))
+        self.orig_virtnet = virt_vm.utils_net.VirtNet
+        virt_vm.utils_net.VirtNet = lambda params, name, instance: []
+        self.vm.instance = "instance"
+
+    def tearDown(self):
+        virt_vm.utils_net.VirtNet = self.orig_virtnet
+
+    def test_fingerprint(self):
+        fingerprint = virt_vm.params_fingerprint(self.params, "vm1")
+        params = dict(self.params, shortname="reboot",
+                      post_command="true", kill_vm="yes")
+        self.assertEqual(virt_vm.params_fingerprint(params, "vm1"),
+                         fingerprint)
+        self.assertNotEqual(virt_vm.params_fingerprint(self.params, "vm2"),
+                            fingerprint)
+        params["mem"] = "2048"
+        self.assertNotEqual(virt_vm.params_fingerprint(params, "vm1"),
+                            fingerprint)
+
+    def test_needs_restart(self):
+        self.assertFalse(self.vm.needs_restart("vm1", self.params, "/"))
+        self.assertEqual(self.vm.commands, 2)
+        # Other test, same VM params: only fingerprints are compared
+        params = dict(self.params, shortname="reboot")
+        self.assertFalse(self.vm.needs_restart("vm1", params, "/"))
+        self.assertEqual(self.vm.commands, 2)
+        # Params not in the command line: full check, then fingerprint
+        params["cdroms"] = "cd2"
+        self.assertFalse(self.vm.needs_restart("vm1", params, "/"))
+        self.assertEqual(self.vm.commands, 4)
+        self.assertFalse(self.vm.needs_restart("vm1", params, "/"))
+        self.assertEqual(self.vm.commands, 4)
+        params["mem"] = "2048"
+        self.assertTrue(self.vm.needs_restart("vm1", params, "/"))
+        # VM params changed by the test
+        self.vm.params["mem"] = "512"
+        self.assertTrue(self.vm.needs_restart("vm1", self.params, "/"))
+
+
+class SerialConsole(object):
+
+    def __init__(self, output_filename):
+        self.output_filename = output_filename
+
+
+class VerifyConsoleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.vm = FakeVM("vm1", {})
+        self.vm.serial_console = None
+        self.log = os.path.join(self.tmpdir, "serial.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_verify(self):
+        self.vm.verify_kernel_crash()
+        self.vm.serial_console = SerialConsole(self.log)
+        open(self.log, "w").write("Booting\n[ 5.0] traps: x[1] trap invalid "
+                                  "opcode ip:1\n")
+        self.vm.verify_kernel_crash()
+        self.assertRaises(virt_vm.VMInvalidInstructionCode,
+                          self.vm.verify_illegal_instruction)
+        open(self.log, "a").write("[ 6.0] general protection fault: 0000 "
+                                  "[#1] SMP\n[ 6.1] RSP <ffff8800>\n")
+        # Unpickled VMs continue from the same offset
+        vm = pickle.loads(pickle.dumps(self.vm))
+        self.assertEqual(vm.console_scanner.offset, 52)
+        try:
+            vm.verify_kernel_crash()
+        except virt_vm.VMDeadKernelCrashError, e:
+            self.assertEqual(e.args[0], "general protection fault: 0000 "
+                             "[#1] SMP\n[ 6.1] RSP <ffff8800>")
+        else:
+            self.fail("Kernel crash was not found")
+        self.assertRaises(virt_vm.VMDeadKernelCrashError,
+                          vm.verify_kernel_crash)
+        # New console session
+        vm.serial_console = SerialConsole(self.log + ".1")
+        vm.verify_kernel_crash()
+        vm.verify_illegal_instruction()
+
+
+class LocalShellVM(FakeVM):
+
+    """
+    VM whose logins are local shells.
+    """
+
+    def __init__(self, name, params):
+        FakeVM.__init__(self, name, params)
+        self.logins = 0
+
+    def wait_for_login(self, nic_index=0, timeout=None):
+        self.logins += 1
+        session = aexpect.ShellSession("/bin/sh", prompt=r"^[\#\$] $")
+        session.read_up_to_prompt()
+        return session
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vm = LocalShellVM("vm1", {"session_pool_size": "1"})
+
+    def tearDown(self):
+        self.vm.invalidate_sessions()
+
+    def test_lease(self):
+        with self.vm.leased_session() as session:
+            self.assertEqual(session.cmd_output("echo 1").strip(), "1")
+        with self.vm.leased_session() as session2:
+            self.assertTrue(session2 is session)
+            session3 = self.vm.lease_session()
+        self.assertEqual(self.vm.logins, 2)
+        # The pool is full
+        self.vm.release_session(session3)
+        self.assertFalse(session3.is_alive())
+        # Dead sessions are not reused
+        session.close()
+        self.vm.lease_session()
+        self.assertEqual(self.vm.logins, 3)
+
+    def test_invalidate(self):
+        try:
+            with self.vm.leased_session() as session:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(session.is_alive())
+        with self.vm.leased_session() as session:
+            pass
+        self.vm.invalidate_sessions()
+        self.assertFalse(session.is_alive())
+        self.assertEqual(self.vm.session_pool, {})
+
+
+class SerialOnlyVM(FakeVM):
+
+    """
+    VM whose serial logins succeed from the third attempt and network
+    logins from the second attempt after a serial login, or after
+    network_delay seconds.
+    """
+
+    def __init__(self, name, params, network_delay=None, serial_delay=0):
+        FakeVM.__init__(self, name, params)
+        self.logins = []
+        self.start_time = time.time()
+        self.network_delay = network_delay
+        self.serial_delay = serial_delay
+        self.serial_console = "serial console"
+
+    def verify_alive(self):
+        pass
+
+    def login(self, nic_index=0, timeout=None, username=None,
+              password=None):
+        self.logins.append("network")
+        if self.network_delay is not None:
+            if time.time() - self.start_time >= self.network_delay:
+                return "network session"
+        elif "serial session" in self.logins:
+            if self.logins[self.logins.index("serial session"):].count(
+                    "network") > 1:
+                return "network session"
+        raise remote.LoginTimeoutError("")
+
+    def serial_login(self, timeout=None, username=None, password=None):
+        time.sleep(self.serial_delay)
+        self.logins.append("serial")
+        if self.logins.count("serial") < 3:
+            raise remote.LoginTimeoutError("")
+        self.logins.append("serial session")
+        return self.serial_console
+
+
+class WaitForLoginTest(unittest.TestCase):
+
+    def test_race_serial(self):
+        vm = SerialOnlyVM("vm1", {"login_race_serial": "yes",
+                                  "shell_client": "nc"})
+        start = time.time()
+        # The shared serial console is never returned
+        self.assertEqual(vm.wait_for_login(timeout=60), "network session")
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(vm.logins.count("serial session"), 1)
+        # The serial login is the first one
+        self.assertTrue(0 < vm.first_login_time < time.time() - start)
+        # Only the first login after the start is recorded
+        first_login_time = vm.first_login_time
+        vm.record_first_login()
+        self.assertEqual(vm.first_login_time, first_login_time)
+
+    def test_race_network_first(self):
+        vm = SerialOnlyVM("vm1", {"login_race_serial": "yes",
+                                  "shell_client": "nc"},
+                          network_delay=0.2, serial_delay=0.5)
+        self.assertEqual(vm.wait_for_login(timeout=60), "network session")
+        # The racer doesn't drive the serial console after the return
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name == "serial-login-vm1"])
+        logins = len(vm.logins)
+        time.sleep(0.6)
+        self.assertEqual(len(vm.logins), logins)
+
+    def test_closed_port(self):
+        vm = SerialOnlyVM("vm1", {"shell_client": "ssh", "shell_port": "22"})
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        vm.get_address = lambda index=0: "127.0.0.1"
+        vm.get_port = lambda port, nic_index=0: listener.getsockname()[1]
+        try:
+            self.assertRaises(remote.LoginPortClosedError,
+                              vm.check_shell_port)
+            listener.listen(1)
+            vm.check_shell_port()
+        finally:
+            listener.close()
+
+
+if __name__ == '__main__':
+    unittest.main()